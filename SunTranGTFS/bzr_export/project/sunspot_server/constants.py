@@ -1,7 +1,34 @@
-    
+
+import os
+import threading
+import types
+
 import yaml
+
+
+def _freeze(value):
+    ''' makes a value from the yaml file read only, lists become tuples and dictionaries become read only mappings
+
+    @param value - the value from yaml.safe_load()
+    @return the read only version of it'''
+
+    if isinstance(value, dict):
+        return types.MappingProxyType({iterKey: _freeze(iterValue) for iterKey, iterValue in value.items()})
+
+    if isinstance(value, list):
+        return tuple(_freeze(iterValue) for iterValue in value)
+
+    return value
+
+
 class Constants:
-    
+    ''' the settings in a YAML config file, as attributes (like constantsObj.CONFIG_DB_PATH).
+
+    Each file is only loaded once per process, Constants(yamlFile) returns the same object every time, and
+    its read only. To pick up changes to the file, reload() (or a ConstantsWatcher) loads it into a new
+    Constants object, that Constants(yamlFile) returns from then on, and anything that is holding on to
+    the old one has to switch to the new one itself'''
+
     # TODO make this use pathlib?
     # SERVER_WORKING_DIR = "/var/www/sunspot"
     # GTFS_ZIP_FILE_STRING = os.path.join(SERVER_WORKING_DIR, "gtfs.zip")
@@ -15,20 +42,138 @@ class Constants:
     # DB_FOLDER = "/var/www/sunspot/dbs/"
     # CONFIG_DB_PATH = "/var/www/sunspot/configdb/"
 
+    # absolute path of the yaml file -> the Constants object loaded from it
+    _loaded = dict()
+    _loadedLock = threading.Lock()
+
+
+    def __new__(cls, yamlFile):
+        ''' returns the Constants for @yamlFile, only loading it if it hasn't been loaded already'''
+
+        yamlPath = os.path.abspath(yamlFile)
+
+        with cls._loadedLock:
+
+            constantsObj = cls._loaded.get(yamlPath)
+
+            if constantsObj is None:
+                constantsObj = cls._loaded[yamlPath] = cls._load(yamlPath)
+
+        return constantsObj
 
 
     def __init__(self, yamlFile):
-        '''constructor, takes a filepath to a yamlFile that loads the constants'''
+        '''constructor, takes a filepath to a yamlFile that loads the constants (__new__ already did the loading)'''
+
+        pass
+
+
+    @classmethod
+    def _load(cls, yamlPath):
+        ''' loads a yaml file into a new Constants object
+
+        @param yamlPath - the absolute path to the yaml file
+        @return the Constants object'''
+
+        # stat first, so if the file changes while we are reading it, the modified time is old and we load it again
+        modifiedTime = os.stat(yamlPath).st_mtime
+
+        with open(yamlPath, "rb") as f:
+            yamlConfig = yaml.safe_load(f) or dict()
+
+        constantsObj = object.__new__(cls)
+
+        # every setting is a normal attribute, so looking one up doesn't go through __getattr__
+        constantsObj.__dict__.update((iterKey, _freeze(iterValue)) for iterKey, iterValue in yamlConfig.items())
+        constantsObj.__dict__["_yamlPath"] = yamlPath
+        constantsObj.__dict__["_modifiedTime"] = modifiedTime
 
-        self.yamlConfig = yaml.safe_load(open(yamlFile, "rb"))
+        return constantsObj
 
 
+    @classmethod
+    def reload(cls, yamlFile):
+        ''' loads @yamlFile again, Constants(yamlFile) returns the new object from now on
+
+        @param yamlFile - the yaml file
+        @return the new Constants object'''
+
+        yamlPath = os.path.abspath(yamlFile)
+        constantsObj = cls._load(yamlPath)
+
+        with cls._loadedLock:
+            cls._loaded[yamlPath] = constantsObj
+
+        return constantsObj
+
 
     def __getattr__(self, name):
-        ''' implements attribute access'''
+        ''' only called for settings that aren't in the yaml file, the ones that are are already attributes'''
+
+        raise AttributeError("{} not found in our config".format(name))
+
+
+    def __setattr__(self, name, value):
+
+        raise AttributeError("Constants are read only, can't set {}".format(name))
+
+
+    def __delattr__(self, name):
+
+        raise AttributeError("Constants are read only, can't delete {}".format(name))
+
+
+class ConstantsWatcher(threading.Thread):
+    ''' thread that checks every @interval seconds if a Constants object's yaml file has been modified, and if it
+    has, loads it again (with Constants.reload()) and calls @callback with the new Constants object. The
+    callback is called on this thread, so it has to get over to whatever thread it needs to be on itself'''
+
+    def __init__(self, constantsObj, interval, callback, logger):
+        ''' constructor
+
+        @param constantsObj - the Constants object to watch the yaml file of
+        @param interval - how many seconds between checks
+        @param callback - function that takes the new Constants object
+        @param logger - a logger object'''
+
+        super().__init__(name="ConstantsWatcher", daemon=True)
+
+        self.lg = logger
+        self.yamlPath = constantsObj._yamlPath
+        self.modifiedTime = constantsObj._modifiedTime
+        self.interval = interval
+        self.callback = callback
+        self.stopEvent = threading.Event()
+
+    def run(self):
+
+        while not self.stopEvent.wait(self.interval):
+
+            try:
+                modifiedTime = os.stat(self.yamlPath).st_mtime
+            except OSError:
+                continue # probably an editor in the middle of replacing the file
+
+            if modifiedTime == self.modifiedTime:
+                continue
+
+            # don't try a broken file again until it changes again
+            self.modifiedTime = modifiedTime
+
+            try:
+                constantsObj = Constants.reload(self.yamlPath)
+            except (OSError, yaml.YAMLError) as e:
+                self.lg.warning("%s changed, but we couldn't load it, keeping the old settings: %s", self.yamlPath, e)
+                continue
+
+            self.lg.info("%s changed, reloaded it", self.yamlPath)
+
+            try:
+                self.callback(constantsObj)
+            except Exception as e:
+                self.lg.exception("error applying the new settings from %s: %s", self.yamlPath, e)
 
+    def stop(self):
+        ''' stops the thread, it finishes on its own time'''
 
-        if name in self.yamlConfig.keys():
-            return self.yamlConfig[name]
-        else:
-            raise AttributeError("{} not found in our config".format(name))
\ No newline at end of file
+        self.stopEvent.set()
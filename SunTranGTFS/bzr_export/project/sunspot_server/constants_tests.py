@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# tests for constants.py, against yaml files in a temporary directory
+#
+
+import unittest
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from constants import Constants, ConstantsWatcher
+
+
+class TestConstants(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.tempDir = tempfile.mkdtemp()
+        self.yamlPath = os.path.join(self.tempDir, "constants_config.yaml")
+        self.writeCount = 0
+
+        self._writeYaml("SAMPLE_RATE: 100\nCLIENT_IDS: [a, b]\nOPTIONS:\n    cache: 10\n    names: [x]\n")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tempDir)
+
+    def _writeYaml(self, text):
+        ''' writes the yaml file, and moves its modified time forward so a change is seen even if it happens
+        in the same second as the last one'''
+
+        with open(self.yamlPath, "w", encoding="utf-8") as f:
+            f.write(text)
+
+        modifiedTime = time.time() + self.writeCount
+        self.writeCount += 1
+        os.utime(self.yamlPath, (modifiedTime, modifiedTime))
+
+    def testSameInstance(self):
+
+        constantsObj = Constants(self.yamlPath)
+
+        self.assertIs(Constants(self.yamlPath), constantsObj)
+
+        # a relative path to the same file is the same file
+        self.assertIs(Constants(os.path.relpath(self.yamlPath)), constantsObj)
+
+        # and changing the file doesn't change anything until someone reloads it
+        self._writeYaml("SAMPLE_RATE: 5\n")
+        self.assertIs(Constants(self.yamlPath), constantsObj)
+        self.assertEqual(Constants(self.yamlPath).SAMPLE_RATE, 100)
+
+    def testReadOnly(self):
+
+        constantsObj = Constants(self.yamlPath)
+
+        self.assertEqual(constantsObj.CLIENT_IDS, ("a", "b"))
+        self.assertEqual(constantsObj.OPTIONS["names"], ("x",))
+
+        with self.assertRaises(AttributeError):
+            constantsObj.SAMPLE_RATE = 1
+
+        with self.assertRaises(AttributeError):
+            del constantsObj.SAMPLE_RATE
+
+        with self.assertRaises(TypeError):
+            constantsObj.OPTIONS["cache"] = 0
+
+        with self.assertRaises(AttributeError):
+            constantsObj.CLIENT_IDS.append("c")
+
+        with self.assertRaises(AttributeError):
+            constantsObj.NOT_IN_THE_FILE
+
+    def testReload(self):
+
+        oldConstants = Constants(self.yamlPath)
+
+        self._writeYaml("SAMPLE_RATE: 5\nCLIENT_IDS: []\n")
+        newConstants = Constants.reload(self.yamlPath)
+
+        self.assertEqual((newConstants.SAMPLE_RATE, newConstants.CLIENT_IDS), (5, ()))
+        self.assertIs(Constants(self.yamlPath), newConstants)
+
+        # whoever is still holding the old one sees the old settings
+        self.assertEqual(oldConstants.SAMPLE_RATE, 100)
+
+    def testWatcher(self):
+
+        changed = list()
+        changedEvent = threading.Event()
+
+        def callback(constantsObj):
+            changed.append(constantsObj)
+            changedEvent.set()
+
+        watcher = ConstantsWatcher(Constants(self.yamlPath), 0.02, callback, logging.getLogger("UnitTest").getChild("ConstantsWatcher"))
+        watcher.start()
+
+        try:
+            # nothing changed yet
+            time.sleep(0.1)
+            self.assertEqual(changed, [])
+
+            self._writeYaml("SAMPLE_RATE: 5\n")
+            self.assertTrue(changedEvent.wait(5))
+
+            # once, not every time it checks
+            time.sleep(0.1)
+            self.assertEqual([iterConstants.SAMPLE_RATE for iterConstants in changed], [5])
+            self.assertIs(changed[0], Constants(self.yamlPath))
+
+            # a broken file keeps the old settings, and fixing it is another change
+            changedEvent.clear()
+            self._writeYaml("SAMPLE_RATE: [5\n")
+            time.sleep(0.1)
+            self.assertFalse(changedEvent.is_set())
+            self.assertEqual(Constants(self.yamlPath).SAMPLE_RATE, 5)
+
+            self._writeYaml("SAMPLE_RATE: 6\n")
+            self.assertTrue(changedEvent.wait(5))
+            time.sleep(0.1)
+            self.assertEqual([iterConstants.SAMPLE_RATE for iterConstants in changed], [5, 6])
+
+        finally:
+            watcher.stop()
+            watcher.join()
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
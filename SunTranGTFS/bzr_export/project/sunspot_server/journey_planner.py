@@ -0,0 +1,490 @@
+#
+# plans trips between two stops, with the Connection Scan Algorithm. Every trip in the schedule is cut into
+# connections (the bus leaves one stop at a time and gets to the next one at a time) and the connections of a
+# service day are kept in one list sorted by when they leave. Finding the earliest arrival is then one pass through
+# that list starting at the time we leave, that stops as soon as the connections leave after we could already be at
+# the destination. It keeps the earliest time we can be at each stop for each number of buses it takes to get there,
+# so out of the journeys that get there the soonest it can give the one with the fewest buses instead of one that
+# changes buses whenever that gets to some stop on the way a few seconds sooner. Walking between stops comes from the
+# stop_transfers table, which parse_gtfs_data.py works out from the stops with the spatial_index when it creates the
+# database.
+#
+# the JourneyPlanner is made once per database (sunspot_server.py keeps it in a LatestDatabaseCache) and the sorted
+# connections once per set of services that run on a day, so a query only has to do the scan
+#
+
+import bisect
+import collections
+import datetime
+import math
+import sqlite3
+import threading
+
+from spatial_index import GridIndex
+from service_calendar import ServiceCalendar
+from trip_predictions import SECONDS_PER_DAY, stopDepartureRows
+
+
+# how far we let people walk between two stops to change buses
+MAX_TRANSFER_METERS = 400
+
+# about 2.7 miles per hour
+WALK_METERS_PER_SECOND = 1.2
+
+# streets don't go in straight lines, so people walk about this much further then the distance between the stops
+WALK_DETOUR_FACTOR = 1.3
+
+# how long it takes to get off one bus and onto another at the same stop
+DEFAULT_CHANGE_SECONDS = 60
+
+# the most buses we let a journey take
+DEFAULT_MAX_BUSES = 5
+
+# how long a journey can take, so we don't go through the rest of the day's connections looking for a way to a stop
+# that nothing goes to
+DEFAULT_MAX_JOURNEY_SECONDS = 3 * 60 * 60
+
+# one part of a Journey. kind is 'bus' or 'walk', the times are seconds since the epoch and stopCount is how many
+# stops the bus goes (0 for walking). The trip fields are None for walking
+JourneyLeg = collections.namedtuple("JourneyLeg", ["kind", "fromStopId", "toStopId", "departure", "arrival",
+    "tripId", "routeId", "headsign", "stopCount"])
+
+# what JourneyPlanner.plan() finds, legs is a tuple of JourneyLegs in order
+Journey = collections.namedtuple("Journey", ["fromStopId", "toStopId", "departure", "arrival", "legs"])
+
+
+def walkSeconds(meters):
+    ''' how long it takes to walk between two stops
+
+    @param meters - the straight line distance between them
+    @return whole seconds'''
+
+    return int(math.ceil(meters * WALK_DETOUR_FACTOR / WALK_METERS_PER_SECOND))
+
+
+def stopTransferRows(cursor, maxMeters=MAX_TRANSFER_METERS):
+    ''' works out which stops are close enough to walk between, from the stops table
+
+    @param cursor - a cursor for the database, that already has the stops table
+    @param maxMeters - how far apart two stops can be
+    @return a list of (from_stop_id, to_stop_id, walk_seconds) tuples, sorted, both ways round for every pair'''
+
+    stopsIndex = GridIndex()
+
+    # stops without a location (if there are any) can't be walked to
+    cursor.execute('''SELECT stop_id, stop_lat, stop_lon FROM stops WHERE stop_lat != ? AND stop_lon != ?''', ("", ""))
+    stops = [(iterStopId, float(iterLat), float(iterLon)) for iterStopId, iterLat, iterLon in cursor.fetchall()]
+
+    for iterStopId, iterLat, iterLon in stops:
+        stopsIndex.add(iterStopId, iterLat, iterLon)
+
+    rows = list()
+
+    for iterStopId, iterLat, iterLon in stops:
+        for iterDistance, iterOtherStopId, iterValue in stopsIndex.withinRadius(iterLat, iterLon, maxMeters):
+            if iterOtherStopId != iterStopId:
+                rows.append((iterStopId, iterOtherStopId, walkSeconds(iterDistance)))
+
+    rows.sort()
+
+    return rows
+
+
+def createStopTransfers(cursor, maxMeters=MAX_TRANSFER_METERS):
+    ''' creates the stop_transfers table, how long it takes to walk from each stop to the stops near it.
+    The stops you can walk to from a stop are 'SELECT to_stop_id, walk_seconds FROM stop_transfers WHERE from_stop_id = ?'
+
+    @param cursor - a cursor for the database, that already has the stops table
+    @param maxMeters - how far apart two stops can be
+    @return how many rows went into the table'''
+
+    cursor.execute('''CREATE TABLE stop_transfers (from_stop_id TEXT, to_stop_id TEXT, walk_seconds INTEGER)''')
+    cursor.execute('''CREATE INDEX stop_transfers_from_index ON stop_transfers (from_stop_id)''')
+
+    rows = stopTransferRows(cursor, maxMeters)
+
+    cursor.executemany('''INSERT INTO stop_transfers VALUES (?, ?, ?)''', rows)
+
+    return len(rows)
+
+
+class DayConnections:
+    ''' the connections of the trips that run on one service day, sorted by when they leave, as separate lists
+    (one per field) so the scan doesn't have to build or unpack a tuple for each one. The times are seconds after
+    the start of the service day, and the trips that are still running from the day before (the ones with times past
+    24:00:00) are in it too, moved back a day'''
+
+    def __init__(self, connections):
+        ''' constructor
+
+        @param connections - a list of (departure, arrival, from stop index, to stop index, trip index), sorted'''
+
+        self.departures = [iterConnection[0] for iterConnection in connections]
+        self.arrivals = [iterConnection[1] for iterConnection in connections]
+        self.fromStops = [iterConnection[2] for iterConnection in connections]
+        self.toStops = [iterConnection[3] for iterConnection in connections]
+        self.trips = [iterConnection[4] for iterConnection in connections]
+
+    def __len__(self):
+        return len(self.departures)
+
+
+class JourneyPlanner:
+    ''' finds the journeys that get from one stop to another the soonest, made from a database that
+    parse_gtfs_data.py created. This never changes once its created, so the request threads can share it'''
+
+    # how many days of DayConnections to keep
+    MAX_CACHED_DAYS = 8
+
+    def __init__(self, stopIds, tripInfo, connections, transfers, serviceCalendar=None, stopNames=None):
+        ''' constructor
+
+        @param stopIds - a list of every stop_id, the stop indexes in the other arguments are indexes into it
+        @param tripInfo - a list of (trip_id, route_id, service_id, headsign), the trip indexes are indexes into it
+        @param connections - a list of (departure, arrival, from stop index, to stop index, trip index) for every
+            connection of every trip, with the times in seconds after the start of the service day, sorted
+        @param transfers - a dictionary of stop index -> list of (stop index, walk seconds), the stops you can walk
+            to from it
+        @param serviceCalendar - the service_calendar.ServiceCalendar, or None if we don't know (every trip runs
+            every day)
+        @param stopNames - a dictionary of stop_id -> stop_name, or None'''
+
+        self.stopIds = stopIds
+        self.stopIndexes = {iterStopId: iterIndex for iterIndex, iterStopId in enumerate(stopIds)}
+        self.tripInfo = tripInfo
+        self.connections = connections
+        self.transfers = [tuple(transfers.get(iterIndex, ())) for iterIndex in range(len(stopIds))]
+        self.serviceCalendar = serviceCalendar
+        self.stopNames = stopNames or dict()
+
+        # (today's services, yesterday's services) -> DayConnections
+        self.dayConnections = dict()
+        self.dayLock = threading.Lock()
+
+    @classmethod
+    def fromDatabase(cls, dbPath):
+        ''' loads the planner from a database that parse_gtfs_data.py created, working out the stop_departures
+        and stop_transfers tables if its a database from before they were in it
+
+        @param dbPath - the path to the sqlite3 database
+        @return a JourneyPlanner'''
+
+        db = sqlite3.connect(dbPath)
+
+        try:
+            cursor = db.cursor()
+
+            try:
+                serviceCalendar = ServiceCalendar.fromCursor(cursor)
+            except sqlite3.OperationalError:
+                serviceCalendar = None
+
+            cursor.execute('''SELECT stop_id, stop_name FROM stops''')
+            stopNames = dict(cursor.fetchall())
+
+            tripIndexes = dict()
+            tripInfo = list()
+            cursor.execute('''SELECT trip_id, route_id, service_id, trip_headsign FROM trips''')
+            for iterTripId, iterRouteId, iterServiceId, iterHeadsign in cursor.fetchall():
+                tripIndexes[iterTripId] = len(tripInfo)
+                tripInfo.append((iterTripId, iterRouteId, iterServiceId, iterHeadsign))
+
+            try:
+                cursor.execute('''SELECT stop_id, departure_seconds, arrival_seconds, trip_id, stop_sequence
+                    FROM stop_departures''')
+                rows = cursor
+            except sqlite3.OperationalError:
+                rows = ((iterRow.stopId, iterRow.departure, iterRow.arrival, iterRow.tripId, iterRow.stopSequence)
+                    for iterRow in stopDepartureRows(cursor))
+
+            stopIds = sorted(stopNames.keys())
+            stopIndexes = {iterStopId: iterIndex for iterIndex, iterStopId in enumerate(stopIds)}
+
+            # trip index -> list of (stop_sequence, stop index, arrival, departure)
+            tripStops = collections.defaultdict(list)
+
+            for iterStopId, iterDeparture, iterArrival, iterTripId, iterSequence in rows:
+
+                if iterStopId not in stopIndexes:
+                    stopIndexes[iterStopId] = len(stopIds)
+                    stopIds.append(iterStopId)
+
+                if iterTripId in tripIndexes:
+                    tripStops[tripIndexes[iterTripId]].append((iterSequence, stopIndexes[iterStopId], iterArrival, iterDeparture))
+
+            try:
+                cursor.execute('''SELECT from_stop_id, to_stop_id, walk_seconds FROM stop_transfers''')
+                transferRows = cursor.fetchall()
+            except sqlite3.OperationalError:
+                transferRows = stopTransferRows(cursor)
+
+        finally:
+            db.close()
+
+        connections = list()
+
+        for iterTripIndex, iterStops in tripStops.items():
+
+            iterStops.sort()
+
+            for (iterSequence, iterFromStop, iterArrival, iterDeparture), (iterNextSequence, iterToStop, iterNextArrival, iterNextDeparture) in zip(iterStops, iterStops[1:]):
+                connections.append((iterDeparture, iterNextArrival, iterFromStop, iterToStop, iterTripIndex))
+
+        connections.sort()
+
+        transfers = collections.defaultdict(list)
+        for iterFromStopId, iterToStopId, iterWalkSeconds in transferRows:
+            if iterFromStopId in stopIndexes and iterToStopId in stopIndexes:
+                transfers[stopIndexes[iterFromStopId]].append((stopIndexes[iterToStopId], iterWalkSeconds))
+
+        return cls(stopIds, tripInfo, connections, transfers, serviceCalendar, stopNames)
+
+    def connectionsFor(self, todayDate):
+        ''' the connections of the trips that run on a service day, only sorting them out the first time we see
+        that set of services
+
+        @param todayDate - the datetime.date of the service day, or None for every trip
+        @return a DayConnections'''
+
+        if todayDate is None or self.serviceCalendar is None:
+            key = (None, None)
+        else:
+            key = (self.serviceCalendar.activeServices(todayDate),
+                self.serviceCalendar.activeServices(todayDate - datetime.timedelta(days=1)))
+
+        dayConnections = self.dayConnections.get(key)
+
+        if dayConnections is None:
+
+            with self.dayLock:
+
+                # another thread might have made it while we waited for the lock
+                dayConnections = self.dayConnections.get(key)
+
+                if dayConnections is None:
+
+                    todayServices, yesterdayServices = key
+                    tripInfo = self.tripInfo
+
+                    if todayServices is None:
+                        todayTrips = yesterdayTrips = None
+                    else:
+                        todayTrips = [iterTrip[2] in todayServices for iterTrip in tripInfo]
+                        yesterdayTrips = [iterTrip[2] in yesterdayServices for iterTrip in tripInfo]
+
+                    connections = [iterConnection for iterConnection in self.connections
+                        if todayTrips is None or todayTrips[iterConnection[4]]]
+
+                    # yesterday's trips that are still running after midnight
+                    connections.extend((iterDeparture - SECONDS_PER_DAY, iterArrival - SECONDS_PER_DAY, iterFromStop, iterToStop, iterTrip)
+                        for iterDeparture, iterArrival, iterFromStop, iterToStop, iterTrip in self.connections
+                        if iterDeparture >= SECONDS_PER_DAY and (yesterdayTrips is None or yesterdayTrips[iterTrip]))
+
+                    connections.sort()
+                    dayConnections = DayConnections(connections)
+
+                    if len(self.dayConnections) >= self.MAX_CACHED_DAYS:
+                        self.dayConnections.clear()
+                    self.dayConnections[key] = dayConnections
+
+        return dayConnections
+
+    def plan(self, fromStopId, toStopId, departure, todayStart, todayDate=None, changeSeconds=DEFAULT_CHANGE_SECONDS,
+            maxBuses=DEFAULT_MAX_BUSES, maxSeconds=DEFAULT_MAX_JOURNEY_SECONDS):
+        ''' finds the journey that gets from one stop to another the soonest, leaving at or after a time, and out of
+        the ones that get there that soon, the one that takes the fewest buses. It takes the buses that run on the
+        service day @departure is in (and the ones still running from the day before), so it won't find journeys
+        that need a bus from the next service day
+
+        @param fromStopId - the stop_id to leave from
+        @param toStopId - the stop_id to get to
+        @param departure - when to leave, seconds since the epoch
+        @param todayStart - the start of the service day @departure is in, from trip_predictions.serviceDayStart()
+        @param todayDate - the datetime.date of that service day, from trip_predictions.serviceDayDate(), or None to
+            not look at the calendar
+        @param changeSeconds - how long it takes to get off one bus and onto another at the same stop
+        @param maxBuses - the most buses a journey can take
+        @param maxSeconds - the longest a journey can take, from @departure
+        @return a Journey, or None if we can't get there that day (or that soon). Raises KeyError if either stop_id isn't one
+            we know about'''
+
+        source = self.stopIndexes[fromStopId]
+        target = self.stopIndexes[toStopId]
+
+        startTime = departure - todayStart
+
+        if source == target:
+            return Journey(fromStopId, toStopId, departure, departure, ())
+
+        dayConnections = self.connectionsFor(todayDate)
+
+        departures = dayConnections.departures
+        arrivals = dayConnections.arrivals
+        fromStops = dayConnections.fromStops
+        toStops = dayConnections.toStops
+        trips = dayConnections.trips
+        transfers = self.transfers
+
+        noTime = float("inf")
+        stopCount = len(self.stopIds)
+
+        # one of these for each number of buses (0 to maxBuses) we could take to get to a stop: the earliest we can
+        # be there, and the earliest we can get on another bus there (later, if we got there on a bus)
+        earliest = [[noTime] * stopCount for i in range(maxBuses + 1)]
+        boardable = [[noTime] * stopCount for i in range(maxBuses + 1)]
+
+        # the earliest a bus can get us to a stop, for each number of buses. We only walk on from a stop we got to
+        # on a bus, so this is what the walks start from, even if we could have walked there sooner
+        byBus = [[noTime] * stopCount for i in range(maxBuses + 1)]
+
+        # the soonest we can get on a bus at each stop, however many buses it takes, so most connections can be
+        # skipped by looking at one list instead of all of them
+        anyBoardable = [noTime] * stopCount
+
+        # how we got to each stop the soonest with that many buses, a ('bus', connection we got on, connection we
+        # got off) tuple or a ('walk', stop index we walked from, walk seconds, the 'bus' tuple of the bus we got off
+        # there or None if it was the stop we left from) tuple. None for the stop we left from
+        howWeGotThere = [[None] * stopCount for i in range(maxBuses + 1)]
+
+        # trip index -> list of (number of buses, connection we got on at), the ways we could be on that trip. Getting
+        # on later only counts if it means fewer buses, so the numbers go down
+        boarded = dict()
+
+        earliest[0][source] = boardable[0][source] = anyBoardable[source] = startTime
+
+        for iterStop, iterWalkSeconds in transfers[source]:
+            if startTime + iterWalkSeconds < earliest[0][iterStop]:
+                earliest[0][iterStop] = boardable[0][iterStop] = anyBoardable[iterStop] = startTime + iterWalkSeconds
+                howWeGotThere[0][iterStop] = ("walk", source, iterWalkSeconds, None)
+
+        # the soonest we can get to the destination, however many buses it takes (it might be close enough to walk)
+        bestArrival = earliest[0][target]
+
+        # we only look for journeys that get there before this
+        giveUpTime = startTime + maxSeconds
+
+        for index in range(bisect.bisect_left(departures, startTime), len(departures)):
+
+            connectionDeparture = departures[index]
+
+            # nothing from here on can get us there any sooner (or as soon with fewer buses)
+            if bestArrival < connectionDeparture or connectionDeparture > giveUpTime:
+                break
+
+            trip = trips[index]
+            fromStop = fromStops[index]
+            tripBoardings = boarded.get(trip)
+
+            if anyBoardable[fromStop] <= connectionDeparture:
+
+                # the fewest buses we could have taken to be here in time, if thats fewer then the ways we are
+                # already on this trip
+                fewestBuses = tripBoardings[-1][0] - 1 if tripBoardings is not None else maxBuses
+                for iterBuses in range(fewestBuses):
+                    if boardable[iterBuses][fromStop] <= connectionDeparture:
+                        if tripBoardings is None:
+                            tripBoardings = boarded[trip] = list()
+                        tripBoardings.append((iterBuses + 1, index))
+                        break
+
+            if tripBoardings is None:
+                continue
+
+            toStop = toStops[index]
+            connectionArrival = arrivals[index]
+
+            for iterBuses, iterBoardedIndex in tripBoardings:
+
+                if connectionArrival >= byBus[iterBuses][toStop] or connectionArrival > giveUpTime:
+                    continue
+
+                byBus[iterBuses][toStop] = connectionArrival
+                busHow = ("bus", iterBoardedIndex, index)
+
+                if connectionArrival < earliest[iterBuses][toStop]:
+
+                    earliest[iterBuses][toStop] = connectionArrival
+                    boardable[iterBuses][toStop] = connectionArrival + changeSeconds
+                    anyBoardable[toStop] = min(anyBoardable[toStop], connectionArrival + changeSeconds)
+                    howWeGotThere[iterBuses][toStop] = busHow
+
+                    if toStop == target:
+                        bestArrival = min(bestArrival, connectionArrival)
+
+                # even if we could already walk to this stop sooner, walking on from it is only possible once a bus
+                # gets us here
+                for iterStop, iterWalkSeconds in transfers[toStop]:
+                    walkArrival = connectionArrival + iterWalkSeconds
+                    if walkArrival < earliest[iterBuses][iterStop]:
+                        earliest[iterBuses][iterStop] = boardable[iterBuses][iterStop] = walkArrival
+                        anyBoardable[iterStop] = min(anyBoardable[iterStop], walkArrival)
+                        howWeGotThere[iterBuses][iterStop] = ("walk", toStop, iterWalkSeconds, busHow)
+
+                        if iterStop == target:
+                            bestArrival = min(bestArrival, walkArrival)
+
+        if bestArrival == noTime:
+            return None
+
+        # the fewest buses that get there that soon
+        for iterBuses in range(maxBuses + 1):
+            if earliest[iterBuses][target] == bestArrival:
+                return self._journey(dayConnections, howWeGotThere, earliest, iterBuses, bestArrival, source, target, todayStart)
+
+    def _journey(self, dayConnections, howWeGotThere, earliest, buses, arrival, source, target, todayStart):
+        ''' follows howWeGotThere back from the destination to the stop we left from, see plan()
+
+        @param buses - how many buses the journey takes
+        @param arrival - when it gets to the destination, in seconds after todayStart
+        @return a Journey'''
+
+        legs = list()
+        stop = target
+
+        # every step goes back to a stop we got to sooner (or as soon), or with one less bus, so this gets back to
+        # the stop we left from, the limit is only there so a mistake can't loop forever
+        for i in range(len(self.stopIds) * len(howWeGotThere)):
+
+            if stop == source and buses == 0:
+                break
+
+            how = howWeGotThere[buses][stop]
+
+            if how[0] == "walk":
+
+                kind, fromStop, walkSeconds, busHow = how
+                legs.append(JourneyLeg("walk", self.stopIds[fromStop], self.stopIds[stop],
+                    todayStart + earliest[buses][stop] - walkSeconds, todayStart + earliest[buses][stop], None, None, None, 0))
+
+                # the bus that got us to where we walked from, which isn't always the soonest way to get there
+                if busHow is not None:
+                    stop = fromStop
+                    how = busHow
+
+            if how[0] == "bus":
+                kind, boardedIndex, leftIndex = how
+                fromStop = dayConnections.fromStops[boardedIndex]
+                tripId, routeId, serviceId, headsign = self.tripInfo[dayConnections.trips[leftIndex]]
+                legs.append(JourneyLeg("bus", self.stopIds[fromStop], self.stopIds[stop],
+                    todayStart + dayConnections.departures[boardedIndex], todayStart + dayConnections.arrivals[leftIndex],
+                    tripId, routeId, headsign, self._stopsBetween(dayConnections, boardedIndex, leftIndex)))
+                buses -= 1
+
+            stop = fromStop
+
+        legs.reverse()
+
+        # we might have left the first stop after the time we asked for, if we had to wait for the first bus
+        departure = legs[0].departure if legs else todayStart + earliest[0][source]
+
+        return Journey(self.stopIds[source], self.stopIds[target], departure, todayStart + arrival, tuple(legs))
+
+    def _stopsBetween(self, dayConnections, boardedIndex, leftIndex):
+        ''' how many stops a bus goes between two of its connections, counting both of them
+
+        @return the number of connections of the trip from @boardedIndex to @leftIndex'''
+
+        trip = dayConnections.trips[boardedIndex]
+        trips = dayConnections.trips
+
+        return sum(1 for iterIndex in range(boardedIndex, leftIndex + 1) if trips[iterIndex] == trip)
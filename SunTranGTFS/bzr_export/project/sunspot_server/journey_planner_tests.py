@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+#
+# tests for journey_planner.py, against a small made up schedule where you have to walk between two stops to
+# change buses
+#
+
+import unittest
+import os
+import sqlite3
+import tempfile
+
+from journey_planner import JourneyPlanner, createStopTransfers
+from trip_predictions import serviceDayStart, serviceDayDate, parseGtfsTime
+from test_fixtures import TIMEZONE, NOW, createScheduleDatabase, createCalendarTables
+
+
+# stop_id -> (lat, lon), D is about 55 meters from C and F is too far from everything to walk to
+STOPS = {
+    "A": (32.2, -110.9), "B": (32.21, -110.9), "C": (32.22, -110.9),
+    "D": (32.2205, -110.9), "E": (32.24, -110.9), "F": (32.3, -110.9)}
+
+
+def createStops(dbPath, transfers=True, stops=STOPS):
+    ''' adds the stops table (and the stop_transfers table) to a database from createScheduleDatabase()
+
+    @param dbPath - the path to the database
+    @param transfers - whether to create the stop_transfers table, like parse_gtfs_data.py has since it had one
+    @param stops - dictionary of stop_id -> (lat, lon)'''
+
+    db = sqlite3.connect(dbPath)
+    cursor = db.cursor()
+
+    cursor.execute('''CREATE TABLE stops
+        (stop_id TEXT, stop_code TEXT, stop_name TEXT, stop_desc TEXT,
+        stop_lat REAL, stop_lon REAL, zone_id TEXT, stop_url TEXT, location_type INTEGER,
+        parent_station TEXT, wheelchair_boarding TEXT)''')
+
+    for iterStopId, (iterLat, iterLon) in sorted(stops.items()):
+        cursor.execute('''INSERT INTO stops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (iterStopId, "", "stop " + iterStopId, "", iterLat, iterLon, "", "", 0, "", ""))
+
+    if transfers:
+        createStopTransfers(cursor)
+
+    db.commit()
+    db.close()
+
+
+class TestJourneyPlanner(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        tmpFile, self.dbPath = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(tmpFile)
+
+        # 1a goes A, B, C. 2a and 2b go from D (a short walk from C) to E, and 3a goes from C to E but leaves C
+        # 30 seconds after 1a gets there. 4a goes from A to B after midnight
+        self.stopTimes = [
+            ("1a", 1, "A", "08:00:00"), ("1a", 2, "B", "08:05:00"), ("1a", 3, "C", "08:10:00"),
+            ("2a", 1, "D", "08:15:00"), ("2a", 2, "E", "08:25:00"),
+            ("2b", 1, "D", "08:30:00"), ("2b", 2, "E", "08:40:00"),
+            ("3a", 1, "C", "08:10:30"), ("3a", 2, "E", "08:20:00"),
+            ("4a", 1, "A", "24:30:00"), ("4a", 2, "B", "24:40:00")]
+        createScheduleDatabase(self.dbPath, self.stopTimes)
+        createStops(self.dbPath)
+
+        self.planner = JourneyPlanner.fromDatabase(self.dbPath)
+        self.todayStart = serviceDayStart(NOW, TIMEZONE)
+
+    def tearDown(self):
+
+        os.remove(self.dbPath)
+
+    def _at(self, gtfsTime):
+        return self.todayStart + parseGtfsTime(gtfsTime)
+
+    def testStopTransfers(self):
+
+        db = sqlite3.connect(self.dbPath)
+        rows = db.execute('''SELECT from_stop_id, to_stop_id, walk_seconds FROM stop_transfers''').fetchall()
+        db.close()
+
+        # 55.6 meters, a bit further for the streets, at 1.2 meters a second
+        self.assertEqual(rows, [("C", "D", 61), ("D", "C", 61)])
+
+    def testOneBus(self):
+
+        journey = self.planner.plan("A", "B", NOW - 60, self.todayStart)
+
+        self.assertEqual(journey.departure, self._at("08:00:00"))
+        self.assertEqual(journey.arrival, self._at("08:05:00"))
+        self.assertEqual([(iterLeg.kind, iterLeg.tripId, iterLeg.routeId, iterLeg.stopCount) for iterLeg in journey.legs],
+            [("bus", "1a", "route1", 1)])
+
+    def testWalkingTransfer(self):
+
+        journey = self.planner.plan("A", "E", NOW, self.todayStart)
+
+        # 3a leaves C before we can get off 1a and onto it, so walk to D and get 2a
+        self.assertEqual(journey.arrival, self._at("08:25:00"))
+        self.assertEqual([(iterLeg.kind, iterLeg.fromStopId, iterLeg.toStopId, iterLeg.tripId) for iterLeg in journey.legs],
+            [("bus", "A", "C", "1a"), ("walk", "C", "D", None), ("bus", "D", "E", "2a")])
+
+        self.assertEqual(journey.legs[0].stopCount, 2)
+        self.assertEqual((journey.legs[1].departure, journey.legs[1].arrival), (self._at("08:10:00"), self._at("08:11:01")))
+        self.assertEqual(journey.legs[2].departure, self._at("08:15:00"))
+
+        # someone who can change buses instantly makes 3a
+        journey = self.planner.plan("A", "E", NOW, self.todayStart, changeSeconds=0)
+        self.assertEqual(journey.arrival, self._at("08:20:00"))
+        self.assertEqual([iterLeg.tripId for iterLeg in journey.legs], ["1a", "3a"])
+
+        # leaving later misses 1a, but we can still walk from C
+        journey = self.planner.plan("C", "E", self._at("08:12:00"), self.todayStart)
+        self.assertEqual(journey.departure, self._at("08:12:00"))
+        self.assertEqual(journey.arrival, self._at("08:25:00"))
+        self.assertEqual([iterLeg.kind for iterLeg in journey.legs], ["walk", "bus"])
+
+    def testFewestBuses(self):
+
+        # 5a goes straight from A to E, it leaves later then 1a but gets there when 1a and then 3a would
+        os.remove(self.dbPath)
+        createScheduleDatabase(self.dbPath, self.stopTimes + [("5a", 1, "A", "08:11:00"), ("5a", 2, "E", "08:20:00")])
+        createStops(self.dbPath)
+
+        journey = JourneyPlanner.fromDatabase(self.dbPath).plan("A", "E", NOW, self.todayStart, changeSeconds=0)
+
+        self.assertEqual(journey.arrival, self._at("08:20:00"))
+        self.assertEqual([iterLeg.tripId for iterLeg in journey.legs], ["5a"])
+
+        # close enough to walk there
+        journey = self.planner.plan("D", "C", NOW, self.todayStart)
+        self.assertEqual((journey.arrival, [iterLeg.kind for iterLeg in journey.legs]), (NOW + 61, ["walk"]))
+
+    def testWalkAfterLaterBus(self):
+
+        # G is only close enough to walk to from D. 1a and a walk get to D at 08:11:01, but you can't walk on
+        # from a walk, so the way to G is 6a (which leaves A after 1a reached C, and gets to D later, at 08:12) and
+        # then the walk
+        os.remove(self.dbPath)
+        createScheduleDatabase(self.dbPath, self.stopTimes + [("6a", 1, "A", "08:06:00"), ("6a", 2, "D", "08:12:00")])
+        createStops(self.dbPath, stops=dict(STOPS, G=(32.224, -110.9)))
+
+        db = sqlite3.connect(self.dbPath)
+        walkSeconds = dict(db.execute('''SELECT from_stop_id, walk_seconds FROM stop_transfers WHERE to_stop_id = ?''', ("G",)).fetchall())
+        db.close()
+
+        self.assertEqual(list(walkSeconds.keys()), ["D"])
+
+        journey = JourneyPlanner.fromDatabase(self.dbPath).plan("A", "G", NOW, self.todayStart)
+
+        self.assertEqual(journey.arrival, self._at("08:12:00") + walkSeconds["D"])
+        self.assertEqual([(iterLeg.kind, iterLeg.fromStopId, iterLeg.toStopId, iterLeg.tripId) for iterLeg in journey.legs],
+            [("bus", "A", "D", "6a"), ("walk", "D", "G", None)])
+        self.assertEqual((journey.legs[1].departure, journey.legs[1].arrival), (self._at("08:12:00"), journey.arrival))
+
+    def testAfterMidnight(self):
+
+        # 12:20 in the morning is tomorrow's service day, but yesterday's 4a is still running
+        tomorrowMorning = self._at("24:20:00")
+        journey = self.planner.plan("A", "B", tomorrowMorning, serviceDayStart(tomorrowMorning, TIMEZONE))
+
+        self.assertEqual([iterLeg.tripId for iterLeg in journey.legs], ["4a"])
+        self.assertEqual(journey.arrival, self._at("24:40:00"))
+
+    def testNoJourney(self):
+
+        # nothing goes back the other way, F is too far to walk to, and everything has left by the evening
+        self.assertIsNone(self.planner.plan("E", "A", NOW, self.todayStart))
+        self.assertIsNone(self.planner.plan("A", "F", NOW, self.todayStart))
+        self.assertIsNone(self.planner.plan("A", "E", self._at("20:00:00"), self.todayStart))
+
+        with self.assertRaises(KeyError):
+            self.planner.plan("A", "nowhere", NOW, self.todayStart)
+
+    def testServiceCalendar(self):
+
+        db = sqlite3.connect(self.dbPath)
+        createCalendarTables(db.cursor(), [("weekday", 1, 1, 1, 1, 1, 0, 0, "20140801", "20140831")], [])
+        db.commit()
+        db.close()
+
+        planner = JourneyPlanner.fromDatabase(self.dbPath)
+
+        self.assertIsNotNone(planner.plan("A", "E", NOW, self.todayStart, serviceDayDate(NOW, TIMEZONE)))
+
+        # none of the trips run on saturday
+        saturday = NOW + 24 * 3600
+        self.assertIsNone(planner.plan("A", "E", saturday, serviceDayStart(saturday, TIMEZONE), serviceDayDate(saturday, TIMEZONE)))
+
+    def testOldDatabase(self):
+
+        # a database from before there were stop_departures and stop_transfers tables
+        os.remove(self.dbPath)
+        createScheduleDatabase(self.dbPath, self.stopTimes, stopDepartures=False)
+        createStops(self.dbPath, transfers=False)
+
+        journey = JourneyPlanner.fromDatabase(self.dbPath).plan("A", "E", NOW, self.todayStart)
+
+        self.assertEqual([iterLeg.tripId for iterLeg in journey.legs], ["1a", None, "2a"])
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#
+# a read only replica of the leveldb_server, for when one leveldb_server can't keep up with every sunspot_server
+# process reading from it. It keeps its own copy of the database (at LEVELDB_REPLICA_DB_PATH) up to date by following
+# the leveldb_server's change log, and serves it with the same protocol as the leveldb_server, but refuses writes.
+# Readers connect to it with ServerDatabase.fromConstants(constantsObj, replica=True), run as many as you want
+#
+
+import argparse
+import asyncio
+import logging
+import os, stat
+import sys
+
+# third party libraries
+
+import leveldb
+
+# project imports
+
+from constants import Constants
+from leveldb_server import LeveldbServer, configureLogging, createUnixServer, isYamlType, watchConstants
+from leveldb_server_cache import ValueCache
+from leveldb_server_messages_pb2 import LeveldbServerMessages
+from server_database import ServerDatabase
+from server_database_mirror import ReplicaFollower
+from server_stats import ServerStats
+
+
+class LeveldbReplicaTarget:
+    ''' the ReplicaFollower target for a replica, writes everything it gets from the leveldb_server to the replica's
+    own leveldb database, and tells the LeveldbServer's ValueCache about it'''
+
+    def __init__(self, db, valueCache=None):
+        ''' constructor
+        @param db - the replica's leveldb.LevelDB
+        @param valueCache - the LeveldbServer.valueCache, or None'''
+
+        self.db = db
+        self.valueCache = valueCache
+
+    def replaceAll(self, items):
+        ''' throws away everything in the database and writes @items instead, all at once so readers never see
+        half of it
+
+        @param items - a list of (key, value) two-tuples of bytes'''
+
+        batch = leveldb.WriteBatch()
+
+        for iterKey in self.db.RangeIter(include_value=False):
+            batch.Delete(iterKey)
+
+        for iterKey, iterValue in items:
+            batch.Put(iterKey, iterValue)
+
+        # no need to sync, we copy everything again when we start anyway
+        self.db.Write(batch)
+
+        if self.valueCache is not None:
+            self.valueCache.clear()
+
+    def applyChanges(self, changes):
+        ''' writes changes from the leveldb_server's change log to the database
+
+        @param changes - a list of changes, each a list of (BatchOperation type, key, value) three-tuples'''
+
+        batch = leveldb.WriteBatch()
+        keysWritten = list()
+
+        for iterOperations in changes:
+            for iterType, iterKey, iterValue in iterOperations:
+
+                if iterType == LeveldbServerMessages.BatchOperation.PUT:
+                    batch.Put(iterKey, iterValue)
+                else:
+                    batch.Delete(iterKey)
+
+                keysWritten.append(iterKey)
+
+        self.db.Write(batch)
+
+        if self.valueCache is not None:
+            self.valueCache.invalidate(keysWritten)
+
+
+def startLeveldbReplica(args):
+    ''' copies the leveldb_server's database, and then serves it (read only) while keeping it up to date
+    @param args - the namespace object we get from argparse.parse_args()
+    '''
+
+    constantsObj = Constants(args.configYaml)
+
+    serverRootLogger = configureLogging(constantsObj, constantsObj.LEVELDB_REPLICA_LOGGING_OUTPUT_NAME)
+
+    loop = asyncio.get_event_loop()
+
+    leveldbOptions = constantsObj.LEVELDB_OPTIONS or dict()
+    serverRootLogger.info("opening replica leveldb with options: %s", leveldbOptions)
+
+    LeveldbServer.dbPath = constantsObj.LEVELDB_REPLICA_DB_PATH
+    LeveldbServer.db = leveldb.LevelDB(LeveldbServer.dbPath, **leveldbOptions)
+    LeveldbServer.stats = ServerStats()
+    LeveldbServer.readOnly = True
+
+    if constantsObj.LEVELDB_SERVER_VALUE_CACHE_ENTRIES > 0:
+        LeveldbServer.valueCache = ValueCache(constantsObj.LEVELDB_SERVER_VALUE_CACHE_ENTRIES)
+
+    follower = ReplicaFollower(lambda: ServerDatabase.fromConstants(constantsObj),
+        LeveldbReplicaTarget(LeveldbServer.db, LeveldbServer.valueCache), serverRootLogger.getChild("ReplicaFollower"))
+    follower.start()
+
+    # don't let anyone connect until we have everything, or they would read from an empty (or old) database
+    serverRootLogger.info("copying the database from the leveldb_server")
+    follower.waitUntilReady()
+
+    unixSocketPath = constantsObj.LEVELDB_REPLICA_UNIX_SOCKET_PATH
+    if unixSocketPath:
+
+        # same as the leveldb_server, remove the socket file if we didn't shut down cleanly last time
+        if os.path.exists(unixSocketPath) and stat.S_ISSOCK(os.stat(unixSocketPath).st_mode):
+            serverRootLogger.info("removing stale unix socket at %s", unixSocketPath)
+            os.remove(unixSocketPath)
+
+        server = loop.run_until_complete(createUnixServer(loop, LeveldbServer, unixSocketPath,
+            constantsObj.LEVELDB_SERVER_UNIX_SOCKET_MODE))
+
+    else:
+        server = loop.run_until_complete(loop.create_server(LeveldbServer, constantsObj.LEVELDB_REPLICA_HOST,
+            constantsObj.LEVELDB_REPLICA_PORT))
+
+    serverRootLogger.info("replica serving on %s", server.sockets[0].getsockname())
+    serverRootLogger.info("using database at %s", LeveldbServer.dbPath)
+
+    watcher = watchConstants(constantsObj, loop, serverRootLogger)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        print("exit")
+    finally:
+        serverRootLogger.info("closing replica and loop")
+        server.close()
+        loop.close()
+        follower.stop()
+
+        if watcher is not None:
+            watcher.stop()
+
+        if unixSocketPath and os.path.exists(unixSocketPath):
+            os.remove(unixSocketPath)
+
+
+if __name__ == "__main__":
+    # if we are being run as a real program
+
+    parser = argparse.ArgumentParser(description="Starts a read only replica of the leveldb_server on localhost")
+
+    parser.add_argument('configYaml',  type=isYamlType, help="the YAML config file that is meant for the Constants class")
+
+    argparseLg = logging.getLogger("argparse")
+
+    try:
+        startLeveldbReplica(parser.parse_args())
+    except Exception as e:
+        argparseLg.exception("uncaught exception: %s", e)
+        logging.shutdown()
+        sys.exit(1)
+
+    # exiting normally
+    argparseLg.info("Shutting down normally")
+    logging.shutdown()
@@ -13,19 +13,28 @@ import json
 import logging, logging.handlers
 import argparse, sys
 import random
+import os, stat
+import collections
+import itertools
+import time
 
 # third party libraries
 
 import yaml
 import leveldb
 import google.protobuf.message # for DecodeError 
-import arrow
 
 
 # project imports
 
-from constants import Constants
+from constants import Constants, ConstantsWatcher
 from leveldb_server_messages_pb2 import LeveldbServerMessages
+from leveldb_server_cache import ValueCache
+from leveldb_server_changelog import ChangeLog, fillChangeLogEntry
+from leveldb_server_executor import StorageScheduler, LoopLagMonitor
+import leveldb_server_frames
+from logging_helpers import RequestLogSampler
+from server_stats import ServerStats, StatsTextProtocol
 
 def base36encode(number, alphabet='0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
     """Converts an integer to a base36 string."""
@@ -55,6 +64,75 @@ class LeveldbServer(asyncio.Protocol):
     dbPath = None
     db = None
 
+    # if not None, then the leveldb calls are run in a thread pool by this StorageScheduler
+    # instead of on the event loop thread
+    scheduler = None
+    maxPendingPerConnection = 64 # stop reading from a connection if it has this many queries waiting on the scheduler
+    loopMonitor = None
+
+    # if not None, a ValueCache of the values GET and MULTI_GET have read from the live database
+    valueCache = None
+
+    # if not None, a ChangeLog of every write, that replicas follow with GET_CHANGES
+    changeLog = None
+
+    # if True, clients can only read, a replica's database only gets written to by its ReplicaFollower
+    readOnly = False
+
+    # how much of the keys and values we put in one RETURN_ATONCE_RANGE_ITER (that has a limit) or GET_CHANGES response,
+    # so it stays under the 64KB that the 2 byte size prefix allows
+    maxResponseBytes = 60000
+
+    # the biggest message the 2 byte size prefix can say the size of
+    maxMessageBytes = 0xFFFF
+
+    # decides which queries get logged at INFO, startLeveldbServer() sets this from the config
+    requestLogSampler = RequestLogSampler(1)
+
+    # counters and latency histograms for the STATS query and the metrics listener
+    stats = ServerStats()
+
+    # ServerQuery type -> its name, like 'GET', what we keep the stats under
+    queryTypeNames = {iterValue.number: iterValue.name for iterValue in 
+        LeveldbServerMessages.ServerQuery.DESCRIPTOR.enum_types_by_name["ServerQueryType"].values}
+
+    # the ServerQuery types that _runQuery() knows how to handle
+    supportedQueryTypes = frozenset([
+        LeveldbServerMessages.ServerQuery.GET,
+        LeveldbServerMessages.ServerQuery.SET,
+        LeveldbServerMessages.ServerQuery.DELETE,
+        LeveldbServerMessages.ServerQuery.DELETE_ALL_IN_RANGE,
+        LeveldbServerMessages.ServerQuery.RETURN_ATONCE_RANGE_ITER,
+        LeveldbServerMessages.ServerQuery.MULTI_GET,
+        LeveldbServerMessages.ServerQuery.COUNT_RANGE,
+        LeveldbServerMessages.ServerQuery.STATS,
+        LeveldbServerMessages.ServerQuery.OPEN_SNAPSHOT,
+        LeveldbServerMessages.ServerQuery.RELEASE_SNAPSHOT,
+        LeveldbServerMessages.ServerQuery.WRITE_BATCH,
+        LeveldbServerMessages.ServerQuery.SET_CONNECTION_OPTIONS,
+        LeveldbServerMessages.ServerQuery.GET_CHANGES])
+
+    # the ServerQuery types that write to the database, which a readOnly server refuses
+    writeQueryTypes = frozenset([
+        LeveldbServerMessages.ServerQuery.SET,
+        LeveldbServerMessages.ServerQuery.DELETE,
+        LeveldbServerMessages.ServerQuery.DELETE_ALL_IN_RANGE,
+        LeveldbServerMessages.ServerQuery.WRITE_BATCH])
+
+    # the ServerQuery types that can read from a snapshot rather then the live database
+    snapshotReadTypes = frozenset([
+        LeveldbServerMessages.ServerQuery.GET,
+        LeveldbServerMessages.ServerQuery.RETURN_ATONCE_RANGE_ITER,
+        LeveldbServerMessages.ServerQuery.MULTI_GET,
+        LeveldbServerMessages.ServerQuery.COUNT_RANGE])
+
+    # the ServerQuery types that don't touch any keys and are cheap, so they always run on the event loop
+    # thread, even if we have a scheduler. SET_CONNECTION_OPTIONS has to, so it applies to the very next message
+    inlineQueryTypes = frozenset([
+        LeveldbServerMessages.ServerQuery.STATS,
+        LeveldbServerMessages.ServerQuery.RELEASE_SNAPSHOT,
+        LeveldbServerMessages.ServerQuery.SET_CONNECTION_OPTIONS])
+
     def __init__(self):
         ''' constructor'''
         self.lg = logging.getLogger("LeveldbServer")
@@ -62,11 +140,26 @@ class LeveldbServer(asyncio.Protocol):
         self.name = "unnamed"
         self.id = base36encode(random.sample(range(10000000), 1)[0])
 
-        # used in holding the data until we get the entire thing
-        self.chunks = list()
-        self.incomingMessageLength = 0
-        self.haveIncompleteMessage = False
-        self.dataReadSoFar = 0
+        # used in holding the data until we get the entire thing, might hold more then one message
+        # if the client is pipelining its requests
+        self.buffer = bytearray()
+
+        # set once we have closed the transport because of an error, so we stop processing messages
+        self.closed = False
+
+        # when using the scheduler, the futures for the responses we haven't written yet, in the
+        # order that the queries came in, since the client expects the responses in that order
+        self.pendingResponses = collections.deque()
+        self.readingPaused = False
+
+        # snapshot id -> leveldb snapshot, for the snapshots this connection has opened, they only
+        # make sense on this connection and get released when it goes away
+        self.snapshots = dict()
+        self.snapshotIdCounter = itertools.count(1)
+
+        # the ConnectionOptions for this connection, the client changes these with SET_CONNECTION_OPTIONS
+        self.compactFrames = False
+        self.echoQuery = True
 
     def __del__(self):
         ''' destructor'''
@@ -74,8 +167,14 @@ class LeveldbServer(asyncio.Protocol):
 
     def _peernameTupleToName(self, peernameTuple):
         ''' turns a string name using the port from a tuple like ('127.0.0.1', "57276") along with this connection's id
+
+        if we are listening on a unix domain socket, then the peername is not a tuple (its usually an empty string)
+        so we just use the connection's id
         '''
 
+        if not isinstance(peernameTuple, tuple):
+            return "<unix,id:{:5s}>".format(self.id)
+
         return "<p:{:5d},id:{:5s}>".format(peernameTuple[1], self.id)
 
     def _returnErrorProtobuf(self, errCode, errMsg):
@@ -83,16 +182,20 @@ class LeveldbServer(asyncio.Protocol):
         transport's connection'''
 
         errProto = LeveldbServerMessages.ActualData()
-        errProto.timestamp = arrow.now().timestamp
+        errProto.timestamp = int(time.time())
         errProto.type = LeveldbServerMessages.ActualData.ERROR
 
         errProto.error.error_code = errCode
         errProto.error.error_message = errMsg
 
-        self.lg.error("closing transport due to error: {}, {}"
-            .format(self.protobufEnumToStr(LeveldbServerMessages.Error, "ErrorType", errCode), errMsg))
-        self.transport.write(errProto.SerializeToString())
+        self.lg.error("closing transport due to error: %s, %s",
+            self.protobufEnumToStr(LeveldbServerMessages.Error, "ErrorType", errCode), errMsg)
+        # size prefix it like every other message, so the client can actually read the error
+        errBytes = errProto.SerializeToString()
+        self.transport.write(len(errBytes).to_bytes(2, "big") + errBytes)
+        LeveldbServer.stats.bytesOut += len(errBytes) + 2
         self.transport.close() 
+        self.closed = True
 
 
     def protobufEnumToStr(self, reflectionObj, enumTypeName, enumValue):
@@ -111,99 +214,150 @@ class LeveldbServer(asyncio.Protocol):
         try:
             return "<ProtoEnum: " + enumTypeName + "." + reflectionObj.DESCRIPTOR.enum_types_by_name[enumTypeName].values_by_number[enumValue].name + ">"
         except Exception as e:
-            self.lg.error("protobufEnumToStr() encountered an exception, returning default string ({})".format(e))
+            self.lg.error("protobufEnumToStr() encountered an exception, returning default string (%s)", e)
 
         # default string if an exception happens
         return "<UNKNOWN>"
 
-    def connection_made(self, transport):
-        ''' called when a client makes a connection to this server
-        @param transport - The transport argument is the transport representing the connection. 
-            You are responsible for storing it somewhere (e.g. as an attribute) if you need to.'''
+    def _rangeIter(self, startKey, endKey, includeValue=True, readFrom=None):
+        ''' helper generator around LeveldbServer.db.RangeIter() that is shared by all of the query types
+        that deal with ranges of keys
 
-        self.lg = self.lg.getChild(self._peernameTupleToName(transport.get_extra_info('peername')))
+        if we are only given a start key, then we treat it as a prefix and stop once the keys no longer
+        startwith() the start key, since RangeIter will happily keep going to the end of the database otherwise.
+        If we have an end key we don't worry about it because RangeIter will end on its own.
 
-        peername = transport.get_extra_info('peername')
-        self.lg.info('connection from {}'.format(peername))
-        self.transport = transport
+        @param startKey - the key (bytes) to start the RangeIter at, also the prefix if endKey is None
+        @param endKey - the key (bytes) to end the RangeIter at, or None
+        @param includeValue - if False, then we don't have leveldb copy the values, and we yield (key, None)
+        @param readFrom - a leveldb snapshot to read from, or None for the live database
+        @return a GENERATOR that yields two-tuples of (key, value) as bytearrays'''
 
-    def data_received(self, data):
-        ''' called when we recieve data from a client
-        Note that this might not be all the data that the client has sent us, so we need to check the size
-        (a 2 byte prefix in the data we get) so we know we have the entire protobuf message
+        if readFrom is None:
+            readFrom = LeveldbServer.db
 
-        @param data - a non-empty bytes object containing the incoming data, might not be complete'''
+        if endKey != None:
+            theGen = readFrom.RangeIter(startKey, endKey, include_value=includeValue)
+        else:
+            theGen = readFrom.RangeIter(startKey, include_value=includeValue)
 
-        self.lg.debug("data_received called with: '{}', len: '{}'".format(data, len(data)))
+        self.lg.debug("\tstarting RangeIter generator loop")
+        for iterEntry in theGen:
 
-        # here we are assuming that we are at least getting 2 bytes, for the size of the message
-        if not len(data) >= 2:
-            self.lg.error("got less then 2 bytes, which means we can't figure out the size of the rest of the message!")
-            return self._returnErrorProtobuf(LeveldbServerMessages.Error.SERVER_ERROR, "didn't get at least 2 bytes in initial " + 
-                "data recieved, so unable determine the of incoming message")
+            # RangeIter only gives us the key (not a tuple) if include_value is False
+            iterKey, iterValue = iterEntry if includeValue else (iterEntry, None)
 
-        sizeOfData = 0 # size of the data , minus the 2 byte size prefix
+            if endKey == None and not iterKey.startswith(startKey):
+                self.lg.debug("\t\tbreaking RangeIter generator loop because endKey is None and the key '%s' does not start with '%s'",
+                    iterKey, startKey)
+                break
 
-        ###################
-        # see if we are in the middle of reading an incomplete message
-        # and set variables
-        ###################
-        if self.haveIncompleteMessage:
+            yield iterKey, iterValue
 
-            # in the middle of an incomplete message, so we already have some data
+    def _get(self, key, snapshot=None):
+        ''' helper method around LeveldbServer.db.Get() that goes through LeveldbServer.valueCache if we have one,
+        snapshots are never cached
 
-            sizeOfData = self.incomingMessageLength
-            
-            self.dataReadSoFar += len(data)
+        @param key - the key as bytes
+        @param snapshot - a leveldb snapshot to read from, or None for the live database
+        @return the value as bytes, raises KeyError if the key doesn't exist'''
 
-            self.lg.debug("\tIncompleteMessage, sizeOfData: '{}', chunks: '{}', dataReadSoFar: '{}'".format(sizeOfData, self.chunks, self.dataReadSoFar))
-            self.chunks.append(data)
+        if snapshot is not None:
+            # the protobuf-py3 library freaks out and wants bytes instead of bytearray
+            return bytes(snapshot.Get(key))
+
+        valueCache = LeveldbServer.valueCache
+
+        if valueCache is None:
+            return bytes(LeveldbServer.db.Get(key))
+
+        return valueCache.get(key, lambda: bytes(LeveldbServer.db.Get(key)))
+
+    def _invalidate(self, keys):
+        ''' tells LeveldbServer.valueCache (if we have one) that some keys were just written to
+
+        @param keys - an iterable of keys (bytes)'''
+
+        if LeveldbServer.valueCache is not None:
+            LeveldbServer.valueCache.invalidate(keys)
+
+    def _applyWrite(self, writeFunc, operations):
+        ''' does a write to leveldb, records it in LeveldbServer.changeLog (if we have one) and then tells
+        LeveldbServer.valueCache about the keys it changed
+
+        @param writeFunc - function that takes no arguments and does the actual write
+        @param operations - a list of (BatchOperation type, key, value) three-tuples that says what @writeFunc
+            does, as PUTs and DELETEs (value is None for DELETE)'''
+
+        changeLog = LeveldbServer.changeLog
+
+        if changeLog is None or not operations:
+            writeFunc()
 
         else:
 
-            # not in middle of incomplete message, this is a new one, we don't have any existing data
+            # the write and the append have to happen together, or a replica could see them in a different order
+            with changeLog.lock:
+                writeFunc()
+                changeLog.append(operations)
 
-            sizeOfData = int.from_bytes(data[:2], "big")
-            self.dataReadSoFar += len(data[2:]) # data minus the size prefix
+        self._invalidate([iterKey for iterType, iterKey, iterValue in operations])
 
-            self.lg.debug("\tNewMessage, sizeOfData: '{}' chunks: '{}', dataReadSoFar: '{}'".format(sizeOfData, self.chunks, self.dataReadSoFar))
-            self.chunks.append(data[2:]) # data minus the size prefix
-            self.lg.debug("\t\tadding chunk: '{}'".format(data))
+    def connection_made(self, transport):
+        ''' called when a client makes a connection to this server
+        @param transport - The transport argument is the transport representing the connection. 
+            You are responsible for storing it somewhere (e.g. as an attribute) if you need to.'''
 
+        self.lg = self.lg.getChild(self._peernameTupleToName(transport.get_extra_info('peername')))
 
+        peername = transport.get_extra_info('peername')
+        self.lg.info('connection from %s', peername)
+        self.transport = transport
+        LeveldbServer.stats.connectionMade()
 
+    def data_received(self, data):
+        ''' called when we recieve data from a client
+        Note that this might not be all the data that the client has sent us, so we need to check the size
+        (a 2 byte prefix in the data we get) so we know we have the entire protobuf message. It might also be
+        more then one message (or one and a half messages) if the client is pipelining requests
+        (like AsyncServerDatabase does), so we keep everything in a buffer and pull out every complete
+        message that is in it.
 
-        ###################
-        # deal with the data we recieved, figure out
-        # if we have retrieved all of it or if we have to wait for another read
-        ###################
-        if self.dataReadSoFar >= sizeOfData:
+        @param data - a non-empty bytes object containing the incoming data, might not be complete'''
 
-            # got all the data, call the actual method to process the complete protobuf message
-            
-            resultData = b''.join(self.chunks)
+        # checking once here is a lot cheaper then having every debug() call below figure it out
+        isDebug = self.lg.isEnabledFor(logging.DEBUG)
 
-            self.lg.debug("\thave all of the data, calling complete_data_received with '{}'".format(resultData))
+        if isDebug:
+            self.lg.debug("data_received called with: '%s', len: '%s'", data, len(data))
 
-            # reset variables
-            self.haveIncompleteMessage = False
-            self.chunks = list()
-            self.incomingMessageLength = 0
-            self.dataReadSoFar = 0
+        self.buffer.extend(data)
+        LeveldbServer.stats.bytesIn += len(data)
 
-            # call the 'real' complete_data_recieved() method with the data , with the 'size' bytes stripped off
-            return self.complete_data_received(resultData)
+        # keep going as long as we have the 2 byte size prefix and the entire message that follows it
+        while len(self.buffer) >= 2 and not self.closed:
 
-        else:
+            sizeOfData = int.from_bytes(self.buffer[:2], "big") # size of the data , minus the 2 byte size prefix
+
+            if len(self.buffer) - 2 < sizeOfData:
 
-            # we didn't get all the data, so we have to do multiple reads, save our state for the next read
+                # we didn't get all the data, so we have to wait for another read
+                if isDebug:
+                    self.lg.debug("\tdon't have all of the data, only have %s/%s bytes (not including size prefix)",
+                        len(self.buffer) - 2, sizeOfData)
+                break
 
-            self.haveIncompleteMessage = True
-            self.incomingMessageLength = sizeOfData
+            # got all the data for this message, call the actual method to process the complete protobuf message
+            # with the 'size' bytes stripped off
+            resultData = bytes(self.buffer[2:2 + sizeOfData])
+            del self.buffer[:2 + sizeOfData]
 
-            self.lg.debug("\tdon't have all of the data, only have {}/{} bytes (not including size prefix)".format(self.dataReadSoFar, sizeOfData))
+            if isDebug:
+                self.lg.debug("\thave all of the data, calling complete_data_received with '%s'", resultData)
+            self.complete_data_received(resultData)
 
-        self.lg.debug("waiting for another data_recieved call...")
+        if isDebug:
+            self.lg.debug("waiting for another data_recieved call...")
 
 
 
@@ -219,48 +373,393 @@ class LeveldbServer(asyncio.Protocol):
         # makes sure a protobuf message has those fields by calling HasField(), and if doesnt then
         # we call _returnErrorProtobuf cause its an invalid request
 
-        self.lg.debug("complete_data_received called with: '{}'".format(data))
+        isDebug = self.lg.isEnabledFor(logging.DEBUG)
+
+        if isDebug:
+            self.lg.debug("complete_data_received called with: '%s'", data)
+
+        if leveldb_server_frames.isCompactFrame(data):
+            return self._compactFrameReceived(data)
 
         try:
             protoObj = LeveldbServerMessages.ActualData.FromString(data)
         except google.protobuf.message.DecodeError as e:
 
             # if they sent a malformed message, close the connection
-            self.lg.error("Couldn't decode sent data, disconnecting this client. error: '{}'".format(e))
+            self.lg.error("Couldn't decode sent data, disconnecting this client. error: '%s'", e)
             return self._returnErrorProtobuf(LeveldbServerMessages.Error.INVALID_REQUEST, "Could not decode protobuf message")
 
-        self.lg.debug("protobuf data recieved: \n********\n{}\n*********".format(str(protoObj)))
+        # turning the whole protobuf message into text is expensive, so only do it if its going to be logged
+        if isDebug:
+            self.lg.debug("protobuf data recieved: \n********\n%s\n*********", protoObj)
 
         # see what type it is
         # TODO ensure that its a query and not a response
         tmpQuery = protoObj.query
-        friendlyName = self.protobufEnumToStr(LeveldbServerMessages.ServerQuery, "ServerQueryType", tmpQuery.type)
-        self.lg.info("Processing query type: {}".format(friendlyName))
+
+        # only log some of the queries at INFO, logging every single one costs more then the leveldb call does
+        requestNumber = LeveldbServer.requestLogSampler.sample()
+        if requestNumber is not None and self.lg.isEnabledFor(logging.INFO):
+            self.lg.info("Processing query type: %s (request #%s, logging 1 in every %s)", 
+                self.protobufEnumToStr(LeveldbServerMessages.ServerQuery, "ServerQueryType", tmpQuery.type), 
+                requestNumber, LeveldbServer.requestLogSampler.sampleRate)
+
+        if tmpQuery.type == LeveldbServerMessages.ServerQuery.START_RANGE_ITER:
+            self.lg.error("NOT IMPLEMENTED: START_RANGE_ITER")
+            return self._returnErrorProtobuf(LeveldbServerMessages.Error.INVALID_REQUEST, "START_RANGE_ITER is not implemented")
+
+        elif tmpQuery.type not in LeveldbServer.supportedQueryTypes:
+
+            # don't recognize the query type
+            self.lg.error("didn't recognize the ServerQuery.type field, is this proto file out of date? entire obj is: %s",
+                protoObj)
+            return self._returnErrorProtobuf(LeveldbServerMessages.Error.SERVER_DOESNT_RECOGNIZE, 
+                "Didn't recognize the ServerQuery.type field... it was {}".format(tmpQuery.type))
+
+        elif LeveldbServer.readOnly and tmpQuery.type in LeveldbServer.writeQueryTypes:
+
+            return self._returnErrorProtobuf(LeveldbServerMessages.Error.INVALID_REQUEST,
+                "This leveldb_server is a read only replica, send writes to the primary")
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.GET_CHANGES:
+
+            if LeveldbServer.changeLog is None:
+                return self._returnErrorProtobuf(LeveldbServerMessages.Error.INVALID_REQUEST,
+                    "This leveldb_server doesn't keep a change log (LEVELDB_SERVER_CHANGE_LOG_ENTRIES is 0)")
+
+            # this might wait for a while, so it gets in line like a scheduled query, and anything after it
+            # on this connection waits too
+            return self._queueResponse(asyncio.get_event_loop().create_task(self._waitForChanges(protoObj)))
+
+        # figure out which snapshot we are reading from (if any) now, rather then when the query runs, so
+        # a RELEASE_SNAPSHOT right after this doesn't pull it out from underneath us
+        snapshot = None
+        if tmpQuery.HasField("snapshot_id") and (tmpQuery.type in LeveldbServer.snapshotReadTypes 
+            or tmpQuery.type == LeveldbServerMessages.ServerQuery.RELEASE_SNAPSHOT):
+
+            snapshot = self.snapshots.get(tmpQuery.snapshot_id)
+
+            if snapshot is None:
+                return self._returnErrorProtobuf(LeveldbServerMessages.Error.INVALID_REQUEST, 
+                    "There is no snapshot with the id {} open on this connection".format(tmpQuery.snapshot_id))
+
+        scheduler = LeveldbServer.scheduler
+
+        if scheduler is None:
+
+            # run everything right here, on the event loop thread
+            return self._respondNow(self._runTimed(tmpQuery.type, self._runQuery, protoObj, snapshot))
+
+        if (tmpQuery.type == LeveldbServerMessages.ServerQuery.GET and (snapshot is not None or not scheduler.isKeyBusy(tmpQuery.key))) \
+            or tmpQuery.type in LeveldbServer.inlineQueryTypes:
+
+            # point GETs are cheap, so as long as nothing that touches the key is still waiting to run (and nothing 
+            # can write to a snapshot), don't bother with the thread pool. The inlineQueryTypes don't touch any keys at all
+            tmpFuture = asyncio.Future()
+            tmpFuture.set_result(self._runTimed(tmpQuery.type, self._runQuery, protoObj, snapshot))
+
+        elif snapshot is not None:
+
+            # nothing can change a snapshot, so there is nothing to wait for
+            tmpFuture = scheduler.schedule(self._runTimed, [tmpQuery.type, self._runQuery, protoObj, snapshot])
+
+        else:
+
+            keys, ranges = self._keysTouchedByQuery(tmpQuery)
+            tmpFuture = scheduler.schedule(self._runTimed, [tmpQuery.type, self._runQuery, protoObj, snapshot], keys, ranges)
+
+        self._queueResponse(tmpFuture)
+
+    def _compactFrameReceived(self, data):
+        ''' like complete_data_received, but for a compact frame (see leveldb_server_frames.py) rather then a 
+        protobuf message, which is only allowed once the client has turned them on with SET_CONNECTION_OPTIONS
+
+        @param data - the frame as bytes, without the size prefix'''
+
+        if not self.compactFrames:
+            return self._returnErrorProtobuf(LeveldbServerMessages.Error.INVALID_REQUEST, 
+                "Got a compact frame, but compact frames were not turned on with SET_CONNECTION_OPTIONS")
+
+        try:
+            queryType, key, value = leveldb_server_frames.unpackQuery(data)
+        except ValueError as e:
+            self.lg.error("Couldn't decode compact frame, disconnecting this client. error: '%s'", e)
+            return self._returnErrorProtobuf(LeveldbServerMessages.Error.INVALID_PROTOBUF_MSG, "Could not decode compact frame")
+
+        if queryType not in leveldb_server_frames.COMPACT_QUERY_TYPES:
+            return self._returnErrorProtobuf(LeveldbServerMessages.Error.SERVER_DOESNT_RECOGNIZE, 
+                "Query type {} can't be sent as a compact frame".format(queryType))
+
+        if LeveldbServer.readOnly and queryType in LeveldbServer.writeQueryTypes:
+            return self._returnErrorProtobuf(LeveldbServerMessages.Error.INVALID_REQUEST,
+                "This leveldb_server is a read only replica, send writes to the primary")
+
+        requestNumber = LeveldbServer.requestLogSampler.sample()
+        if requestNumber is not None and self.lg.isEnabledFor(logging.INFO):
+            self.lg.info("Processing compact query type: %s (request #%s, logging 1 in every %s)", 
+                LeveldbServer.queryTypeNames.get(queryType), requestNumber, LeveldbServer.requestLogSampler.sampleRate)
+
+        scheduler = LeveldbServer.scheduler
+
+        if scheduler is None:
+            return self._respondNow(self._runTimed(queryType, self._runCompactQuery, queryType, key, value))
+
+        if queryType == LeveldbServerMessages.ServerQuery.GET and not scheduler.isKeyBusy(key):
+
+            # same as complete_data_received(), point GETs run inline if nothing is waiting to touch the key
+            tmpFuture = asyncio.Future()
+            tmpFuture.set_result(self._runTimed(queryType, self._runCompactQuery, queryType, key, value))
+
+        else:
+            tmpFuture = scheduler.schedule(self._runTimed, [queryType, self._runCompactQuery, queryType, key, value], [key])
+
+        self._queueResponse(tmpFuture)
+
+
+    def _keysTouchedByQuery(self, tmpQuery):
+        ''' figures out what keys and ranges of keys a query reads or writes, so the StorageScheduler knows what 
+        it has to wait for before running it
+
+        @param tmpQuery - the ServerQuery protobuf object
+        @return a two-tuple of (list of keys, list of (startKey, endKey) ranges)'''
+
+        if tmpQuery.type in (LeveldbServerMessages.ServerQuery.GET, LeveldbServerMessages.ServerQuery.SET,
+            LeveldbServerMessages.ServerQuery.DELETE):
+
+            return [tmpQuery.key], []
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.MULTI_GET:
+
+            return list(tmpQuery.multiple_keys), []
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.OPEN_SNAPSHOT:
+
+            # the snapshot has to have everything that was sent before it, so it waits for everything
+            return [], [(b'', None)]
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.WRITE_BATCH:
+
+            keys = list()
+            ranges = list()
+
+            for iterOp in tmpQuery.batch_operations:
+
+                if iterOp.type == LeveldbServerMessages.BatchOperation.DELETE_RANGE:
+                    ranges.append((iterOp.key, iterOp.rangeiter_end if iterOp.HasField("rangeiter_end") else None))
+                else:
+                    keys.append(iterOp.key)
+
+            return keys, ranges
+
+        else:
+
+            # one of the range queries
+            endKey = None if not tmpQuery.HasField("rangeiter_end") else tmpQuery.rangeiter_end
+            return [], [(tmpQuery.key, endKey)]
+
+    def _queueResponse(self, tmpFuture):
+        ''' adds a future that will have the response bytes for a query to the list of responses we have to write,
+        they get written in the order the queries came in, even if the scheduler finishes them in a different order
+
+        @param tmpFuture - a future that will have the size prefixed bytes to write to the transport'''
+
+        self.pendingResponses.append(tmpFuture)
+        tmpFuture.add_done_callback(self._flushResponses)
+
+        # don't let one client queue up an unlimited amount of work
+        if len(self.pendingResponses) >= LeveldbServer.maxPendingPerConnection and not self.readingPaused:
+            self.lg.debug("pausing reading, have %s queries waiting", len(self.pendingResponses))
+            self.readingPaused = True
+            self.transport.pause_reading()
+
+    def _flushResponses(self, doneFuture=None):
+        ''' writes every response at the front of the line that is done, callback for the futures in _queueResponse
+
+        @param doneFuture - the future that finished'''
+
+        while self.pendingResponses and self.pendingResponses[0].done():
+
+            tmpFuture = self.pendingResponses.popleft()
+
+            if self.closed:
+                continue
+
+            if tmpFuture.cancelled() or tmpFuture.exception() is not None:
+                self.lg.error("running query in the scheduler failed: %s",
+                    "cancelled" if tmpFuture.cancelled() else tmpFuture.exception())
+                self._returnErrorProtobuf(LeveldbServerMessages.Error.SERVER_ERROR, "error when running the query")
+                continue
+
+            self._writeResponse(tmpFuture.result())
+
+        if self.readingPaused and not self.closed and len(self.pendingResponses) <= LeveldbServer.maxPendingPerConnection // 2:
+            self.lg.debug("resuming reading, have %s queries waiting", len(self.pendingResponses))
+            self.readingPaused = False
+            self.transport.resume_reading()
+
+    def _respondNow(self, returnBytes):
+        ''' writes a response we already have, unless there are responses to earlier queries that we are still
+        waiting on (like a GET_CHANGES that is waiting for a change), then it gets in line behind them
+
+        @param returnBytes - the size prefixed bytes of the response'''
+
+        if not self.pendingResponses:
+            return self._writeResponse(returnBytes)
+
+        tmpFuture = asyncio.Future()
+        tmpFuture.set_result(returnBytes)
+        self._queueResponse(tmpFuture)
+
+    @asyncio.coroutine
+    def _waitForChanges(self, protoObj):
+        ''' coroutine for GET_CHANGES, waits up to ServerQuery.wait_milliseconds for there to be a change after
+        ServerQuery.since_sequence, and then runs the query
+
+        @param protoObj - the ActualData protobuf object that the client sent us
+        @return the bytes of the response (with the 2 byte size prefix)'''
+
+        tmpQuery = protoObj.query
+        changeLog = LeveldbServer.changeLog
+
+        if tmpQuery.wait_milliseconds > 0:
+
+            waitFuture = changeLog.waitForChanges(asyncio.get_event_loop(), tmpQuery.since_sequence)
+
+            try:
+                yield from asyncio.wait_for(waitFuture, tmpQuery.wait_milliseconds / 1000)
+            except asyncio.TimeoutError:
+                pass # no changes, so the response just has none
+            finally:
+                changeLog.removeWaiter(waitFuture)
+
+        return self._runTimed(tmpQuery.type, self._runQuery, protoObj, None)
+
+    def _writeResponse(self, returnBytes):
+        ''' writes the response to the client
+
+        @param returnBytes - the size prefixed bytes of the response'''
+
+        if self.lg.isEnabledFor(logging.DEBUG):
+            self.lg.debug("writing to transport: %s", returnBytes)
+        self.transport.write(returnBytes)
+        LeveldbServer.stats.bytesOut += len(returnBytes)
+
+    def _runTimed(self, queryType, runFunc, *args):
+        ''' calls _runQuery() or _runCompactQuery() and records how long it took in LeveldbServer.stats, like 
+        those this can get called in one of the StorageScheduler's threads
+
+        @param queryType - the ServerQuery type, what the time is recorded under
+        @param runFunc - the method to call, _runQuery or _runCompactQuery
+        @param args - the arguments to call @runFunc with
+        @return whatever @runFunc returns, the bytes of the response (with the 2 byte size prefix)'''
+
+        startTime = time.perf_counter()
+        failed = True
+
+        try:
+            returnBytes = runFunc(*args)
+            failed = False
+            return returnBytes
+
+        finally:
+            LeveldbServer.stats.recordOperation(LeveldbServer.queryTypeNames.get(queryType, "UNKNOWN"), 
+                time.perf_counter() - startTime, failed)
+
+    def _runCompactQuery(self, queryType, key, value):
+        ''' the compact frame version of _runQuery(), for GET, SET and DELETE
+
+        @param queryType - the ServerQuery type, one of leveldb_server_frames.COMPACT_QUERY_TYPES
+        @param key - the key, as bytes
+        @param value - the value, as bytes (empty unless this is a SET)
+        @return the bytes of the compact response frame (with the 2 byte size prefix) to write to the transport'''
+
+        if queryType == LeveldbServerMessages.ServerQuery.GET:
+
+            try:
+                returnBytes = leveldb_server_frames.packResponse(LeveldbServerMessages.ServerResponse.GET_RETURNED_VALUE, self._get(key))
+            except KeyError:
+                returnBytes = leveldb_server_frames.packResponse(LeveldbServerMessages.ServerResponse.GET_PRODUCED_KEYERROR)
+
+        elif queryType == LeveldbServerMessages.ServerQuery.SET:
+
+            self._applyWrite(lambda: LeveldbServer.db.Put(key, value), [(LeveldbServerMessages.BatchOperation.PUT, key, value)])
+            returnBytes = leveldb_server_frames.packResponse(LeveldbServerMessages.ServerResponse.SET_SUCCESSFUL)
+
+        else:
+
+            self._applyWrite(lambda: LeveldbServer.db.Delete(key), [(LeveldbServerMessages.BatchOperation.DELETE, key, None)])
+            returnBytes = leveldb_server_frames.packResponse(LeveldbServerMessages.ServerResponse.DELETE_SUCCESSFUL)
+
+        return self._sizePrefixed(returnBytes)
+
+    def _sizePrefixed(self, returnBytes):
+        ''' puts the 2 byte size prefix in front of a response, or if its too big for that, puts it in front of a
+        RESPONSE_TOO_LARGE error instead. Unlike _returnErrorProtobuf() this doesn't close the connection, the query
+        was fine, there was just too much to send back at once. Like _runQuery() this can get called in one of the
+        StorageScheduler's threads, so it can't touch the transport
+
+        @param returnBytes - the bytes of the response (a protobuf message or a compact frame)
+        @return the size prefixed bytes to write to the transport'''
+
+        if len(returnBytes) > LeveldbServer.maxMessageBytes:
+
+            self.lg.warning("response is %s bytes, more then the %s a message can be, sending RESPONSE_TOO_LARGE instead",
+                len(returnBytes), LeveldbServer.maxMessageBytes)
+
+            errProto = LeveldbServerMessages.ActualData()
+            errProto.timestamp = int(time.time())
+            errProto.type = LeveldbServerMessages.ActualData.ERROR
+            errProto.error.error_code = LeveldbServerMessages.Error.RESPONSE_TOO_LARGE
+            errProto.error.error_message = "the response would be {} bytes, but a message can only be {}, ask for less at once".format(
+                len(returnBytes), LeveldbServer.maxMessageBytes)
+
+            returnBytes = errProto.SerializeToString()
+
+        return len(returnBytes).to_bytes(2, "big") + returnBytes
+
+
+    def _runQuery(self, protoObj, snapshot=None):
+        ''' actually runs the query against the leveldb database and creates the response.
+
+        This gets called on the event loop thread, or in one of the StorageScheduler's threads, so this 
+        can't touch the transport!
+
+        @param protoObj - the ActualData protobuf object that the client sent us
+        @param snapshot - the leveldb snapshot to read from for the query types in snapshotReadTypes (the
+            snapshot being released for RELEASE_SNAPSHOT), or None to use the live database
+        @return the bytes of the response (with the 2 byte size prefix) to write to the transport'''
+
+        tmpQuery = protoObj.query
+        isDebug = self.lg.isEnabledFor(logging.DEBUG)
 
         # the protobuf object we will be writing at the end
         returnProtoObj = LeveldbServerMessages.ActualData()
 
         returnProtoObj.type = LeveldbServerMessages.ActualData.RESPONSE
-        returnProtoObj.timestamp = arrow.now().timestamp
-        returnProtoObj.response.query_ran.CopyFrom(protoObj.query)
+        returnProtoObj.timestamp = int(time.time()) # same as arrow.now().timestamp, without the timezone lookup every query
+
+        # nothing we have actually looks at this, and for a small GET its most of the response
+        if self.echoQuery:
+            returnProtoObj.response.query_ran.CopyFrom(protoObj.query)
 
         if tmpQuery.type == LeveldbServerMessages.ServerQuery.GET:
 
-            self.lg.debug("in GET section")
+            if isDebug:
+                self.lg.debug("in GET section")
             
             
             keyToLookUp = tmpQuery.key
-            self.lg.debug("\tattempting Get() with key: {}".format(keyToLookUp))
+            if isDebug:
+                self.lg.debug("\tattempting Get() with key: %s", keyToLookUp)
             try:
-                # encode the string to look it up, we get back bytes, so decode that to turn it back into a string
-
-                # the protobuf-py3 library freaks out and wants bytes instead of bytearray
-                returnProtoObj.response.returned_value = bytes(LeveldbServer.db.Get(keyToLookUp))  
+                returnProtoObj.response.returned_value = self._get(keyToLookUp, snapshot)
                 returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.GET_RETURNED_VALUE
-                self.lg.debug("\tGet successful, got {}".format(returnProtoObj.response.returned_value))
+                if isDebug:
+                    self.lg.debug("\tGet successful, got %s", returnProtoObj.response.returned_value)
 
             except KeyError:
-                self.lg.debug("\tGet unsuccessful, got keyerror")
+                if isDebug:
+                    self.lg.debug("\tGet unsuccessful, got keyerror")
                 # error, set type to be the keyerror one
                 returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.GET_PRODUCED_KEYERROR
                 # returned_value is nothing
@@ -271,14 +770,18 @@ class LeveldbServer(asyncio.Protocol):
         elif tmpQuery.type == LeveldbServerMessages.ServerQuery.SET:
 
             # this operation can't really fail
-            self.lg.debug("in SET section")
+            if isDebug:
+                self.lg.debug("in SET section")
 
             keyToUse = tmpQuery.key
             valueToUse = tmpQuery.value
-            self.lg.debug("\tAttempting Set() with key: {}, value: {}".format(keyToUse, valueToUse))
+            if isDebug:
+                self.lg.debug("\tAttempting Set() with key: %s, value: %s", keyToUse, valueToUse)
 
-            LeveldbServer.db.Put(keyToUse, valueToUse)
-            self.lg.debug("\tSet successful")
+            self._applyWrite(lambda: LeveldbServer.db.Put(keyToUse, valueToUse), 
+                [(LeveldbServerMessages.BatchOperation.PUT, keyToUse, valueToUse)])
+            if isDebug:
+                self.lg.debug("\tSet successful")
 
             returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.SET_SUCCESSFUL
 
@@ -288,59 +791,47 @@ class LeveldbServer(asyncio.Protocol):
             # this operation also can't really fail, if you call Delete on a key that doesn't exist, the leveldb library
             # doesn't complain...
 
-            self.lg.debug("in DELETE section")
+            if isDebug:
+                self.lg.debug("in DELETE section")
 
             keyToUse = tmpQuery.key
-            self.lg.debug("\tAttempting Delete() with key: {}".format(keyToUse))
-            LeveldbServer.db.Delete(keyToUse)
-            self.lg.debug("\tDelete successful")
+            if isDebug:
+                self.lg.debug("\tAttempting Delete() with key: %s", keyToUse)
+            self._applyWrite(lambda: LeveldbServer.db.Delete(keyToUse), [(LeveldbServerMessages.BatchOperation.DELETE, keyToUse, None)])
+            if isDebug:
+                self.lg.debug("\tDelete successful")
 
             returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.DELETE_SUCCESSFUL
 
 
 
-        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.START_RANGE_ITER:
-            self.lg.error("NOT IMPLEMENTED: START_RANGE_ITER")
-            pass
-
         elif tmpQuery.type == LeveldbServerMessages.ServerQuery.DELETE_ALL_IN_RANGE:
 
             # this operation, like delete, also can't really fail, but we need to be careful
             # we don't delete more then we want to (since if you start a RangeIter at a prefix, 
             # it will keep going if no endKey is given...)
 
-            # TODO make this and RETURN ATONCE RANGE ITER use the same code for the generator stuff...
-
-            self.lg.debug("in DELETE_ALL_IN_RANGE section")
+            if isDebug:
+                self.lg.debug("in DELETE_ALL_IN_RANGE section")
             
             # both are optional, TODO check this to make sure both are there!
             startKey = tmpQuery.key
             endKey = None if not tmpQuery.HasField("rangeiter_end") else tmpQuery.rangeiter_end
 
-            self.lg.debug("\tStart,end keys are '{}' / '{}'".format(startKey, endKey))
-
-            if endKey != None:
-                theGen = LeveldbServer.db.RangeIter(startKey, endKey)
-            else:
-                theGen = LeveldbServer.db.RangeIter(startKey)
-
-            toDelList = list()
-            self.lg.debug("\tstarting RangeIter generator loop")
-            for iterResult in theGen:
+            if isDebug:
+                self.lg.debug("\tStart,end keys are '%s' / '%s'", startKey, endKey)
 
-                # here, if we are only given a start key, break out of the loop when 
-                # the keys no longer startwith() the start key (or prefix)
-                # if we have an end key we don't worry about it because it will end on its own.
-                if endKey == None and not iterResult[0].startswith(startKey):
-                    self.lg.debug("\t\tbreaking RangeIter generator loop because endKey is None and the key '{}' does not start with '{}'"
-                        .format(iterResult[0], startKey))
-                    break
+            # collect the keys first, so we are not deleting keys out from underneath the RangeIter generator
+            toDelList = [bytes(iterKey) for iterKey, iterValue in self._rangeIter(startKey, endKey, includeValue=False)]
+            LeveldbServer.stats.recordRangeScan(len(toDelList))
 
-                toDelList.append(iterResult[0])
+            def deleteKeys():
+                for iterEntry in toDelList:
+                    if isDebug:
+                        self.lg.debug("\tDeleting key %s", iterEntry)
+                    self.db.Delete(iterEntry)
 
-            for iterEntry in toDelList:
-                self.lg.debug("\tDeleting key {}".format(iterEntry))
-                self.db.Delete(iterEntry)
+            self._applyWrite(deleteKeys, [(LeveldbServerMessages.BatchOperation.DELETE, iterKey, None) for iterKey in toDelList])
 
             returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.DELETE_SUCCESSFUL
 
@@ -349,51 +840,240 @@ class LeveldbServer(asyncio.Protocol):
             
             # i don't think this operation can fail... maybe i'm wrong
 
-            self.lg.debug("in RETURN_ATONCE_RANGE_ITER section")
-
-            # TODO make this and DELETE_ALL_IN_RANGE use the same code for the generator stuff...
+            if isDebug:
+                self.lg.debug("in RETURN_ATONCE_RANGE_ITER section")
 
             # both are optional, TODO check this to make sure both are there!
             startKey = tmpQuery.key
             endKey = None if not tmpQuery.HasField("rangeiter_end") else tmpQuery.rangeiter_end
 
-            self.lg.debug("\tStart,end keys are '{}' / '{}'".format(startKey, endKey))
+            if isDebug:
+                self.lg.debug("\tStart,end keys are '%s' / '%s'", startKey, endKey)
+
+            # with a limit, the client pages through the range (like a replica copying everything), so also stop
+            # before the response gets too big to send
+            limit = tmpQuery.limit if tmpQuery.HasField("limit") else None
+            totalBytes = 0
+
+            for iterEntry in self._rangeIter(startKey, endKey, readFrom=snapshot):
 
-            if endKey != None:
-                theGen = LeveldbServer.db.RangeIter(startKey, endKey)
-            else:
-                theGen = LeveldbServer.db.RangeIter(startKey)
+                if isDebug:
+                    self.lg.debug("\tGot key/value: '%s' / '%s'", iterEntry[0], iterEntry[1])
 
-            toReturnList = list()
-            self.lg.debug("starting RangeIter generator loop")
+                if limit is not None:
 
-            # we only want the 
-            for iterEntry in theGen:
+                    totalBytes += len(iterEntry[0]) + len(iterEntry[1]) + 8
 
-                # here, if we are only given a start key, break out of the loop when 
-                # the keys no longer startwith() the start key (or prefix)
-                # if we have an end key we don't worry about it because it will end on its own.
-                if endKey == None and not iterEntry[0].startswith(startKey):
-                    self.lg.debug("\t\tbreaking RangeIter generator loop because endKey is None and the key '{}' does not start with '{}'"
-                        .format(iterEntry[0], startKey))
-                    break
-                
-                self.lg.debug("\tGot key/value: '{}' / '{}'".format(iterEntry[0], iterEntry[1]))
+                    if len(returnProtoObj.response.multiple_returned_values) >= limit or \
+                        (totalBytes > LeveldbServer.maxResponseBytes and returnProtoObj.response.multiple_returned_values):
+
+                        returnProtoObj.response.has_more = True
+                        break
 
                 # mutliple_returned_values is a repeated KeyValue field, which is basically just a dictionary.
                 tmpKeyVal = returnProtoObj.response.multiple_returned_values.add() # creates a new KeyValue message for us to modify
                 tmpKeyVal.key = bytes(iterEntry[0]) # the protobuf-py3 library freaks out and wants bytes instead of bytearray
                 tmpKeyVal.value = bytes(iterEntry[1]) # the protobuf-py3 library freaks out and wants bytes instead of bytearray
 
+            LeveldbServer.stats.recordRangeScan(len(returnProtoObj.response.multiple_returned_values))
             returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.RANGEITER_ATONCE_RETURNED
 
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.MULTI_GET:
+
+            # like GET, but for a bunch of keys at once, so callers that already know which keys they want
+            # don't have to do one round trip per key. Keys that don't exist are not an error, they just have
+            # found set to false
+
+            if isDebug:
+                self.lg.debug("in MULTI_GET section")
+
+            for keyToLookUp in tmpQuery.multiple_keys:
+
+                tmpResult = returnProtoObj.response.multi_get_results.add()
+                tmpResult.key = keyToLookUp
+
+                try:
+                    tmpResult.value = self._get(keyToLookUp, snapshot)
+                    tmpResult.found = True
+                except KeyError:
+                    tmpResult.found = False
+
+                if isDebug:
+                    self.lg.debug("\tkey '%s', found: %s", keyToLookUp, tmpResult.found)
+
+            returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.MULTI_GET_RETURNED
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.COUNT_RANGE:
+
+            # same rules as RETURN_ATONCE_RANGE_ITER for the start/end keys, but we only send back
+            # how many keys there are, and don't even have leveldb copy the values for us
+
+            if isDebug:
+                self.lg.debug("in COUNT_RANGE section")
+
+            startKey = tmpQuery.key
+            endKey = None if not tmpQuery.HasField("rangeiter_end") else tmpQuery.rangeiter_end
+
+            if isDebug:
+                self.lg.debug("\tStart,end keys are '%s' / '%s'", startKey, endKey)
+
+            counter = 0
+            for iterEntry in self._rangeIter(startKey, endKey, includeValue=False, readFrom=snapshot):
+                counter += 1
+
+            if isDebug:
+                self.lg.debug("\tcounted %s keys", counter)
+
+            LeveldbServer.stats.recordRangeScan(counter)
+            returnProtoObj.response.range_count = counter
+            returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.COUNT_RANGE_RETURNED
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.STATS:
+
+            # how the server is doing, so you don't need to turn on DEBUG logging to find out
+
+            if isDebug:
+                self.lg.debug("in STATS section")
+
+            LeveldbServer.stats.fillProto(returnProtoObj.response.stats, LeveldbServer.leveldbStatsText(), LeveldbServer.valueCache,
+                LeveldbServer.scheduler, LeveldbServer.loopMonitor)
+            returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.STATS_RETURNED
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.OPEN_SNAPSHOT:
+
+            # a snapshot of the database as it is right now, reads that use it will see the same thing no matter
+            # what gets written after this, until the client releases it (or disconnects)
+
+            snapshotId = next(self.snapshotIdCounter)
+
+            if isDebug:
+                self.lg.debug("in OPEN_SNAPSHOT section, snapshot id will be %s", snapshotId)
+
+            # complete_data_received() only looks snapshots up after the client gets this response, so
+            # adding it from one of the scheduler's threads is fine. If the client went away while we were
+            # waiting to run, then nobody is ever going to release it, so don't bother
+            if not self.closed:
+
+                changeLog = LeveldbServer.changeLog
+
+                if changeLog is None:
+                    self.snapshots[snapshotId] = LeveldbServer.db.CreateSnapshot()
+
+                else:
+
+                    # a replica copies everything from this snapshot, and then asks for the changes after 
+                    # change_sequence, so no write can happen in between the two
+                    with changeLog.lock:
+                        self.snapshots[snapshotId] = LeveldbServer.db.CreateSnapshot()
+                        returnProtoObj.response.change_sequence = changeLog.sequence
+
+                    returnProtoObj.response.change_log_id = changeLog.logId
+
+                LeveldbServer.stats.snapshotsOpened(1)
+
+            returnProtoObj.response.snapshot_id = snapshotId
+            returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.SNAPSHOT_OPENED
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.RELEASE_SNAPSHOT:
+
+            # complete_data_received() already made sure the snapshot exists, and this always runs on the
+            # event loop thread. Queries that are still using it already have it, so its ok to forget about it now
+
+            if isDebug:
+                self.lg.debug("in RELEASE_SNAPSHOT section, snapshot id %s", tmpQuery.snapshot_id)
+
+            del self.snapshots[tmpQuery.snapshot_id]
+            LeveldbServer.stats.snapshotsReleased(1)
+
+            returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.SNAPSHOT_RELEASED
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.WRITE_BATCH:
+
+            # a bunch of puts and deletes that either all happen or none of them do, and that nothing
+            # can see half of
+
+            if isDebug:
+                self.lg.debug("in WRITE_BATCH section, %s operations", len(tmpQuery.batch_operations))
+
+            batch = leveldb.WriteBatch()
+            operations = list()
+
+            for iterOp in tmpQuery.batch_operations:
+
+                if iterOp.type == LeveldbServerMessages.BatchOperation.PUT:
+                    batch.Put(iterOp.key, iterOp.value)
+                    operations.append((iterOp.type, iterOp.key, iterOp.value))
+
+                elif iterOp.type == LeveldbServerMessages.BatchOperation.DELETE:
+                    batch.Delete(iterOp.key)
+                    operations.append((iterOp.type, iterOp.key, None))
+
+                elif iterOp.type == LeveldbServerMessages.BatchOperation.DELETE_RANGE:
+
+                    # this is what is in the database before the batch, so it doesn't delete anything
+                    # that is PUT earlier in the same batch
+                    endKey = iterOp.rangeiter_end if iterOp.HasField("rangeiter_end") else None
+                    for iterKey, iterValue in self._rangeIter(iterOp.key, endKey, includeValue=False):
+                        batch.Delete(iterKey)
+                        operations.append((LeveldbServerMessages.BatchOperation.DELETE, bytes(iterKey), None))
+
+                else:
+                    raise ValueError("_runQuery() can't handle BatchOperation type {}".format(iterOp.type))
+
+            # sync, since the publisher uses this to commit a new version of the data
+            self._applyWrite(lambda: LeveldbServer.db.Write(batch, sync=True), operations)
+
+            returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.WRITE_BATCH_SUCCESSFUL
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.SET_CONNECTION_OPTIONS:
+
+            # this always runs on the event loop thread (see inlineQueryTypes), so it applies to the very next
+            # message we get. We send back what the options are now, so the client knows we understood them
+
+            options = tmpQuery.connection_options
+
+            if options.HasField("compact_frames"):
+                self.compactFrames = options.compact_frames
+
+            if options.HasField("echo_query"):
+                self.echoQuery = options.echo_query
+
+            if isDebug:
+                self.lg.debug("in SET_CONNECTION_OPTIONS section, compact frames: %s, echo query: %s", 
+                    self.compactFrames, self.echoQuery)
+
+            returnProtoObj.response.connection_options.compact_frames = self.compactFrames
+            returnProtoObj.response.connection_options.echo_query = self.echoQuery
+            returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.CONNECTION_OPTIONS_SET
+
+        elif tmpQuery.type == LeveldbServerMessages.ServerQuery.GET_CHANGES:
+
+            # the writes after since_sequence, for replicas. _waitForChanges() already waited for there to be
+            # some (if the client asked us to), and complete_data_received() made sure we have a change log
+
+            changeLog = LeveldbServer.changeLog
+            limit = tmpQuery.limit if tmpQuery.HasField("limit") else 1000
+
+            entries, sequence, resyncNeeded, hasMore = changeLog.changesSince(tmpQuery.since_sequence, limit, 
+                LeveldbServer.maxResponseBytes)
+
+            if isDebug:
+                self.lg.debug("in GET_CHANGES section, since %s, returning %s changes, latest is %s, resync needed: %s",
+                    tmpQuery.since_sequence, len(entries), sequence, resyncNeeded)
+
+            for iterSequence, iterOperations in entries:
+                fillChangeLogEntry(returnProtoObj.response.changes.add(), iterSequence, iterOperations)
+
+            returnProtoObj.response.change_sequence = sequence
+            returnProtoObj.response.change_log_id = changeLog.logId
+            returnProtoObj.response.resync_needed = resyncNeeded
+            returnProtoObj.response.has_more = hasMore
+            returnProtoObj.response.type = LeveldbServerMessages.ServerResponse.CHANGES_RETURNED
+
         else:
 
-            # don't recognize the query type
-            self.lg.error("didn't recognize the ServerQuery.type field, is this proto file out of date? entire obj is: {}"
-                .format(str(protoQuery)))
-            return self._returnErrorProtobuf(LeveldbServerMessages.Error.SERVER_DOESNT_RECOGNIZE, 
-                "Didn't recognize the ServerQuery.type field... it was {}".format(tmpQuery.type))
+            # complete_data_received() makes sure we only get the types in supportedQueryTypes
+            raise ValueError("_runQuery() can't handle ServerQuery type {}".format(tmpQuery.type))
 
 
         # return the result
@@ -401,11 +1081,31 @@ class LeveldbServer(asyncio.Protocol):
 
         # here we have to specify how many bytes are in the message so the reciver knows when they have
         # read the entire message
-        returnBytes = len(returnBytes).to_bytes(2, "big") + returnBytes 
-        self.lg.debug("writing to transport: {}".format(returnBytes))
-        self.transport.write(returnBytes)
+        return self._sizePrefixed(returnBytes)
+
+
 
+    @staticmethod
+    def leveldbStatsText():
+        ''' gets leveldb's own stats (what leveldb calls the 'leveldb.stats' property), the files at each level,
+        how much has been compacted, etc
 
+        @return a string, or None if we couldn't get them'''
+
+        try:
+            # py-leveldb doesn't have GetProperty(), GetStats() is GetProperty("leveldb.stats")
+            return LeveldbServer.db.GetStats()
+        except Exception:
+            return None
+
+    @staticmethod
+    def statsText():
+        ''' the stats as plaintext, for the metrics listener
+
+        @return a string'''
+
+        return LeveldbServer.stats.toText(LeveldbServer.leveldbStatsText(), LeveldbServer.valueCache, LeveldbServer.scheduler,
+            LeveldbServer.loopMonitor)
 
     def eof_received(self):
 
@@ -415,7 +1115,15 @@ class LeveldbServer(asyncio.Protocol):
     def connection_lost(self, exc):
         ''' called when the client disconnects from the server'''
 
-        self.lg.info("lost connection to {}".format(self.transport.get_extra_info("peername")))
+        self.lg.info("lost connection to %s", self.transport.get_extra_info("peername"))
+
+        # so we don't try and write any responses that the scheduler finishes after this
+        self.closed = True
+        LeveldbServer.stats.connectionLost()
+
+        # the snapshots only make sense on this connection, leveldb releases them once nothing references them
+        LeveldbServer.stats.snapshotsReleased(len(self.snapshots))
+        self.snapshots.clear()
 
         #self.transport.write(data)
 
@@ -448,12 +1156,13 @@ def isYamlType(stringArg):
     # if it succeeds, then return the yaml filepath
     return stringArg
 
-def startLeveldbServer(args):
-    '''Starts a server to serve a levelDB database on localhost
-    @param args - the namespace object we get from argparse.parse_args()
-    '''
+def configureLogging(constantsObj, outputName=None):
+    ''' sets up logging for the leveldb_server (and leveldb_replica), to the console or a rotating file depending
+    on the Constants
 
-    constantsObj = Constants(args.configYaml)
+    @param constantsObj - a Constants object
+    @param outputName - the file to log to if we are not logging to the console, SERVERDATABASE_LOGGING_OUTPUT_NAME if None
+    @return the "LeveldbServer" logger, that every LeveldbServer logger is a child of'''
 
     serverRootLogger = logging.getLogger("LeveldbServer")
 
@@ -462,7 +1171,7 @@ def startLeveldbServer(args):
         handler = logging.StreamHandler(sys.stdout)
     else:
         handler = logging.handlers.RotatingFileHandler(
-            filename=constantsObj.SERVERDATABASE_LOGGING_OUTPUT_NAME,
+            filename=outputName or constantsObj.SERVERDATABASE_LOGGING_OUTPUT_NAME,
             mode="a", 
             maxBytes=constantsObj.SERVERDATABASE_LOGGING_MAXBYTES,
             backupCount=constantsObj.SERVERDATABASE_LOGGING_NUMBACKUPS,
@@ -477,24 +1186,153 @@ def startLeveldbServer(args):
     serverRootLogger.setLevel(constantsObj.SERVERDATABASE_LOGGING_LEVEL)
 
     serverRootLogger.info("loggers have been configured")
-    serverRootLogger.info("\tusing handler: {}".format(handler))
+    serverRootLogger.info("\tusing handler: %s", handler)
+
+    LeveldbServer.requestLogSampler = RequestLogSampler(constantsObj.SERVERDATABASE_LOGGING_REQUEST_SAMPLE_RATE)
+    serverRootLogger.info("\tlogging 1 in every %s queries", constantsObj.SERVERDATABASE_LOGGING_REQUEST_SAMPLE_RATE)
 
     # shut the asyncio logger up
     aLg = logging.getLogger("asyncio")
     aLg.setLevel("WARNING")
 
+    return serverRootLogger
+
+def applyReloadedConstants(constantsObj, serverRootLogger):
+    ''' applies the settings that can change without restarting, after the yaml file was changed. Called
+    on the event loop thread
+
+    @param constantsObj - the new Constants object
+    @param serverRootLogger - the "LeveldbServer" logger'''
+
+    serverRootLogger.setLevel(constantsObj.SERVERDATABASE_LOGGING_LEVEL)
+    LeveldbServer.requestLogSampler = RequestLogSampler(constantsObj.SERVERDATABASE_LOGGING_REQUEST_SAMPLE_RATE)
+
+    # turning the cache on or off needs a restart, a write that is already running wouldn't know about it
+    if LeveldbServer.valueCache is not None and constantsObj.LEVELDB_SERVER_VALUE_CACHE_ENTRIES > 0:
+        LeveldbServer.valueCache.resize(constantsObj.LEVELDB_SERVER_VALUE_CACHE_ENTRIES)
+
+    serverRootLogger.warning("applied new settings: logging level %s, logging 1 in every %s queries, value cache size %s "
+        "(anything else needs a restart)", constantsObj.SERVERDATABASE_LOGGING_LEVEL, constantsObj.SERVERDATABASE_LOGGING_REQUEST_SAMPLE_RATE,
+        LeveldbServer.valueCache.maxEntries if LeveldbServer.valueCache is not None else 0)
+
+def watchConstants(constantsObj, loop, serverRootLogger):
+    ''' starts a ConstantsWatcher that calls applyReloadedConstants() whenever the yaml file changes, if
+    CONSTANTS_RELOAD_INTERVAL isn't 0
+
+    @param constantsObj - the Constants object
+    @param loop - the event loop that the LeveldbServer is running on
+    @param serverRootLogger - the "LeveldbServer" logger
+    @return the ConstantsWatcher, or None'''
+
+    if constantsObj.CONSTANTS_RELOAD_INTERVAL <= 0:
+        return None
+
+    watcher = ConstantsWatcher(constantsObj, constantsObj.CONSTANTS_RELOAD_INTERVAL,
+        lambda newConstants: loop.call_soon_threadsafe(applyReloadedConstants, newConstants, serverRootLogger),
+        serverRootLogger.getChild("ConstantsWatcher"))
+    watcher.start()
+
+    serverRootLogger.info("checking for changes to the config file every %s seconds", constantsObj.CONSTANTS_RELOAD_INTERVAL)
+
+    return watcher
+
+@asyncio.coroutine
+def createUnixServer(loop, protocolFactory, unixSocketPath, socketMode):
+    ''' coroutine that creates a server listening on a unix domain socket that only the users that @socketMode
+    allows can connect to. The socket file is created under a umask that takes away every other permission, rather
+    then chmod()ing it after it is bound, so there is never a moment where anyone else can connect to it
+
+    @param loop - the event loop
+    @param protocolFactory - the asyncio.Protocol subclass to serve, like LeveldbServer
+    @param unixSocketPath - the path of the socket file
+    @param socketMode - the permissions of the socket file as an octal string, like LEVELDB_SERVER_UNIX_SOCKET_MODE
+    @return the asyncio Server'''
+
+    mode = int(socketMode, 8)
+
+    # the umask is for the whole process, but create_unix_server() binds the socket before it yields for the
+    # first time, so nothing else runs while it is set
+    oldUmask = os.umask(0o777 & ~mode)
+    try:
+        server = yield from loop.create_unix_server(protocolFactory, unixSocketPath)
+    finally:
+        os.umask(oldUmask)
+
+    # the umask can only take permissions away, this sets exactly the ones that were asked for
+    os.chmod(unixSocketPath, mode)
+
+    return server
+
+def startLeveldbServer(args):
+    '''Starts a server to serve a levelDB database on localhost
+    @param args - the namespace object we get from argparse.parse_args()
+    '''
+
+    constantsObj = Constants(args.configYaml)
+
+    serverRootLogger = configureLogging(constantsObj)
 
     loop = asyncio.get_event_loop()
-    coro = loop.create_server(LeveldbServer, '127.0.0.1', 8888)
 
-    # create class member for the database
+    # see if we are listening on a unix domain socket or on tcp
+    unixSocketPath = constantsObj.LEVELDB_SERVER_UNIX_SOCKET_PATH
+    if unixSocketPath:
+
+        # if we didn't shut down cleanly last time the socket file is still there, and create_unix_server
+        # will fail with 'address already in use', so remove it, but only if it really is a socket
+        if os.path.exists(unixSocketPath) and stat.S_ISSOCK(os.stat(unixSocketPath).st_mode):
+            serverRootLogger.info("removing stale unix socket at %s", unixSocketPath)
+            os.remove(unixSocketPath)
+
+        # the file permissions are what keeps other users from connecting to us
+        coro = createUnixServer(loop, LeveldbServer, unixSocketPath, constantsObj.LEVELDB_SERVER_UNIX_SOCKET_MODE)
+    else:
+        coro = loop.create_server(LeveldbServer, constantsObj.LEVELDB_SERVER_HOST, constantsObj.LEVELDB_SERVER_PORT)
+
+    # create class member for the database, LEVELDB_OPTIONS are passed straight through as keyword 
+    # arguments (block_cache_size, write_buffer_size, etc)
+    leveldbOptions = constantsObj.LEVELDB_OPTIONS or dict()
+    serverRootLogger.info("opening leveldb with options: %s", leveldbOptions)
+
     LeveldbServer.dbPath = constantsObj.CONFIG_DB_PATH
-    LeveldbServer.db = leveldb.LevelDB(LeveldbServer.dbPath)
+    LeveldbServer.db = leveldb.LevelDB(LeveldbServer.dbPath, **leveldbOptions)
+    LeveldbServer.stats = ServerStats()
+
+    if constantsObj.LEVELDB_SERVER_VALUE_CACHE_ENTRIES > 0:
+        LeveldbServer.valueCache = ValueCache(constantsObj.LEVELDB_SERVER_VALUE_CACHE_ENTRIES)
+        serverRootLogger.info("caching up to %s values in memory", constantsObj.LEVELDB_SERVER_VALUE_CACHE_ENTRIES)
+
+    if constantsObj.LEVELDB_SERVER_CHANGE_LOG_ENTRIES > 0:
+        LeveldbServer.changeLog = ChangeLog(constantsObj.LEVELDB_SERVER_CHANGE_LOG_ENTRIES)
+        serverRootLogger.info("keeping the last %s writes in the change log for replicas, change log id is %s",
+            constantsObj.LEVELDB_SERVER_CHANGE_LOG_ENTRIES, LeveldbServer.changeLog.logId)
+
 
+    # see if we are running the leveldb calls in a thread pool
+    if constantsObj.LEVELDB_SERVER_EXECUTOR_THREADS > 0:
+        LeveldbServer.scheduler = StorageScheduler(loop, constantsObj.LEVELDB_SERVER_EXECUTOR_THREADS, 
+            serverRootLogger.getChild("StorageScheduler"))
+        LeveldbServer.maxPendingPerConnection = constantsObj.LEVELDB_SERVER_EXECUTOR_MAX_PENDING_PER_CONNECTION
+        serverRootLogger.info("running leveldb calls in a pool of %s threads", constantsObj.LEVELDB_SERVER_EXECUTOR_THREADS)
+
+    if constantsObj.LEVELDB_SERVER_LOOP_MONITOR_INTERVAL > 0:
+        LeveldbServer.loopMonitor = LoopLagMonitor(loop, constantsObj.LEVELDB_SERVER_LOOP_MONITOR_INTERVAL, 
+            constantsObj.LEVELDB_SERVER_LOOP_MONITOR_LOG_INTERVAL, serverRootLogger.getChild("LoopLagMonitor"), LeveldbServer.scheduler)
+        LeveldbServer.loopMonitor.start()
+
+    watcher = watchConstants(constantsObj, loop, serverRootLogger)
 
     server = loop.run_until_complete(coro)
-    serverRootLogger.info('serving on {}'.format(server.sockets[0].getsockname()))
-    serverRootLogger.info("using database at {}".format(LeveldbServer.dbPath))
+
+    serverRootLogger.info('serving on %s', server.sockets[0].getsockname())
+    serverRootLogger.info("using database at %s", LeveldbServer.dbPath)
+
+    # the plaintext metrics listener, if we have one
+    metricsServer = None
+    if constantsObj.LEVELDB_SERVER_METRICS_PORT > 0:
+        metricsServer = loop.run_until_complete(loop.create_server(lambda: StatsTextProtocol(LeveldbServer.statsText), 
+            constantsObj.LEVELDB_SERVER_METRICS_HOST, constantsObj.LEVELDB_SERVER_METRICS_PORT))
+        serverRootLogger.info("serving plaintext metrics on %s", metricsServer.sockets[0].getsockname())
 
     try:
         loop.run_forever()
@@ -503,8 +1341,21 @@ def startLeveldbServer(args):
     finally:
         serverRootLogger.info("closing server and loop")
         server.close()
+
+        if metricsServer is not None:
+            metricsServer.close()
+
+        if watcher is not None:
+            watcher.stop()
+
         loop.close()
 
+        if LeveldbServer.scheduler is not None:
+            LeveldbServer.scheduler.shutdown()
+
+        if unixSocketPath and os.path.exists(unixSocketPath):
+            os.remove(unixSocketPath)
+
 
 
 if __name__ == "__main__":
@@ -520,7 +1371,7 @@ if __name__ == "__main__":
     try:
         startLeveldbServer(parser.parse_args())
     except Exception as e:
-        argparseLg.exception("uncaught exception: {}".format(e))
+        argparseLg.exception("uncaught exception: %s", e)
         logging.shutdown()
         sys.exit(1)
 
@@ -0,0 +1,99 @@
+#
+# an in-process LRU cache of values that sits in front of leveldb's Get() in the leveldb_server, so
+# the keys that every request reads (like KEY_LAST_DOWNLOAD_TIME) don't have to go through leveldb each time
+#
+
+import collections
+import threading
+
+
+class ValueCache:
+    ''' LRU cache of key -> value (both bytes) for the live database (never snapshots). Everything that
+    writes to the database through the leveldb_server has to call invalidate() for the keys it changed,
+    since nothing else tells us when a value is out of date.
+
+    This is safe to call from more then one thread (like the StorageScheduler's threads)'''
+
+    def __init__(self, maxEntries):
+        ''' constructor
+        @param maxEntries - how many values to keep before we start throwing out the least recently used ones'''
+
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # bumped every time something is invalidated, so a get() that was reading from leveldb while a write
+        # happened knows that the value it read might already be out of date, and doesn't cache it
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loadFunc):
+        ''' gets a value from the cache, or calls @loadFunc to get it from leveldb if its not in the cache
+
+        @param key - the key, as bytes
+        @param loadFunc - function that takes no arguments and returns the value as bytes, or raises KeyError
+            if the key doesn't exist (which we don't cache)
+        @return the value, as bytes'''
+
+        with self.lock:
+
+            value = self.entries.get(key)
+
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            generation = self.generation
+
+        # don't hold the lock while leveldb is working
+        value = loadFunc()
+
+        with self.lock:
+
+            if generation == self.generation:
+
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+
+                if len(self.entries) > self.maxEntries:
+                    self.entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, keys):
+        ''' forgets the values for some keys, call this AFTER the write to leveldb has happened
+
+        @param keys - an iterable of keys (bytes)'''
+
+        with self.lock:
+
+            self.generation += 1
+
+            for iterKey in keys:
+                self.entries.pop(bytes(iterKey), None)
+
+    def clear(self):
+        ''' forgets every value, for when the whole database was replaced (like a replica copying everything again)'''
+
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def resize(self, maxEntries):
+        ''' changes how many values we keep, throwing out the least recently used ones if we have too many now
+
+        @param maxEntries - the new maximum'''
+
+        with self.lock:
+
+            self.maxEntries = maxEntries
+
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,143 @@
+#
+# the change log that the leveldb_server keeps of every write, so read replicas (leveldb_replica.py) and
+# the mirrors in server_database_mirror.py can keep their own copy of the database up to date with GET_CHANGES
+#
+
+import asyncio
+import collections
+import itertools
+import random
+import threading
+
+
+class ChangeLog:
+    ''' the last @maxEntries writes to the database, each one a list of PUTs and DELETEs with a sequence number.
+
+    Whatever writes to leveldb has to hold self.lock while it does the write AND calls append(), so the
+    order of the log is the order the writes really happened in (the StorageScheduler can run writes to
+    different keys at the same time). Anything that needs to know exactly which changes a leveldb snapshot
+    has (OPEN_SNAPSHOT) takes the lock too'''
+
+    def __init__(self, maxEntries):
+        ''' constructor
+        @param maxEntries - how many writes to remember, a replica that falls further behind then this has to copy
+            the whole database again'''
+
+        # different every time the leveldb_server starts, so replicas know the sequence numbers started over
+        self.logId = "{:016x}".format(random.getrandbits(64))
+
+        self.entries = collections.deque(maxlen=maxEntries)
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+        # (event loop, future) for the GET_CHANGES queries waiting for the next change
+        self.waiters = list()
+
+    def append(self, operations):
+        ''' records a write, the caller must be holding self.lock
+
+        @param operations - a list of (BatchOperation type, key, value) three-tuples, value is None for DELETE'''
+
+        self.sequence += 1
+        self.entries.append((self.sequence, operations))
+
+        waiters, self.waiters = self.waiters, list()
+
+        # this might be one of the StorageScheduler's threads, and futures are not thread safe
+        for iterLoop, iterFuture in waiters:
+            iterLoop.call_soon_threadsafe(self._wake, iterFuture)
+
+    @staticmethod
+    def _wake(future):
+        ''' called on the event loop thread to tell a waiting GET_CHANGES there is something new
+
+        @param future - the future from waitForChanges()'''
+
+        if not future.done():
+            future.set_result(None)
+
+    def waitForChanges(self, loop, sinceSequence):
+        ''' gets a future that is done once there is a change after @sinceSequence, right away if there already is one
+
+        @param loop - the event loop the future belongs to
+        @param sinceSequence - the sequence number the client already has
+        @return a asyncio.Future, call removeWaiter() with it if you stop waiting before its done'''
+
+        future = asyncio.Future(loop=loop)
+
+        with self.lock:
+
+            if sinceSequence != self.sequence:
+                future.set_result(None)
+            else:
+                self.waiters.append((loop, future))
+
+        return future
+
+    def removeWaiter(self, future):
+        ''' stops waking up a future from waitForChanges()
+
+        @param future - the future'''
+
+        with self.lock:
+            self.waiters = [iterWaiter for iterWaiter in self.waiters if iterWaiter[1] is not future]
+
+    def changesSince(self, sinceSequence, maxEntries, maxBytes):
+        ''' gets the changes after @sinceSequence
+
+        @param sinceSequence - the sequence number the client already has
+        @param maxEntries - return at most this many changes
+        @param maxBytes - stop adding changes once their keys and values add up to more then this
+        @return a four-tuple of (list of (sequence, operations) two-tuples, the latest sequence number, True if
+            the client needs to resync because we don't have everything since @sinceSequence anymore (or the next
+            change is too big to send by itself), True if we stopped because of @maxEntries or @maxBytes)'''
+
+        with self.lock:
+
+            oldestSequence = self.entries[0][0] if self.entries else self.sequence + 1
+
+            # either from before what we remember, or from a different log (the client is ahead of us)
+            if sinceSequence > self.sequence or (sinceSequence < self.sequence and sinceSequence + 1 < oldestSequence):
+                return [], self.sequence, True, False
+
+            result = list()
+            totalBytes = 0
+            hasMore = False
+
+            for iterEntry in itertools.islice(self.entries, sinceSequence + 1 - oldestSequence, None):
+
+                entryBytes = sum(len(iterKey) + len(iterValue or b"") + 8 for iterType, iterKey, iterValue in iterEntry[1])
+
+                if not result and entryBytes > maxBytes:
+
+                    # a DELETE_ALL_IN_RANGE of a lot of keys can be bigger then a message can be, copying
+                    # everything again is the only way the client is going to get it
+                    return [], self.sequence, True, False
+
+                if len(result) >= maxEntries or totalBytes + entryBytes > maxBytes:
+                    hasMore = True
+                    break
+
+                result.append(iterEntry)
+                totalBytes += entryBytes
+
+            return result, self.sequence, False, hasMore
+
+
+def fillChangeLogEntry(entryProto, sequence, operations):
+    ''' fills out a LeveldbServerMessages.ChangeLogEntry protobuf object
+
+    @param entryProto - the ChangeLogEntry to fill out
+    @param sequence - the sequence number of the change
+    @param operations - the list of (BatchOperation type, key, value) three-tuples'''
+
+    entryProto.sequence = sequence
+
+    for iterType, iterKey, iterValue in operations:
+
+        tmpOp = entryProto.operations.add()
+        tmpOp.type = iterType
+        tmpOp.key = iterKey
+
+        if iterValue is not None:
+            tmpOp.value = iterValue
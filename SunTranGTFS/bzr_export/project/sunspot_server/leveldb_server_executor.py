@@ -0,0 +1,239 @@
+#
+# helpers for leveldb_server.py to run the blocking leveldb calls somewhere other then
+# the event loop thread, and to keep an eye on if the event loop is ever blocked anyway
+#
+
+import asyncio
+import concurrent.futures
+
+
+class StorageScheduler:
+    ''' runs the blocking leveldb calls for the LeveldbServer in a bounded pool of threads, so a big
+    DELETE_ALL_IN_RANGE, range scan or leveldb compaction stall doesn't freeze every connected client.
+
+    Since the threads can run things in any order, we keep track of what keys (and ranges of keys) each
+    operation touches, and an operation only starts after every operation that was scheduled before it
+    that touches the same keys has finished. So a GET that was sent after a SET to the same key always
+    sees the SET, no matter which connection sent them.
+
+    All of the methods here must be called from the event loop thread, only the functions we are given
+    get run in the thread pool.'''
+
+    def __init__(self, loop, maxWorkers, logger):
+        ''' constructor
+        @param loop - the asyncio event loop the LeveldbServer is running in
+        @param maxWorkers - how many threads we run leveldb calls in at most
+        @param logger - a logger object'''
+
+        self.loop = loop
+        self.lg = logger
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+
+        # key -> the future of the last scheduled operation that touches that key, only has unfinished operations
+        self.lastFutureForKey = dict()
+
+        # future -> list of (startKey, endKey) for operations that touch ranges of keys that haven't finished yet
+        self.pendingRanges = dict()
+
+        # future -> the keys it touches, so we can clean up lastFutureForKey once its done
+        self.keysForFuture = dict()
+
+        # stats, how many operations are scheduled (or running) right now and the most we have seen, these show
+        # up in the leveldb_server's STATS
+        self.queueDepth = 0
+        self.maxQueueDepth = 0
+        self.totalScheduled = 0
+
+    def _rangeContains(self, keyRange, key):
+        ''' sees if a key is in a range of keys, using the same rules as LeveldbServer._rangeIter
+
+        @param keyRange - a two-tuple of (startKey, endKey), endKey can be None, meaning startKey is a prefix
+        @param key - the key (bytes) to check
+        @return True or False'''
+
+        startKey, endKey = keyRange
+
+        if endKey is None:
+            return key.startswith(startKey)
+        else:
+            return startKey <= key <= endKey
+
+    def _rangesOverlap(self, rangeOne, rangeTwo):
+        ''' sees if two ranges of keys have any keys in common. All of the keys that start with a prefix are next
+        to each other in leveldb's ordering, so both kinds of ranges are really just intervals, and two intervals
+        overlap if one of them contains where the other one starts
+
+        @param rangeOne - a two-tuple of (startKey, endKey)
+        @param rangeTwo - a two-tuple of (startKey, endKey)
+        @return True or False'''
+
+        return self._rangeContains(rangeOne, rangeTwo[0]) or self._rangeContains(rangeTwo, rangeOne[0])
+
+    def isKeyBusy(self, key):
+        ''' sees if there is an operation that touches @key that hasn't finished yet, if there isn't,
+        then it is safe to run a read of @key right now, on the event loop thread
+
+        @param key - the key (bytes) to check
+        @return True or False'''
+
+        if key in self.lastFutureForKey:
+            return True
+
+        for iterRangeList in self.pendingRanges.values():
+            for iterRange in iterRangeList:
+                if self._rangeContains(iterRange, key):
+                    return True
+
+        return False
+
+    def schedule(self, func, args, keys=(), ranges=()):
+        ''' schedules func(*args) to be run in the thread pool, once every operation that was scheduled
+        before it that touches any of the same keys or ranges has finished
+
+        @param func - the function to run in the thread pool
+        @param args - an iterable of arguments to call @func with
+        @param keys - an iterable of keys (bytes) that @func touches
+        @param ranges - an iterable of (startKey, endKey) two-tuples of ranges of keys that @func touches,
+            use (b'', None) for something that needs to wait for everything (since every key starts with b'')
+        @return an asyncio.Future that will have the result of func(*args)'''
+
+        keys = list(keys)
+        ranges = list(ranges)
+
+        # figure out what we have to wait for
+        dependsOn = set()
+
+        for iterKey in keys:
+            if iterKey in self.lastFutureForKey:
+                dependsOn.add(self.lastFutureForKey[iterKey])
+
+        for iterFuture, iterRangeList in self.pendingRanges.items():
+            for iterRange in iterRangeList:
+                if any(self._rangeContains(iterRange, iterKey) for iterKey in keys) \
+                    or any(self._rangesOverlap(iterRange, iterOtherRange) for iterOtherRange in ranges):
+                    dependsOn.add(iterFuture)
+
+        if ranges:
+            for iterKey, iterFuture in self.lastFutureForKey.items():
+                if any(self._rangeContains(iterRange, iterKey) for iterRange in ranges):
+                    dependsOn.add(iterFuture)
+
+        tmpFuture = self.loop.create_task(self._runAfter(dependsOn, func, args))
+
+        # we are now the operation that anything else touching these keys has to wait for
+        for iterKey in keys:
+            self.lastFutureForKey[iterKey] = tmpFuture
+        self.keysForFuture[tmpFuture] = keys
+
+        if ranges:
+            self.pendingRanges[tmpFuture] = ranges
+
+        tmpFuture.add_done_callback(self._operationDone)
+
+        self.queueDepth += 1
+        self.totalScheduled += 1
+        self.maxQueueDepth = max(self.maxQueueDepth, self.queueDepth)
+
+        return tmpFuture
+
+    @asyncio.coroutine
+    def _runAfter(self, dependsOn, func, args):
+        ''' coroutine that waits for the futures in @dependsOn to finish, and then runs func(*args) in the thread pool
+
+        @param dependsOn - a set of futures we have to wait for
+        @param func - the function to run in the thread pool
+        @param args - the arguments to call @func with
+        @return whatever @func returns'''
+
+        if dependsOn:
+            # we only care that they are done, not if they worked, asyncio.wait() doesn't raise their exceptions
+            yield from asyncio.wait(dependsOn)
+
+        return (yield from self.loop.run_in_executor(self.executor, func, *args))
+
+    def _operationDone(self, fut):
+        ''' callback for when a scheduled operation is finished, forgets about it so the dictionaries don't grow forever
+
+        @param fut - the future that is done'''
+
+        for iterKey in self.keysForFuture.pop(fut, []):
+
+            # only forget about the key if nothing was scheduled for it after us
+            if self.lastFutureForKey.get(iterKey) is fut:
+                del self.lastFutureForKey[iterKey]
+
+        self.pendingRanges.pop(fut, None)
+
+        self.queueDepth -= 1
+
+    def shutdown(self):
+        ''' stops the thread pool, waiting for anything running to finish'''
+
+        self.executor.shutdown(wait=True)
+
+
+
+class LoopLagMonitor:
+    ''' keeps track of how late the event loop runs a callback that we schedule every @interval seconds,
+    if something is blocking the loop (like a big leveldb call that is running inline), then the callback
+    runs late and we see it here. Every @logInterval seconds we log the worst lag we saw along with how many
+    operations the StorageScheduler has queued up.'''
+
+    def __init__(self, loop, interval, logInterval, logger, scheduler=None):
+        ''' constructor
+        @param loop - the asyncio event loop to watch
+        @param interval - how often (in seconds) to check how late the loop is
+        @param logInterval - how often (in seconds) to log what we have seen, 0 to never log
+        @param logger - a logger object
+        @param scheduler - the StorageScheduler, so we can log its queue depth, or None'''
+
+        self.loop = loop
+        self.interval = interval
+        self.logInterval = logInterval
+        self.lg = logger
+        self.scheduler = scheduler
+
+        # lag is in seconds, lastLag, maxLagEver and totalChecks show up in the leveldb_server's STATS
+        self.lastLag = 0.0
+        self.maxLag = 0.0 # since the last time we logged
+        self.maxLagEver = 0.0
+        self.totalChecks = 0
+
+        self.expectedTime = None
+        self.lastLogTime = None
+
+    def start(self):
+        ''' starts checking the loop, call this from the event loop thread'''
+
+        self.lastLogTime = self.loop.time()
+        self._scheduleNext()
+
+    def _scheduleNext(self):
+        ''' schedules the next check'''
+
+        self.expectedTime = self.loop.time() + self.interval
+        self.loop.call_later(self.interval, self._check)
+
+    def _check(self):
+        ''' called by the event loop, hopefully @interval seconds after the last check'''
+
+        now = self.loop.time()
+
+        self.lastLag = max(0.0, now - self.expectedTime)
+        self.maxLag = max(self.maxLag, self.lastLag)
+        self.maxLagEver = max(self.maxLagEver, self.lastLag)
+        self.totalChecks += 1
+
+        if self.logInterval and now - self.lastLogTime >= self.logInterval:
+
+            if self.scheduler is not None:
+                self.lg.info("event loop lag: last {:.4f}s, max {:.4f}s. scheduler queue depth: {}, max {}, total scheduled {}"
+                    .format(self.lastLag, self.maxLag, self.scheduler.queueDepth, self.scheduler.maxQueueDepth,
+                        self.scheduler.totalScheduled))
+            else:
+                self.lg.info("event loop lag: last {:.4f}s, max {:.4f}s".format(self.lastLag, self.maxLag))
+
+            self.maxLag = 0.0
+            self.lastLogTime = now
+
+        self._scheduleNext()
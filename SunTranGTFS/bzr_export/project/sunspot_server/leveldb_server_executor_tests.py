@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+#
+# tests for leveldb_server_executor.py, the StorageScheduler on its own, and a LeveldbServer (with a leveldb
+# database in a temporary directory and a stand in transport) to see which GETs skip the scheduler
+#
+
+import unittest
+import asyncio
+import logging
+import shutil
+import tempfile
+import threading
+
+import leveldb
+
+from leveldb_server import LeveldbServer
+from leveldb_server_executor import StorageScheduler
+from leveldb_server_messages_pb2 import LeveldbServerMessages
+
+
+class StandInTransport:
+    ''' the parts of an asyncio transport that the LeveldbServer uses, keeps everything written to it'''
+
+    def __init__(self):
+        self.written = list()
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 12345)
+
+    def write(self, data):
+        self.written.append(data)
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorageScheduler(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = StorageScheduler(self.loop, 4, logging.getLogger("UnitTest").getChild("StorageScheduler"))
+
+        # the names of the operations, in the order they ran
+        self.ran = list()
+
+    def tearDown(self):
+
+        self.scheduler.shutdown()
+        self.loop.close()
+
+    def _record(self, name, release=None):
+        ''' an operation for the scheduler to run, waits for @release (if there is one) and then records that it ran'''
+
+        if release is not None:
+            release.wait(5)
+
+        self.ran.append(name)
+        return name
+
+    def _runUntilDone(self, *futures):
+        ''' runs the event loop until every one of @futures is done, and then once more so the scheduler's
+        done callbacks get to run'''
+
+        self.loop.run_until_complete(asyncio.wait(futures, timeout=5))
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertTrue(all(iterFuture.done() for iterFuture in futures))
+
+    def testKeyOrdering(self):
+
+        release = threading.Event()
+
+        setFuture = self.scheduler.schedule(self._record, ["set a", release], [b"a"])
+        getFuture = self.scheduler.schedule(self._record, ["get a"], [b"a"])
+        otherFuture = self.scheduler.schedule(self._record, ["get b"], [b"b"])
+
+        # a different key doesn't wait for anything, the GET of a waits for the SET of a
+        self._runUntilDone(otherFuture)
+        self.assertEqual(self.ran, ["get b"])
+        self.assertFalse(getFuture.done())
+
+        release.set()
+        self._runUntilDone(setFuture, getFuture)
+
+        self.assertEqual(self.ran, ["get b", "set a", "get a"])
+        self.assertEqual(getFuture.result(), "get a")
+
+    def testRangeOrdering(self):
+
+        release = threading.Event()
+
+        rangeFuture = self.scheduler.schedule(self._record, ["delete prefix p", release], ranges=[(b"p", None)])
+        inRangeFuture = self.scheduler.schedule(self._record, ["get pa"], [b"pa"])
+        overlapFuture = self.scheduler.schedule(self._record, ["count o to pb"], ranges=[(b"o", b"pb")])
+        outsideFuture = self.scheduler.schedule(self._record, ["get q"], [b"q"])
+        outsideRangeFuture = self.scheduler.schedule(self._record, ["count x to z"], ranges=[(b"x", b"z")])
+
+        self._runUntilDone(outsideFuture, outsideRangeFuture)
+        self.assertEqual(sorted(self.ran), ["count x to z", "get q"])
+        self.assertFalse(inRangeFuture.done() or overlapFuture.done())
+
+        release.set()
+        self._runUntilDone(rangeFuture, inRangeFuture, overlapFuture)
+        self.assertEqual(self.ran[2], "delete prefix p")
+
+        # and the other way around, a range waits for a key in it that was scheduled before it
+        release = threading.Event()
+        self.ran = list()
+
+        keyFuture = self.scheduler.schedule(self._record, ["set m", release], [b"m"])
+        rangeFuture = self.scheduler.schedule(self._record, ["count a to n"], ranges=[(b"a", b"n")])
+
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertFalse(rangeFuture.done())
+
+        release.set()
+        self._runUntilDone(keyFuture, rangeFuture)
+        self.assertEqual(self.ran, ["set m", "count a to n"])
+
+    def testIsKeyBusy(self):
+
+        release = threading.Event()
+
+        tmpFuture = self.scheduler.schedule(self._record, ["write", release], [b"k"], [(b"r", b"s")])
+
+        self.assertTrue(self.scheduler.isKeyBusy(b"k"))
+        self.assertTrue(self.scheduler.isKeyBusy(b"r1"))
+        self.assertTrue(self.scheduler.isKeyBusy(b"s")) # the end of a range is included
+        self.assertFalse(self.scheduler.isKeyBusy(b"j"))
+        self.assertFalse(self.scheduler.isKeyBusy(b"t"))
+        self.assertEqual(self.scheduler.queueDepth, 1)
+
+        release.set()
+        self._runUntilDone(tmpFuture)
+
+        # once its done nothing is busy, and the scheduler forgot about it
+        self.assertFalse(self.scheduler.isKeyBusy(b"k"))
+        self.assertFalse(self.scheduler.isKeyBusy(b"r1"))
+        self.assertEqual((self.scheduler.queueDepth, self.scheduler.maxQueueDepth, self.scheduler.totalScheduled), (0, 1, 1))
+        self.assertEqual((self.scheduler.lastFutureForKey, self.scheduler.pendingRanges), ({}, {}))
+
+
+class TestInlineGets(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.dbPath = tempfile.mkdtemp()
+        self.oldDb, self.oldScheduler = LeveldbServer.db, LeveldbServer.scheduler
+
+        LeveldbServer.db = leveldb.LevelDB(self.dbPath)
+        LeveldbServer.db.Put(b"key", b"value")
+        LeveldbServer.scheduler = StorageScheduler(self.loop, 2, logging.getLogger("UnitTest").getChild("StorageScheduler"))
+
+        self.transport = StandInTransport()
+        self.server = LeveldbServer()
+        self.server.connection_made(self.transport)
+
+    def tearDown(self):
+
+        self.server.connection_lost(None)
+        LeveldbServer.scheduler.shutdown()
+        LeveldbServer.db, LeveldbServer.scheduler = self.oldDb, self.oldScheduler
+
+        shutil.rmtree(self.dbPath)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _sendGet(self, key):
+        ''' sends the LeveldbServer a GET like a ServerDatabase would'''
+
+        protoObj = LeveldbServerMessages.ActualData()
+        protoObj.timestamp = 0
+        protoObj.type = LeveldbServerMessages.ActualData.QUERY
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.GET
+        protoObj.query.key = key
+
+        queryBytes = protoObj.SerializeToString()
+        self.server.data_received(len(queryBytes).to_bytes(2, "big") + queryBytes)
+
+    def _responses(self):
+        ''' the values of the GETs the LeveldbServer has answered, None for a KeyError'''
+
+        data = b"".join(self.transport.written)
+        values = list()
+
+        while data:
+
+            size = int.from_bytes(data[:2], "big")
+            protoResult = LeveldbServerMessages.ActualData.FromString(data[2:2 + size])
+            data = data[2 + size:]
+
+            if protoResult.response.type == LeveldbServerMessages.ServerResponse.GET_RETURNED_VALUE:
+                values.append(protoResult.response.returned_value)
+            else:
+                values.append(None)
+
+        return values
+
+    def testInlineGet(self):
+
+        self._sendGet(b"key")
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        # nothing touches the key, so it didn't go through the scheduler
+        self.assertEqual(LeveldbServer.scheduler.totalScheduled, 0)
+        self.assertEqual(self._responses(), [b"value"])
+
+    def testBusyKeyIsQueued(self):
+
+        release = threading.Event()
+        blockingFuture = LeveldbServer.scheduler.schedule(release.wait, [5], [b"key"])
+
+        # something is still going to touch the key, so the GET has to wait for it in the scheduler
+        self._sendGet(b"key")
+        self.assertEqual(LeveldbServer.scheduler.totalScheduled, 2)
+
+        # a different key still runs inline, but its response waits behind the first one
+        self._sendGet(b"other")
+        self.assertEqual(LeveldbServer.scheduler.totalScheduled, 2)
+
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self._responses(), [])
+
+        release.set()
+        self.loop.run_until_complete(asyncio.wait([blockingFuture] + list(self.server.pendingResponses), timeout=5))
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(self._responses(), [b"value", None])
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#
+# the 'compact' frames that the leveldb_server and ServerDatabase can use for GET, SET and DELETE instead of
+# a whole ActualData protobuf message, once the client turns them on with a SET_CONNECTION_OPTIONS query.
+#
+# they go inside the same 2 byte size prefix as the protobuf messages, and start with a 0 byte, which a
+# serialized ActualData never does (the first byte of a protobuf message is a field tag, and there is no field 0)
+#
+#   query:    0x00, query type (1 byte, the ServerQuery.ServerQueryType), key length (2 bytes, big endian), key, value
+#   response: 0x00, response type (1 byte, the ServerResponse.ServerResponseType), value
+#
+# the value is whatever is left over, and is empty for everything but SET queries and GET_RETURNED_VALUE responses
+#
+
+import struct
+
+from leveldb_server_messages_pb2 import LeveldbServerMessages
+
+
+COMPACT_FRAME_MARKER = b"\x00"
+
+# the query types that can be sent as a compact frame, everything else has to be a protobuf message
+COMPACT_QUERY_TYPES = frozenset([
+    LeveldbServerMessages.ServerQuery.GET,
+    LeveldbServerMessages.ServerQuery.SET,
+    LeveldbServerMessages.ServerQuery.DELETE])
+
+_queryHeader = struct.Struct(">cBH")
+_responseHeader = struct.Struct(">cB")
+
+
+def isCompactFrame(data):
+    ''' sees if a message (without the size prefix) is a compact frame rather then a protobuf message
+
+    @param data - the bytes of the message
+    @return True or False'''
+
+    return data[:1] == COMPACT_FRAME_MARKER
+
+
+def packQuery(queryType, key, value=b""):
+    ''' creates a compact query frame
+
+    @param queryType - one of the COMPACT_QUERY_TYPES
+    @param key - the key, as bytes
+    @param value - the value, as bytes (only for SET)
+    @return the bytes of the frame, without the size prefix'''
+
+    return _queryHeader.pack(COMPACT_FRAME_MARKER, queryType, len(key)) + key + value
+
+
+def unpackQuery(data):
+    ''' reads a compact query frame
+
+    @param data - the bytes of the frame, without the size prefix
+    @return a three-tuple of (query type, key, value), raises ValueError if the frame is malformed'''
+
+    if len(data) < _queryHeader.size:
+        raise ValueError("compact query frame is too short, only {} bytes".format(len(data)))
+
+    marker, queryType, keyLength = _queryHeader.unpack_from(data)
+    keyEnd = _queryHeader.size + keyLength
+
+    if len(data) < keyEnd:
+        raise ValueError("compact query frame says the key is {} bytes, but only has {}".format(keyLength, len(data) - _queryHeader.size))
+
+    return queryType, data[_queryHeader.size:keyEnd], data[keyEnd:]
+
+
+def packResponse(responseType, value=b""):
+    ''' creates a compact response frame
+
+    @param responseType - the ServerResponse type
+    @param value - the value, as bytes (only for GET_RETURNED_VALUE)
+    @return the bytes of the frame, without the size prefix'''
+
+    return _responseHeader.pack(COMPACT_FRAME_MARKER, responseType) + value
+
+
+def unpackResponse(data):
+    ''' reads a compact response frame
+
+    @param data - the bytes of the frame, without the size prefix
+    @return a two-tuple of (response type, value)'''
+
+    return data[1], data[_responseHeader.size:]
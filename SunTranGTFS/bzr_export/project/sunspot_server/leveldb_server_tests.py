@@ -1,16 +1,44 @@
 #!/usr/bin/env python3
 
 import unittest
-from server_database import ServerDatabase
+from server_database import ServerDatabase, AsyncServerDatabase, ResponseTooLargeError
+from server_database_mirror import ReplicaFollower, ServerDatabaseMirror, MirroredServerDatabase
+from leveldb_server_messages_pb2 import LeveldbServerMessages
 import random
 import logging
+import asyncio
+import os, sys, shutil, socket, subprocess, tempfile
+import threading
+import time
+import yaml
 
 ipAddr = "127.0.0.1"
 port = "8888"
+unixSocketPath = None # set this to the LEVELDB_SERVER_UNIX_SOCKET_PATH to test over the unix domain socket instead
 
 alphabet = "a b c d e f g h i j k l m n o p q r s t u v w x y z 0 1 2 3 4 5 6 7 8 9 ! @ # $ % ^ & * ( ) _ + = -".split(" ")
 
 
+def serverKeepsChangeLog():
+    ''' sees if the leveldb_server we are testing keeps a change log, which replication needs, its off unless
+    LEVELDB_SERVER_CHANGE_LOG_ENTRIES is more then 0
+
+    @return True or False'''
+
+    sdb = ServerDatabase(ipAddr, port, None, unixSocketPath)
+
+    try:
+        snapshotId, sequence, changeLogId = sdb.openReplicationSnapshot()
+        sdb.releaseSnapshot(snapshotId)
+        return True
+
+    except Exception:
+        return False
+
+    finally:
+        sdb.close()
+
+
 class TestLeveldbServer(unittest.TestCase):
     ''' note that test methods must start with the word 'test' '''
 
@@ -21,6 +49,14 @@ class TestLeveldbServer(unittest.TestCase):
     # START_RANGE_ITER = 3;
     # DELETE_ALL_IN_RANGE = 4;
     # RETURN_ATONCE_RANGE_ITER = 5;
+    # MULTI_GET = 6;
+    # COUNT_RANGE = 7;
+    # STATS = 8;
+    # OPEN_SNAPSHOT = 9;
+    # RELEASE_SNAPSHOT = 10;
+    # WRITE_BATCH = 11;
+    # SET_CONNECTION_OPTIONS = 12;
+    # GET_CHANGES = 13;
 
     def _log(self, message, level=logging.DEBUG):
         TestLeveldbServer.lg.log(level, message)
@@ -162,6 +198,620 @@ class TestLeveldbServer(unittest.TestCase):
 
 
 
+    def testMultiGet(self):
+
+        sdb = TestLeveldbServer.serverDb
+
+        theDict = dict()
+
+        for idx in range(5):
+            randomKey = "MULTIGET_" + "".join(random.sample(alphabet, 5))
+            randomValue = "".join(random.sample(alphabet, 10))
+
+            sdb[randomKey] = randomValue
+            theDict[randomKey] = randomValue
+
+        missingKey = "SHOULDNOTBEHERE_" + "".join(random.sample(alphabet, 5))
+
+        result = sdb.multiGet(list(theDict.keys()) + [missingKey])
+
+        # keys that exist give us their values, keys that don't give us None
+        for key, value in theDict.items():
+            self.assertEqual(result[key], value)
+
+        self.assertIsNone(result[missingKey])
+
+        # multiGetWithPrefix keeps the order of the format entries it was given
+        self.assertEqual(sdb.multiGetWithPrefix("{}{}", [["MULTIGET_", key[len("MULTIGET_"):]] for key in theDict.keys()]),
+            list(theDict.values()))
+
+    def testMultiGetTooBig(self):
+
+        sdb = TestLeveldbServer.serverDb
+
+        prefix = "MULTIGETBIG_" + "".join(random.sample(alphabet, 5)) + "_"
+        theDict = {"{}{:02d}".format(prefix, idx): "".join(random.choice(alphabet) for i in range(5000)) for idx in range(30)}
+
+        for key, value in theDict.items():
+            sdb[key] = value
+
+        # all of them at once is more then the 2 byte size prefix can say, the server sends back an error
+        # and keeps the connection open
+        with self.assertRaises(ResponseTooLargeError):
+            sdb._multiGetBatch(list(theDict.keys()))
+
+        self.assertEqual(sdb[prefix + "00"], theDict[prefix + "00"])
+
+        # multiGet splits it up until the responses fit
+        self.assertEqual(sdb.multiGet(theDict.keys()), theDict)
+
+        sdb.deleteAllInRange("{}", [prefix])
+
+    def testCountRange(self):
+
+        sdb = TestLeveldbServer.serverDb
+
+        prefix = "COUNTRANGE_" + "".join(random.sample(alphabet, 5)) + "_"
+
+        for idx in range(7):
+            sdb["{}{}".format(prefix, idx)] = "".join(random.sample(alphabet, 10))
+
+        # a key that sorts right after the prefix but doesn't start with it shouldn't get counted
+        sdb[prefix[:-1] + "z"] = "notcounted"
+
+        self.assertEqual(sdb.countWithPrefix("{}", [prefix]), 7)
+
+        # with an end key, the end key is included in the count
+        self.assertEqual(sdb.countRange(prefix + "2", prefix + "4"), 3)
+
+        self.assertEqual(sdb.countWithPrefix("{}", ["SHOULDNOTBEHERE_" + "".join(random.sample(alphabet, 5))]), 0)
+
+    def testStats(self):
+
+        sdb = TestLeveldbServer.serverDb
+
+        randomKey = "STATS_" + "".join(random.sample(alphabet, 5))
+        sdb[randomKey] = "value"
+        sdb[randomKey]
+        sdb.countWithPrefix("{}", [randomKey])
+
+        stats = sdb.getStats()
+
+        self.assertGreaterEqual(stats.active_connections, 1)
+        self.assertGreater(stats.bytes_in, 0)
+        self.assertGreater(stats.bytes_out, 0)
+
+        opsByName = {iterOp.name: iterOp for iterOp in stats.operations}
+
+        for iterName in ("GET", "SET", "COUNT_RANGE"):
+            self.assertIn(iterName, opsByName)
+            self.assertGreaterEqual(opsByName[iterName].count, 1)
+
+            # every operation lands in exactly one bucket
+            self.assertEqual(sum(iterBucket.count for iterBucket in opsByName[iterName].latency_buckets), 
+                opsByName[iterName].count)
+
+        self.assertGreaterEqual(sum(iterBucket.count for iterBucket in stats.range_scan_sizes), 1)
+        self.assertIn("Compactions", stats.leveldb_stats)
+
+        # the StorageScheduler and the LoopLagMonitor are only in there if the server has them turned on
+        if stats.HasField("scheduler_total_scheduled"):
+            self.assertGreaterEqual(stats.scheduler_max_queue_depth, stats.scheduler_queue_depth)
+
+        if stats.HasField("loop_lag_checks"):
+            self.assertGreaterEqual(stats.loop_max_lag_seconds, stats.loop_lag_seconds)
+
+    def testSnapshot(self):
+
+        sdb = TestLeveldbServer.serverDb
+
+        prefix = "SNAPSHOT_" + "".join(random.sample(alphabet, 5)) + "_"
+        sdb[prefix + "a"] = "old"
+        sdb[prefix + "b"] = "old"
+
+        with sdb.snapshot():
+
+            # writes still go to the real database, but we shouldn't see them while in the snapshot
+            sdb[prefix + "a"] = "new"
+            sdb[prefix + "c"] = "new"
+            del sdb[prefix + "b"]
+
+            self.assertEqual(sdb[prefix + "a"], "old")
+            self.assertEqual(sdb[prefix + "b"], "old")
+            with self.assertRaises(KeyError):
+                sdb[prefix + "c"]
+
+            self.assertEqual(sdb.countWithPrefix("{}", [prefix]), 2)
+            self.assertEqual(list(sdb.getGeneratorWithPrefix("{}", [prefix])), [(prefix + "a", "old"), (prefix + "b", "old")])
+            self.assertEqual(sdb.multiGet([prefix + "a", prefix + "c"]), {prefix + "a": "old", prefix + "c": None})
+
+            self.assertEqual(sdb.getStats().open_snapshots, 1)
+
+        # out of the snapshot, so we should see the writes now
+        self.assertEqual(sdb[prefix + "a"], "new")
+        self.assertEqual(sdb[prefix + "c"], "new")
+        with self.assertRaises(KeyError):
+            sdb[prefix + "b"]
+
+        self.assertEqual(sdb.getStats().open_snapshots, 0)
+
+        sdb.deleteAllInRange("{}", [prefix])
+
+    def testWriteBatch(self):
+
+        sdb = TestLeveldbServer.serverDb
+
+        prefix = "BATCH_" + "".join(random.sample(alphabet, 5)) + "_"
+        for idx in range(10):
+            sdb["{}old_{:02d}".format(prefix, idx)] = str(idx)
+        sdb[prefix + "single"] = "single"
+
+        with sdb.writeBatch() as batch:
+            batch.deleteAllInRange("{}old_", [prefix])
+            del batch[prefix + "single"]
+            batch[prefix + "new_a"] = "a"
+            batch.setWithPrefix("{}new_{}", [prefix, "b"], "b")
+
+            # nothing is written until the batch is committed
+            self.assertEqual(len(batch), 4)
+            self.assertEqual(sdb[prefix + "single"], "single")
+            with self.assertRaises(KeyError):
+                sdb[prefix + "new_a"]
+
+        self.assertEqual(sdb.countWithPrefix("{}", [prefix]), 2)
+        self.assertEqual(sdb.multiGet([prefix + "new_a", prefix + "new_b"]), {prefix + "new_a": "a", prefix + "new_b": "b"})
+
+        # if there is an exception then nothing in the batch gets written
+        with self.assertRaises(ValueError):
+            with sdb.writeBatch() as batch:
+                batch[prefix + "new_a"] = "changed"
+                raise ValueError("oops")
+
+        self.assertEqual(sdb[prefix + "new_a"], "a")
+
+        sdb.deleteAllInRange("{}", [prefix])
+
+    def testReadsAfterWrites(self):
+        ''' read a key after every kind of write, so if the server has a value cache (LEVELDB_SERVER_VALUE_CACHE_ENTRIES)
+        then we make sure all of them throw out the old value '''
+
+        sdb = TestLeveldbServer.serverDb
+
+        prefix = "CACHE_" + "".join(random.sample(alphabet, 5)) + "_"
+        key = prefix + "key"
+
+        sdb[key] = "set"
+        self.assertEqual(sdb[key], "set")
+        self.assertEqual(sdb.multiGet([key]), {key: "set"})
+
+        sdb[key] = "set again"
+        self.assertEqual(sdb[key], "set again")
+
+        with sdb.writeBatch() as batch:
+            batch[key] = "batch put"
+        self.assertEqual(sdb[key], "batch put")
+
+        with sdb.writeBatch() as batch:
+            batch.deleteAllInRange("{}", [prefix])
+        with self.assertRaises(KeyError):
+            sdb[key]
+
+        sdb[key] = "set after batch delete"
+        self.assertEqual(sdb[key], "set after batch delete")
+
+        del sdb[key]
+        with self.assertRaises(KeyError):
+            sdb[key]
+
+        sdb[key] = "set after delete"
+        self.assertEqual(sdb.multiGet([key]), {key: "set after delete"})
+
+        sdb.deleteAllInRange("{}", [prefix])
+        self.assertEqual(sdb.multiGet([key]), {key: None})
+
+        # snapshots never go through the cache
+        sdb[key] = "before snapshot"
+        self.assertEqual(sdb[key], "before snapshot")
+        with sdb.snapshot():
+            sdb[key] = "after snapshot"
+            self.assertEqual(sdb[key], "before snapshot")
+        self.assertEqual(sdb[key], "after snapshot")
+
+        sdb.deleteAllInRange("{}", [prefix])
+
+    def testCompactFrames(self):
+
+        sdb = ServerDatabase(ipAddr, port, TestLeveldbServer.lg.getChild("CompactServerDatabase"), compactFrames=True, echoQuery=False)
+
+        prefix = "COMPACT_" + "".join(random.sample(alphabet, 5)) + "_"
+        key = prefix + "key"
+        value = "".join(random.sample(alphabet, 10))
+
+        sdb[key] = value
+        self.assertEqual(sdb[key], value)
+        self.assertEqual(TestLeveldbServer.serverDb[key], value)
+
+        del sdb[key]
+        with self.assertRaises(KeyError):
+            sdb[key]
+
+        # reads inside a snapshot, and everything that isn't a GET/SET/DELETE, still go as protobuf messages
+        sdb[key] = "old"
+        with sdb.snapshot():
+            sdb[key] = "new"
+            self.assertEqual(sdb[key], "old")
+        self.assertEqual(sdb[key], "new")
+        self.assertEqual(sdb.countWithPrefix("{}", [prefix]), 1)
+
+        sdb.deleteAllInRange("{}", [prefix])
+
+    def testCompactFramesNotTurnedOn(self):
+
+        # the server doesn't accept compact frames unless we asked for them first, and closes the connection
+        sdb = ServerDatabase(ipAddr, port, TestLeveldbServer.lg.getChild("CompactServerDatabase"))
+
+        with self.assertRaises(Exception):
+            sdb._sendCompactQueryAndGetResponse(LeveldbServerMessages.ServerQuery.GET, b"some key")
+
+
+
+
+
+
+class TestAsyncServerDatabase(unittest.TestCase):
+    ''' tests for the asyncio version of the ServerDatabase, note that test methods must start with the word 'test' '''
+
+    def _runCoroutine(self, coro):
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def setUp(self):
+        self.serverDb = self._runCoroutine(AsyncServerDatabase.connect(ipAddr, port, 
+            logging.getLogger("UnitTest").getChild("AsyncServerDatabase"), unixSocketPath))
+
+    def tearDown(self):
+        self._runCoroutine(self.serverDb.close())
+
+    def testGetSetDelete(self):
+
+        sdb = self.serverDb
+
+        randomKey = "ASYNC_" + "".join(random.sample(alphabet, 5))
+        randomValue = "".join(random.sample(alphabet, 10))
+
+        self._runCoroutine(sdb.set(randomKey, randomValue))
+        self.assertEqual(self._runCoroutine(sdb.get(randomKey)), randomValue)
+
+        self._runCoroutine(sdb.delete(randomKey))
+        with self.assertRaises(KeyError):
+            self._runCoroutine(sdb.get(randomKey))
+
+    def testPipelining(self):
+        ''' send a bunch of queries at once over the one connection and make sure that every
+        coroutine gets its own answer back'''
+
+        sdb = self.serverDb
+
+        prefix = "ASYNCPIPE_" + "".join(random.sample(alphabet, 5)) + "_"
+        theDict = {"{}{:03d}".format(prefix, idx) : "".join(random.sample(alphabet, 10)) for idx in range(100)}
+
+        self._runCoroutine(asyncio.gather(*[sdb.set(key, value) for key, value in theDict.items()]))
+
+        keyList = list(theDict.keys())
+        results = self._runCoroutine(asyncio.gather(*[sdb.get(key) for key in keyList]))
+        self.assertEqual(results, [theDict[key] for key in keyList])
+
+        self.assertEqual(self._runCoroutine(sdb.range(prefix)), sorted(theDict.items()))
+        self.assertEqual(self._runCoroutine(sdb.countRange(prefix)), len(theDict))
+
+        self._runCoroutine(sdb.deleteAllInRange(prefix))
+        self.assertEqual(self._runCoroutine(sdb.countRange(prefix)), 0)
+
+    def testSnapshot(self):
+
+        sdb = self.serverDb
+
+        randomKey = "ASYNCSNAP_" + "".join(random.sample(alphabet, 5))
+        self._runCoroutine(sdb.set(randomKey, "old"))
+
+        snapshotId = self._runCoroutine(sdb.openSnapshot())
+        self._runCoroutine(sdb.set(randomKey, "new"))
+
+        self.assertEqual(self._runCoroutine(sdb.get(randomKey, snapshotId)), "old")
+        self.assertEqual(self._runCoroutine(sdb.multiGet([randomKey], snapshotId)), {randomKey: "old"})
+        self.assertEqual(self._runCoroutine(sdb.get(randomKey)), "new")
+
+        self._runCoroutine(sdb.releaseSnapshot(snapshotId))
+        self._runCoroutine(sdb.delete(randomKey))
+
+    def testCompactFrames(self):
+
+        sdb = self._runCoroutine(AsyncServerDatabase.connect(ipAddr, port, 
+            logging.getLogger("UnitTest").getChild("AsyncServerDatabase"), unixSocketPath, compactFrames=True, echoQuery=False))
+
+        try:
+            self.assertTrue(sdb.compactFrames)
+
+            prefix = "ASYNCCOMPACT_" + "".join(random.sample(alphabet, 5)) + "_"
+            theDict = {"{}{:03d}".format(prefix, idx) : "".join(random.sample(alphabet, 10)) for idx in range(50)}
+
+            self._runCoroutine(asyncio.gather(*[sdb.set(key, value) for key, value in theDict.items()]))
+
+            keyList = list(theDict.keys())
+            results = self._runCoroutine(asyncio.gather(*[sdb.get(key) for key in keyList]))
+            self.assertEqual(results, [theDict[key] for key in keyList])
+
+            # protobuf queries mixed in with the compact frames still get their own answers
+            self.assertEqual(self._runCoroutine(sdb.countRange(prefix)), len(theDict))
+
+            self._runCoroutine(asyncio.gather(*[sdb.delete(key) for key in keyList]))
+            with self.assertRaises(KeyError):
+                self._runCoroutine(sdb.get(keyList[0]))
+
+        finally:
+            self._runCoroutine(sdb.close())
+
+
+
+class TestReplication(unittest.TestCase):
+    ''' tests for the change log (GET_CHANGES) and the copies of the database that follow it, note that test methods 
+    must start with the word 'test' '''
+
+    def setUp(self):
+        self.lg = logging.getLogger("UnitTest")
+        self.serverDb = ServerDatabase(ipAddr, port, self.lg.getChild("ServerDatabase"), unixSocketPath)
+
+    def _needChangeLog(self):
+        ''' skips the test if the leveldb_server doesn't keep a change log'''
+
+        if not serverKeepsChangeLog():
+            self.skipTest("the leveldb_server doesn't keep a change log, set LEVELDB_SERVER_CHANGE_LOG_ENTRIES to test replication")
+
+    def _waitFor(self, func, timeout=5):
+        ''' calls @func until it returns True, failing the test if that takes longer then @timeout seconds'''
+
+        endTime = time.time() + timeout
+        while not func():
+            if time.time() > endTime:
+                self.fail("timed out waiting for {}".format(func))
+            time.sleep(0.02)
+
+    def testGetChanges(self):
+
+        self._needChangeLog()
+        sdb = self.serverDb
+
+        prefix = "CHANGES_" + "".join(random.sample(alphabet, 5)) + "_"
+
+        snapshotId, sequence, changeLogId = sdb.openReplicationSnapshot()
+        sdb.releaseSnapshot(snapshotId)
+
+        sdb[prefix + "a"] = "1"
+        del sdb[prefix + "a"]
+        with sdb.writeBatch() as batch:
+            batch[prefix + "b"] = "2"
+            batch[prefix + "c"] = "3"
+        sdb.deleteAllInRange("{}", [prefix])
+
+        resp = sdb.getChanges(sequence)
+
+        PUT = LeveldbServerMessages.BatchOperation.PUT
+        DELETE = LeveldbServerMessages.BatchOperation.DELETE
+
+        self.assertEqual(resp.change_log_id, changeLogId)
+        self.assertFalse(resp.resync_needed)
+        self.assertEqual(resp.change_sequence, sequence + 4)
+        self.assertEqual([iterEntry.sequence for iterEntry in resp.changes], list(range(sequence + 1, sequence + 5)))
+        self.assertEqual([[(iterOp.type, iterOp.key.decode("utf-8")) for iterOp in iterEntry.operations] for iterEntry in resp.changes],
+            [[(PUT, prefix + "a")], [(DELETE, prefix + "a")], [(PUT, prefix + "b"), (PUT, prefix + "c")],
+            [(DELETE, prefix + "b"), (DELETE, prefix + "c")]])
+
+        # a limit
+        resp = sdb.getChanges(sequence, limit=1)
+        self.assertEqual(len(resp.changes), 1)
+        self.assertTrue(resp.has_more)
+
+        # from the future (like a different leveldb_server) means copying everything again
+        self.assertTrue(sdb.getChanges(sequence + 1000).resync_needed)
+
+    def testGetChangesWaits(self):
+
+        self._needChangeLog()
+        sdb = self.serverDb
+        key = "CHANGES_WAIT_" + "".join(random.sample(alphabet, 5))
+
+        snapshotId, sequence, changeLogId = sdb.openReplicationSnapshot()
+        sdb.releaseSnapshot(snapshotId)
+
+        # nothing changes, so we get nothing back, but only after waiting
+        startTime = time.time()
+        self.assertEqual(len(sdb.getChanges(sequence, waitMilliseconds=200).changes), 0)
+        self.assertGreaterEqual(time.time() - startTime, 0.15)
+
+        # something else writes while we wait, so we get it right away
+        otherSdb = ServerDatabase(ipAddr, port, self.lg.getChild("OtherServerDatabase"), unixSocketPath)
+        writer = threading.Timer(0.1, otherSdb.__setitem__, [key, "value"])
+        writer.start()
+
+        startTime = time.time()
+        resp = sdb.getChanges(sequence, waitMilliseconds=10000)
+        writer.join()
+
+        self.assertLess(time.time() - startTime, 5)
+        self.assertEqual(resp.changes[0].operations[0].key.decode("utf-8"), key)
+
+        # and the connection keeps working afterwards
+        self.assertEqual(sdb[key], "value")
+        del sdb[key]
+
+    def testRangePage(self):
+
+        sdb = self.serverDb
+
+        prefix = "PAGE_" + "".join(random.sample(alphabet, 5)) + "_"
+        for idx in range(10):
+            sdb["{}{:02d}".format(prefix, idx)] = str(idx)
+
+        items = list()
+        startKey = prefix.encode("utf-8")
+
+        while True:
+            page, hasMore = sdb.getRangePage(startKey, prefix.encode("utf-8") + b"\xff", 3)
+            self.assertLessEqual(len(page), 3)
+            items.extend(page)
+            if not hasMore:
+                break
+            startKey = page[-1][0] + b"\x00"
+
+        self.assertEqual(items, [("{}{:02d}".format(prefix, idx).encode("utf-8"), str(idx).encode("utf-8")) for idx in range(10)])
+
+        sdb.deleteAllInRange("{}", [prefix])
+
+    def testMirror(self):
+
+        self._needChangeLog()
+        sdb = self.serverDb
+
+        prefix = "MIRROR_" + "".join(random.sample(alphabet, 5)) + "_"
+        sdb[prefix + "before"] = "copied"
+
+        mirror = ServerDatabaseMirror()
+        follower = ReplicaFollower(lambda: ServerDatabase(ipAddr, port, None, unixSocketPath), mirror, 
+            self.lg.getChild("ReplicaFollower"), waitMilliseconds=1000)
+        mirror.follower = follower
+
+        # reads go to the leveldb_server until the mirror is ready
+        mirroredSdb = MirroredServerDatabase(mirror, lambda: ServerDatabase(ipAddr, port, None, unixSocketPath))
+        self.assertEqual(mirroredSdb[prefix + "before"], "copied")
+
+        follower.start()
+
+        try:
+            self.assertTrue(follower.waitUntilReady(5))
+            self.assertEqual(mirror.get((prefix + "before").encode("utf-8")), b"copied")
+
+            # writes go to the leveldb_server, and come back to the mirror through the change log
+            mirroredSdb[prefix + "a"] = "1"
+            with sdb.writeBatch() as batch:
+                batch[prefix + "b"] = "2"
+                batch[prefix + "c"] = "3"
+            del sdb[prefix + "before"]
+
+            self._waitFor(lambda: mirroredSdb.countWithPrefix("{}", [prefix]) == 3)
+
+            with mirroredSdb.snapshot():
+                self.assertEqual(mirroredSdb[prefix + "a"], "1")
+                self.assertEqual(mirroredSdb.getWithPrefix("{}{}", [prefix, "b"]), "2")
+                with self.assertRaises(KeyError):
+                    mirroredSdb[prefix + "before"]
+                self.assertEqual(list(mirroredSdb.getGeneratorWithPrefix("{}", [prefix])), 
+                    [(prefix + "a", "1"), (prefix + "b", "2"), (prefix + "c", "3")])
+                self.assertEqual(mirroredSdb.multiGet([prefix + "c", prefix + "d"]), {prefix + "c": "3", prefix + "d": None})
+                self.assertEqual(mirroredSdb.countRange(prefix + "a", prefix + "b"), 2)
+
+            sdb.deleteAllInRange("{}", [prefix])
+            self._waitFor(lambda: mirroredSdb.countWithPrefix("{}", [prefix]) == 0)
+
+        finally:
+            follower.stop()
+
+
+class TestLeveldbReplica(unittest.TestCase):
+    ''' starts a leveldb_replica.py process that follows the leveldb_server we are testing, note that test methods 
+    must start with the word 'test' '''
+
+    @classmethod
+    def setUpClass(cls):
+
+        if not serverKeepsChangeLog():
+            raise unittest.SkipTest("the leveldb_server doesn't keep a change log, set LEVELDB_SERVER_CHANGE_LOG_ENTRIES to test replication")
+
+        cls.tempDir = tempfile.mkdtemp(prefix="leveldb_replica_tests_")
+
+        with socket.socket() as tmpSocket:
+            tmpSocket.bind(("127.0.0.1", 0))
+            cls.replicaPort = tmpSocket.getsockname()[1]
+
+        # the normal config, pointed at the leveldb_server we are testing, and with the replica somewhere temporary
+        testDir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(testDir, "constants_config.yaml"), encoding="utf-8") as f:
+            config = yaml.safe_load(f)
+
+        config.update({
+            "LEVELDB_SERVER_HOST": ipAddr,
+            "LEVELDB_SERVER_PORT": int(port),
+            "LEVELDB_SERVER_UNIX_SOCKET_PATH": unixSocketPath or "",
+            "LEVELDB_REPLICA_DB_PATH": os.path.join(cls.tempDir, "replicadb"),
+            "LEVELDB_REPLICA_HOST": "127.0.0.1",
+            "LEVELDB_REPLICA_PORT": cls.replicaPort,
+            "LEVELDB_REPLICA_UNIX_SOCKET_PATH": "",
+            "SERVERDATABASE_LOGGING_OUTPUT_TO_CONSOLE": True,
+            "SERVERDATABASE_LOGGING_LEVEL": "WARNING"})
+
+        configPath = os.path.join(cls.tempDir, "constants_config.yaml")
+        with open(configPath, "w", encoding="utf-8") as f:
+            yaml.safe_dump(config, f)
+
+        cls.replicaProcess = subprocess.Popen([sys.executable, os.path.join(testDir, "leveldb_replica.py"), configPath],
+            cwd=testDir, stdout=subprocess.DEVNULL)
+
+        # it only starts listening once it has copied everything
+        endTime = time.time() + 15
+        while True:
+            try:
+                cls.replicaDb = ServerDatabase("127.0.0.1", cls.replicaPort, logging.getLogger("UnitTest").getChild("ReplicaServerDatabase"))
+                break
+            except OSError:
+                if time.time() > endTime or cls.replicaProcess.poll() is not None:
+                    cls.tearDownClass()
+                    raise
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        cls.replicaDb = None
+        cls.replicaProcess.terminate()
+        cls.replicaProcess.wait()
+        shutil.rmtree(cls.tempDir, ignore_errors=True)
+
+    def testReplication(self):
+
+        sdb = ServerDatabase(ipAddr, port, logging.getLogger("UnitTest").getChild("ServerDatabase"), unixSocketPath)
+        replicaDb = TestLeveldbReplica.replicaDb
+
+        prefix = "REPLICA_" + "".join(random.sample(alphabet, 5)) + "_"
+
+        sdb[prefix + "a"] = "1"
+        with sdb.writeBatch() as batch:
+            batch[prefix + "b"] = "2"
+            batch[prefix + "c"] = "3"
+        del sdb[prefix + "c"]
+
+        endTime = time.time() + 5
+        while replicaDb.countWithPrefix("{}", [prefix]) != 2:
+            self.assertLess(time.time(), endTime, "timed out waiting for the replica")
+            time.sleep(0.02)
+
+        self.assertEqual(replicaDb.multiGet([prefix + "a", prefix + "b", prefix + "c"]), 
+            {prefix + "a": "1", prefix + "b": "2", prefix + "c": None})
+
+        with replicaDb.snapshot():
+            self.assertEqual(list(replicaDb.getGeneratorWithPrefix("{}", [prefix])), [(prefix + "a", "1"), (prefix + "b", "2")])
+
+        sdb.deleteAllInRange("{}", [prefix])
+
+        endTime = time.time() + 5
+        while replicaDb.countWithPrefix("{}", [prefix]) != 0:
+            self.assertLess(time.time(), endTime, "timed out waiting for the replica")
+            time.sleep(0.02)
+
+    def testReplicaIsReadOnly(self):
+
+        # the replica closes the connection after it tells us no, so use our own
+        replicaDb = ServerDatabase("127.0.0.1", TestLeveldbReplica.replicaPort)
+
+        with self.assertRaises(Exception):
+            replicaDb["REPLICA_WRITE"] = "nope"
 
 
 
@@ -0,0 +1,39 @@
+#
+# small helpers for logging in the hot paths of leveldb_server.py and server_database.py without
+# paying for it when nobody is going to read the log messages
+#
+
+import itertools
+import threading
+
+
+class RequestLogSampler:
+    ''' decides which requests get a line in the log. Logging every single request at INFO ends up costing
+    more then the leveldb call does, so we only log one out of every @sampleRate requests, along with
+    how many requests we have seen in total so the log still tells you how busy the server is.
+
+    This is safe to call from more then one thread (like the StorageScheduler's threads)'''
+
+    def __init__(self, sampleRate):
+        ''' constructor
+        @param sampleRate - log one out of every this many requests, 1 logs every request and 0 logs none of them'''
+
+        self.sampleRate = sampleRate
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        ''' counts a request, and sees if it should be logged
+
+        @return the number of the request (starting at 1) if it should be logged, or None if it shouldn't'''
+
+        if self.sampleRate <= 0:
+            return None
+
+        with self.lock:
+            requestNumber = next(self.counter)
+
+        if requestNumber % self.sampleRate == 0 or requestNumber == 1:
+            return requestNumber
+
+        return None
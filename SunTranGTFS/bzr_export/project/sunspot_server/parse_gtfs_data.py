@@ -6,7 +6,11 @@
 # database to the current version of the database
 #
 from constants import Constants
-from server_database import ServerDatabase, ServerDatabaseEnums
+from server_database import ServerDatabase, ServerDatabaseEnums, ServerDatabaseWriteBatch
+from spatial_index import createStopsGrid
+from service_calendar import createServiceDates
+from trip_predictions import createStopDepartures
+from journey_planner import createStopTransfers
 
 import logging
 import collections
@@ -46,7 +50,7 @@ class GTFSDataParser:
         logger = logger.getChild("parser")
         self.constants = Constants(args.constantsYamlPath)
         
-        sbObj = ServerDatabase(self.constants.CONFIG_DB_PATH, logger)
+        sbObj = ServerDatabase.fromConstants(self.constants, logger)
 
 
         if args.verbose:
@@ -79,6 +83,10 @@ class GTFSDataParser:
 
         logger.info("Are we skipping database generation? {}".format(downloadResult.zipFilePath is None))
         logger.info("Did we get a new database and generating new patches? {}".format(shouldGeneratePatches))
+
+        # everything we publish goes into this batch and gets written all at once at the end, so the sunspot_server
+        # never sees the new KEY_LAST_DOWNLOAD_TIME before the database location and patches that go with it
+        publishBatch = ServerDatabaseWriteBatch()
         
         ###################
         # FINDING DATABASE PATH
@@ -148,6 +156,14 @@ class GTFSDataParser:
             csvFilesDict["shapes"] = io.TextIOWrapper(gtfsZipFile.open("shapes.txt", "r"), encoding="utf-8", newline="")
             csvFilesDict["stop_times"] = io.TextIOWrapper(gtfsZipFile.open("stop_times.txt", "r"), encoding="utf-8", newline="")
 
+            # a feed only has to have one of these two
+            for iterName in ["calendar", "calendar_dates"]:
+                if iterName + ".txt" in gtfsZipFile.namelist():
+                    csvFilesDict[iterName] = io.TextIOWrapper(gtfsZipFile.open(iterName + ".txt", "r"), encoding="utf-8", newline="")
+                else:
+                    logger.info("the zip file doesn't have {}.txt".format(iterName))
+                    csvFilesDict[iterName] = None
+
             logger.debug("Opened txt files within zip files successfully")
 
             ####################
@@ -157,6 +173,20 @@ class GTFSDataParser:
             self.parseStopsTxt(cursor, csvFilesDict["stops"], logger)
             db.commit()
 
+            ####################
+            # put the stops into a grid, for finding the stops near somewhere
+            ####################
+
+            self.createStopsGrid(cursor, logger)
+            db.commit()
+
+            ####################
+            # work out which stops are close enough to walk between, for the journey planner
+            ####################
+
+            self.createStopTransfers(cursor, logger)
+            db.commit()
+
             ####################
             # parse the routes.txt file
             ####################
@@ -172,6 +202,15 @@ class GTFSDataParser:
             self.parseTrips(cursor, csvFilesDict["trips"], logger)
             db.commit()
 
+            ###################
+            # parse calendar.txt and calendar_dates.txt, and work out which days each service runs
+            ###################
+
+            self.parseCalendarTxt(cursor, csvFilesDict["calendar"], logger)
+            self.parseCalendarDatesTxt(cursor, csvFilesDict["calendar_dates"], logger)
+            self.createServiceDates(cursor, logger)
+            db.commit()
+
             ###################
             # parse stop_times.txt
             ###################
@@ -179,6 +218,13 @@ class GTFSDataParser:
             self.parseStopTimes(cursor, csvFilesDict["stop_times"], logger)
             db.commit()
 
+            ###################
+            # sort every stop's departures into its timetable
+            ###################
+
+            self.createStopDepartures(cursor, logger)
+            db.commit()
+
             ###################
             # parse shapes.txt
             ###################
@@ -211,48 +257,73 @@ class GTFSDataParser:
             logger.info("Inserting database path into config database")
 
             # insert the database's location into our config database
-            sbObj.setWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [databaseTime], sqliteResult.sqlitePath)
+            publishBatch.setWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [databaseTime], sqliteResult.sqlitePath)
 
             # then , create patches for every database version up to this one
 
+        stalePatchFiles = list()
         if shouldGeneratePatches:
-            self.createDbPatches(databaseTime, sqliteResult, sbObj, logger)
+            stalePatchFiles = self.createDbPatches(databaseTime, sqliteResult, sbObj, publishBatch, logger)
         else:
             logger.info("skipping patch generation")
 
+        # publish it all at once
+        publishBatch[ServerDatabaseEnums.KEY_LAST_DOWNLOAD_TIME] = str(databaseTime)
+
+        logger.info("Committing {} changes to the config database".format(len(publishBatch)))
+        sbObj.commitBatch(publishBatch)
+
+        # now that nothing in the config database points to the old patch files, we can delete them
+        for iterPatchFile in stalePatchFiles:
+            logger.debug("Deleting old patch file: {}".format(iterPatchFile))
+            iterPatchFile.unlink()
+
         logger.info("done")
         
 
 
-    def createDbPatches(self, generatedDbTime, sqliteResultObj, serverDbObj, logger):
+    def createDbPatches(self, generatedDbTime, sqliteResultObj, serverDbObj, publishBatch, logger):
         ''' this creates a patch file from every sqlite database we have generated (according to our ServerDatabase database),
         to the current one we just generated in this script (identified by generatedDbTime)
 
+        The patch entries don't get written to the ServerDatabase here, they get added to @publishBatch, so they
+        show up at the same time as the new database does
+
         @param generatedDbTime - the time / version of the database we just generated
         @param sqliteResultObj - the SqliteResult object , we need the path for the database
         @param serverDbObj - the ServerDatabase object
-        @param logger - the logger'''
+        @param publishBatch - the ServerDatabaseWriteBatch that we add the patch entries to
+        @param logger - the logger
+        @return a list of pathlib.Path objects of the old patch files that nothing will point to once @publishBatch
+            is committed, delete them after that'''
 
 
         lg = logger.getChild("patching")
 
-        # we start out by deleting everything in the db patches folder, and clearing any ServerDatabase keys
-        # that link to other patches. We do this because when this method is called, we are getting a new database
-        # and therefore we need to generate new patches anyway
-        for iterPatchFile in pathlib.Path(self.constants.DB_PATCHES_FOLDER).glob("*.bsdiff4"):
-            lg.debug("Deleting old patch file: {}".format(iterPatchFile))
-            iterPatchFile.unlink()
+        # we are getting a new database, so every patch entry in the ServerDatabase is getting replaced, and the 
+        # patch files they point to get deleted. But the sunspot_server might still be using them until @publishBatch 
+        # is committed, so just remember what they are for now
+        stalePatchFiles = set(pathlib.Path(self.constants.DB_PATCHES_FOLDER).glob("*.bsdiff4"))
 
-        lg.debug("Deleting old patch entries in server config db")
-        serverDbObj.deleteAllInRange(ServerDatabaseEnums.KEY_DB_PATCH_LETTER, [])
+        lg.debug("Deleting old patch entries in server config db (once the batch is committed)")
+        publishBatch.deleteAllInRange(ServerDatabaseEnums.KEY_DB_PATCH_LETTER, [])
 
 
         lg.info("Starting database patch creation, current database time is {}".format(generatedDbTime))
+
+        # get every database version we know about first, so we can look up all of their patch entries
+        # in one round trip to the leveldb_server instead of one per database version
+        dbVersionList = list()
         for iterKey, iterValue in serverDbObj.getGeneratorWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [""]):
 
-            tmpKeyStr = iterKey.decode("utf-8")
-            prevDbVersion = tmpKeyStr[tmpKeyStr.find(":") + 1:]
-            prevDbPath = iterValue.decode("utf-8")
+            # getGeneratorWithPrefix already decodes the keys and values for us
+            dbVersionList.append((iterKey[iterKey.find(":") + 1:], iterValue))
+
+        existingEntryList = serverDbObj.multiGetWithPrefix(ServerDatabaseEnums.PREFIX_DB_PATCH, 
+            [(iterVersion, generatedDbTime) for iterVersion, iterPath in dbVersionList])
+
+        for (prevDbVersion, prevDbPath), existingEntry in zip(dbVersionList, existingEntryList):
+
             lg.debug(" On key: '{}', value: '{}'".format(prevDbVersion, prevDbPath))
 
 
@@ -263,22 +334,16 @@ class GTFSDataParser:
                 continue
 
 
-            # see if we even need to generate a patch
-            existingEntry = None
-            keepGoing = False
-            try:
-                existingEntry = serverDbObj.getWithPrefix(ServerDatabaseEnums.PREFIX_DB_PATCH, [prevDbVersion, generatedDbTime])
-            except KeyError:
-                # doesn't exist, keep going
-                keepGoing = True
-
-            if not keepGoing:
+            # see if we even need to generate a patch, existingEntry is None if there is no patch entry
+            if existingEntry is not None:
                 # we have a database entry already, does the patch exist on filesystem?
                 existingPatchPath = pathlib.Path(existingEntry)
                 if existingPatchPath.exists():
-                    # don't need to generate a patch
+                    # don't need to generate a patch, but the batch deletes every patch entry, so add it back
                     lg.info("  patch already exists for database version {} to {} at {}, skipping"
                         .format(prevDbVersion, generatedDbTime, existingPatchPath))
+                    publishBatch.setWithPrefix(ServerDatabaseEnums.PREFIX_DB_PATCH, [prevDbVersion, generatedDbTime], existingEntry)
+                    stalePatchFiles.discard(existingPatchPath)
                     continue
                 else:
                     # shouldn't happen, but generate a patch as we don't have one on disk
@@ -287,8 +352,8 @@ class GTFSDataParser:
 
             lg.debug("  creating patch from database version {} to current version {}".format(prevDbVersion, generatedDbTime))
 
-            # get the path to the current database
-            curDbPath = serverDbObj.getWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [generatedDbTime])
+            # get the path to the current database, its entry might only be in publishBatch so far
+            curDbPath = sqliteResultObj.sqlitePath
 
             # where are we storing the patch?
             patchDir = pathlib.Path(self.constants.DB_PATCHES_FOLDER)
@@ -303,8 +368,11 @@ class GTFSDataParser:
             # src_path, dst_path, patch_path
             bsdiff4.file_diff(prevDbPath, curDbPath, str(patchPath))
 
-            # then save the fact that we have a patch into our config database
-            serverDbObj.setWithPrefix(ServerDatabaseEnums.PREFIX_DB_PATCH, [prevDbVersion, generatedDbTime], str(patchPath))
+            # then save the fact that we have a patch into our config database, once the batch is committed
+            publishBatch.setWithPrefix(ServerDatabaseEnums.PREFIX_DB_PATCH, [prevDbVersion, generatedDbTime], str(patchPath))
+            stalePatchFiles.discard(patchPath)
+
+        return sorted(stalePatchFiles)
 
             
 
@@ -369,8 +437,7 @@ class GTFSDataParser:
                             f.write(iterFileChunk)
                         logger.debug("\tFile written successfully")
 
-                    # set new modified date after we finished downloading
-                    sbObj[ServerDatabaseEnums.KEY_LAST_DOWNLOAD_TIME] = str(remoteDate.timestamp)
+                    # parse() sets the new KEY_LAST_DOWNLOAD_TIME once the database for it is ready, along with everything else
                     databaseTime = remoteDate.timestamp
 
                     return DownloadResult(self.constants.GTFS_ZIP_FILE_STRING, databaseTime)
@@ -463,6 +530,28 @@ class GTFSDataParser:
         sLogger.debug("inserted {} rows into stops table".format(counter))
 
 
+    def createStopsGrid(self, cursor, logger):
+        ''' creates the stops_grid table from the stops table, so the sunspot_server (and the app) can find the
+        stops near somewhere without going through every stop'''
+
+        gLogger = logger.getChild("stops_grid")
+
+        counter = createStopsGrid(cursor)
+
+        gLogger.debug("inserted {} rows into the stops_grid table".format(counter))
+
+
+    def createStopTransfers(self, cursor, logger):
+        ''' creates the stop_transfers table from the stops table, how long it takes to walk between the stops that
+        are close to each other, so the journey planner can change buses at stops that aren't the same stop'''
+
+        tLogger = logger.getChild("stop_transfers")
+
+        counter = createStopTransfers(cursor)
+
+        tLogger.debug("inserted {} rows into the stop_transfers table".format(counter))
+
+
     def parseTrips(self, cursor, tripsFileObj, logger):
         ''' parse trips.txt file object into the sqlite3 database '''
 
@@ -493,6 +582,78 @@ class GTFSDataParser:
         tLogger.debug("inserted {} rows into trips table".format(counter))
 
 
+    def parseCalendarTxt(self, cursor, calendarFileObj, logger):
+        ''' parse calendar.txt file object into the sqlite3 database, if the feed has one (the table is empty
+        if it doesn't)'''
+
+        cLogger = logger.getChild("calendar")
+
+        # create table
+        # service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date
+        cursor.execute('''CREATE TABLE calendar
+            (service_id TEXT, monday INTEGER, tuesday INTEGER, wednesday INTEGER, thursday INTEGER,
+            friday INTEGER, saturday INTEGER, sunday INTEGER, start_date TEXT, end_date TEXT)''')
+
+        cLogger.debug("calendar table created successfully")
+
+        if calendarFileObj is None:
+            return
+
+        calendarReader = csv.reader(calendarFileObj)
+        next(calendarReader) # skip first line of field names
+
+        # insert data
+        counter = 0
+        for iterRow in calendarReader:
+
+            cursor.execute('''INSERT INTO calendar VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', tuple(iterRow))
+            counter += 1
+
+        cLogger.debug("inserted {} rows into calendar table".format(counter))
+
+
+    def parseCalendarDatesTxt(self, cursor, calendarDatesFileObj, logger):
+        ''' parse calendar_dates.txt file object into the sqlite3 database, if the feed has one (the table is
+        empty if it doesn't)'''
+
+        cLogger = logger.getChild("calendar_dates")
+
+        # create table
+        # service_id,date,exception_type
+        cursor.execute('''CREATE TABLE calendar_dates
+            (service_id TEXT, date TEXT, exception_type INTEGER)''')
+
+        cLogger.debug("calendar_dates table created successfully")
+
+        if calendarDatesFileObj is None:
+            return
+
+        calendarDatesReader = csv.reader(calendarDatesFileObj)
+        next(calendarDatesReader) # skip first line of field names
+
+        # insert data
+        counter = 0
+        for iterRow in calendarDatesReader:
+
+            cursor.execute('''INSERT INTO calendar_dates VALUES
+                (?, ?, ?)''', tuple(iterRow))
+            counter += 1
+
+        cLogger.debug("inserted {} rows into calendar_dates table".format(counter))
+
+
+    def createServiceDates(self, cursor, logger):
+        ''' creates the service_dates table from the calendar and calendar_dates tables, so "which trips run
+        today" is a join against it instead of working out the calendar for every trip'''
+
+        sLogger = logger.getChild("service_dates")
+
+        counter = createServiceDates(cursor)
+
+        sLogger.debug("inserted {} rows into the service_dates table".format(counter))
+
+
     def parseStopTimes(self, cursor, stopTimesFileObj, logger):
         '''parse stop_times.txt file object into the sqlite3 database'''
 
@@ -523,6 +684,17 @@ class GTFSDataParser:
         stLogger.debug("inserted {} rows into stop_times table".format(counter))
 
 
+    def createStopDepartures(self, cursor, logger):
+        ''' creates the stop_departures table from the trips and stop_times tables, so the next buses to leave a
+        stop are an index lookup instead of going through (and parsing the text times of) all of its stop_times'''
+
+        dLogger = logger.getChild("stop_departures")
+
+        counter = createStopDepartures(cursor)
+
+        dLogger.debug("inserted {} rows into the stop_departures table".format(counter))
+
+
     def parseShapes(self, cursor, shapesFileObj, logger):
         ''' parse shapes.txt file object into the sqlite3 database'''
 
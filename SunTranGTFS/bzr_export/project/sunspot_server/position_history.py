@@ -0,0 +1,482 @@
+#
+# records where the buses have been, so we can look at on time performance (and make better predictions) later
+# instead of only ever knowing where they are now. The PositionRecorder listens to a RealtimeFeedPoller and keeps
+# every position that is different from the last one it kept for that bus, writing them out every
+# POSITION_RECORDER_BLOCK_SECONDS as a block at the end of that day's file (see protoc/position_history.proto).
+# The PositionArchive reads them back by vehicle, route and time, only reading the blocks that can have what was
+# asked for.
+#
+# Run this as its own process (like the leveldb_replica), so the positions are only recorded once no matter how
+# many sunspot_server processes there are:
+#
+#     python3 position_history.py /var/www/sunspot/constants_config.yaml
+#
+
+import argparse
+import bisect
+import collections
+import itertools
+import logging
+import os
+import signal
+import struct
+import sys
+import threading
+import zlib
+
+import google.protobuf.message # for DecodeError
+
+from position_history_pb2 import PositionHistory
+from realtime_delta import compactVehicle, COORDINATE_SCALE, SPEED_SCALE
+
+
+# a position read back from the PositionArchive, the coordinates and bearing are degrees and the speed is meters
+# per second, any of bearing, speed, tripId and routeId can be None if the feed didn't say
+RecordedPosition = collections.namedtuple("RecordedPosition",
+    ["label", "timestamp", "latitude", "longitude", "bearing", "speed", "tripId", "routeId"])
+
+# the length of the BlockIndex in front of each block
+_indexLength = struct.Struct(">I")
+
+# the file for each day (in the agency's timezone), YYYY-MM-DD
+FILE_NAME_FORMAT = "positions_{}.pb"
+
+
+def encodeBlock(positions):
+    ''' makes a block (the length, the BlockIndex and the compressed Block) out of some positions
+
+    @param positions - a list of (timestamp, realtime_delta.CompactVehicle) tuples
+    @return the bytes to append to the day's file'''
+
+    tracks = collections.defaultdict(list)
+    for iterTimestamp, iterVehicle in positions:
+        tracks[iterVehicle.label].append((iterTimestamp, iterVehicle))
+
+    # the trip_ids and route_ids, each one is only stored once and the tracks use its number
+    stringNumbers = dict()
+
+    def stringNumber(value):
+
+        if value is None:
+            return 0
+
+        number = stringNumbers.get(value)
+        if number is None:
+            number = stringNumbers[value] = len(stringNumbers) + 1
+
+        return number
+
+    block = PositionHistory.Block()
+
+    for iterLabel in sorted(tracks.keys()):
+
+        tmpTrack = block.tracks.add()
+        tmpTrack.label = iterLabel
+
+        lastTimestamp, lastLatitude, lastLongitude = 0, 0, 0
+
+        for iterTimestamp, iterVehicle in sorted(tracks[iterLabel], key=lambda position: position[0]):
+
+            tmpTrack.timestamps.append(iterTimestamp - lastTimestamp)
+            tmpTrack.latitudes.append(iterVehicle.latitude - lastLatitude)
+            tmpTrack.longitudes.append(iterVehicle.longitude - lastLongitude)
+            tmpTrack.bearings.append(iterVehicle.bearing + 1 if iterVehicle.bearing is not None else 0)
+            tmpTrack.speeds.append(iterVehicle.speed + 1 if iterVehicle.speed is not None else 0)
+            tmpTrack.trip_ids.append(stringNumber(iterVehicle.tripId))
+            tmpTrack.route_ids.append(stringNumber(iterVehicle.routeId))
+
+            lastTimestamp, lastLatitude, lastLongitude = iterTimestamp, iterVehicle.latitude, iterVehicle.longitude
+
+    block.strings.extend(sorted(stringNumbers.keys(), key=stringNumbers.get))
+
+    blockBytes = zlib.compress(block.SerializeToString())
+
+    index = PositionHistory.BlockIndex()
+    index.start_time = min(iterPosition[0] for iterPosition in positions)
+    index.end_time = max(iterPosition[0] for iterPosition in positions)
+    index.vehicle_labels.extend(sorted(tracks.keys()))
+    index.route_ids.extend(sorted(set(iterVehicle.routeId for iterTimestamp, iterVehicle in positions if iterVehicle.routeId is not None)))
+    index.block_length = len(blockBytes)
+    index.compressed = True
+
+    indexBytes = index.SerializeToString()
+
+    return b"".join([_indexLength.pack(len(indexBytes)), indexBytes, blockBytes])
+
+
+def decodeBlock(block, startTime, endTime, label=None, routeId=None):
+    ''' the positions in a Block that are between @startTime and @endTime (and for @label / @routeId, if they
+    aren't None)
+
+    @param block - the PositionHistory.Block
+    @return a list of RecordedPositions'''
+
+    strings = [None] + list(block.strings)
+
+    # what the route_ids column has for @routeId
+    if routeId is not None:
+        if routeId not in block.strings:
+            return []
+        routeNumber = strings.index(routeId)
+
+    positions = list()
+
+    for iterTrack in block.tracks:
+
+        if label is not None and iterTrack.label != label:
+            continue
+
+        # each track is sorted by time, so only the rows between these two are in the time range
+        timestamps = list(itertools.accumulate(iterTrack.timestamps))
+        firstRow = bisect.bisect_left(timestamps, startTime)
+        endRow = bisect.bisect_right(timestamps, endTime)
+
+        if firstRow >= endRow:
+            continue
+
+        # the deltas have to be added up from the start even for the rows we don't want
+        latitudes = list(itertools.accumulate(iterTrack.latitudes[:endRow]))
+        longitudes = list(itertools.accumulate(iterTrack.longitudes[:endRow]))
+        bearings = iterTrack.bearings[firstRow:endRow]
+        speeds = iterTrack.speeds[firstRow:endRow]
+        tripIds = iterTrack.trip_ids[firstRow:endRow]
+        routeIds = iterTrack.route_ids[firstRow:endRow]
+
+        for iterRow in range(firstRow, endRow):
+
+            columnRow = iterRow - firstRow
+
+            if routeId is not None and routeIds[columnRow] != routeNumber:
+                continue
+
+            bearing = bearings[columnRow]
+            speed = speeds[columnRow]
+
+            positions.append(RecordedPosition(iterTrack.label, timestamps[iterRow],
+                latitudes[iterRow] / COORDINATE_SCALE, longitudes[iterRow] / COORDINATE_SCALE,
+                bearing - 1 if bearing else None, (speed - 1) / SPEED_SCALE if speed else None,
+                strings[tripIds[columnRow]], strings[routeIds[columnRow]]))
+
+    return positions
+
+
+def _blockIndexes(f):
+    ''' goes through the BlockIndexes of a day's file, stopping at a block that didn't get completely written (if
+    we died while writing it)
+
+    @param f - the file, opened in binary mode
+    @return a generator of (BlockIndex, where its Block starts) tuples'''
+
+    fileLength = os.fstat(f.fileno()).st_size
+    offset = 0
+
+    while offset + _indexLength.size <= fileLength:
+
+        f.seek(offset)
+        indexLength, = _indexLength.unpack(f.read(_indexLength.size))
+
+        blockOffset = offset + _indexLength.size + indexLength
+        if blockOffset > fileLength:
+            return
+
+        try:
+            index = PositionHistory.BlockIndex.FromString(f.read(indexLength))
+        except google.protobuf.message.DecodeError:
+            return
+
+        if blockOffset + index.block_length > fileLength:
+            return
+
+        yield (index, blockOffset)
+
+        offset = blockOffset + index.block_length
+
+
+class PositionArchive:
+    ''' the per day files of recorded positions in a directory'''
+
+    def __init__(self, directory, timezone):
+        ''' constructor
+
+        @param directory - where the files are
+        @param timezone - the agency's timezone name, for which day a position is in'''
+
+        self.directory = directory
+        self.timezone = timezone
+
+        # the files we have checked for a half written block at the end (see appendPositions())
+        self.checkedPaths = set()
+        self.lock = threading.Lock()
+
+    def dayOf(self, timestamp):
+        ''' which day's file a timestamp goes in
+
+        @param timestamp - seconds since the epoch
+        @return 'YYYY-MM-DD' in the agency's timezone'''
+
+        import arrow
+
+        return arrow.get(timestamp).to(self.timezone).format("YYYY-MM-DD")
+
+    def dayPath(self, day):
+        ''' the file for a day
+
+        @param day - the 'YYYY-MM-DD' from dayOf()
+        @return the path'''
+
+        return os.path.join(self.directory, FILE_NAME_FORMAT.format(day))
+
+    def appendPositions(self, positions):
+        ''' writes some positions as a new block at the end of each day's file that they are in
+
+        @param positions - a list of (timestamp, realtime_delta.CompactVehicle) tuples
+        @return how many bytes were written, or raises OSError'''
+
+        days = dict()
+        positionsByDay = collections.defaultdict(list)
+
+        for iterTimestamp, iterVehicle in positions:
+
+            day = days.get(iterTimestamp)
+            if day is None:
+                day = days[iterTimestamp] = self.dayOf(iterTimestamp)
+
+            positionsByDay[day].append((iterTimestamp, iterVehicle))
+
+        bytesWritten = 0
+
+        with self.lock:
+
+            os.makedirs(self.directory, exist_ok=True)
+
+            for iterDay, iterPositions in sorted(positionsByDay.items()):
+
+                path = self.dayPath(iterDay)
+                blockBytes = encodeBlock(iterPositions)
+
+                with open(path, "ab") as f:
+
+                    # if a process died half way through writing a block, anything after it would never be read
+                    if path not in self.checkedPaths:
+                        self._truncateDamaged(f)
+                        self.checkedPaths.add(path)
+
+                    f.write(blockBytes)
+
+                bytesWritten += len(blockBytes)
+
+        return bytesWritten
+
+    def _truncateDamaged(self, f):
+        ''' cuts off a block that didn't get completely written at the end of a file
+
+        @param f - the file, opened for appending'''
+
+        with open(f.name, "rb") as readFile:
+
+            goodLength = 0
+            for iterIndex, iterBlockOffset in _blockIndexes(readFile):
+                goodLength = iterBlockOffset + iterIndex.block_length
+
+        if goodLength < os.fstat(f.fileno()).st_size:
+            logging.getLogger("PositionArchive").warning("%s has a half written block at the end, cutting it off at %s bytes",
+                f.name, goodLength)
+            f.truncate(goodLength)
+
+    def days(self, startTime, endTime):
+        ''' the days between two times
+
+        @param startTime - seconds since the epoch
+        @param endTime - seconds since the epoch
+        @return a list of 'YYYY-MM-DD' '''
+
+        import arrow
+
+        startDay = arrow.get(startTime).to(self.timezone).floor("day")
+        endDay = arrow.get(endTime).to(self.timezone).floor("day")
+
+        return [iterDay.format("YYYY-MM-DD") for iterDay in arrow.Arrow.range("day", startDay, endDay)]
+
+    def read(self, startTime, endTime, label=None, routeId=None):
+        ''' the recorded positions between two times, of one vehicle and / or route if they aren't None. Only the
+        days' files between the times are opened, and only the blocks whose index says they have positions in the
+        time range (and of the vehicle / route) are read
+
+        @param startTime - seconds since the epoch
+        @param endTime - seconds since the epoch, including positions at this time
+        @param label - the vehicle label, or None for every vehicle
+        @param routeId - the route_id, or None for every route
+        @return a list of RecordedPositions, sorted by timestamp and label'''
+
+        positions = list()
+
+        for iterDay in self.days(startTime, endTime):
+
+            try:
+                f = open(self.dayPath(iterDay), "rb")
+            except FileNotFoundError:
+                continue
+
+            with f:
+
+                for iterIndex, iterBlockOffset in _blockIndexes(f):
+
+                    if iterIndex.end_time < startTime or iterIndex.start_time > endTime:
+                        continue
+                    if label is not None and label not in iterIndex.vehicle_labels:
+                        continue
+                    if routeId is not None and routeId not in iterIndex.route_ids:
+                        continue
+
+                    f.seek(iterBlockOffset)
+                    blockBytes = f.read(iterIndex.block_length)
+
+                    if iterIndex.compressed:
+                        blockBytes = zlib.decompress(blockBytes)
+
+                    positions.extend(decodeBlock(PositionHistory.Block.FromString(blockBytes), startTime, endTime, label, routeId))
+
+        positions.sort(key=lambda position: (position.timestamp, position.label))
+
+        return positions
+
+
+class PositionRecorder:
+    ''' keeps every new position of every bus from a RealtimeFeedPoller, and writes them to a PositionArchive every
+    @blockSeconds. A bus that hasn't moved and hasn't sent a new report (its CompactVehicle is the same as last
+    time) isn't kept again. Positions that haven't been written yet are lost if the process dies'''
+
+    def __init__(self, poller, archive, blockSeconds, logger=None):
+        ''' constructor, starts listening to @poller
+
+        @param poller - the RealtimeFeedPoller of the VehiclePositions feed
+        @param archive - the PositionArchive
+        @param blockSeconds - how often to write what we have
+        @param logger - a logging.Logger'''
+
+        self.poller = poller
+        self.archive = archive
+        self.blockSeconds = blockSeconds
+        self.lg = logger if logger is not None else logging.getLogger("PositionRecorder")
+
+        self.lock = threading.Lock()
+
+        # vehicle label -> the CompactVehicle we kept last
+        self.lastPositions = dict()
+
+        # the (timestamp, CompactVehicle) tuples that haven't been written yet, and when we got the first of them
+        self.positions = list()
+        self.blockStartTime = None
+
+        poller.addListener(self._onSnapshot)
+
+    def _onSnapshot(self, oldSnapshot, newSnapshot):
+        ''' called (on the poller's thread) when the feed changes
+
+        @param oldSnapshot - the VehicleSnapshot before, or None
+        @param newSnapshot - the new VehicleSnapshot'''
+
+        with self.lock:
+
+            for iterLabel, iterVehicle in newSnapshot.vehicles.items():
+
+                vehicle = compactVehicle(iterVehicle)
+
+                if self.lastPositions.get(iterLabel) == vehicle:
+                    continue
+
+                self.lastPositions[iterLabel] = vehicle
+
+                # when the bus reported its position if the feed says, otherwise when we downloaded the feed
+                self.positions.append((int(iterVehicle.timestamp or newSnapshot.fetchedTime), vehicle))
+
+            if self.positions and self.blockStartTime is None:
+                self.blockStartTime = newSnapshot.fetchedTime
+
+            if self.blockStartTime is not None and newSnapshot.fetchedTime - self.blockStartTime >= self.blockSeconds:
+                self._flush()
+
+    def flush(self):
+        ''' writes what we have now, instead of waiting for the block to fill up'''
+
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        ''' writes self.positions to the archive, call this with self.lock held'''
+
+        if not self.positions:
+            return
+
+        try:
+            bytesWritten = self.archive.appendPositions(self.positions)
+        except OSError as e:
+            # keep them and try again with the next block
+            self.lg.error("couldn't write %s positions to %s: %s", len(self.positions), self.archive.directory, e)
+            return
+
+        self.lg.info("wrote %s positions in %s bytes", len(self.positions), bytesWritten)
+
+        self.positions = list()
+        self.blockStartTime = None
+
+
+def startPositionRecorder(args):
+    ''' downloads the VehiclePositions feed and records the positions until we get killed
+    @param args - the namespace object we get from argparse.parse_args()
+    '''
+
+    from constants import Constants
+    from leveldb_server import configureLogging
+    from realtime_feed import RealtimeFeedPoller
+
+    constantsObj = Constants(args.configYaml)
+
+    recorderLogger = configureLogging(constantsObj, constantsObj.POSITION_RECORDER_LOGGING_OUTPUT_NAME).getChild("PositionRecorder")
+
+    poller = RealtimeFeedPoller(constantsObj.REALTIME_VEHICLE_POSITIONS_URL, constantsObj.REALTIME_POLL_INTERVAL,
+        constantsObj.REALTIME_REQUEST_TIMEOUT, recorderLogger.getChild("realtime"))
+    recorder = PositionRecorder(poller, PositionArchive(constantsObj.POSITION_RECORDER_DIRECTORY, constantsObj.GTFS_TIMEZONE),
+        constantsObj.POSITION_RECORDER_BLOCK_SECONDS, recorderLogger)
+
+    # write what we have before going away when we get stopped
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: stopped.set())
+
+    poller.start()
+    recorderLogger.info("recording positions from %s to %s every %s seconds", poller.url, constantsObj.POSITION_RECORDER_DIRECTORY,
+        constantsObj.POSITION_RECORDER_BLOCK_SECONDS)
+
+    try:
+        # with a timeout, or KeyboardInterrupt doesn't get through
+        while not stopped.wait(60):
+            pass
+    except KeyboardInterrupt:
+        print("exit")
+    finally:
+        recorderLogger.info("stopping the poller and writing what we have")
+        poller.stop()
+        recorder.flush()
+
+
+if __name__ == "__main__":
+    # if we are being run as a real program
+
+    from leveldb_server import isYamlType
+
+    parser = argparse.ArgumentParser(description="Records the positions of the buses from the GTFS realtime feed")
+
+    parser.add_argument('configYaml',  type=isYamlType, help="the YAML config file that is meant for the Constants class")
+
+    argparseLg = logging.getLogger("argparse")
+
+    try:
+        startPositionRecorder(parser.parse_args())
+    except Exception as e:
+        argparseLg.exception("uncaught exception: %s", e)
+        logging.shutdown()
+        sys.exit(1)
+
+    # exiting normally
+    argparseLg.info("Shutting down normally")
+    logging.shutdown()
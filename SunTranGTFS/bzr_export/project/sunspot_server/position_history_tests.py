@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# tests for position_history.py, records made up versions of the VehiclePositions feed to a temporary directory
+# and reads them back
+#
+
+import unittest
+import os
+import shutil
+import tempfile
+
+from realtime_feed import VehicleSnapshot
+from position_history import PositionArchive, PositionRecorder, _blockIndexes
+from test_fixtures import TIMEZONE, NOW, StandInPoller, createFeedBytes
+
+
+class TestPositionHistory(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        self.archive = PositionArchive(self.directory, TIMEZONE)
+
+        self.poller = StandInPoller()
+        self.recorder = PositionRecorder(self.poller, self.archive, 60)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def setFeed(self, vehicles, feedTimestamp, routeIds=None):
+        self.poller.setSnapshot(VehicleSnapshot.fromFeedBytes(createFeedBytes(vehicles, feedTimestamp,
+            routeIds or ["4"] * len(vehicles)), feedTimestamp))
+
+    def testRoundTrip(self):
+
+        # bus 100 drives north on route 4 every 15 seconds, bus 200 sits still on route 8
+        for iterNumber in range(10):
+            self.setFeed([("100", 32.2 + iterNumber / 1000, -110.9), ("200", 32.3, -110.8)], NOW + iterNumber * 15, ["4", "8"])
+
+        self.recorder.flush()
+
+        # written in blocks of 60 seconds, the first one at NOW + 60 and the second at NOW + 135, so flush() had
+        # nothing left to write
+        with open(self.archive.dayPath(self.archive.dayOf(NOW)), "rb") as f:
+            self.assertEqual([(iterIndex.start_time - NOW, iterIndex.end_time - NOW) for iterIndex, iterOffset in _blockIndexes(f)],
+                [(0, 60), (75, 135)])
+
+        positions = self.archive.read(NOW, NOW + 3600)
+        self.assertEqual(len(positions), 20)
+
+        busPositions = self.archive.read(NOW, NOW + 3600, label="100")
+        self.assertEqual([iterPosition.timestamp for iterPosition in busPositions], [NOW + iterNumber * 15 for iterNumber in range(10)])
+        self.assertAlmostEqual(busPositions[-1].latitude, 32.209, places=5)
+        self.assertAlmostEqual(busPositions[-1].longitude, -110.9, places=5)
+        self.assertEqual(busPositions[-1].routeId, "4")
+        self.assertIsNone(busPositions[-1].bearing)
+
+        # by route and time
+        routePositions = self.archive.read(NOW + 20, NOW + 50, routeId="8")
+        self.assertEqual([(iterPosition.label, iterPosition.timestamp) for iterPosition in routePositions],
+            [("200", NOW + 30), ("200", NOW + 45)])
+
+        self.assertEqual(self.archive.read(NOW, NOW + 3600, label="999"), [])
+        self.assertEqual(self.archive.read(NOW - 7200, NOW - 1), [])
+
+    def testOnlyKeepsNewPositions(self):
+
+        # the same version of the feed twice is only recorded once
+        self.setFeed([("100", 32.2, -110.9)], NOW)
+        self.setFeed([("100", 32.2, -110.9)], NOW)
+        self.recorder.flush()
+
+        self.assertEqual(len(self.archive.read(NOW - 60, NOW + 60)), 1)
+
+        # and nothing is written if nothing changed
+        self.setFeed([("100", 32.2, -110.9)], NOW)
+        self.recorder.flush()
+
+        with open(self.archive.dayPath(self.archive.dayOf(NOW)), "rb") as f:
+            self.assertEqual(len(list(_blockIndexes(f))), 1)
+
+    def testAcrossDays(self):
+
+        # 11:59:50 PM and then 00:00:05 AM, Tucson time
+        midnight = NOW + 16 * 3600
+        self.setFeed([("100", 32.2, -110.9)], midnight - 10)
+        self.setFeed([("100", 32.21, -110.9)], midnight + 5)
+        self.recorder.flush()
+
+        self.assertEqual(sorted(os.listdir(self.directory)), ["positions_2014-08-22.pb", "positions_2014-08-23.pb"])
+        self.assertEqual([iterPosition.timestamp for iterPosition in self.archive.read(midnight - 60, midnight + 60)],
+            [midnight - 10, midnight + 5])
+
+    def testHalfWrittenBlock(self):
+
+        self.setFeed([("100", 32.2, -110.9)], NOW)
+        self.recorder.flush()
+
+        path = self.archive.dayPath(self.archive.dayOf(NOW))
+        goodLength = os.path.getsize(path)
+
+        # like we died part way through writing the next block
+        with open(path, "ab") as f:
+            f.write(b"\x00\x00\x00\x20garbage")
+
+        self.assertEqual(len(self.archive.read(NOW - 60, NOW + 60)), 1)
+
+        # a new process cuts it off before it writes anything else
+        recorder = PositionRecorder(self.poller, PositionArchive(self.directory, TIMEZONE), 60)
+        self.setFeed([("100", 32.3, -110.9)], NOW + 15)
+        recorder.flush()
+
+        self.assertGreater(os.path.getsize(path), goodLength)
+        self.assertEqual(len(self.archive.read(NOW - 60, NOW + 60, label="100")), 2)
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
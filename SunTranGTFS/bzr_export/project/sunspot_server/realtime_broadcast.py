@@ -0,0 +1,223 @@
+#
+# pushes realtime vehicle positions to clients instead of them asking over and over. The RealtimeBroadcaster
+# listens to the RealtimeFeedPoller, works out which vehicles and routes changed in each new version of the feed,
+# and wakes up only the requests (long polls, or server sent event streams) that are waiting on one of those.
+# sunspot_server.py's RealtimeSubscribe is the cherrypy side of it
+#
+
+import collections
+import json
+import threading
+import time
+
+
+# what a subscription can ask about, a vehicle (by label) or a route (by route_id)
+KEY_VEHICLE = "vehicle"
+KEY_ROUTE = "route"
+
+
+class RealtimeBroadcaster:
+    ''' keeps a version number that goes up every time the feed changes, and the version each vehicle and route
+    last changed at, so a client that says "I have version X of vehicle 100 and route 4" can be told about
+    (or wait for) anything newer.
+
+    The version is the timestamp in the feed's header, so every process (each mod_wsgi process has its own poller
+    and broadcaster) agrees on it, and a client whose next request lands on another process picks up where it
+    left off. A process that is a poll behind just waits until it sees something newer. A version that isn't a
+    number at all waits for the next change too, only a client without one gets everything straight away'''
+
+    def __init__(self, poller):
+        ''' constructor, starts listening to @poller
+
+        @param poller - the RealtimeFeedPoller'''
+
+        self.poller = poller
+
+        self.lock = threading.Lock()
+
+        # the version of the newest feed (its header timestamp), and the newest VehicleSnapshot
+        self.versionNumber = 0
+        self.snapshot = None
+
+        # (KEY_VEHICLE, label) or (KEY_ROUTE, route_id) -> the versionNumber it last changed at
+        self.keyVersions = dict()
+
+        # same kind of key -> set of threading.Events of the requests waiting on it
+        self.waiters = collections.defaultdict(set)
+
+        poller.addListener(self._onSnapshot)
+
+        # the poller might already have a snapshot, which it won't tell us about
+        currentSnapshot = poller.snapshot
+        if currentSnapshot is not None:
+            self._onSnapshot(None, currentSnapshot)
+
+    def version(self, versionNumber=None):
+        ''' the version string for a version number
+
+        @param versionNumber - the number, or None for the newest one
+        @return the version string'''
+
+        return str(self.versionNumber if versionNumber is None else versionNumber)
+
+    def _parseVersion(self, versionString):
+        ''' the version number of a version string that a client gave us, call this with self.lock held
+
+        @param versionString - the string, or None
+        @return the number, None if the client doesn't have one, or the newest version if its not a version
+            at all (like one from before versions were feed timestamps), so the client waits for the next change'''
+
+        if not versionString:
+            return None
+
+        if not versionString.isdigit():
+            return self.versionNumber
+
+        return int(versionString)
+
+    def _snapshotVersion(self, snapshot):
+        ''' the version number for a new VehicleSnapshot, call this with self.lock held
+
+        @param snapshot - the VehicleSnapshot
+        @return the number'''
+
+        versionNumber = int(snapshot.feedTimestamp or snapshot.fetchedTime)
+
+        # a feed whose header timestamp didn't go forward but whose vehicles changed anyway (or one without
+        # a timestamp) still has to get a newer version. Other processes might not agree on this one, which
+        # only means a client that moves between them gets a bit more, or waits a bit longer, then it has to
+        return max(versionNumber, self.versionNumber + 1)
+
+    def _onSnapshot(self, oldSnapshot, newSnapshot):
+        ''' called (on the poller's thread) when the feed changes, finds the vehicles and routes that are different
+        and wakes up whoever is waiting on them
+
+        @param oldSnapshot - the VehicleSnapshot before, or None
+        @param newSnapshot - the new VehicleSnapshot'''
+
+        with self.lock:
+
+            # the poller's old snapshot might not be the one we have, if it got one before we started listening
+            oldSnapshot = self.snapshot
+
+            changedKeys = set()
+
+            oldVehicles = oldSnapshot.vehicles if oldSnapshot is not None else dict()
+            for iterLabel in set(oldVehicles.keys()) | set(newSnapshot.vehicles.keys()):
+                if oldVehicles.get(iterLabel) != newSnapshot.vehicles.get(iterLabel):
+                    changedKeys.add((KEY_VEHICLE, iterLabel))
+
+            # VehiclePositions compare by value, so this is any bus on the route moving, coming or going
+            oldRoutes = oldSnapshot.vehiclesByRoute if oldSnapshot is not None else dict()
+            for iterRouteId in set(oldRoutes.keys()) | set(newSnapshot.vehiclesByRoute.keys()):
+                if oldRoutes.get(iterRouteId) != newSnapshot.vehiclesByRoute.get(iterRouteId):
+                    changedKeys.add((KEY_ROUTE, iterRouteId))
+
+            self.versionNumber = self._snapshotVersion(newSnapshot)
+            self.snapshot = newSnapshot
+
+            wakeUp = set()
+            for iterKey in changedKeys:
+                self.keyVersions[iterKey] = self.versionNumber
+                wakeUp.update(self.waiters.get(iterKey, ()))
+
+        for iterEvent in wakeUp:
+            iterEvent.set()
+
+    def _changedSince(self, keys, sinceNumber):
+        ''' which of @keys changed after version @sinceNumber, call this with self.lock held'''
+
+        return [iterKey for iterKey in keys if self.keyVersions.get(iterKey, 0) > sinceNumber]
+
+    def waitForChange(self, keys, since, timeout):
+        ''' waits until one of @keys changes after the version @since, or @timeout seconds go by
+
+        @param keys - a list of (KEY_VEHICLE, label) / (KEY_ROUTE, route_id) tuples
+        @param since - the version string the client has, or None if it doesn't have one, in which case it gets all
+            of @keys straight away
+        @param timeout - how many seconds to wait
+        @return (the version string, the VehicleSnapshot, the list of keys that changed), an empty list if we
+            timed out'''
+
+        endTime = time.time() + timeout
+        event = threading.Event()
+
+        with self.lock:
+
+            sinceNumber = self._parseVersion(since)
+
+            if sinceNumber is None:
+                return (self.version(), self.snapshot, list(keys))
+
+            changedKeys = self._changedSince(keys, sinceNumber)
+            if changedKeys:
+                return (self.version(), self.snapshot, changedKeys)
+
+            for iterKey in keys:
+                self.waiters[iterKey].add(event)
+
+        try:
+            while True:
+
+                timeLeft = endTime - time.time()
+                if timeLeft <= 0 or not event.wait(timeLeft):
+                    break
+
+                # if this process was behind the one that gave the client its version, catching up to that version
+                # wakes us up without anything being newer then it, so keep waiting
+                with self.lock:
+                    changedKeys = self._changedSince(keys, sinceNumber)
+                    if changedKeys:
+                        break
+                    event.clear()
+
+        finally:
+            with self.lock:
+
+                for iterKey in keys:
+                    keyWaiters = self.waiters.get(iterKey)
+                    if keyWaiters is not None:
+                        keyWaiters.discard(event)
+                        if not keyWaiters:
+                            del self.waiters[iterKey]
+
+        with self.lock:
+
+            # a client that is ahead of this process keeps its own version, so it doesn't get sent what it already has
+            return (self.version(max(self.versionNumber, sinceNumber)), self.snapshot, self._changedSince(keys, sinceNumber))
+
+
+def updateJson(version, snapshot, changedKeys):
+    ''' the JSON that a subscriber gets, made out of the JSON that the snapshot already serialized:
+
+        {"version": "...", "vehicles": [<vehicle>, ...], "gone_vehicles": ["label", ...], "routes": [<route>, ...]}
+
+    where <vehicle> is what tmpFindBus returns and <route> is what /vehicles?route= returns
+
+    @param version - the version string
+    @param snapshot - the VehicleSnapshot
+    @param changedKeys - the (KEY_VEHICLE, label) / (KEY_ROUTE, route_id) keys to include
+    @return the JSON as bytes'''
+
+    vehicleParts = list()
+    goneVehicles = list()
+    routeParts = list()
+
+    for iterKind, iterId in sorted(changedKeys):
+
+        if iterKind == KEY_VEHICLE:
+
+            vehicleJson = snapshot.vehicleJson.get(iterId) if snapshot is not None else None
+
+            if vehicleJson is None:
+                goneVehicles.append(iterId)
+            else:
+                vehicleParts.append(vehicleJson)
+
+        elif snapshot is not None:
+            routeParts.append(snapshot.routeJson.get(iterId) or snapshot.vehicleListJson("route_id", iterId, ()))
+
+    return b"".join([b'{"version": ', json.dumps(version).encode("utf-8"),
+        b', "vehicles": [', b", ".join(vehicleParts),
+        b'], "gone_vehicles": ', json.dumps(goneVehicles).encode("utf-8"),
+        b', "routes": [', b", ".join(routeParts), b"]}"])
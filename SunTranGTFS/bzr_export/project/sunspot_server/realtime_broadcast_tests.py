@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# tests for realtime_broadcast.py, feeds VehicleSnapshots straight to the broadcaster instead of running a poller
+#
+
+import unittest
+import json
+import threading
+import time
+
+from realtime_feed import VehicleSnapshot
+from realtime_broadcast import RealtimeBroadcaster, updateJson, KEY_VEHICLE, KEY_ROUTE
+from test_fixtures import StandInPoller, createFeedBytes
+
+
+class TestRealtimeBroadcaster(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.poller = StandInPoller()
+        self.setFeed(self.poller, [("100", 32.2, -110.9), ("200", 32.3, -110.8)], ["4", "8"], 1000)
+
+        self.broadcaster = RealtimeBroadcaster(self.poller)
+
+    def setFeed(self, poller, vehicles, routeIds, feedTimestamp):
+        ''' does what a new version of the feed does'''
+
+        poller.setSnapshot(VehicleSnapshot.fromFeedBytes(createFeedBytes(vehicles, feedTimestamp, routeIds), feedTimestamp))
+
+    def testFirstRequestGetsEverything(self):
+
+        version, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_VEHICLE, "100"), (KEY_ROUTE, "8")], None, 5)
+
+        self.assertIs(snapshot, self.poller.snapshot)
+        self.assertEqual(changedKeys, [(KEY_VEHICLE, "100"), (KEY_ROUTE, "8")])
+
+        update = json.loads(updateJson(version, snapshot, changedKeys).decode("utf-8"))
+        self.assertEqual(update["version"], version)
+        self.assertEqual([iterVehicle["vehicle"] for iterVehicle in update["vehicles"]], ["100"])
+        self.assertEqual(update["routes"][0]["route_id"], "8")
+        self.assertEqual(update["gone_vehicles"], [])
+
+    def testOnlyWakesForItsKeys(self):
+
+        version, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_VEHICLE, "100")], None, 5)
+
+        # bus 200 (on route 8) moves, bus 100 doesn't (not even its timestamp), so a long poll on 100 times out
+        # with nothing
+        self.setFeed(self.poller, [("100", 32.2, -110.9), ("200", 32.31, -110.8)], ["4", "8"], 1000)
+
+        startTime = time.time()
+        newVersion, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_VEHICLE, "100")], version, 0.2)
+
+        self.assertEqual(changedKeys, [])
+        self.assertGreaterEqual(time.time() - startTime, 0.15)
+
+        # but route 8 did change since that version
+        otherVersion, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_ROUTE, "8"), (KEY_ROUTE, "4")], version, 5)
+        self.assertEqual(changedKeys, [(KEY_ROUTE, "8")])
+
+        # and asking again with the version we got back waits again
+        otherVersion, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_ROUTE, "8")], otherVersion, 0.05)
+        self.assertEqual(changedKeys, [])
+
+    def testWakesUpWaiters(self):
+
+        version, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_VEHICLE, "200")], None, 5)
+
+        results = list()
+        waiters = [threading.Thread(target=lambda: results.append(self.broadcaster.waitForChange([(KEY_VEHICLE, "200")], version, 10)))
+            for i in range(5)]
+
+        for iterThread in waiters:
+            iterThread.start()
+
+        # let them all start waiting, then bus 200 leaves
+        time.sleep(0.1)
+        startTime = time.time()
+        self.setFeed(self.poller, [("100", 32.2, -110.9)], ["4"], 1030)
+
+        for iterThread in waiters:
+            iterThread.join(5)
+
+        self.assertLess(time.time() - startTime, 5)
+        self.assertEqual(len(results), 5)
+
+        for iterVersion, iterSnapshot, iterChangedKeys in results:
+
+            self.assertEqual(iterChangedKeys, [(KEY_VEHICLE, "200")])
+
+            update = json.loads(updateJson(iterVersion, iterSnapshot, iterChangedKeys).decode("utf-8"))
+            self.assertEqual(update["gone_vehicles"], ["200"])
+
+        # nobody is left waiting
+        self.assertEqual(len(self.broadcaster.waiters), 0)
+
+    def testVersionIsTheFeedTimestamp(self):
+
+        version, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_VEHICLE, "100")], None, 5)
+        self.assertEqual(version, "1000")
+
+        # a feed whose timestamp didn't go forward still gets a newer version
+        self.setFeed(self.poller, [("100", 32.25, -110.9)], ["4"], 1000)
+        version, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_VEHICLE, "100")], version, 5)
+        self.assertEqual((version, changedKeys), ("1001", [(KEY_VEHICLE, "100")]))
+
+    def testUnknownVersionWaits(self):
+
+        # like a version from before versions were feed timestamps, it waits for the next change instead of
+        # getting everything straight away (which would make the client poll as fast as it can)
+        startTime = time.time()
+        version, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_VEHICLE, "100")], "deadbeef.5", 0.2)
+
+        self.assertEqual((version, changedKeys), ("1000", []))
+        self.assertGreaterEqual(time.time() - startTime, 0.15)
+
+    def testOtherProcess(self):
+
+        # another process, with its own poller and broadcaster, that hasn't seen the newest feed yet
+        otherPoller = StandInPoller()
+        self.setFeed(otherPoller, [("100", 32.2, -110.9), ("200", 32.3, -110.8)], ["4", "8"], 1000)
+        otherBroadcaster = RealtimeBroadcaster(otherPoller)
+
+        self.setFeed(self.poller, [("100", 32.25, -110.9), ("200", 32.3, -110.8)], ["4", "8"], 1030)
+        version, snapshot, changedKeys = self.broadcaster.waitForChange([(KEY_VEHICLE, "100")], None, 5)
+
+        # the client's next long poll lands on the other process, which is behind it, so that waits instead of
+        # answering with what the client already has
+        results = list()
+        waiter = threading.Thread(target=lambda: results.append(otherBroadcaster.waitForChange([(KEY_VEHICLE, "100")], version, 10)))
+        waiter.start()
+
+        time.sleep(0.1)
+        self.setFeed(otherPoller, [("100", 32.25, -110.9), ("200", 32.3, -110.8)], ["4", "8"], 1030)
+
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+
+        # and once it sees something newer then the client has, it answers with the same version this one would
+        self.setFeed(otherPoller, [("100", 32.3, -110.9), ("200", 32.3, -110.8)], ["4", "8"], 1060)
+        self.setFeed(self.poller, [("100", 32.3, -110.9), ("200", 32.3, -110.8)], ["4", "8"], 1060)
+        waiter.join(5)
+
+        otherVersion, otherSnapshot, otherChangedKeys = results[0]
+        self.assertEqual((otherVersion, otherChangedKeys), ("1060", [(KEY_VEHICLE, "100")]))
+        self.assertEqual(self.broadcaster.waitForChange([(KEY_VEHICLE, "100")], version, 5)[0], otherVersion)
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
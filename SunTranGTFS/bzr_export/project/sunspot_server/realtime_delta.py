@@ -0,0 +1,390 @@
+#
+# compact deltas of the realtime feeds for the phones. The RealtimeDeltaHistory listens to the VehiclePositions and
+# TripUpdates pollers, and remembers which buses moved, showed up or left and which trips' delays changed in the
+# last few versions of each. The sequence number is made from the timestamps in the two feeds' headers, so every
+# server process agrees on it, and a phone that has sequence number N gets only what changed since N (from
+# whichever process it asks), as a RealtimeDelta protobuf (see protoc/realtime_delta.proto), instead of the whole
+# feed. sunspot_server.py's RealtimeDeltas is the cherrypy side of it
+#
+
+import collections
+import hashlib
+import threading
+
+from realtime_delta_pb2 import RealtimeDelta
+
+
+# the coordinates are sent as degrees * COORDINATE_SCALE (about 10cm), and the speed as meters per second * SPEED_SCALE
+COORDINATE_SCALE = 1000000
+SPEED_SCALE = 10
+
+# a vehicle the way the phone sees it, rounded like it gets sent, so a bus that only moved by less than that
+# hasn't changed
+CompactVehicle = collections.namedtuple("CompactVehicle",
+    ["label", "latitude", "longitude", "bearing", "speed", "timestamp", "tripId", "routeId"])
+
+# a trip in the TripUpdates feed the way the phone sees it, see tripDelay()
+CompactTripDelay = collections.namedtuple("CompactTripDelay", ["tripId", "delay", "canceled"])
+
+# a sequence number is the VehiclePositions feed's timestamp in the high 32 bits and the TripUpdates feed's in the
+# low 32 bits
+SEQUENCE_SHIFT = 32
+SEQUENCE_MASK = (1 << SEQUENCE_SHIFT) - 1
+
+# what changed in one version of one of the feeds, its timestamp and the keys (vehicle labels or trip_ids) that
+# showed up, changed or went away
+FeedChange = collections.namedtuple("FeedChange", ["timestamp", "keys"])
+
+
+def compactVehicle(vehicle):
+    ''' rounds a VehiclePosition like the RealtimeDelta sends it
+
+    @param vehicle - the realtime_feed.VehiclePosition
+    @return a CompactVehicle'''
+
+    return CompactVehicle(vehicle.label,
+        int(round(vehicle.latitude * COORDINATE_SCALE)),
+        int(round(vehicle.longitude * COORDINATE_SCALE)),
+        int(round(vehicle.bearing)) % 360 if vehicle.bearing is not None else None,
+        max(0, int(round(vehicle.speed * SPEED_SCALE))) if vehicle.speed is not None else None,
+        vehicle.timestamp, vehicle.tripId, vehicle.routeId)
+
+
+def tripDelay(tripUpdate):
+    ''' how late a trip in the TripUpdates feed is, which is the first delay in its stop time updates (the departure
+    delay, or the arrival delay if there isn't one). The feed drops stops once the bus has left them, so that is
+    how late it is at the next stop
+
+    @param tripUpdate - the trip_predictions.TripUpdateInfo
+    @return a CompactTripDelay, its delay is None if the feed only has times and not delays'''
+
+    for iterUpdate in tripUpdate.stopTimeUpdates:
+
+        delay = iterUpdate.departureDelay if iterUpdate.departureDelay is not None else iterUpdate.arrivalDelay
+
+        if delay is not None:
+            return CompactTripDelay(tripUpdate.tripId, delay, tripUpdate.canceled)
+
+    return CompactTripDelay(tripUpdate.tripId, None, tripUpdate.canceled)
+
+
+def changedKeys(oldDict, newDict):
+    ''' the keys that were added, removed, or have a different value
+
+    @param oldDict - the dictionary before
+    @param newDict - the dictionary after
+    @return a set of keys'''
+
+    return set(iterKey for iterKey in set(oldDict.keys()) | set(newDict.keys()) if oldDict.get(iterKey) != newDict.get(iterKey))
+
+
+def joinSequence(vehicleTimestamp, tripTimestamp):
+    ''' makes a sequence number out of the timestamps of the two feeds
+
+    @param vehicleTimestamp - the VehiclePositions feed's timestamp, 0 if we don't have it
+    @param tripTimestamp - the TripUpdates feed's timestamp, 0 if we don't have it
+    @return the sequence number'''
+
+    return (vehicleTimestamp << SEQUENCE_SHIFT) | (tripTimestamp & SEQUENCE_MASK)
+
+
+def parseSequence(text):
+    ''' the sequence number a phone sent us
+
+    @param text - the sequence number, as a string
+    @return the number, or raises ValueError if it isn't a whole number that fits in the RealtimeDelta's uint64'''
+
+    sequence = int(text)
+
+    if not 0 <= sequence < 1 << 64:
+        raise ValueError("sequence number out of range: {}".format(sequence))
+
+    return sequence
+
+
+def splitSequence(sequence):
+    ''' the other way around from joinSequence()
+
+    @param sequence - the sequence number
+    @return (the VehiclePositions feed's timestamp, the TripUpdates feed's timestamp)'''
+
+    return (sequence >> SEQUENCE_SHIFT, sequence & SEQUENCE_MASK)
+
+
+class FeedChanges:
+    ''' the newest version of one of the realtime feeds (as a dictionary of whatever the phones see of it), its
+    timestamp, and which keys changed in its last @maxHistory versions that changed something'''
+
+    def __init__(self, maxHistory):
+        ''' constructor
+
+        @param maxHistory - how many FeedChanges to remember'''
+
+        self.timestamp = 0
+        self.values = dict()
+
+        # FeedChanges, oldest first
+        self.changes = collections.deque(maxlen=maxHistory)
+
+        # we know everything that changed after this timestamp, None until we have a version of the feed
+        self.knownSince = None
+
+    def update(self, newValues, feedTimestamp):
+        ''' moves on to a new version of the feed
+
+        @param newValues - the dictionary of what the phones see
+        @param feedTimestamp - the timestamp in the feed's header (or when we downloaded it, if it didn't have one)
+        @return whether the timestamp or anything in the feed changed'''
+
+        keys = changedKeys(self.values, newValues)
+        timestamp = int(feedTimestamp)
+
+        if timestamp <= self.timestamp:
+
+            if not keys:
+                return False
+
+            # the feed changed without its timestamp going forward, it still needs a newer one. Other processes might
+            # not agree on this one, which only means a phone that moves between them gets a bit more then it needs
+            timestamp = self.timestamp + 1
+
+        if self.knownSince is None:
+            # the first version we have, we don't know what changed before it
+            self.knownSince = timestamp
+
+        elif keys:
+
+            # when the oldest change falls off we don't know what changed at its timestamp anymore
+            if len(self.changes) == self.changes.maxlen:
+                self.knownSince = self.changes[0].timestamp
+
+            self.changes.append(FeedChange(timestamp, frozenset(keys)))
+
+        self.values = newValues
+        self.timestamp = timestamp
+
+        return True
+
+    def changedSince(self, timestamp):
+        ''' the keys that changed after @timestamp
+
+        @param timestamp - the timestamp the phone has
+        @return a set of keys, empty if the phone is up to date (or ahead of us), or None if we don't remember back
+            that far'''
+
+        if timestamp >= self.timestamp:
+            return set()
+
+        if self.knownSince is None or timestamp < self.knownSince:
+            return None
+
+        keys = set()
+
+        for iterChange in self.changes:
+            if iterChange.timestamp > timestamp:
+                keys.update(iterChange.keys)
+
+        return keys
+
+
+class RealtimeDeltaHistory:
+    ''' keeps the vehicles and trip delays from the newest versions of the realtime feeds, the sequence number they
+    are at, and what changed in the last @maxHistory versions of each feed that changed something.
+
+    The sequence number is the timestamps in the two feeds' headers, so it is the same in every process that has
+    the same versions of the feeds. A phone whose sequence number came from a process that is ahead of this one
+    gets nothing for that feed, and keeps its own timestamp for it, instead of being moved backwards.
+
+    A delta from sequence N only has the vehicles and trips that changed after N, with their newest values, so a
+    bus that moved three times since then is only sent once. The serialized RealtimeDelta for each N is kept until
+    the next change, since most of the phones asking are at the same few sequence numbers'''
+
+    def __init__(self, vehiclePoller, tripUpdatesPoller=None, maxHistory=40):
+        ''' constructor, starts listening to the pollers
+
+        @param vehiclePoller - the RealtimeFeedPoller of the VehiclePositions feed
+        @param tripUpdatesPoller - the RealtimeFeedPoller of the TripUpdates feed (see trip_predictions.py), or None
+            to only send vehicles
+        @param maxHistory - how many sequence numbers back a phone can be and still get a delta'''
+
+        self.vehiclePoller = vehiclePoller
+        self.tripUpdatesPoller = tripUpdatesPoller
+
+        # sequence numbers are timestamps from the feeds, so they are comparable with ones from any process that is
+        # downloading the same feeds
+        feedUrls = [vehiclePoller.url, tripUpdatesPoller.url if tripUpdatesPoller is not None else ""]
+        self.streamId = hashlib.sha1(" ".join(feedUrls).encode("utf-8")).hexdigest()[:8]
+
+        self.lock = threading.Lock()
+
+        self.sequence = 0
+        self.feedTimestamp = None
+
+        # FeedChanges of vehicle label -> CompactVehicle, and of trip_id -> CompactTripDelay
+        self.vehicles = FeedChanges(maxHistory)
+        self.tripDelays = FeedChanges(maxHistory)
+
+        # from sequence (None for a full snapshot) -> the serialized RealtimeDelta up to self.sequence
+        self.deltaCache = dict()
+
+        vehiclePoller.addListener(self._onVehicles)
+        if tripUpdatesPoller is not None:
+            tripUpdatesPoller.addListener(self._onTripUpdates)
+
+        # the pollers might already have snapshots, which they won't tell us about
+        for iterPoller, iterListener in [(vehiclePoller, self._onVehicles), (tripUpdatesPoller, self._onTripUpdates)]:
+            currentSnapshot = iterPoller.snapshot if iterPoller is not None else None
+            if currentSnapshot is not None:
+                iterListener(None, currentSnapshot)
+
+    def _onVehicles(self, oldSnapshot, newSnapshot):
+        ''' called (on the poller's thread) when the VehiclePositions feed changes
+
+        @param oldSnapshot - the VehicleSnapshot before, or None
+        @param newSnapshot - the new VehicleSnapshot'''
+
+        newVehicles = {iterLabel: compactVehicle(iterVehicle) for iterLabel, iterVehicle in newSnapshot.vehicles.items()}
+
+        with self.lock:
+
+            self.feedTimestamp = newSnapshot.feedTimestamp
+
+            if self.vehicles.update(newVehicles, newSnapshot.feedTimestamp or newSnapshot.fetchedTime):
+                self._changed()
+
+    def _onTripUpdates(self, oldSnapshot, newSnapshot):
+        ''' called (on the poller's thread) when the TripUpdates feed changes
+
+        @param oldSnapshot - the trip_predictions.TripUpdatesSnapshot before, or None
+        @param newSnapshot - the new TripUpdatesSnapshot'''
+
+        newTripDelays = {iterTripId: tripDelay(iterTripUpdate) for iterTripId, iterTripUpdate in newSnapshot.tripUpdates.items()}
+
+        with self.lock:
+
+            if self.tripDelays.update(newTripDelays, newSnapshot.feedTimestamp or newSnapshot.fetchedTime):
+                self._changed()
+
+    def _changed(self):
+        ''' moves on to the new sequence number, call this with self.lock held'''
+
+        self.sequence = joinSequence(self.vehicles.timestamp, self.tripDelays.timestamp)
+        self.deltaCache = dict()
+
+    def _changedSince(self, sequence):
+        ''' what changed after @sequence, call this with self.lock held
+
+        @param sequence - the sequence number the phone has
+        @return (the set of vehicle labels, the set of trip_ids), or None if we don't remember back that far'''
+
+        vehicleTimestamp, tripTimestamp = splitSequence(sequence)
+
+        vehicleLabels = self.vehicles.changedSince(vehicleTimestamp)
+        tripIds = self.tripDelays.changedSince(tripTimestamp)
+
+        if vehicleLabels is None or tripIds is None:
+            return None
+
+        return (vehicleLabels, tripIds)
+
+    def deltaBytes(self, streamId, sequence):
+        ''' the RealtimeDelta that brings a phone from what it has up to our newest sequence number
+
+        @param streamId - the stream_id the phone got with its sequence number, or None
+        @param sequence - the sequence number the phone has, or None if it doesn't have anything
+        @return the serialized RealtimeDelta, which is a full snapshot if the phone didn't have anything, its
+            sequence number is from other feeds or we don't remember back that far'''
+
+        with self.lock:
+
+            changed = None
+            if streamId == self.streamId and sequence is not None:
+                changed = self._changedSince(sequence)
+
+            if changed is None:
+                sequence = None
+
+            deltaBytes = self.deltaCache.get(sequence)
+
+            if deltaBytes is None:
+
+                deltaBytes = self._createDelta(sequence, changed).SerializeToString()
+
+                # a sequence number that is ahead of ours could be anything, so those aren't worth keeping
+                if sequence is None or sequence <= self.sequence:
+                    self.deltaCache[sequence] = deltaBytes
+
+            return deltaBytes
+
+    def _createDelta(self, sequence, changed):
+        ''' makes the RealtimeDelta from @sequence (or a full snapshot if its None), call this with self.lock held
+
+        @param sequence - the sequence number the phone has, or None
+        @param changed - what changed after @sequence, from _changedSince()'''
+
+        delta = RealtimeDelta()
+        delta.stream_id = self.streamId
+
+        if self.feedTimestamp is not None:
+            delta.feed_timestamp = self.feedTimestamp
+
+        if sequence is None:
+
+            delta.from_sequence = 0
+            delta.to_sequence = self.sequence
+            delta.full_snapshot = True
+
+            vehicleLabels = self.vehicles.values.keys()
+            tripIds = self.tripDelays.values.keys()
+
+        else:
+
+            # the phone keeps the timestamp of a feed it is ahead of us on
+            vehicleTimestamp, tripTimestamp = splitSequence(sequence)
+
+            delta.from_sequence = sequence
+            delta.to_sequence = joinSequence(max(vehicleTimestamp, self.vehicles.timestamp), max(tripTimestamp, self.tripDelays.timestamp))
+
+            vehicleLabels, tripIds = changed
+
+        for iterLabel in sorted(vehicleLabels):
+
+            iterVehicle = self.vehicles.values.get(iterLabel)
+
+            if iterVehicle is None:
+                delta.removed_vehicles.append(iterLabel)
+                continue
+
+            tmpVehicle = delta.vehicles.add()
+            tmpVehicle.label = iterVehicle.label
+            tmpVehicle.latitude = iterVehicle.latitude
+            tmpVehicle.longitude = iterVehicle.longitude
+
+            if iterVehicle.bearing is not None:
+                tmpVehicle.bearing = iterVehicle.bearing
+            if iterVehicle.speed is not None:
+                tmpVehicle.speed = iterVehicle.speed
+            if iterVehicle.timestamp is not None:
+                tmpVehicle.timestamp = iterVehicle.timestamp
+            if iterVehicle.tripId is not None:
+                tmpVehicle.trip_id = iterVehicle.tripId
+            if iterVehicle.routeId is not None:
+                tmpVehicle.route_id = iterVehicle.routeId
+
+        for iterTripId in sorted(tripIds):
+
+            iterTripDelay = self.tripDelays.values.get(iterTripId)
+
+            if iterTripDelay is None:
+                delta.removed_trips.append(iterTripId)
+                continue
+
+            tmpTripDelay = delta.trip_delays.add()
+            tmpTripDelay.trip_id = iterTripId
+
+            if iterTripDelay.delay is not None:
+                tmpTripDelay.delay = iterTripDelay.delay
+            if iterTripDelay.canceled:
+                tmpTripDelay.canceled = True
+
+        return delta
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# tests for realtime_delta.py, feeds snapshots of both realtime feeds straight to the RealtimeDeltaHistory
+# instead of running pollers
+#
+
+import unittest
+
+from gtfs_realtime_pb2 import FeedMessage
+from realtime_delta_pb2 import RealtimeDelta
+from realtime_feed import VehicleSnapshot
+from trip_predictions import TripUpdatesSnapshot
+from test_fixtures import StandInPoller, createFeedBytes, createTripUpdatesBytes
+from realtime_delta import RealtimeDeltaHistory, compactVehicle, joinSequence, parseSequence, COORDINATE_SCALE
+
+
+class TestRealtimeDeltaHistory(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.history = self.createHistory()
+
+    def createHistory(self):
+        ''' a RealtimeDeltaHistory with pollers of its own, like the one in another process, that start out with
+        the feeds at 1000'''
+
+        history = RealtimeDeltaHistory(StandInPoller("http://example.com/vehicles"), StandInPoller("http://example.com/trips"), 3)
+
+        self.setVehicles([("100", 32.2, -110.9), ("200", 32.3, -110.8)], 1000, history)
+        self.setTripUpdates([("1a", False, [(2, 120, False)])], 1000, history)
+
+        return history
+
+    def setVehicles(self, vehicles, feedTimestamp, history=None):
+        ''' a new version of the VehiclePositions feed, the buses' own timestamps stay the same so only the ones
+        that moved change'''
+
+        feed = FeedMessage.FromString(createFeedBytes(vehicles, 1000, ["4"] * len(vehicles)))
+        feed.header.timestamp = feedTimestamp
+
+        history = history if history is not None else self.history
+        history.vehiclePoller.setSnapshot(VehicleSnapshot.fromFeedBytes(feed.SerializeToString(), feedTimestamp))
+
+    def setTripUpdates(self, tripUpdates, feedTimestamp, history=None):
+
+        history = history if history is not None else self.history
+        history.tripUpdatesPoller.setSnapshot(TripUpdatesSnapshot.fromFeedBytes(createTripUpdatesBytes(tripUpdates, feedTimestamp), feedTimestamp))
+
+    def delta(self, streamId, sequence, history=None):
+
+        history = history if history is not None else self.history
+        return RealtimeDelta.FromString(history.deltaBytes(streamId, sequence))
+
+    def testFullSnapshot(self):
+
+        delta = self.delta(None, None)
+
+        self.assertTrue(delta.full_snapshot)
+        self.assertEqual(delta.stream_id, self.history.streamId)
+        self.assertEqual(delta.to_sequence, joinSequence(1000, 1000))
+        self.assertEqual([iterVehicle.label for iterVehicle in delta.vehicles], ["100", "200"])
+        # the feed has floats, so 32.2 is more like 32.2000007
+        self.assertAlmostEqual(delta.vehicles[0].latitude, 32.2 * COORDINATE_SCALE, delta=1)
+        self.assertEqual(delta.vehicles[0].route_id, "4")
+        self.assertEqual([(iterTrip.trip_id, iterTrip.delay) for iterTrip in delta.trip_delays], [("1a", 120)])
+
+        # every process downloading the same feeds has the same stream_id, and a sequence number from other feeds
+        # gets everything
+        self.assertEqual(self.createHistory().streamId, self.history.streamId)
+        self.assertTrue(self.delta("deadbeef", delta.to_sequence).full_snapshot)
+
+    def testMergedDelta(self):
+
+        streamId = self.history.streamId
+
+        # 100 moves twice, 200 leaves, 300 shows up and then leaves again, and 1a gets later
+        self.setVehicles([("100", 32.21, -110.9), ("300", 32.0, -111.0)], 1030)
+        self.setVehicles([("100", 32.22, -110.9)], 1060)
+        self.setTripUpdates([("1a", False, [(2, 300, False)])], 1030)
+
+        delta = self.delta(streamId, joinSequence(1000, 1000))
+
+        self.assertFalse(delta.full_snapshot)
+        self.assertEqual((delta.from_sequence, delta.to_sequence), (joinSequence(1000, 1000), joinSequence(1060, 1030)))
+        self.assertEqual([iterVehicle.label for iterVehicle in delta.vehicles], ["100"])
+        self.assertAlmostEqual(delta.vehicles[0].latitude, 32.22 * COORDINATE_SCALE, delta=1)
+        self.assertEqual(list(delta.removed_vehicles), ["200", "300"])
+        self.assertEqual([(iterTrip.trip_id, iterTrip.delay) for iterTrip in delta.trip_delays], [("1a", 300)])
+
+        # only the trip
+        delta = self.delta(streamId, joinSequence(1060, 1000))
+        self.assertEqual(len(delta.vehicles), 0)
+        self.assertEqual(len(delta.removed_vehicles), 0)
+        self.assertEqual(len(delta.trip_delays), 1)
+
+        # a phone that is up to date gets an empty delta, and the delta is smaller than everything
+        delta = self.delta(streamId, joinSequence(1060, 1030))
+        self.assertFalse(delta.full_snapshot)
+        self.assertEqual(len(delta.vehicles) + len(delta.removed_vehicles) + len(delta.trip_delays), 0)
+        self.assertLess(len(self.history.deltaBytes(streamId, joinSequence(1060, 1000))), len(self.history.deltaBytes(None, None)))
+
+    def testNothingChanged(self):
+
+        sequence = self.history.sequence
+
+        # the same version of the feeds again doesn't change the sequence number
+        self.setVehicles([("100", 32.2, -110.9), ("200", 32.3, -110.8)], 1000)
+        self.setTripUpdates([("1a", False, [(2, 120, False)])], 1000)
+
+        self.assertEqual(self.history.sequence, sequence)
+
+        # a new version with the same buses does (so every process gives it the same one), but there is nothing in it
+        self.setVehicles([("100", 32.2, -110.9), ("200", 32.3, -110.8)], 1030)
+
+        self.assertEqual(self.history.sequence, joinSequence(1030, 1000))
+        self.assertEqual(len(self.delta(self.history.streamId, sequence).vehicles), 0)
+
+        # and a bus moving by less than we send isn't a change
+        vehicle = self.history.vehiclePoller.snapshot.vehicles["100"]
+        self.assertEqual(compactVehicle(vehicle), compactVehicle(vehicle._replace(latitude=vehicle.latitude + 1e-8)))
+
+    def testTooFarBehind(self):
+
+        streamId = self.history.streamId
+
+        for iterNumber in range(1, 5):
+            self.setVehicles([("100", 32.2 + iterNumber / 100, -110.9)], 1000 + iterNumber * 30)
+
+        # we remember 3 changes, so from 1030 (the changes at 1060, 1090 and 1120) is a delta but from 1000 isn't
+        self.assertEqual(self.history.sequence, joinSequence(1120, 1000))
+        self.assertFalse(self.delta(streamId, joinSequence(1030, 1000)).full_snapshot)
+        self.assertTrue(self.delta(streamId, joinSequence(1000, 1000)).full_snapshot)
+
+        # one from the future (from a process that already has a newer feed) gets nothing, and keeps its sequence
+        delta = self.delta(streamId, joinSequence(1150, 1000))
+        self.assertFalse(delta.full_snapshot)
+        self.assertEqual((len(delta.vehicles), delta.to_sequence), (0, joinSequence(1150, 1000)))
+
+    def testOtherProcess(self):
+
+        # this process sees every version of the VehiclePositions feed, the other one misses 1030
+        otherHistory = self.createHistory()
+
+        self.setVehicles([("100", 32.21, -110.9), ("200", 32.3, -110.8)], 1030)
+        self.setVehicles([("100", 32.21, -110.9), ("200", 32.31, -110.8)], 1060)
+        self.setVehicles([("100", 32.21, -110.9), ("200", 32.31, -110.8)], 1060, otherHistory)
+
+        self.assertEqual(otherHistory.sequence, self.history.sequence)
+
+        # a phone that got 1030 from this one asks the other one, which doesn't know exactly what changed after 1030
+        # but does know everything that changed after 1000, which is enough
+        delta = self.delta(self.history.streamId, joinSequence(1030, 1000), otherHistory)
+
+        self.assertFalse(delta.full_snapshot)
+        self.assertEqual(delta.to_sequence, self.history.sequence)
+        self.assertEqual([iterVehicle.label for iterVehicle in delta.vehicles], ["100", "200"])
+        self.assertAlmostEqual(delta.vehicles[1].latitude, 32.31 * COORDINATE_SCALE, delta=1)
+
+    def testCanceledTrip(self):
+
+        self.setTripUpdates([("1a", True, [])], 1030)
+
+        delta = self.delta(self.history.streamId, joinSequence(1000, 1000))
+        self.assertTrue(delta.trip_delays[0].canceled)
+        self.assertFalse(delta.trip_delays[0].HasField("delay"))
+
+        self.setTripUpdates([], 1060)
+        self.assertEqual(list(self.delta(self.history.streamId, joinSequence(1000, 1030)).removed_trips), ["1a"])
+
+    def testParseSequence(self):
+
+        self.assertEqual(parseSequence("0"), 0)
+        self.assertEqual(parseSequence(str(joinSequence(1120, 1000))), joinSequence(1120, 1000))
+        self.assertEqual(parseSequence(str(2 ** 64 - 1)), 2 ** 64 - 1)
+
+        # anything that doesn't fit in from_sequence is a bad request, not a crash
+        for iterText in ["-1", str(2 ** 64), "1.5", "soon"]:
+            with self.assertRaises(ValueError):
+                parseSequence(iterText)
+
+        delta = RealtimeDelta()
+        delta.from_sequence = parseSequence(str(2 ** 64 - 1))
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
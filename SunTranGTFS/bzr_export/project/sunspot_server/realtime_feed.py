@@ -0,0 +1,330 @@
+#
+# a background poller for SunTran's GTFS realtime VehiclePositions feed, so sunspot_server.py's request threads
+# read the vehicles from memory instead of each one downloading and parsing the whole feed. The poller fetches the
+# feed every REALTIME_POLL_INTERVAL seconds (with a conditional GET, so an unchanged feed costs a 304), parses it
+# once, and publishes a read only VehicleSnapshot that every thread can use without locking (the same poller, with a
+# different parse function, downloads the TripUpdates feed for trip_predictions.py). Each snapshot is
+# indexed (by vehicle label, vehicle id, trip, route and where the vehicle is) and has its JSON responses serialized
+# ahead of time, so answering a request is a dictionary lookup
+#
+
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import types
+
+import google.protobuf.message # for DecodeError
+import requests
+
+from gtfs_realtime_pb2 import FeedMessage
+from spatial_index import GridIndex
+
+
+# what we keep about each vehicle in the feed
+VehiclePosition = collections.namedtuple("VehiclePosition",
+    ["label", "vehicleId", "latitude", "longitude", "bearing", "speed", "timestamp", "tripId", "routeId"])
+
+
+def _isoformat(timestamp):
+    ''' formats seconds since the epoch like arrow.get(timestamp).isoformat() does
+
+    @param timestamp - seconds since the epoch
+    @return a string like 2014-08-22T17:00:00+00:00'''
+
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+
+class VehicleSnapshot:
+    ''' the vehicles from one version of the VehiclePositions feed, this never changes once its created, the
+    poller replaces it with a new one instead.
+
+    Everything is worked out here (on the poller's thread) so the request threads just look things up:
+
+        vehicles - vehicle label -> VehiclePosition
+        vehiclesById - vehicle id -> VehiclePosition
+        vehiclesByTrip / vehiclesByRoute - trip_id / route_id -> tuple of VehiclePositions, sorted by label
+        vehicleGrid - a GridIndex of label -> VehiclePosition, for finding the vehicles near somewhere
+        vehicleJson - vehicle label -> the JSON response (bytes) for that vehicle
+        tripJson / routeJson - trip_id / route_id -> the JSON response (bytes) for every vehicle on it'''
+
+    def __init__(self, vehicles, feedTimestamp, fetchedTime):
+        ''' constructor
+
+        @param vehicles - a dictionary of vehicle label -> VehiclePosition
+        @param feedTimestamp - the timestamp in the feed's header (seconds since the epoch), or None
+        @param fetchedTime - time.time() of when we downloaded this version of the feed'''
+
+        self.vehicles = types.MappingProxyType(vehicles)
+        self.feedTimestamp = feedTimestamp
+        self.fetchedTime = fetchedTime
+
+        vehiclesById = dict()
+        vehiclesByTrip = collections.defaultdict(list)
+        vehiclesByRoute = collections.defaultdict(list)
+        self.vehicleGrid = GridIndex()
+
+        for iterLabel in sorted(vehicles.keys()):
+
+            iterVehicle = vehicles[iterLabel]
+
+            if iterVehicle.vehicleId is not None:
+                vehiclesById[iterVehicle.vehicleId] = iterVehicle
+            if iterVehicle.tripId is not None:
+                vehiclesByTrip[iterVehicle.tripId].append(iterVehicle)
+            if iterVehicle.routeId is not None:
+                vehiclesByRoute[iterVehicle.routeId].append(iterVehicle)
+
+            # a vehicle that didn't send a position shows up at 0, 0, which isn't near anything
+            if iterVehicle.latitude or iterVehicle.longitude:
+                self.vehicleGrid.add(iterLabel, iterVehicle.latitude, iterVehicle.longitude, iterVehicle)
+
+        self.vehiclesById = types.MappingProxyType(vehiclesById)
+        self.vehiclesByTrip = types.MappingProxyType({iterKey: tuple(iterValue) for iterKey, iterValue in vehiclesByTrip.items()})
+        self.vehiclesByRoute = types.MappingProxyType({iterKey: tuple(iterValue) for iterKey, iterValue in vehiclesByRoute.items()})
+
+        self.vehicleJson = types.MappingProxyType({iterLabel: json.dumps(self.vehicleDict(iterVehicle)).encode("utf-8")
+            for iterLabel, iterVehicle in vehicles.items()})
+        self.tripJson = types.MappingProxyType({iterTripId: self.vehicleListJson("trip_id", iterTripId, iterVehicles)
+            for iterTripId, iterVehicles in self.vehiclesByTrip.items()})
+        self.routeJson = types.MappingProxyType({iterRouteId: self.vehicleListJson("route_id", iterRouteId, iterVehicles)
+            for iterRouteId, iterVehicles in self.vehiclesByRoute.items()})
+
+    def vehicleDict(self, vehicle):
+        ''' the JSON for one vehicle (before it gets serialized), the first four keys are what tmpFindBus has
+        always returned
+
+        @param vehicle - the VehiclePosition
+        @return a dictionary'''
+
+        return collections.OrderedDict([
+            ("vehicle", vehicle.label),
+            ("lat", vehicle.latitude),
+            ("lon", vehicle.longitude),
+            # when the bus reported its position if the feed says, otherwise when we downloaded the feed
+            ("timestamp", _isoformat(vehicle.timestamp or self.fetchedTime)),
+            ("vehicle_id", vehicle.vehicleId),
+            ("bearing", vehicle.bearing),
+            ("speed", vehicle.speed),
+            ("trip_id", vehicle.tripId),
+            ("route_id", vehicle.routeId)])
+
+    def vehicleListJson(self, keyName, keyValue, vehicles):
+        ''' the JSON response for a list of vehicles, like every vehicle on a route
+
+        @param keyName - what the list is of, like 'route_id'
+        @param keyValue - which one, like the route id
+        @param vehicles - an iterable of VehiclePositions, empty if there aren't any
+        @return the JSON as bytes'''
+
+        return json.dumps(collections.OrderedDict([
+            (keyName, keyValue),
+            ("feed_timestamp", _isoformat(self.feedTimestamp or self.fetchedTime)),
+            ("vehicles", [self.vehicleDict(iterVehicle) for iterVehicle in vehicles])])).encode("utf-8")
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    @classmethod
+    def fromFeedBytes(cls, feedBytes, fetchedTime):
+        ''' parses the VehiclePositions feed
+
+        @param feedBytes - the serialized FeedMessage
+        @param fetchedTime - time.time() of when we downloaded it
+        @return a VehicleSnapshot, or raises google.protobuf.message.DecodeError'''
+
+        feed = FeedMessage.FromString(feedBytes)
+
+        # some versions of protobuf give up on garbage part way through without complaining, and just give us
+        # whatever they parsed before that, which won't have the (required) header
+        if not feed.IsInitialized():
+            raise google.protobuf.message.DecodeError("the feed is missing required fields, its probably not a FeedMessage")
+
+        vehicles = dict()
+
+        for iterEntity in feed.entity:
+
+            if not iterEntity.HasField("vehicle"):
+                continue
+
+            tmpVehicle = iterEntity.vehicle
+
+            # the vehicle label is the number painted on the bus, which is what riders know it by
+            label = tmpVehicle.vehicle.label
+            if not label:
+                continue
+
+            vehicles[label] = VehiclePosition(label, tmpVehicle.vehicle.id or None, tmpVehicle.position.latitude, tmpVehicle.position.longitude,
+                tmpVehicle.position.bearing if tmpVehicle.position.HasField("bearing") else None,
+                tmpVehicle.position.speed if tmpVehicle.position.HasField("speed") else None,
+                tmpVehicle.timestamp if tmpVehicle.HasField("timestamp") else None,
+                tmpVehicle.trip.trip_id or None, tmpVehicle.trip.route_id or None)
+
+        return cls(vehicles, feed.header.timestamp if feed.header.HasField("timestamp") else None, fetchedTime)
+
+
+class RealtimeFeedPoller:
+    ''' downloads the VehiclePositions feed (or another GTFS realtime feed) every @interval seconds in a thread,
+    and keeps the newest snapshot of it in self.snapshot. If a download fails we keep the last snapshot we had,
+    check its fetchedTime to see how old it is.'''
+
+    # pid -> {url -> the RealtimeFeedPoller for that feed in that process}, see shared()
+    _sharedPollers = dict()
+    _sharedLock = threading.Lock()
+
+    def __init__(self, url, interval, timeout=10, logger=None, parseFunc=None):
+        ''' constructor
+        @param url - the url of the feed
+        @param interval - how many seconds between downloads
+        @param timeout - how many seconds to wait for the feed's server before giving up on that download
+        @param logger - a logging.Logger
+        @param parseFunc - function that takes the feed's bytes and time.time() of when we downloaded them, and
+            returns the (read only) snapshot, or raises google.protobuf.message.DecodeError. The default is
+            VehicleSnapshot.fromFeedBytes'''
+
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.lg = logger if logger is not None else logging.getLogger("RealtimeFeedPoller")
+        self.parseFunc = parseFunc if parseFunc is not None else VehicleSnapshot.fromFeedBytes
+
+        # None until the first download works, then replaced (never changed) by each new version of the feed
+        self.snapshot = None
+
+        # what the feed's server told us about the version we have, for the conditional GET
+        self.etag = None
+        self.lastModified = None
+
+        # time.time() of the last time we heard from the feed's server, even if it was a 304
+        self.lastCheckedTime = None
+
+        # functions that get called (on the poller's thread) with the old and the new snapshot when the feed changes
+        self.listeners = list()
+
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.session = requests.Session()
+        self.thread = threading.Thread(target=self._run, name="RealtimeFeedPoller", daemon=True)
+
+    @classmethod
+    def shared(cls, constantsObj, logger=None, url=None, parseFunc=None):
+        ''' gets the RealtimeFeedPoller of a feed for this process, creating and starting it the first time. It is
+        per process, since the thread doesn't survive a fork
+
+        @param constantsObj - a Constants object, for the REALTIME_* settings
+        @param logger - a logging.Logger
+        @param url - the feed, or None for REALTIME_VEHICLE_POSITIONS_URL
+        @param parseFunc - see the constructor, only used the first time
+        @return a RealtimeFeedPoller, that might not have downloaded the feed yet (see waitUntilReady())'''
+
+        if url is None:
+            url = constantsObj.REALTIME_VEHICLE_POSITIONS_URL
+
+        with cls._sharedLock:
+
+            pid = os.getpid()
+
+            # anything in here from another pid is from before a fork, and those threads are gone
+            if pid not in cls._sharedPollers:
+                cls._sharedPollers = {pid: dict()}
+
+            poller = cls._sharedPollers[pid].get(url)
+
+            if poller is None:
+
+                poller = cls(url, constantsObj.REALTIME_POLL_INTERVAL, constantsObj.REALTIME_REQUEST_TIMEOUT, logger, parseFunc)
+                poller.start()
+
+                cls._sharedPollers[pid][url] = poller
+
+            return poller
+
+    def addListener(self, listener):
+        ''' calls @listener every time we get a new version of the feed, after self.snapshot is the new one.
+        It gets called on the poller's thread, so it shouldn't take long
+
+        @param listener - function that takes the old VehicleSnapshot (None the first time) and the new one'''
+
+        self.listeners.append(listener)
+
+    def start(self):
+        ''' starts downloading the feed in a new thread'''
+
+        self.thread.start()
+
+    def stop(self):
+        ''' stops downloading the feed'''
+
+        self.stopped.set()
+
+        if self.thread.is_alive():
+            self.thread.join(self.timeout + 1)
+
+    def waitUntilReady(self, timeout=None):
+        ''' waits for the first download of the feed
+
+        @param timeout - how many seconds to wait, or None to wait forever
+        @return True if we have a snapshot, False if we timed out'''
+
+        return self.ready.wait(timeout)
+
+    def _run(self):
+        ''' the thread, downloads the feed every self.interval seconds until stop() is called'''
+
+        while not self.stopped.is_set():
+
+            startTime = time.time()
+
+            try:
+                self.poll()
+            except (requests.RequestException, google.protobuf.message.DecodeError) as e:
+                self.lg.warning("couldn't get the feed from %s, keeping the one from %s: %s", self.url,
+                    self.snapshot.fetchedTime if self.snapshot is not None else None, e)
+            except Exception as e:
+                self.lg.exception("error getting the feed from %s: %s", self.url, e)
+
+            # every interval seconds from the start of the last download, not the end
+            self.stopped.wait(max(0, self.interval - (time.time() - startTime)))
+
+    def poll(self):
+        ''' downloads the feed once, if it changed since last time
+
+        @return True if we got a new version of the feed, False if it hasn't changed'''
+
+        headers = dict()
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.lastModified is not None:
+            headers["If-Modified-Since"] = self.lastModified
+
+        resp = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        fetchedTime = time.time()
+
+        if resp.status_code == 304:
+            self.lastCheckedTime = fetchedTime
+            return False
+
+        resp.raise_for_status()
+
+        snapshot = self.parseFunc(resp.content, fetchedTime)
+
+        # swapping the reference is all the request threads see, they never see half of a new snapshot
+        oldSnapshot = self.snapshot
+        self.snapshot = snapshot
+        self.etag = resp.headers.get("ETag")
+        self.lastModified = resp.headers.get("Last-Modified")
+        self.lastCheckedTime = fetchedTime
+        self.ready.set()
+
+        self.lg.debug("got a new version of the feed, %s entities", len(snapshot))
+
+        for iterListener in self.listeners:
+            try:
+                iterListener(oldSnapshot, snapshot)
+            except Exception as e:
+                self.lg.exception("error in a listener for the new version of the feed: %s", e)
+
+        return True
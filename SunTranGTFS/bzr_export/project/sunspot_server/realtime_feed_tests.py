@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# tests for realtime_feed.py, against a local stand-in for SunTran's VehiclePositions feed so they don't need the
+# internet (or leveldb_server)
+#
+
+import unittest
+import http.server
+import json
+import logging
+import threading
+import time
+
+import google.protobuf.message
+
+from realtime_feed import RealtimeFeedPoller, VehicleSnapshot
+from test_fixtures import createFeedBytes
+
+
+class StandInFeedHandler(http.server.BaseHTTPRequestHandler):
+    ''' serves whatever is in the server's 'feedBytes' attribute, with an ETag so the poller can do a conditional GET'''
+
+    def do_GET(self):
+
+        self.server.requestCount += 1
+
+        etag = '"{}"'.format(self.server.version)
+
+        if self.headers.get("If-None-Match") == etag:
+            self.server.notModifiedCount += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(self.server.feedBytes)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(self.server.feedBytes)
+
+    def log_message(self, format, *args):
+        pass # keep the test output readable
+
+
+class TestRealtimeFeedPoller(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), StandInFeedHandler)
+        self.server.requestCount = 0
+        self.server.notModifiedCount = 0
+        self._setFeed(createFeedBytes([("100", 32.2, -110.9), ("200", 32.3, -110.8)]))
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.url = "http://127.0.0.1:{}/VehiclePositions.pb".format(self.server.server_address[1])
+        self.poller = RealtimeFeedPoller(self.url, 0.05, timeout=5, logger=logging.getLogger("UnitTest.RealtimeFeedPoller"))
+
+    def tearDown(self):
+
+        self.poller.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _setFeed(self, feedBytes):
+        ''' changes what the stand-in server serves'''
+
+        self.server.version = getattr(self.server, "version", 0) + 1
+        self.server.feedBytes = feedBytes
+
+    def testPoll(self):
+
+        self.assertTrue(self.poller.poll())
+
+        snapshot = self.poller.snapshot
+        self.assertEqual(len(snapshot.vehicles), 2)
+        self.assertEqual(snapshot.feedTimestamp, 1000)
+
+        vehicle = snapshot.vehicles["100"]
+        self.assertAlmostEqual(vehicle.latitude, 32.2, places=4)
+        self.assertAlmostEqual(vehicle.longitude, -110.9, places=4)
+        self.assertEqual(vehicle.routeId, "route0")
+        self.assertIsNone(vehicle.tripId)
+        self.assertNotIn("300", snapshot.vehicles)
+
+    def testConditionalGet(self):
+
+        self.assertTrue(self.poller.poll())
+        firstSnapshot = self.poller.snapshot
+
+        # nothing changed, so the server says 304 and we keep the same snapshot
+        self.assertFalse(self.poller.poll())
+        self.assertIs(self.poller.snapshot, firstSnapshot)
+        self.assertEqual(self.server.notModifiedCount, 1)
+
+        self._setFeed(createFeedBytes([("100", 32.25, -110.95)], 2000))
+
+        self.assertTrue(self.poller.poll())
+        self.assertIsNot(self.poller.snapshot, firstSnapshot)
+        self.assertEqual(list(self.poller.snapshot.vehicles.keys()), ["100"])
+
+        # and the old one didn't change under whoever was still reading it
+        self.assertEqual(len(firstSnapshot.vehicles), 2)
+        with self.assertRaises(TypeError):
+            firstSnapshot.vehicles["300"] = None
+
+    def testBadFeedKeepsSnapshot(self):
+
+        self.assertTrue(self.poller.poll())
+        firstSnapshot = self.poller.snapshot
+
+        self._setFeed(b"this is not a protobuf message \xff\xff\xff")
+
+        with self.assertRaises(google.protobuf.message.DecodeError):
+            self.poller.poll()
+
+        self.assertIs(self.poller.snapshot, firstSnapshot)
+
+    def testBackgroundThread(self):
+
+        self.poller.start()
+        self.assertTrue(self.poller.waitUntilReady(5))
+        self.assertIn("200", self.poller.snapshot.vehicles)
+
+        # it keeps asking, and the feed hasn't changed
+        for i in range(100):
+            if self.server.notModifiedCount > 0:
+                break
+            time.sleep(0.02)
+
+        self.assertGreater(self.server.notModifiedCount, 0)
+
+        self._setFeed(createFeedBytes([("300", 32.1, -110.7)], 3000))
+
+        for i in range(100):
+            if "300" in self.poller.snapshot.vehicles:
+                break
+            time.sleep(0.02)
+
+        self.assertIn("300", self.poller.snapshot.vehicles)
+
+
+class TestVehicleSnapshot(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        feedBytes = createFeedBytes([("300", 32.1, -110.7), ("100", 32.2, -110.9), ("200", 32.3, -110.8)],
+            routeIds=["4", "4", "8"], tripIds=["t1", "t2", "t3"])
+
+        self.snapshot = VehicleSnapshot.fromFeedBytes(feedBytes, 1500)
+
+    def testIndexes(self):
+
+        self.assertEqual(self.snapshot.vehiclesById["id100"].label, "100")
+
+        # sorted by label, not the order they are in the feed
+        self.assertEqual([iterVehicle.label for iterVehicle in self.snapshot.vehiclesByRoute["4"]], ["100", "300"])
+        self.assertEqual([iterVehicle.label for iterVehicle in self.snapshot.vehiclesByRoute["8"]], ["200"])
+        self.assertEqual(self.snapshot.vehiclesByTrip["t2"][0].label, "100")
+        self.assertNotIn("5", self.snapshot.vehiclesByRoute)
+
+        with self.assertRaises(TypeError):
+            self.snapshot.vehiclesByRoute["5"] = ()
+
+        # 100 is at 32.2, -110.9
+        nearest = self.snapshot.vehicleGrid.nearest(32.21, -110.91, 2)
+        self.assertEqual([iterLabel for iterDistance, iterLabel, iterVehicle in nearest], ["100", "200"])
+
+    def testJson(self):
+
+        vehicleDict = json.loads(self.snapshot.vehicleJson["100"].decode("utf-8"))
+        self.assertEqual(vehicleDict["vehicle"], "100")
+        self.assertAlmostEqual(vehicleDict["lat"], 32.2, places=4)
+        self.assertEqual(vehicleDict["timestamp"], "1970-01-01T00:16:40+00:00")
+        self.assertEqual(vehicleDict["route_id"], "4")
+
+        routeDict = json.loads(self.snapshot.routeJson["4"].decode("utf-8"))
+        self.assertEqual(routeDict["route_id"], "4")
+        self.assertEqual([iterVehicle["vehicle"] for iterVehicle in routeDict["vehicles"]], ["100", "300"])
+
+        tripDict = json.loads(self.snapshot.tripJson["t3"].decode("utf-8"))
+        self.assertEqual([iterVehicle["vehicle"] for iterVehicle in tripDict["vehicles"]], ["200"])
+
+        emptyDict = json.loads(self.snapshot.vehicleListJson("route_id", "5", ()).decode("utf-8"))
+        self.assertEqual(emptyDict["vehicles"], [])
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#
+# logging of the requests that sunspot_server.py gets. Writing every request body to the log costs more then
+# handling the request does, so by default nothing gets logged, and what does get logged is sampled and cut short.
+# See the SUNSPOT_REQUEST_LOGGING_* settings in constants_config.yaml
+#
+
+import logging
+
+from logging_helpers import RequestLogSampler
+from sunspot_messages_pb2 import SunspotMessages
+
+
+class RequestLogger:
+    ''' logs the requests that Root.POST gets:
+
+        INFO: one line for 1 out of every @sampleRate requests, saying who sent it and what they asked for
+        DEBUG: also the first @previewBytes of the request body and of the decoded protobuf message
+
+    requests from the clients in @debugClientIds get everything logged (at WARNING, so it shows up with
+    the default level), so you can watch one phone without turning on logging for everyone. Requests that
+    failed or took at least @slowSeconds always get their line logged at WARNING, whether they were sampled or not.
+
+    This is safe to call from more then one of cherrypy's threads'''
+
+    def __init__(self, logger, sampleRate, previewBytes, debugClientIds=(), slowSeconds=0):
+        ''' constructor
+
+        @param logger - the logger to log to, its level decides what gets logged
+        @param sampleRate - log one out of every this many requests, 1 logs every request and 0 logs none of them
+        @param previewBytes - the most of the request body (and decoded message) to log
+        @param debugClientIds - an iterable of client_id strings to log everything for
+        @param slowSeconds - always log requests that took at least this many seconds, 0 to not'''
+
+        self.lg = logger
+        self.sampler = RequestLogSampler(sampleRate)
+        self.previewBytes = previewBytes
+        self.debugClientIds = frozenset(debugClientIds)
+        self.slowSeconds = slowSeconds
+
+    @classmethod
+    def fromConstants(cls, constantsObj, logger):
+        ''' creates a RequestLogger with the SUNSPOT_REQUEST_LOGGING_* settings, and sets the level of @logger
+
+        @param constantsObj - a Constants object
+        @param logger - the logger to log to
+        @return a RequestLogger'''
+
+        logger.setLevel(constantsObj.SUNSPOT_REQUEST_LOGGING_LEVEL)
+
+        return cls(logger, constantsObj.SUNSPOT_REQUEST_LOGGING_SAMPLE_RATE, constantsObj.SUNSPOT_REQUEST_LOGGING_PREVIEW_BYTES,
+            constantsObj.SUNSPOT_REQUEST_LOGGING_DEBUG_CLIENT_IDS or (), constantsObj.SUNSPOT_REQUEST_LOGGING_SLOW_SECONDS)
+
+    def _preview(self, value):
+        ''' cuts @value down to self.previewBytes
+
+        @param value - bytes or a string
+        @return a string'''
+
+        if len(value) <= self.previewBytes:
+            return repr(value)
+
+        return "{!r}... ({} more)".format(value[:self.previewBytes], len(value) - self.previewBytes)
+
+    def logRequest(self, data, clientObj=None, seconds=None, failed=False):
+        ''' logs a request, if it should be, call this once the request is done
+
+        @param data - the request body (bytes)
+        @param clientObj - the ActualSunspotMessage decoded from @data, or None if it couldn't be decoded
+        @param seconds - how long the request took, or None if we don't know
+        @param failed - True if we sent back an error (or raised an exception)'''
+
+        clientId = clientObj.client_id if clientObj is not None and clientObj.HasField("client_id") else None
+        isSlow = self.slowSeconds > 0 and seconds is not None and seconds >= self.slowSeconds
+
+        if clientId is not None and clientId in self.debugClientIds:
+            level = detailLevel = logging.WARNING
+            requestNumber = None
+
+        elif failed or isSlow:
+
+            # these are the ones you want to look at, so they don't get sampled away
+            level = logging.WARNING
+            detailLevel = logging.DEBUG
+            requestNumber = None
+
+        else:
+
+            # the production default, check this first so we don't even count the request
+            if not self.lg.isEnabledFor(logging.INFO):
+                return
+
+            requestNumber = self.sampler.sample()
+            if requestNumber is None:
+                return
+
+            level = logging.INFO
+            detailLevel = logging.DEBUG
+
+        if clientObj is None:
+            summary = "undecodable message"
+        else:
+            summary = SunspotMessages.ActualSunspotMessage.SunspotMessageType.Name(clientObj.message_type)
+
+            if clientObj.HasField("server_query_message"):
+                summary += " asking for " + SunspotMessages.ServerQuery.ServerQueryType.Name(clientObj.server_query_message.asking_for)
+
+        if seconds is not None:
+            summary += ", took {:.3f} seconds".format(seconds)
+
+        if failed:
+            summary += ", FAILED"
+
+        self.lg.log(level, "request%s from client %s: %s, %s bytes", "" if requestNumber is None else " #{}".format(requestNumber),
+            clientId, summary, len(data))
+
+        if self.lg.isEnabledFor(detailLevel):
+            self.lg.log(detailLevel, "\trequest body: %s", self._preview(data))
+
+            if clientObj is not None:
+                self.lg.log(detailLevel, "\tdecoded: %s", self._preview(str(clientObj)))
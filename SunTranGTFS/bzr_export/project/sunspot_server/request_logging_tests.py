@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# tests for request_logging.py and the RequestLogSampler in logging_helpers.py, the log records are caught by
+# a handler rather then written anywhere
+#
+
+import unittest
+import logging
+
+from logging_helpers import RequestLogSampler
+from request_logging import RequestLogger
+from sunspot_messages_pb2 import SunspotMessages
+
+
+class ListHandler(logging.Handler):
+    ''' a logging handler that keeps every record it gets'''
+
+    def __init__(self):
+        super().__init__()
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def createClientObj(clientId="phone"):
+    ''' creates an ActualSunspotMessage asking for the full database, like the app sends
+
+    @param clientId - the client_id, or None to leave it out
+    @return a two-tuple of (the message, its bytes)'''
+
+    clientObj = SunspotMessages.ActualSunspotMessage()
+    clientObj.timestamp = "0"
+    clientObj.message_type = SunspotMessages.ActualSunspotMessage.SERVER_QUERY
+    clientObj.server_query_message.asking_for = SunspotMessages.ServerQuery.NEED_FULL_DB
+
+    if clientId is not None:
+        clientObj.client_id = clientId
+
+    return clientObj, clientObj.SerializeToString()
+
+
+class TestRequestLogSampler(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def testSampleRate(self):
+
+        sampler = RequestLogSampler(10)
+        logged = [iterNumber for iterNumber in (sampler.sample() for i in range(100)) if iterNumber is not None]
+
+        # the first one, so you know the server is getting requests at all, and then every 10th
+        self.assertEqual(logged, [1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100])
+
+    def testEverythingAndNothing(self):
+
+        sampler = RequestLogSampler(1)
+        self.assertEqual([sampler.sample() for i in range(3)], [1, 2, 3])
+
+        sampler = RequestLogSampler(0)
+        self.assertEqual([sampler.sample() for i in range(3)], [None, None, None])
+
+
+class TestRequestLogger(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.handler = ListHandler()
+
+        # a logger of our own, so the records don't go anywhere else
+        self.lg = logging.getLogger("UnitTest.RequestLogger.{}".format(self.id()))
+        self.lg.propagate = False
+        self.lg.addHandler(self.handler)
+
+    def tearDown(self):
+
+        self.lg.removeHandler(self.handler)
+
+    def _messages(self):
+        ''' the (level name, message) of everything that was logged so far'''
+
+        return [(iterRecord.levelname, iterRecord.getMessage()) for iterRecord in self.handler.records]
+
+    def testSampling(self):
+
+        self.lg.setLevel(logging.INFO)
+        requestLog = RequestLogger(self.lg, 3, 256)
+        clientObj, data = createClientObj()
+
+        for i in range(7):
+            requestLog.logRequest(data, clientObj, 0.01)
+
+        self.assertEqual([iterMessage.split(" from")[0] for iterLevel, iterMessage in self._messages()],
+            ["request #1", "request #3", "request #6"])
+
+        # at WARNING (the production default) nothing normal gets logged
+        self.handler.records = list()
+        self.lg.setLevel(logging.WARNING)
+
+        for i in range(7):
+            requestLog.logRequest(data, clientObj, 0.01)
+
+        self.assertEqual(self._messages(), [])
+
+    def testSlowAndFailedAlwaysLogged(self):
+
+        self.lg.setLevel(logging.WARNING)
+        requestLog = RequestLogger(self.lg, 0, 256, slowSeconds=1.0)
+        clientObj, data = createClientObj()
+
+        requestLog.logRequest(data, clientObj, 0.999)
+        requestLog.logRequest(data, clientObj, 1.5)
+        requestLog.logRequest(data, clientObj, 0.01, failed=True)
+        requestLog.logRequest(data)
+
+        self.assertEqual([iterLevel for iterLevel, iterMessage in self._messages()], ["WARNING", "WARNING"])
+        self.assertIn("took 1.500 seconds", self._messages()[0][1])
+        self.assertIn("FAILED", self._messages()[1][1])
+
+        # with slowSeconds at 0 only the failed one is
+        self.handler.records = list()
+        requestLog = RequestLogger(self.lg, 0, 256)
+
+        requestLog.logRequest(data, clientObj, 100.0)
+        requestLog.logRequest(data, clientObj, 100.0, failed=True)
+
+        self.assertEqual(len(self._messages()), 1)
+
+    def testRecordFormat(self):
+
+        self.lg.setLevel(logging.DEBUG)
+        requestLog = RequestLogger(self.lg, 1, 8)
+        clientObj, data = createClientObj("abc")
+
+        requestLog.logRequest(data, clientObj, 0.25)
+
+        messages = self._messages()
+
+        self.assertEqual(messages[0], ("INFO",
+            "request #1 from client abc: SERVER_QUERY asking for NEED_FULL_DB, took 0.250 seconds, {} bytes".format(len(data))))
+
+        # the body and the decoded message get cut down to previewBytes
+        self.assertEqual(messages[1], ("DEBUG", "\trequest body: {!r}... ({} more)".format(data[:8], len(data) - 8)))
+        self.assertEqual(messages[2], ("DEBUG", "\tdecoded: {!r}... ({} more)".format(str(clientObj)[:8], len(str(clientObj)) - 8)))
+
+        # a request that couldn't be decoded, and doesn't say how long it took
+        self.handler.records = list()
+        requestLog.logRequest(b"junk")
+
+        self.assertEqual(self._messages(), [("INFO", "request #2 from client None: undecodable message, 4 bytes"),
+            ("DEBUG", "\trequest body: b'junk'")])
+
+    def testDebugClientIds(self):
+
+        self.lg.setLevel(logging.WARNING)
+        requestLog = RequestLogger(self.lg, 0, 256, debugClientIds=["watched"])
+
+        watchedObj, watchedData = createClientObj("watched")
+        otherObj, otherData = createClientObj("other")
+
+        requestLog.logRequest(otherData, otherObj, 0.01)
+        requestLog.logRequest(watchedData, watchedObj, 0.01)
+
+        # everything about the watched phone, at WARNING, and nothing about the other one
+        self.assertEqual([iterLevel for iterLevel, iterMessage in self._messages()], ["WARNING"] * 3)
+        self.assertTrue(self._messages()[0][1].startswith("request from client watched: "))
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#
+# timing of the stages (parsing, ServerDatabase lookups, reading files, compression...) of each request that
+# sunspot_server.py handles. Each request gets a RequestTimer, which becomes the request's Server-Timing header
+# and gets added to the RequestTimingStats histograms that the /stats page shows
+#
+
+import collections
+import contextlib
+import os
+import threading
+import time
+
+from server_stats import LatencyHistogram
+
+
+class RequestTimer:
+    ''' times the stages (spans) of one request. Use it like:
+
+        with timer.span("db"):
+            ...
+
+    then call finish() once the request is done'''
+
+    def __init__(self):
+        ''' constructor, the total time of the request starts now'''
+
+        self.startTime = time.perf_counter()
+        self.totalSeconds = None
+
+        # span name -> seconds, in the order they happened. A span that happens more then once gets added up
+        self.spans = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        ''' context manager that times whatever is inside the with block, it counts even if it raises
+        an exception (or returns)
+
+        @param name - the name of the span, this is a HTTP token in the Server-Timing header, so no spaces'''
+
+        startTime = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0) + time.perf_counter() - startTime
+
+    def finish(self):
+        ''' stops the clock for the total time of the request'''
+
+        self.totalSeconds = time.perf_counter() - self.startTime
+
+    def serverTimingHeader(self):
+        ''' creates the value of the Server-Timing header, like 'parse;dur=0.120, db;dur=1.503, total;dur=2.000'
+
+        @return a string, the durations are in milliseconds'''
+
+        spans = list(self.spans.items())
+        if self.totalSeconds is not None:
+            spans.append(("total", self.totalSeconds))
+
+        return ", ".join("{};dur={:.3f}".format(iterName, iterSeconds * 1000) for iterName, iterSeconds in spans)
+
+
+class RequestTimingStats:
+    ''' a LatencyHistogram for each span name (plus 'total') of every request this process has handled.
+    cherrypy runs requests on a pool of threads, so this takes a lock'''
+
+    def __init__(self):
+        ''' constructor'''
+
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+
+        self.requests = 0
+
+        # span name -> LatencyHistogram
+        self.spans = dict()
+
+    def record(self, timer):
+        ''' adds the spans of a finished request
+
+        @param timer - the request's RequestTimer, after finish() was called on it'''
+
+        spans = list(timer.spans.items())
+        spans.append(("total", timer.totalSeconds))
+
+        with self.lock:
+
+            self.requests += 1
+
+            for iterName, iterSeconds in spans:
+
+                if iterName not in self.spans:
+                    self.spans[iterName] = LatencyHistogram()
+
+                self.spans[iterName].record(iterSeconds)
+
+    def toDict(self):
+        ''' the stats as a dictionary that can be turned into JSON. The percentiles are estimates from the
+        histogram buckets (see Histogram.percentile()) and everything is in milliseconds
+
+        @return a dictionary'''
+
+        result = collections.OrderedDict([
+            ("pid", os.getpid()),
+            ("uptime_seconds", time.time() - self.startTime)])
+
+        spans = collections.OrderedDict()
+
+        with self.lock:
+
+            result["requests"] = self.requests
+
+            for iterName in sorted(self.spans.keys()):
+
+                iterHistogram = self.spans[iterName]
+
+                spans[iterName] = collections.OrderedDict([
+                    ("count", iterHistogram.count),
+                    ("mean_ms", iterHistogram.total / iterHistogram.count * 1000),
+                    ("p50_ms", iterHistogram.percentile(0.5) * 1000),
+                    ("p95_ms", iterHistogram.percentile(0.95) * 1000),
+                    ("p99_ms", iterHistogram.percentile(0.99) * 1000),
+                    ("max_ms", iterHistogram.max * 1000),
+                    ("buckets", [[None if iterBound is None else iterBound * 1000, iterCount]
+                        for iterBound, iterCount in iterHistogram.buckets()])])
+
+        result["spans"] = spans
+
+        return result
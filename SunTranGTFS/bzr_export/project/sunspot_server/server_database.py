@@ -1,8 +1,11 @@
-import leveldb
 import logging
 import socket
-import arrow
+import asyncio
+import collections
+import contextlib
+import time
 from leveldb_server_messages_pb2 import LeveldbServerMessages
+import leveldb_server_frames
 
 class ServerDatabaseEnums:
     ''' this class will hold various full keys or 'prefixes' for leveldb keys
@@ -17,7 +20,198 @@ class ServerDatabaseEnums:
 
 
 
-class ServerDatabase:
+class ResponseTooLargeError(Exception):
+    ''' the leveldb_server sent us a RESPONSE_TOO_LARGE error, the answer to the query wouldn't fit in one
+    message. Unlike the other errors the connection is still open, so ask for less at once and try again'''
+
+
+
+
+class ServerDatabaseWriteBatch:
+    ''' a bunch of sets and deletes that get sent to the leveldb_server all at once and applied all at once, 
+    nobody reading from the leveldb_server sees some of them without the rest. Nothing is sent until the 
+    batch is committed, so reading a key you set in the batch gets you the old value.
+
+    Get one of these from ServerDatabase.writeBatch()'''
+
+    def __init__(self):
+        ''' constructor'''
+
+        # list of LeveldbServerMessages.BatchOperation objects, in the order they were added
+        self.operations = list()
+
+    def _addOperation(self, opType, key, value=None, endKey=None):
+        ''' helper method that adds a BatchOperation
+
+        @param opType - the BatchOperation type
+        @param key - the key as a string
+        @param value - the value as a string, or None
+        @param endKey - the end of the range as a string for DELETE_RANGE, or None'''
+
+        tmpOp = LeveldbServerMessages.BatchOperation()
+        tmpOp.type = opType
+        tmpOp.key = key.encode("utf-8")
+
+        if value is not None:
+            tmpOp.value = value.encode("utf-8")
+
+        if endKey is not None:
+            tmpOp.rangeiter_end = endKey.encode("utf-8")
+
+        self.operations.append(tmpOp)
+
+    def __setitem__(self, key, value):
+        '''implementation of batch[item] = something
+
+        @param key - a string
+        @param value - a string'''
+
+        self._addOperation(LeveldbServerMessages.BatchOperation.PUT, key, value)
+
+    def __delitem__(self, key):
+        '''implementation of del batch["item"]
+
+        @param key - a string'''
+
+        self._addOperation(LeveldbServerMessages.BatchOperation.DELETE, key)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def setWithPrefix(self, key, formatEntries, value):
+        ''' same as ServerDatabase.setWithPrefix, but in the batch'''
+
+        self[key.format(*formatEntries)] = value
+
+    def deleteAllInRange(self, rangeStr, formatEntries, endKey=None):
+        ''' same as ServerDatabase.deleteAllInRange, but in the batch. Only deletes keys that are in 
+        the database before the batch is applied, not ones that were set earlier in this batch
+
+        @param rangeStr - the string key to start deleting at, that has some format markers ({}), if @endKey is None
+            then it is treated as a prefix
+        @param formatEntries - an iterable we use when we call .format() on @rangeStr
+        @param endKey - the string key to stop deleting at (its deleted too), or None'''
+
+        self._addOperation(LeveldbServerMessages.BatchOperation.DELETE_RANGE, rangeStr.format(*formatEntries), endKey=endKey)
+
+
+
+
+class BaseServerDatabase:
+    ''' the stuff that is shared between ServerDatabase and AsyncServerDatabase, creating the protobuf
+    queries that we send to the leveldb_server and logging'''
+
+    # how many keys multiGet() asks for in one MULTI_GET, if the values are big enough that the response still
+    # doesn't fit in one message, the batch gets split in half until it does
+    multiGetBatchKeys = 500
+
+    def _log(self, msg, *args, severity=logging.DEBUG):
+        ''' logs a message under the DEBUG level, overridden by subclasses
+
+        like the logging module, the message is only formatted with @args if it is actually going to be
+        logged, so pass the arguments rather then calling .format() yourself
+
+        @param msg - the message to log, with %s style format markers
+        @param args - the arguments for the format markers in @msg
+        @param severity - what severity to log this message under, defaults to DEBUG
+        '''
+
+        if self.lg:
+            self.lg.log(severity, msg, *args)
+
+    def _isLogEnabled(self, severity=logging.DEBUG):
+        ''' sees if a message at @severity would actually get logged, so we can skip building
+        expensive log messages (like turning a whole protobuf message into text), overridden by subclasses
+
+        @param severity - the severity to check, defaults to DEBUG
+        @return True or False'''
+
+        return bool(self.lg) and self.lg.isEnabledFor(severity)
+
+    def _errorFromServer(self, protoResult):
+        ''' helper method that turns an ERROR message from the leveldb_server into the exception to raise
+
+        @param protoResult - the ActualData protobuf object of type ERROR
+        @return a ResponseTooLargeError if the server said the response was too big (and the connection is still
+            open), otherwise an Exception (and the server has closed the connection)'''
+
+        msg = "leveldb_server sent us an error: {}, {}".format(protoResult.error.error_code, protoResult.error.error_message)
+
+        if protoResult.error.error_code == LeveldbServerMessages.Error.RESPONSE_TOO_LARGE:
+            return ResponseTooLargeError(msg)
+
+        return Exception(msg)
+
+    def _multiGetBatches(self, keys):
+        ''' helper method that splits the keys for a multiGet into batches of at most multiGetBatchKeys keys,
+        a MULTI_GET with all of them at once could have a response too big for one message
+
+        @param keys - an iterable of strings
+        @return a list of lists of strings'''
+
+        keys = list(keys)
+
+        return [keys[i:i + self.multiGetBatchKeys] for i in range(0, len(keys), self.multiGetBatchKeys)]
+
+    def _createProtoQuery(self):
+        ''' helper method that creates the LeveldbServerMessages.ActualData object for us, sets the timestamp
+        and the type, and then returns it for us
+
+        this is for a ServerQuery
+
+        @return a ActualData protobuf object'''
+
+        protoObj = LeveldbServerMessages.ActualData()
+        protoObj.timestamp = int(time.time()) # int64, same as arrow.now().timestamp but a lot cheaper
+        protoObj.type = LeveldbServerMessages.ActualData.QUERY
+        
+        return protoObj
+
+    def _isProtoComplete(self, protoObj):
+        ''' helper method that sees if a protobuf object is complete
+        and we can send it. TODO this should probably be a decorator...
+
+        @param protoObj - the protobuf object to check
+
+        @return if the protoObj is not complete, then we raise an exception, if not, we return
+            the protoObj serialized as bytes'''
+
+        if protoObj.IsInitialized():
+            return protoObj.SerializeToString()
+        else:
+            self._log("Protobuf object is not complete!", severity=logging.ERROR)
+            raise ValueError("protobuf object is not complete!")
+
+    def _createBatchQuery(self, batch):
+        ''' helper method that creates the WRITE_BATCH query for a ServerDatabaseWriteBatch
+
+        @param batch - the ServerDatabaseWriteBatch
+        @return a ActualData protobuf object'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.WRITE_BATCH
+        protoObj.query.batch_operations.extend(batch.operations)
+
+        return protoObj
+
+    def _createConnectionOptionsQuery(self, compactFrames, echoQuery):
+        ''' helper method that creates the SET_CONNECTION_OPTIONS query
+
+        @param compactFrames - if True, we send GET, SET and DELETE as compact frames (see leveldb_server_frames.py)
+        @param echoQuery - if False, the leveldb_server doesn't send the query back to us in every response
+        @return a ActualData protobuf object'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.SET_CONNECTION_OPTIONS
+        protoObj.query.connection_options.compact_frames = compactFrames
+        protoObj.query.connection_options.echo_query = echoQuery
+
+        return protoObj
+
+
+
+
+class ServerDatabase(BaseServerDatabase):
     ''' class that wraps around a LevelDB database that holds various stuff about the state of our server,
     what databases we have, what patches we have, what is the latest version of the GTFS data, etc.
 
@@ -26,11 +220,16 @@ class ServerDatabase:
 
 
 
-    def __init__(self, ipAddr, port, logger=None):
+    def __init__(self, ipAddr, port, logger=None, unixSocketPath=None, compactFrames=False, echoQuery=True):
         '''constructor
         @param ipAddr - the ip address as a string of the leveldb_server that we want to connect to
         @param port - the port as a string of the leveldb_server that we want to connect to
-        @param logger - a logger object'''
+        @param logger - a logger object
+        @param unixSocketPath - if not None, then we connect to the leveldb_server over the unix domain socket
+            at this path, and @ipAddr and @port are ignored
+        @param compactFrames - if True, send GET, SET and DELETE (outside of a snapshot) as compact frames rather
+            then protobuf messages, which is less work for both us and the leveldb_server
+        @param echoQuery - if False, the leveldb_server doesn't send our query back to us in every response'''
 
         # self.db = leveldb.LevelDB(databasePath)
         # self.dbFilePath = databasePath
@@ -38,9 +237,48 @@ class ServerDatabase:
 
         self.lg = logger
 
+        # if not None, reads are done against this snapshot, see snapshot()
+        self.snapshotId = None
+
         #self._log("Opening database at {}".format(databasePath))
 
-        self.socket = socket.create_connection((ipAddr, port))
+        if unixSocketPath:
+            self._log("connecting to leveldb_server over unix socket at %s", unixSocketPath)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(unixSocketPath)
+        else:
+            self.socket = socket.create_connection((ipAddr, port))
+
+        self.compactFrames = compactFrames
+
+        # we don't wait for the answer to SET_CONNECTION_OPTIONS, it gets read (in _socketRecvResponse()) right before
+        # the response to the first real query, so changing the options doesn't cost us a round trip
+        self.connectionOptionsPending = False
+
+        if compactFrames or not echoQuery:
+            self._socketSend(self._isProtoComplete(self._createConnectionOptionsQuery(compactFrames, echoQuery)))
+            self.connectionOptionsPending = True
+
+    @classmethod
+    def fromConstants(cls, constantsObj, logger=None, replica=False):
+        ''' creates a ServerDatabase (or a subclass) that connects to wherever the Constants say the
+        leveldb_server is listening, either the unix domain socket or the host/port, with the connection
+        options that the Constants say to use
+
+        @param constantsObj - a Constants object
+        @param logger - a logger object
+        @param replica - if True, connect to the read only replica (leveldb_replica.py) at LEVELDB_REPLICA_HOST/PORT
+            or LEVELDB_REPLICA_UNIX_SOCKET_PATH instead, which refuses writes
+        @return a new ServerDatabase object'''
+
+        if replica:
+            return cls(constantsObj.LEVELDB_REPLICA_HOST, constantsObj.LEVELDB_REPLICA_PORT, logger, 
+                constantsObj.LEVELDB_REPLICA_UNIX_SOCKET_PATH or None, constantsObj.LEVELDB_SERVER_COMPACT_FRAMES,
+                constantsObj.LEVELDB_SERVER_ECHO_QUERY)
+
+        return cls(constantsObj.LEVELDB_SERVER_HOST, constantsObj.LEVELDB_SERVER_PORT, logger, 
+            constantsObj.LEVELDB_SERVER_UNIX_SOCKET_PATH or None, constantsObj.LEVELDB_SERVER_COMPACT_FRAMES,
+            constantsObj.LEVELDB_SERVER_ECHO_QUERY)
 
     def _socketSend(self, msg):
         ''' method to handle sending / writing data to the socket that is connected to the 'leveldb_server'.
@@ -59,7 +297,7 @@ class ServerDatabase:
         while totalsent < msgLen:
             sent = self.socket.send(actualMsg[totalsent:])
             if sent == 0:
-                self._log("Got 0 bytes on socket.send(), connection is broken!", severity="ERROR")
+                self._log("Got 0 bytes on socket.send(), connection is broken!", severity=logging.ERROR)
                 raise RuntimeError("socket connection broken")
             totalsent = totalsent + sent
 
@@ -75,6 +313,29 @@ class ServerDatabase:
         # then read 'SIZE' bytes and return it
         return self._socketRecv(sizePrefix)
 
+    def _socketRecvResponse(self):
+        ''' reads the next response from the leveldb_server, after reading the response to SET_CONNECTION_OPTIONS
+        if we haven't read that yet
+
+        @return the bytes of the response, without the size prefix'''
+
+        if self.connectionOptionsPending:
+
+            self.connectionOptionsPending = False
+            protoResult = LeveldbServerMessages.ActualData.FromString(self._socketRecvWithSizePrefix())
+
+            if protoResult.type != LeveldbServerMessages.ActualData.RESPONSE:
+                # the server closes the connection after it sends us an error, so there is nothing to fall back to
+                self._log("leveldb_server didn't accept our connection options: %s, %s", protoResult.error.error_code, 
+                    protoResult.error.error_message, severity=logging.ERROR)
+                raise Exception("leveldb_server didn't accept our connection options, it might be older then this "
+                    "ServerDatabase (try LEVELDB_SERVER_COMPACT_FRAMES: false). error: {}, {}".format(
+                    protoResult.error.error_code, protoResult.error.error_message))
+
+            self._log("connection options are now: %s", protoResult.response.connection_options)
+
+        return self._socketRecvWithSizePrefix()
+
     def _socketRecv(self, msgLen):
         ''' method to handle reading / receiving data from the socket that is connected to the 'leveldb_server'.
         Since a socket can read only part of the data that was sent, we need to keep trying until we have read
@@ -90,7 +351,7 @@ class ServerDatabase:
             #print("\treading, msgLen is {}".format(msgLen))
             chunk = self.socket.recv(min(msgLen - bytes_recd, 2048))
             if chunk == b'':
-                self._log("Got 0 bytes on socket.recv(), connection is broken!", severity="ERROR")
+                self._log("Got 0 bytes on socket.recv(), connection is broken!", severity=logging.ERROR)
                 raise RuntimeError("socket connection broken")
             #print("\t\tgot chunk: {}".format(chunk))
             chunks.append(chunk)
@@ -99,44 +360,70 @@ class ServerDatabase:
         #print("\tdone reading")
         return b''.join(chunks)
 
-    def _log(self, msg, severity=logging.DEBUG):
-        ''' logs a message under the DEBUG level, overridden by subclasses
-        @param msg - the message to log
-        @param severity - what severity to log this message under, defaults to DEBUG
-        '''
+    def _sendQueryAndGetResponse(self, protoObj):
+        ''' helper method that sends a ServerQuery to the leveldb_server and waits for the response
 
-        if self.lg:
-            self.lg.log(severity, msg)
+        @param protoObj - the ActualData protobuf object (from _createProtoQuery()) with the query filled out
+        @return the ServerResponse protobuf object that the server sent back'''
 
-    def _createProtoQuery(self):
-        ''' helper method that creates the LeveldbServerMessages.ActualData object for us, sets the timestamp
-        and the type, and then returns it for us
+        # turning the protobuf messages into text is expensive, so only do it if its going to be logged
+        isDebug = self._isLogEnabled(logging.DEBUG)
 
-        this is for a ServerQuery
+        # if we are inside snapshot(), then read from the snapshot. The leveldb_server ignores this for writes
+        if self.snapshotId is not None and not protoObj.query.HasField("snapshot_id"):
+            protoObj.query.snapshot_id = self.snapshotId
 
-        @return a ActualData protobuf object'''
+        # send it
+        self._socketSend(self._isProtoComplete(protoObj))
+        if isDebug:
+            self._log("Sending proto message: %s", protoObj)
 
-        protoObj = LeveldbServerMessages.ActualData()
-        protoObj.timestamp = arrow.now().timestamp # int64
-        protoObj.type = LeveldbServerMessages.ActualData.QUERY
-        
-        return protoObj
+        # wait for response and return it, we get back bytes of a protobuf object
+        resultBytes = self._socketRecvResponse()
+        if isDebug:
+            self._log("got back bytes: %s", resultBytes)
 
-    def _isProtoComplete(self, protoObj):
-        ''' helper method that sees if a protobuf object is complete
-        and we can send it. TODO this should probably be a decorator...
+        protoResult = LeveldbServerMessages.ActualData.FromString(resultBytes)
+        if isDebug:
+            self._log("recieved protoMessage: %s", protoResult)
 
-        @param protoObj - the protobuf object to check
+        if protoResult.type == LeveldbServerMessages.ActualData.ERROR:
+            # the server closes the connection after it sends us an error, unless it was RESPONSE_TOO_LARGE
+            self._log("leveldb_server sent us an error: %s, %s", protoResult.error.error_code, 
+                protoResult.error.error_message, severity=logging.ERROR)
+            raise self._errorFromServer(protoResult)
 
-        @return if the protoObj is not complete, then we raise an exception, if not, we return
-            the protoObj serialized as bytes'''
+        return protoResult.response
 
-        if protoObj.IsInitialized():
-            return protoObj.SerializeToString()
-        else:
-            self._log("Protobuf object is not complete!", severity=logging.ERROR)
-            raise ValueError("protobuf object is not complete!")
+    def _sendCompactQueryAndGetResponse(self, queryType, key, value=b""):
+        ''' helper method that sends a GET, SET or DELETE to the leveldb_server as a compact frame, see leveldb_server_frames.py
+
+        @param queryType - the ServerQuery type
+        @param key - the key as bytes
+        @param value - the value as bytes, only for SET
+        @return a two-tuple of (ServerResponse type, value as bytes)'''
+
+        self._socketSend(leveldb_server_frames.packQuery(queryType, key, value))
+
+        resultBytes = self._socketRecvResponse()
+
+        if not leveldb_server_frames.isCompactFrame(resultBytes):
+
+            # the only protobuf message we get back for a compact frame is an error, and the server closes the connection after it
+            # (unless it was RESPONSE_TOO_LARGE)
+            protoResult = LeveldbServerMessages.ActualData.FromString(resultBytes)
+            self._log("leveldb_server sent us an error: %s, %s", protoResult.error.error_code, 
+                protoResult.error.error_message, severity=logging.ERROR)
+            raise self._errorFromServer(protoResult)
 
+        return leveldb_server_frames.unpackResponse(resultBytes)
+
+    def _useCompactFrames(self):
+        ''' sees if the next GET, SET or DELETE can go as a compact frame, they can't say what snapshot to read from
+
+        @return True or False'''
+
+        return self.compactFrames and self.snapshotId is None
 
     def __getitem__(self, key):
         '''implementation of obj[item]
@@ -144,42 +431,37 @@ class ServerDatabase:
         @param key - a string
         @return A STRING'''
 
-        self._log("retrieving value from key '{}'".format(key))
+        self._log("retrieving value from key '%s'", key)
 
         #return self.db.Get(key.encode("utf-8")).decode("utf-8")
-        
-        protoObj = self._createProtoQuery()
-        query = protoObj.query
 
-        # set the key, encoded into bytes
-        query.key = key.encode("utf-8")
-        # set the operation we want the server to do
-        query.type = LeveldbServerMessages.ServerQuery.GET
+        if self._useCompactFrames():
+            respType, returnedValue = self._sendCompactQueryAndGetResponse(LeveldbServerMessages.ServerQuery.GET, key.encode("utf-8"))
 
-        # send it
-        self._socketSend(self._isProtoComplete(protoObj))
-        self._log("Sending proto message: {}".format(str(protoObj)))
+        else:
+            protoObj = self._createProtoQuery()
+            query = protoObj.query
 
-        # wait for response and return it, we get back bytes of a protobuf object
-        resultBytes = self._socketRecvWithSizePrefix()
-        self._log("got back bytes: {}".format(resultBytes))
+            # set the key, encoded into bytes
+            query.key = key.encode("utf-8")
+            # set the operation we want the server to do
+            query.type = LeveldbServerMessages.ServerQuery.GET
 
-        # figure out if the server sent us a KeyError or a real value
-        protoResult = LeveldbServerMessages.ActualData.FromString(resultBytes)
-        self._log("recieved protoMessage: {}".format(str(protoResult)))
-        resp = protoResult.response
+            resp = self._sendQueryAndGetResponse(protoObj)
+            respType, returnedValue = resp.type, resp.returned_value
 
-        if resp.type == LeveldbServerMessages.ServerResponse.GET_PRODUCED_KEYERROR:
+        # figure out if the server sent us a KeyError or a real value
+        if respType == LeveldbServerMessages.ServerResponse.GET_PRODUCED_KEYERROR:
             # key error happened, raise the exception as normal
             self._log("Got keyerror from server!", severity=logging.ERROR)
-            raise KeyError(resp.query_ran.key.decode("utf-8"))
+            raise KeyError(key)
 
-        elif resp.type == LeveldbServerMessages.ServerResponse.GET_RETURNED_VALUE:
+        elif respType == LeveldbServerMessages.ServerResponse.GET_RETURNED_VALUE:
             # return the value
-            self._log("got normal value back from server, {}".format(resp.returned_value))
-            return resp.returned_value.decode("utf-8")
+            self._log("got normal value back from server, %s", returnedValue)
+            return returnedValue.decode("utf-8")
         else:
-            self._log("Didn't get an expected ServerResponse type! got: {}".format())
+            self._log("Didn't get an expected ServerResponse type! got: %s", respType, severity=logging.ERROR)
             raise Exception("Unexpected ServerResponse")
 
 
@@ -192,39 +474,33 @@ class ServerDatabase:
         @param value - a string
         '''
 
-        self._log("Setting key: '{}' , value: '{}'".format(key, value))
+        self._log("Setting key: '%s' , value: '%s'", key, value)
 
         #self.db.Put(key.encode("utf-8"), value.encode("utf-8"))
 
-        protoObj = self._createProtoQuery()
-        query = protoObj.query
+        if self._useCompactFrames():
+            respType, returnedValue = self._sendCompactQueryAndGetResponse(LeveldbServerMessages.ServerQuery.SET, 
+                key.encode("utf-8"), value.encode("utf-8"))
 
-        # set the key, encoded into bytes
-        query.key = key.encode("utf-8")
-        query.value = value.encode("utf-8")
+        else:
+            protoObj = self._createProtoQuery()
+            query = protoObj.query
 
-        # set the operation we want the server to do
-        query.type = LeveldbServerMessages.ServerQuery.SET
+            # set the key, encoded into bytes
+            query.key = key.encode("utf-8")
+            query.value = value.encode("utf-8")
 
-         # send it
-        self._socketSend(self._isProtoComplete(protoObj))
-        self._log("Sending proto message: {}".format(str(protoObj)))
+            # set the operation we want the server to do
+            query.type = LeveldbServerMessages.ServerQuery.SET
 
-        # wait for response and return it, we get back bytes of a protobuf object
-        resultBytes = self._socketRecvWithSizePrefix()
-        self._log("got back bytes: {}".format(resultBytes))
+            respType = self._sendQueryAndGetResponse(protoObj).type
 
-         # figure out if the server sent us a KeyError or a real value
-        protoResult = LeveldbServerMessages.ActualData.FromString(resultBytes)
-        self._log("recieved protoMessage: {}".format(str(protoResult)))
-        resp = protoResult.response
-
-        if resp.type == LeveldbServerMessages.ServerResponse.SET_SUCCESSFUL:
+        if respType == LeveldbServerMessages.ServerResponse.SET_SUCCESSFUL:
 
             self._log("set was successful!")
 
         else:
-            raise Exception("Got a unsuccessful server message for set! {}".format(resp.type))
+            raise Exception("Got a unsuccessful server message for set! {}".format(respType))
 
 
 
@@ -234,40 +510,43 @@ class ServerDatabase:
         @param key - a string
         '''
 
-        self._log("Deleting key: '{}'".format(key))
+        self._log("Deleting key: '%s'", key)
         #self.db.Delete(key.encode("utf-8"))
 
+        if self._useCompactFrames():
+            respType, returnedValue = self._sendCompactQueryAndGetResponse(LeveldbServerMessages.ServerQuery.DELETE, key.encode("utf-8"))
 
-        protoObj = self._createProtoQuery()
-        query = protoObj.query
-
-        # set the key, encoded into bytes
-        query.key = key.encode("utf-8")
-
-        # set the operation we want the server to do
-        query.type = LeveldbServerMessages.ServerQuery.DELETE
+        else:
+            protoObj = self._createProtoQuery()
+            query = protoObj.query
 
-        # send it
-        self._socketSend(self._isProtoComplete(protoObj))
-        self._log("Sending proto message: {}".format(str(protoObj)))
+            # set the key, encoded into bytes
+            query.key = key.encode("utf-8")
 
-        # wait for response and return it, we get back bytes of a protobuf object
-        resultBytes = self._socketRecvWithSizePrefix()
-        self._log("got back bytes: {}".format(resultBytes))
+            # set the operation we want the server to do
+            query.type = LeveldbServerMessages.ServerQuery.DELETE
 
-         # figure out if the server sent us a KeyError or a real value
-        protoResult = LeveldbServerMessages.ActualData.FromString(resultBytes)
-        self._log("recieved protoMessage: {}".format(str(protoResult)))
-        resp = protoResult.response
+            respType = self._sendQueryAndGetResponse(protoObj).type
 
-        if resp.type == LeveldbServerMessages.ServerResponse.DELETE_SUCCESSFUL:
+        if respType == LeveldbServerMessages.ServerResponse.DELETE_SUCCESSFUL:
             self._log("Delete was successful!")
 
         else:
-            raise Exception("Got an unsuccessful server message for delete! {}".format(resp.type))
+            raise Exception("Got an unsuccessful server message for delete! {}".format(respType))
 
 
 
+    def close(self):
+        ''' closes the connection to the leveldb_server, which also makes a call that is waiting on it in another
+        thread (like getChanges()) fail. You don't have to call this, __del__ does it too'''
+
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # already closed, or never connected
+
+        self.socket.close()
+
     def __del__(self):
         ''' destructor'''
 
@@ -280,7 +559,7 @@ class ServerDatabase:
             self.socket.close()
 
         except Exception as e:
-            self._log("Error in deconstructor: {}".format(e))
+            self._log("Error in deconstructor: %s", e)
             pass
 
         self._log("ServerDatabase.__del__() called")
@@ -327,7 +606,7 @@ class ServerDatabase:
 
         thekey = key.format(*formatEntries)
 
-        self._log("get generator with prefix: key: {}, formatEntries: {}".format(key, formatEntries))
+        self._log("get generator with prefix: key: %s, formatEntries: %s", key, formatEntries)
 
 
         protoObj = self._createProtoQuery()
@@ -339,18 +618,7 @@ class ServerDatabase:
         # set the operation we want the server to do
         query.type = LeveldbServerMessages.ServerQuery.RETURN_ATONCE_RANGE_ITER
 
-        # send it
-        self._socketSend(self._isProtoComplete(protoObj))
-        self._log("Sending proto message: {}".format(str(protoObj)))
-
-        # wait for response and return it, we get back bytes of a protobuf object
-        resultBytes = self._socketRecvWithSizePrefix()
-        self._log("got back bytes: {}".format(resultBytes))
-
-         # figure out if the server sent us a KeyError or a real value
-        protoResult = LeveldbServerMessages.ActualData.FromString(resultBytes)
-        self._log("recieved protoMessage: {}".format(str(protoResult)))
-        resp = protoResult.response
+        resp = self._sendQueryAndGetResponse(protoObj)
         if resp.type == LeveldbServerMessages.ServerResponse.RANGEITER_ATONCE_RETURNED:
 
             self._log("return range atonce successful")
@@ -391,23 +659,12 @@ class ServerDatabase:
 
         # set the key, encoded into bytes
         tmp = rangeStr.format(*formatEntries)
-        query.rangeiter_start = tmp.encode("utf-8")
+        query.key = tmp.encode("utf-8") # key is also the rangeiter start
 
         # set the operation we want the server to do
         query.type = LeveldbServerMessages.ServerQuery.DELETE_ALL_IN_RANGE
 
-        # send it
-        self._socketSend(self._isProtoComplete(protoObj))
-        self._log("Sending proto message: {}".format(str(protoObj)))
-
-        # wait for response and return it, we get back bytes of a protobuf object
-        resultBytes = self._socketRecvWithSizePrefix()
-        self._log("got back bytes: {}".format(resultBytes))
-
-         # figure out if the server sent us a KeyError or a real value
-        protoResult = LeveldbServerMessages.ActualData.FromString(resultBytes)
-        self._log("recieved protoMessage: {}".format(str(protoResult)))
-        resp = protoResult.response
+        resp = self._sendQueryAndGetResponse(protoObj)
 
         if resp.type == LeveldbServerMessages.ServerResponse.DELETE_SUCCESSFUL:
             self._log("Delete all in range successful!")
@@ -415,25 +672,801 @@ class ServerDatabase:
         else:
             raise Exception("Got an unsuccessful server message for delete all in range! {}".format(resp.type))
 
+    def multiGet(self, keys):
+        ''' looks up a bunch of keys in one round trip to the leveldb_server (or a few, for a lot of keys or
+        big values), rather then calling __getitem__ once per key
+
+        @param keys - an iterable of strings
+        @return a DICTIONARY of key -> value (both strings), keys that don't exist in the database
+            map to None rather then raising a KeyError'''
+
+        resultDict = dict()
+        batches = self._multiGetBatches(keys)
+
+        while batches:
+
+            batch = batches.pop()
+
+            try:
+                resultDict.update(self._multiGetBatch(batch))
+
+            except ResponseTooLargeError:
+
+                # one value on its own is too big, nothing we can do about that
+                if len(batch) == 1:
+                    raise
+
+                self._log("multi get of %s keys was too big for one response, splitting it", len(batch))
+                batches.extend([batch[:len(batch) // 2], batch[len(batch) // 2:]])
+
+        return resultDict
+
+    def _multiGetBatch(self, keys):
+        ''' helper method for multiGet() that sends one MULTI_GET
+
+        @param keys - a list of strings
+        @return a DICTIONARY of key -> value (both strings), keys that don't exist map to None'''
+
+        protoObj = self._createProtoQuery()
+        query = protoObj.query
+
+        # set the keys, encoded into bytes
+        query.multiple_keys.extend([iterKey.encode("utf-8") for iterKey in keys])
+
+        # set the operation we want the server to do
+        query.type = LeveldbServerMessages.ServerQuery.MULTI_GET
+
+        resp = self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type == LeveldbServerMessages.ServerResponse.MULTI_GET_RETURNED:
+
+            self._log("multi get successful")
+
+            resultDict = dict()
+            for iterResult in resp.multi_get_results:
+                resultDict[iterResult.key.decode("utf-8")] = iterResult.value.decode("utf-8") if iterResult.found else None
+
+            return resultDict
+
+        else:
+            raise Exception("Got an unsuccessful server message for multi get! {}".format(resp.type))
+
+    def multiGetWithPrefix(self, key, listOfFormatEntries):
+        ''' like getWithPrefix, but for many different formatEntries at once, in one round trip
+
+        @param key - the key to use to retrieve values from the leveldb database, that has some format markers ({})
+        @param listOfFormatEntries - a list of iterables, we call .format() on @key once with each of them
+        @return a LIST of values (strings) in the same order as @listOfFormatEntries, or None for the
+            keys that don't exist in the database'''
+
+        formattedKeys = [key.format(*iterFormatEntries) for iterFormatEntries in listOfFormatEntries]
+
+        resultDict = self.multiGet(formattedKeys)
+
+        return [resultDict[iterKey] for iterKey in formattedKeys]
+
+    def countRange(self, startKey, endKey=None):
+        ''' returns how many keys are in a range without having the leveldb_server send us the
+        keys or values
+
+        @param startKey - the string key to start counting at. If @endKey is None, then this is treated as a prefix, 
+            and we only count the keys that startwith() it
+        @param endKey - the string key to stop counting at, or None
+        @return an INT'''
+
+        protoObj = self._createProtoQuery()
+        query = protoObj.query
+
+        # set the keys, encoded into bytes
+        query.key = startKey.encode("utf-8")
+        if endKey is not None:
+            query.rangeiter_end = endKey.encode("utf-8")
+
+        # set the operation we want the server to do
+        query.type = LeveldbServerMessages.ServerQuery.COUNT_RANGE
+
+        resp = self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type == LeveldbServerMessages.ServerResponse.COUNT_RANGE_RETURNED:
+
+            self._log("count range successful, got %s", resp.range_count)
+            return resp.range_count
+
+        else:
+            raise Exception("Got an unsuccessful server message for count range! {}".format(resp.type))
+
+    def countWithPrefix(self, key, formatEntries):
+        ''' returns how many keys start with the @key formatted with @formatEntries (should be something from ServerDatabaseEnums )
+
+        @param key - the key prefix, that has some format markers ({})
+        @param formatEntries - an iterable we use when we call .format() on @key
+        @return an INT'''
+
+        return self.countRange(key.format(*formatEntries))
+
+    def getStats(self):
+        ''' asks the leveldb_server how its doing, operation counts and latencies, bytes in/out, connections,
+        range scan sizes and leveldb's own stats
+
+        @return a LeveldbServerMessages.ServerStats protobuf object'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.STATS
+
+        resp = self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type == LeveldbServerMessages.ServerResponse.STATS_RETURNED:
+            return resp.stats
+
+        else:
+            raise Exception("Got an unsuccessful server message for stats! {}".format(resp.type))
+
+    def openSnapshot(self):
+        ''' has the leveldb_server take a snapshot of the database, which you can read from with snapshot(), 
+        you probably want to use snapshot() instead of calling this directly. Release it with releaseSnapshot()
+
+        @return the snapshot id, an INT'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.OPEN_SNAPSHOT
+
+        resp = self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type == LeveldbServerMessages.ServerResponse.SNAPSHOT_OPENED:
+            self._log("opened snapshot %s", resp.snapshot_id)
+            return resp.snapshot_id
+
+        else:
+            raise Exception("Got an unsuccessful server message for open snapshot! {}".format(resp.type))
+
+    def releaseSnapshot(self, snapshotId):
+        ''' tells the leveldb_server we are done with a snapshot from openSnapshot()
+
+        @param snapshotId - the id of the snapshot'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.RELEASE_SNAPSHOT
+        protoObj.query.snapshot_id = snapshotId
+
+        resp = self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type == LeveldbServerMessages.ServerResponse.SNAPSHOT_RELEASED:
+            self._log("released snapshot %s", snapshotId)
+
+        else:
+            raise Exception("Got an unsuccessful server message for release snapshot! {}".format(resp.type))
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        ''' context manager where every read (__getitem__, getWithPrefix, getGeneratorWithPrefix, multiGet, countRange, etc) 
+        sees the database as it was when the with statement started, so several reads always agree with each other
+        even if something is writing to the database at the same time. Writes still go to the real database.
+        getGeneratorWithPrefix() doesn't send its query until you start iterating over it, so do that inside the with statement.
+
+            with serverDb.snapshot():
+                latestDbTime = serverDb[ServerDatabaseEnums.KEY_LAST_DOWNLOAD_TIME]
+                latestDbPath = serverDb.getWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [latestDbTime])
+
+        @return this ServerDatabase object'''
+
+        previousSnapshotId = self.snapshotId
+        snapshotId = self.openSnapshot()
+        self.snapshotId = snapshotId
+
+        try:
+            yield self
+
+        finally:
+            self.snapshotId = previousSnapshotId
+            self.releaseSnapshot(snapshotId)
+
+    def commitBatch(self, batch):
+        ''' sends a ServerDatabaseWriteBatch to the leveldb_server, where all of it is applied at once. 
+        You probably want to use writeBatch() instead of calling this directly
+
+        Note that the whole batch has to fit in one message (64KB)
+
+        @param batch - the ServerDatabaseWriteBatch'''
+
+        resp = self._sendQueryAndGetResponse(self._createBatchQuery(batch))
+
+        if resp.type == LeveldbServerMessages.ServerResponse.WRITE_BATCH_SUCCESSFUL:
+            self._log("write batch with %s operations successful", len(batch))
+
+        else:
+            raise Exception("Got an unsuccessful server message for write batch! {}".format(resp.type))
+
+    @contextlib.contextmanager
+    def writeBatch(self):
+        ''' context manager that gives you a ServerDatabaseWriteBatch, and commits it if the with statement
+        finishes without an exception. If there is an exception, then nothing in the batch is written.
+
+            with serverDb.writeBatch() as batch:
+                batch[ServerDatabaseEnums.KEY_LAST_DOWNLOAD_TIME] = "1234"
+                batch.setWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, ["1234"], "/some/path")
+
+        @return a ServerDatabaseWriteBatch'''
+
+        batch = ServerDatabaseWriteBatch()
+
+        yield batch
+
+        self.commitBatch(batch)
+
+    def openReplicationSnapshot(self):
+        ''' like openSnapshot(), but also gets where the leveldb_server's change log was when it took the snapshot,
+        so a replica can copy everything in the snapshot with getRangePage() and then keep up to date with
+        getChanges(), without missing or repeating a write. Release it with releaseSnapshot()
+
+        @return a three-tuple of (snapshot id, change sequence number, change log id), raises an Exception if
+            the leveldb_server doesn't keep a change log'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.OPEN_SNAPSHOT
+
+        resp = self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type != LeveldbServerMessages.ServerResponse.SNAPSHOT_OPENED:
+            raise Exception("Got an unsuccessful server message for open snapshot! {}".format(resp.type))
+
+        if not resp.HasField("change_log_id"):
+            self.releaseSnapshot(resp.snapshot_id)
+            raise Exception("leveldb_server doesn't keep a change log, is LEVELDB_SERVER_CHANGE_LOG_ENTRIES 0?")
+
+        self._log("opened replication snapshot %s at change %s of log %s", resp.snapshot_id, resp.change_sequence, resp.change_log_id)
+        return resp.snapshot_id, resp.change_sequence, resp.change_log_id
+
+    def getRangePage(self, startKey, endKey, limit, snapshotId=None):
+        ''' gets up to @limit keys and values from @startKey to @endKey (including @endKey), for copying a lot of
+        the database a page at a time. The leveldb_server also stops at about 60KB
+
+        @param startKey - the key (bytes) to start at, b"" for the beginning of the database
+        @param endKey - the key (bytes) to end at
+        @param limit - the most keys to get back
+        @param snapshotId - the snapshot to read from, or None for the live database (or the snapshot() we are in)
+        @return a two-tuple of (list of (key, value) two-tuples of bytes, True if there are more keys after these)'''
+
+        protoObj = self._createProtoQuery()
+        query = protoObj.query
+
+        query.type = LeveldbServerMessages.ServerQuery.RETURN_ATONCE_RANGE_ITER
+        query.key = startKey
+        query.rangeiter_end = endKey
+        query.limit = limit
+
+        if snapshotId is not None:
+            query.snapshot_id = snapshotId
+
+        resp = self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type == LeveldbServerMessages.ServerResponse.RANGEITER_ATONCE_RETURNED:
+            return [(iterKeyValue.key, iterKeyValue.value) for iterKeyValue in resp.multiple_returned_values], resp.has_more
+
+        else:
+            raise Exception("Got an unsuccessful server message for range page! {}".format(resp.type))
+
+    def getChanges(self, sinceSequence, waitMilliseconds=0, limit=None):
+        ''' asks the leveldb_server for the writes after @sinceSequence in its change log. If there aren't any, the 
+        leveldb_server waits up to @waitMilliseconds for one before answering, so don't use a connection that
+        anything else is using
+
+        @param sinceSequence - the sequence number of the last change we have
+        @param waitMilliseconds - how long the leveldb_server should wait for a change if there isn't one yet
+        @param limit - the most changes to get back, or None for the leveldb_server's default
+        @return the ServerResponse protobuf object, with changes, change_sequence, change_log_id, resync_needed and has_more'''
+
+        protoObj = self._createProtoQuery()
+        query = protoObj.query
+
+        query.type = LeveldbServerMessages.ServerQuery.GET_CHANGES
+        query.since_sequence = sinceSequence
+        query.wait_milliseconds = waitMilliseconds
+
+        if limit is not None:
+            query.limit = limit
+
+        resp = self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type == LeveldbServerMessages.ServerResponse.CHANGES_RETURNED:
+            self._log("got %s changes since %s, latest is %s", len(resp.changes), sinceSequence, resp.change_sequence)
+            return resp
+
+        else:
+            raise Exception("Got an unsuccessful server message for get changes! {}".format(resp.type))
+
 class CherrypyServerDatabase (ServerDatabase):
     ''' subclass of ServerDatabase, the only reason we do this
     is because cherrypy's LogManager is not a logging.logger so we have to do 
     something different in order to log'''
 
 
-    def _log(self, msg, severity=logging.DEBUG):
+    def _log(self, msg, *args, severity=logging.DEBUG):
         ''' overriding the '_log' method, which uses the cherrypy LogManager, which is a wrapper
         around a logging.Logger object, so we always log using error(), but we can specify a custom 
         prefix and severity
 
-        @param msg - the message to log
+        the LogManager formats the message right away, so we check the level of the logger it wraps first
+
+        @param msg - the message to log, with %s style format markers
+        @param args - the arguments for the format markers in @msg
         @param severity - what severity to log this message under, defaults to DEBUG'''
 
-        self.lg.error(msg, "ServerDatabase", severity=severity)
+        if not self._isLogEnabled(severity):
+            return
+
+        self.lg.error(msg % args if args else msg, "ServerDatabase", severity=severity)
+
+    def _isLogEnabled(self, severity=logging.DEBUG):
+        ''' overriding the '_isLogEnabled' method, the LogManager isn't a logging.Logger, so ask
+        the logger it uses for error() instead
+
+        @param severity - the severity to check, defaults to DEBUG
+        @return True or False'''
+
+        return self.lg.error_log.isEnabledFor(severity)
+
+
+class AsyncServerDatabase(BaseServerDatabase):
+    ''' asyncio version of ServerDatabase, for things that are running in an event loop and don't want to 
+    block it (or dedicate a thread to it) while waiting on the leveldb_server.
+
+    All of the methods are coroutines. Queries are pipelined, meaning that many coroutines can be waiting on
+    queries at the same time over the one connection, we write each query as soon as it is made and the 
+    leveldb_server answers them in the order they were sent, so we just match up the responses in order.
+
+    Create one of these with the connect() or fromConstants() coroutines rather then the constructor.
+    '''
+
+    def __init__(self, reader, writer, logger=None):
+        '''constructor, use connect() or fromConstants() instead of calling this directly
+
+        @param reader - the asyncio.StreamReader that is connected to the leveldb_server
+        @param writer - the asyncio.StreamWriter that is connected to the leveldb_server
+        @param logger - a logger object'''
+
+        self.lg = logger
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_event_loop()
+
+        # set by connect() once the leveldb_server has agreed to it
+        self.compactFrames = False
+
+        # futures for the queries that we have sent but haven't got a response for yet, in the order we sent them
+        self.pendingFutures = collections.deque()
+
+        self.readerTask = self.loop.create_task(self._readResponses())
+
+    @classmethod
+    @asyncio.coroutine
+    def connect(cls, ipAddr, port, logger=None, unixSocketPath=None, compactFrames=False, echoQuery=True):
+        ''' coroutine that connects to the leveldb_server and returns a new AsyncServerDatabase
+
+        @param ipAddr - the ip address as a string of the leveldb_server that we want to connect to
+        @param port - the port of the leveldb_server that we want to connect to
+        @param logger - a logger object
+        @param unixSocketPath - if not None, then we connect to the leveldb_server over the unix domain socket
+            at this path, and @ipAddr and @port are ignored
+        @param compactFrames - if True, send get(), set() and delete() (without a snapshot) as compact frames
+        @param echoQuery - if False, the leveldb_server doesn't send our query back to us in every response
+        @return a AsyncServerDatabase object'''
+
+        if unixSocketPath:
+            reader, writer = yield from asyncio.open_unix_connection(unixSocketPath)
+        else:
+            reader, writer = yield from asyncio.open_connection(ipAddr, port)
+
+        serverDb = cls(reader, writer, logger)
+
+        if compactFrames or not echoQuery:
+
+            # unlike ServerDatabase we wait for the answer here, since these connections stick around
+            resp = yield from serverDb._sendQueryAndGetResponse(serverDb._createConnectionOptionsQuery(compactFrames, echoQuery))
+
+            if resp.type != LeveldbServerMessages.ServerResponse.CONNECTION_OPTIONS_SET:
+                raise Exception("Got an unsuccessful server message for set connection options! {}".format(resp.type))
+
+            serverDb.compactFrames = resp.connection_options.compact_frames
+
+        return serverDb
+
+    @classmethod
+    @asyncio.coroutine
+    def fromConstants(cls, constantsObj, logger=None):
+        ''' coroutine that connects to wherever the Constants say the leveldb_server is listening
+
+        @param constantsObj - a Constants object
+        @param logger - a logger object
+        @return a AsyncServerDatabase object'''
+
+        return (yield from cls.connect(constantsObj.LEVELDB_SERVER_HOST, constantsObj.LEVELDB_SERVER_PORT, logger, 
+            constantsObj.LEVELDB_SERVER_UNIX_SOCKET_PATH or None, constantsObj.LEVELDB_SERVER_COMPACT_FRAMES,
+            constantsObj.LEVELDB_SERVER_ECHO_QUERY))
+
+    @asyncio.coroutine
+    def _readResponses(self):
+        ''' coroutine that runs for as long as we are connected, reading the size prefixed responses that the 
+        leveldb_server sends us and handing them to whatever future is next in line'''
+
+        try:
+            while True:
+
+                sizePrefix = yield from self.reader.readexactly(2)
+                resultBytes = yield from self.reader.readexactly(int.from_bytes(sizePrefix, "big"))
+
+                if leveldb_server_frames.isCompactFrame(resultBytes):
+                    protoResult = None
+                else:
+                    protoResult = LeveldbServerMessages.ActualData.FromString(resultBytes)
+
+                if not self.pendingFutures:
+                    self._log("Got a response from the server when we weren't waiting for one!", severity=logging.ERROR)
+                    continue
+
+                tmpFuture = self.pendingFutures.popleft()
+
+                # the coroutine that was waiting on this might have been cancelled
+                if tmpFuture.cancelled():
+                    continue
+
+                if protoResult is None:
+                    # the answer to a compact frame, the future gets a two-tuple of (response type, value)
+                    tmpFuture.set_result(leveldb_server_frames.unpackResponse(resultBytes))
+
+                elif protoResult.type == LeveldbServerMessages.ActualData.ERROR:
+                    # the server closes the connection after it sends us an error, so everything after this fails
+                    # too, unless it was RESPONSE_TOO_LARGE
+                    tmpFuture.set_exception(self._errorFromServer(protoResult))
+                else:
+                    tmpFuture.set_result(protoResult.response)
+
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self._log("connection to leveldb_server was lost: %s", e)
+
+        except asyncio.CancelledError:
+            self._log("stopped reading responses from the leveldb_server")
+
+        finally:
+
+            # nothing else is going to answer these
+            while self.pendingFutures:
+                tmpFuture = self.pendingFutures.popleft()
+                if not tmpFuture.done():
+                    tmpFuture.set_exception(ConnectionError("connection to the leveldb_server was lost"))
+
+    @asyncio.coroutine
+    def _sendQueryAndGetResponse(self, protoObj):
+        ''' coroutine that sends a ServerQuery to the leveldb_server and waits for the response, other
+        coroutines can send their own queries while we wait
+
+        @param protoObj - the ActualData protobuf object (from _createProtoQuery()) with the query filled out
+        @return the ServerResponse protobuf object that the server sent back'''
+
+        return (yield from self._sendAndWait(self._isProtoComplete(protoObj)))
+
+    @asyncio.coroutine
+    def _sendCompactQueryAndGetResponse(self, queryType, key, value=b""):
+        ''' coroutine version of ServerDatabase._sendCompactQueryAndGetResponse
+
+        @param queryType - the ServerQuery type
+        @param key - the key as bytes
+        @param value - the value as bytes, only for SET
+        @return a two-tuple of (ServerResponse type, value as bytes)'''
+
+        return (yield from self._sendAndWait(leveldb_server_frames.packQuery(queryType, key, value)))
+
+    @asyncio.coroutine
+    def _sendAndWait(self, msg):
+        ''' coroutine that writes a message to the leveldb_server and waits for _readResponses() to hand us the response
+
+        @param msg - the bytes of the message, without the size prefix
+        @return whatever _readResponses() gives the future, the ServerResponse protobuf object, or for a 
+            compact frame a two-tuple of (response type, value)'''
+
+        if self.readerTask.done():
+            raise ConnectionError("connection to the leveldb_server was lost")
+
+        tmpFuture = asyncio.Future()
+        self.pendingFutures.append(tmpFuture)
+
+        # appends a 2 byte 'size prefix' to the data we send to the server
+        self.writer.write(len(msg).to_bytes(2, "big") + msg)
+
+        return (yield from tmpFuture)
+
+    @asyncio.coroutine
+    def close(self):
+        ''' coroutine that closes the connection to the leveldb_server, any queries that haven't been
+        answered yet fail with a ConnectionError'''
+
+        self.writer.close()
+        self.readerTask.cancel()
+
+        try:
+            yield from self.readerTask
+        except asyncio.CancelledError:
+            pass
+
+    @asyncio.coroutine
+    def get(self, key, snapshotId=None):
+        ''' coroutine version of ServerDatabase.__getitem__
+
+        @param key - a string
+        @param snapshotId - the id of a snapshot from openSnapshot() to read from, or None
+        @return A STRING, or raises a KeyError'''
+
+        if self.compactFrames and snapshotId is None:
+            respType, returnedValue = yield from self._sendCompactQueryAndGetResponse(LeveldbServerMessages.ServerQuery.GET, 
+                key.encode("utf-8"))
+
+        else:
+            protoObj = self._createProtoQuery()
+            protoObj.query.key = key.encode("utf-8")
+            protoObj.query.type = LeveldbServerMessages.ServerQuery.GET
+            if snapshotId is not None:
+                protoObj.query.snapshot_id = snapshotId
+
+            resp = yield from self._sendQueryAndGetResponse(protoObj)
+            respType, returnedValue = resp.type, resp.returned_value
+
+        if respType == LeveldbServerMessages.ServerResponse.GET_PRODUCED_KEYERROR:
+            raise KeyError(key)
+
+        elif respType == LeveldbServerMessages.ServerResponse.GET_RETURNED_VALUE:
+            return returnedValue.decode("utf-8")
+
+        else:
+            raise Exception("Unexpected ServerResponse for get! {}".format(respType))
+
+    @asyncio.coroutine
+    def set(self, key, value):
+        ''' coroutine version of ServerDatabase.__setitem__
+
+        @param key - a string
+        @param value - a string'''
+
+        if self.compactFrames:
+            respType, returnedValue = yield from self._sendCompactQueryAndGetResponse(LeveldbServerMessages.ServerQuery.SET, 
+                key.encode("utf-8"), value.encode("utf-8"))
+
+        else:
+            protoObj = self._createProtoQuery()
+            protoObj.query.key = key.encode("utf-8")
+            protoObj.query.value = value.encode("utf-8")
+            protoObj.query.type = LeveldbServerMessages.ServerQuery.SET
+
+            respType = (yield from self._sendQueryAndGetResponse(protoObj)).type
+
+        if respType != LeveldbServerMessages.ServerResponse.SET_SUCCESSFUL:
+            raise Exception("Got a unsuccessful server message for set! {}".format(respType))
+
+    @asyncio.coroutine
+    def delete(self, key):
+        ''' coroutine version of ServerDatabase.__delitem__
+
+        @param key - a string'''
+
+        if self.compactFrames:
+            respType, returnedValue = yield from self._sendCompactQueryAndGetResponse(LeveldbServerMessages.ServerQuery.DELETE, 
+                key.encode("utf-8"))
+
+        else:
+            protoObj = self._createProtoQuery()
+            protoObj.query.key = key.encode("utf-8")
+            protoObj.query.type = LeveldbServerMessages.ServerQuery.DELETE
+
+            respType = (yield from self._sendQueryAndGetResponse(protoObj)).type
+
+        if respType != LeveldbServerMessages.ServerResponse.DELETE_SUCCESSFUL:
+            raise Exception("Got an unsuccessful server message for delete! {}".format(respType))
+
+    @asyncio.coroutine
+    def range(self, startKey, endKey=None, snapshotId=None):
+        ''' coroutine that returns every key/value in a range, all at once
+
+        @param startKey - the string key to start at. If @endKey is None, then this is treated as a prefix, 
+            and we only get the keys that startwith() it
+        @param endKey - the string key to stop at, or None
+        @param snapshotId - the id of a snapshot from openSnapshot() to read from, or None
+        @return a LIST of two-tuples of (key, value) strings'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.key = startKey.encode("utf-8")
+        if endKey is not None:
+            protoObj.query.rangeiter_end = endKey.encode("utf-8")
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.RETURN_ATONCE_RANGE_ITER
+        if snapshotId is not None:
+            protoObj.query.snapshot_id = snapshotId
+
+        resp = yield from self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type != LeveldbServerMessages.ServerResponse.RANGEITER_ATONCE_RETURNED:
+            raise Exception("Got an unsuccessful server message for range! {}".format(resp.type))
+
+        return [(keyValueObj.key.decode("utf-8"), keyValueObj.value.decode("utf-8")) 
+            for keyValueObj in resp.multiple_returned_values]
+
+    @asyncio.coroutine
+    def deleteAllInRange(self, startKey, endKey=None):
+        ''' coroutine that deletes every key in a range
+
+        @param startKey - the string key to start at. If @endKey is None, then this is treated as a prefix, 
+            and we only delete the keys that startwith() it
+        @param endKey - the string key to stop at, or None'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.key = startKey.encode("utf-8")
+        if endKey is not None:
+            protoObj.query.rangeiter_end = endKey.encode("utf-8")
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.DELETE_ALL_IN_RANGE
+
+        resp = yield from self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type != LeveldbServerMessages.ServerResponse.DELETE_SUCCESSFUL:
+            raise Exception("Got an unsuccessful server message for delete all in range! {}".format(resp.type))
+
+    @asyncio.coroutine
+    def multiGet(self, keys, snapshotId=None):
+        ''' coroutine version of ServerDatabase.multiGet
+
+        @param keys - an iterable of strings
+        @param snapshotId - the id of a snapshot from openSnapshot() to read from, or None
+        @return a DICTIONARY of key -> value (both strings), keys that don't exist map to None'''
+
+        resultDict = dict()
+        batches = self._multiGetBatches(keys)
+
+        while batches:
+
+            batch = batches.pop()
+
+            try:
+                resultDict.update((yield from self._multiGetBatch(batch, snapshotId)))
+
+            except ResponseTooLargeError:
+
+                if len(batch) == 1:
+                    raise
+
+                self._log("multi get of %s keys was too big for one response, splitting it", len(batch))
+                batches.extend([batch[:len(batch) // 2], batch[len(batch) // 2:]])
+
+        return resultDict
+
+    @asyncio.coroutine
+    def _multiGetBatch(self, keys, snapshotId):
+        ''' helper coroutine for multiGet() that sends one MULTI_GET
+
+        @param keys - a list of strings
+        @param snapshotId - the id of a snapshot to read from, or None
+        @return a DICTIONARY of key -> value (both strings), keys that don't exist map to None'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.multiple_keys.extend([iterKey.encode("utf-8") for iterKey in keys])
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.MULTI_GET
+        if snapshotId is not None:
+            protoObj.query.snapshot_id = snapshotId
+
+        resp = yield from self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type != LeveldbServerMessages.ServerResponse.MULTI_GET_RETURNED:
+            raise Exception("Got an unsuccessful server message for multi get! {}".format(resp.type))
+
+        return {iterResult.key.decode("utf-8"): iterResult.value.decode("utf-8") if iterResult.found else None 
+            for iterResult in resp.multi_get_results}
+
+    @asyncio.coroutine
+    def countRange(self, startKey, endKey=None, snapshotId=None):
+        ''' coroutine version of ServerDatabase.countRange
+
+        @param startKey - the string key to start counting at, treated as a prefix if @endKey is None
+        @param endKey - the string key to stop counting at, or None
+        @param snapshotId - the id of a snapshot from openSnapshot() to read from, or None
+        @return an INT'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.key = startKey.encode("utf-8")
+        if endKey is not None:
+            protoObj.query.rangeiter_end = endKey.encode("utf-8")
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.COUNT_RANGE
+        if snapshotId is not None:
+            protoObj.query.snapshot_id = snapshotId
+
+        resp = yield from self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type != LeveldbServerMessages.ServerResponse.COUNT_RANGE_RETURNED:
+            raise Exception("Got an unsuccessful server message for count range! {}".format(resp.type))
+
+        return resp.range_count
+
+    @asyncio.coroutine
+    def getStats(self):
+        ''' coroutine version of ServerDatabase.getStats
+
+        @return a LeveldbServerMessages.ServerStats protobuf object'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.STATS
+
+        resp = yield from self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type != LeveldbServerMessages.ServerResponse.STATS_RETURNED:
+            raise Exception("Got an unsuccessful server message for stats! {}".format(resp.type))
+
+        return resp.stats
+
+    @asyncio.coroutine
+    def openSnapshot(self):
+        ''' coroutine version of ServerDatabase.openSnapshot, pass the id it returns as the snapshotId of get(), range(), 
+        multiGet() or countRange() to read from the snapshot. Since other coroutines share the connection, there is no 
+        snapshot() context manager like ServerDatabase has
+
+        @return the snapshot id, an INT'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.OPEN_SNAPSHOT
+
+        resp = yield from self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type != LeveldbServerMessages.ServerResponse.SNAPSHOT_OPENED:
+            raise Exception("Got an unsuccessful server message for open snapshot! {}".format(resp.type))
+
+        return resp.snapshot_id
+
+    @asyncio.coroutine
+    def releaseSnapshot(self, snapshotId):
+        ''' coroutine version of ServerDatabase.releaseSnapshot
+
+        @param snapshotId - the id of the snapshot'''
+
+        protoObj = self._createProtoQuery()
+        protoObj.query.type = LeveldbServerMessages.ServerQuery.RELEASE_SNAPSHOT
+        protoObj.query.snapshot_id = snapshotId
+
+        resp = yield from self._sendQueryAndGetResponse(protoObj)
+
+        if resp.type != LeveldbServerMessages.ServerResponse.SNAPSHOT_RELEASED:
+            raise Exception("Got an unsuccessful server message for release snapshot! {}".format(resp.type))
+
+    @asyncio.coroutine
+    def commitBatch(self, batch):
+        ''' coroutine version of ServerDatabase.commitBatch
+
+        @param batch - a ServerDatabaseWriteBatch'''
+
+        resp = yield from self._sendQueryAndGetResponse(self._createBatchQuery(batch))
+
+        if resp.type != LeveldbServerMessages.ServerResponse.WRITE_BATCH_SUCCESSFUL:
+            raise Exception("Got an unsuccessful server message for write batch! {}".format(resp.type))
+
+    @asyncio.coroutine
+    def getWithPrefix(self, key, formatEntries):
+        ''' coroutine version of ServerDatabase.getWithPrefix, @key should be something from ServerDatabaseEnums'''
+
+        return (yield from self.get(key.format(*formatEntries)))
+
+    @asyncio.coroutine
+    def setWithPrefix(self, key, formatEntries, value):
+        ''' coroutine version of ServerDatabase.setWithPrefix, @key should be something from ServerDatabaseEnums'''
+
+        yield from self.set(key.format(*formatEntries), value)
 
+    @asyncio.coroutine
+    def rangeWithPrefix(self, key, formatEntries):
+        ''' coroutine version of ServerDatabase.getGeneratorWithPrefix, @key should be something from ServerDatabaseEnums
 
+        @return a LIST of two-tuples of (key, value) strings'''
 
+        return (yield from self.range(key.format(*formatEntries)))
 
+    @asyncio.coroutine
+    def deleteAllInRangeWithPrefix(self, key, formatEntries):
+        ''' coroutine version of ServerDatabase.deleteAllInRange, @key should be something from ServerDatabaseEnums'''
 
+        yield from self.deleteAllInRange(key.format(*formatEntries))
 
+    @asyncio.coroutine
+    def countWithPrefix(self, key, formatEntries):
+        ''' coroutine version of ServerDatabase.countWithPrefix, @key should be something from ServerDatabaseEnums'''
 
+        return (yield from self.countRange(key.format(*formatEntries)))
@@ -0,0 +1,446 @@
+#
+# read only copies of the leveldb_server's database, kept up to date from its change log (GET_CHANGES), so
+# reads don't all have to go through the one leveldb_server. ReplicaFollower does the copying and following,
+# into either a ServerDatabaseMirror (in memory, one per sunspot_server process) or a leveldb database of its
+# own (leveldb_replica.py). Writes always go to the leveldb_server.
+#
+
+import bisect
+import contextlib
+import logging
+import os
+import threading
+
+from leveldb_server_messages_pb2 import LeveldbServerMessages
+from server_database import ServerDatabase
+
+
+class ReplicaFollower:
+    ''' copies everything from the leveldb_server into a target, and then keeps the target up to date by long
+    polling the leveldb_server for changes, in a thread of its own.
+
+    The target has to have two methods:
+
+        replaceAll(items) - throw away everything and use @items instead, a list of (key, value) two-tuples of bytes
+        applyChanges(changes) - apply a list of changes in order, each one a list of (BatchOperation type, key, value)
+            three-tuples (PUT or DELETE, value is None for DELETE) that should be applied all at once
+    '''
+
+    # every key the ServerDatabase writes is utf-8, which never has a 0xff byte, so this is after all of them
+    lastPossibleKey = b"\xff\xff\xff\xff"
+
+    def __init__(self, connectFunc, target, logger=None, waitMilliseconds=30000, pageSize=500, retrySeconds=5):
+        ''' constructor
+        @param connectFunc - function that takes no arguments and returns a new ServerDatabase connected to the
+            leveldb_server (not a replica, they don't keep a change log), the follower uses it for nothing else
+        @param target - what we copy everything into, see the class docstring
+        @param logger - a logging.Logger
+        @param waitMilliseconds - how long each GET_CHANGES waits for a change before the leveldb_server answers anyway
+        @param pageSize - how many keys to ask for at once when copying everything
+        @param retrySeconds - how long to wait before connecting again if we lose the connection'''
+
+        self.connectFunc = connectFunc
+        self.target = target
+        self.lg = logger if logger is not None else logging.getLogger("ReplicaFollower")
+        self.waitMilliseconds = waitMilliseconds
+        self.pageSize = pageSize
+        self.retrySeconds = retrySeconds
+
+        # where we are in the leveldb_server's change log, None until we have copied everything once
+        self.changeLogId = None
+        self.sequence = 0
+
+        # set once the target has a full copy, it stays set if we lose the connection, the target just gets
+        # further behind until we are back
+        self.ready = threading.Event()
+
+        self.stopped = threading.Event()
+        self.serverDb = None
+        self.thread = threading.Thread(target=self._run, name="ReplicaFollower", daemon=True)
+
+    def start(self):
+        ''' starts following the leveldb_server in a new thread'''
+
+        self.thread.start()
+
+    def stop(self):
+        ''' stops following, closing the connection wakes up a GET_CHANGES that is waiting'''
+
+        self.stopped.set()
+
+        serverDb = self.serverDb
+        if serverDb is not None:
+            serverDb.close()
+
+        self.thread.join(10)
+
+    def waitUntilReady(self, timeout=None):
+        ''' waits for the target to have a full copy of the database
+
+        @param timeout - how many seconds to wait, or None to wait forever
+        @return True if the target is ready, False if we timed out'''
+
+        return self.ready.wait(timeout)
+
+    def _run(self):
+        ''' the thread, keeps connecting to the leveldb_server and following its change log until stop() is called'''
+
+        while not self.stopped.is_set():
+
+            try:
+                self.serverDb = self.connectFunc()
+
+                # if we were following before we lost the connection, try and pick up where we left off,
+                # GET_CHANGES tells us if we can't
+                if self.changeLogId is None:
+                    self._resync()
+
+                while not self.stopped.is_set():
+                    self._follow()
+
+            except Exception as e:
+
+                if self.stopped.is_set():
+                    break
+
+                self.lg.error("lost the leveldb_server (%s), trying again in %s seconds", e, self.retrySeconds)
+
+                if self.serverDb is not None:
+                    self.serverDb.close()
+
+                self.stopped.wait(self.retrySeconds)
+
+            finally:
+                self.serverDb = None
+
+    def _resync(self):
+        ''' copies everything from a snapshot of the leveldb_server's database into the target'''
+
+        snapshotId, sequence, changeLogId = self.serverDb.openReplicationSnapshot()
+
+        items = list()
+        startKey = b""
+
+        while True:
+
+            page, hasMore = self.serverDb.getRangePage(startKey, ReplicaFollower.lastPossibleKey, self.pageSize, snapshotId)
+            items.extend(page)
+
+            if not hasMore:
+                break
+
+            # the first key after the last one we got
+            startKey = page[-1][0] + b"\x00"
+
+        self.serverDb.releaseSnapshot(snapshotId)
+
+        self.target.replaceAll(items)
+        self.changeLogId = changeLogId
+        self.sequence = sequence
+        self.ready.set()
+
+        self.lg.info("copied %s keys from the leveldb_server, at change %s of change log %s", len(items), sequence, changeLogId)
+
+    def _follow(self):
+        ''' asks the leveldb_server for the changes since the last one we have (waiting for one if there aren't any
+        yet), and applies them to the target'''
+
+        resp = self.serverDb.getChanges(self.sequence, self.waitMilliseconds)
+
+        if resp.change_log_id != self.changeLogId or resp.resync_needed:
+
+            # the leveldb_server restarted, or we fell too far behind
+            self.lg.info("have to copy everything again, the change log id is %s (we had %s), resync needed: %s",
+                resp.change_log_id, self.changeLogId, resp.resync_needed)
+            return self._resync()
+
+        if not resp.changes:
+            return
+
+        changes = list()
+        for iterEntry in resp.changes:
+            changes.append([(iterOp.type, iterOp.key, iterOp.value if iterOp.type == LeveldbServerMessages.BatchOperation.PUT else None)
+                for iterOp in iterEntry.operations])
+
+        self.target.applyChanges(changes)
+        self.sequence = resp.changes[-1].sequence
+
+
+class ServerDatabaseMirror:
+    ''' an in memory copy of the leveldb_server's database, for a ReplicaFollower to keep up to date. The
+    keys and values are bytes, use a MirroredServerDatabase to read from it like a ServerDatabase.
+
+    Safe to use from more then one thread, hold self.lock for several reads that have to agree with each other'''
+
+    # pid -> the ServerDatabaseMirror for that process, see shared()
+    _sharedMirrors = dict()
+    _sharedLock = threading.Lock()
+
+    def __init__(self):
+        ''' constructor'''
+
+        self.values = dict()
+        self.sortedKeys = list() # so we can do range reads
+        self.lock = threading.RLock()
+
+        self.follower = None
+
+    @classmethod
+    def shared(cls, constantsObj):
+        ''' gets the ServerDatabaseMirror for this process, creating it (and the ReplicaFollower that fills it)
+        the first time. It is per process, since the follower thread doesn't survive a fork
+
+        @param constantsObj - a Constants object, to find the leveldb_server with
+        @return a ServerDatabaseMirror, that might not have finished copying the database yet (see isReady())'''
+
+        with cls._sharedLock:
+
+            pid = os.getpid()
+            mirror = cls._sharedMirrors.get(pid)
+
+            if mirror is None:
+
+                mirror = cls()
+                mirror.follower = ReplicaFollower(lambda: ServerDatabase.fromConstants(constantsObj), mirror,
+                    logging.getLogger("ServerDatabaseMirror"))
+                mirror.follower.start()
+
+                cls._sharedMirrors = {pid: mirror}
+
+            return mirror
+
+    def isReady(self):
+        ''' sees if we have a full copy of the database yet
+
+        @return True or False'''
+
+        return self.follower is not None and self.follower.ready.is_set()
+
+    def replaceAll(self, items):
+        ''' ReplicaFollower target method, replaces everything with @items
+
+        @param items - a list of (key, value) two-tuples of bytes'''
+
+        values = dict(items)
+        sortedKeys = sorted(values)
+
+        with self.lock:
+            self.values = values
+            self.sortedKeys = sortedKeys
+
+    def applyChanges(self, changes):
+        ''' ReplicaFollower target method, applies changes from the change log
+
+        @param changes - a list of changes, each a list of (BatchOperation type, key, value) three-tuples'''
+
+        with self.lock:
+
+            for iterOperations in changes:
+                for iterType, iterKey, iterValue in iterOperations:
+
+                    if iterType == LeveldbServerMessages.BatchOperation.PUT:
+
+                        if iterKey not in self.values:
+                            bisect.insort(self.sortedKeys, iterKey)
+
+                        self.values[iterKey] = iterValue
+
+                    elif iterKey in self.values:
+
+                        del self.values[iterKey]
+                        del self.sortedKeys[bisect.bisect_left(self.sortedKeys, iterKey)]
+
+    def get(self, key):
+        ''' gets a value
+
+        @param key - the key as bytes
+        @return the value as bytes, raises KeyError if the key doesn't exist'''
+
+        return self.values[key]
+
+    def rangeItems(self, startKey, endKey=None):
+        ''' gets the keys and values in a range, with the same rules as the leveldb_server: if @endKey is None then
+        @startKey is a prefix, otherwise its every key from @startKey to @endKey (including @endKey)
+
+        @param startKey - the key (bytes) to start at
+        @param endKey - the key (bytes) to end at, or None
+        @return a list of (key, value) two-tuples of bytes'''
+
+        result = list()
+
+        with self.lock:
+
+            for iterIndex in range(bisect.bisect_left(self.sortedKeys, startKey), len(self.sortedKeys)):
+
+                iterKey = self.sortedKeys[iterIndex]
+
+                if (endKey is None and not iterKey.startswith(startKey)) or (endKey is not None and iterKey > endKey):
+                    break
+
+                result.append((iterKey, self.values[iterKey]))
+
+        return result
+
+
+class MirroredServerDatabase:
+    ''' has the same methods as ServerDatabase, but reads from a ServerDatabaseMirror, and only connects to the
+    leveldb_server for writes (and for reads, if the mirror hasn't finished copying the database yet).
+
+    The mirror is usually a few milliseconds behind the leveldb_server, so reading a key right after writing it
+    might still give you the old value. If that matters, use a ServerDatabase'''
+
+    def __init__(self, mirror, primaryFunc, logger=None):
+        ''' constructor
+        @param mirror - the ServerDatabaseMirror to read from
+        @param primaryFunc - function that takes no arguments and returns a ServerDatabase (or a subclass) connected to the
+            leveldb_server, only called the first time we need it
+        @param logger - a logger object'''
+
+        self.mirror = mirror
+        self.primaryFunc = primaryFunc
+        self.lg = logger
+        self.primary = None
+
+        # set while we are in a snapshot() of the leveldb_server, because the mirror wasn't ready when it started
+        self.readFromPrimary = False
+
+    @classmethod
+    def fromConstants(cls, constantsObj, logger=None, primaryClass=ServerDatabase):
+        ''' creates a MirroredServerDatabase that reads from this process's shared ServerDatabaseMirror, and
+        writes to wherever the Constants say the leveldb_server is
+
+        @param constantsObj - a Constants object
+        @param logger - a logger object, passed on to the @primaryClass
+        @param primaryClass - ServerDatabase or a subclass (like CherrypyServerDatabase), what we write with
+        @return a new MirroredServerDatabase'''
+
+        return cls(ServerDatabaseMirror.shared(constantsObj), lambda: primaryClass.fromConstants(constantsObj, logger), logger)
+
+    def _getPrimary(self):
+        ''' gets the ServerDatabase connected to the leveldb_server, connecting the first time
+
+        @return a ServerDatabase'''
+
+        if self.primary is None:
+            self.primary = self.primaryFunc()
+
+        return self.primary
+
+    def _readFromMirror(self):
+        ''' sees if reads should go to the mirror or the leveldb_server
+
+        @return True or False'''
+
+        return not self.readFromPrimary and self.mirror.isReady()
+
+    def __getattr__(self, name):
+        ''' anything we don't read from the mirror (writes, getStats(), etc) goes to the leveldb_server'''
+
+        return getattr(self._getPrimary(), name)
+
+    def __getitem__(self, key):
+        '''implementation of obj[item]
+
+        @param key - a string
+        @return A STRING'''
+
+        if not self._readFromMirror():
+            return self._getPrimary()[key]
+
+        return self.mirror.get(key.encode("utf-8")).decode("utf-8")
+
+    def __setitem__(self, key, value):
+        '''implementation of obj[item] = something, goes to the leveldb_server
+
+        @param key - a string
+        @param value - a string'''
+
+        self._getPrimary()[key] = value
+
+    def __delitem__(self, key):
+        '''implementation of del obj["item"], goes to the leveldb_server
+
+        @param key - a string'''
+
+        del self._getPrimary()[key]
+
+    def setWithPrefix(self, key, formatEntries, value):
+        ''' see ServerDatabase.setWithPrefix()'''
+
+        self[key.format(*formatEntries)] = value
+
+    def getWithPrefix(self, key, formatEntries):
+        ''' see ServerDatabase.getWithPrefix()'''
+
+        return self[key.format(*formatEntries)]
+
+    def getGeneratorWithPrefix(self, key, formatEntries):
+        ''' see ServerDatabase.getGeneratorWithPrefix(), yields two-tuples of strings'''
+
+        if not self._readFromMirror():
+            yield from self._getPrimary().getGeneratorWithPrefix(key, formatEntries)
+            return
+
+        for iterKey, iterValue in self.mirror.rangeItems(key.format(*formatEntries).encode("utf-8")):
+            yield iterKey.decode("utf-8"), iterValue.decode("utf-8")
+
+    def multiGet(self, keys):
+        ''' see ServerDatabase.multiGet()'''
+
+        if not self._readFromMirror():
+            return self._getPrimary().multiGet(keys)
+
+        resultDict = dict()
+
+        with self.mirror.lock:
+            for iterKey in keys:
+                iterValue = self.mirror.values.get(iterKey.encode("utf-8"))
+                resultDict[iterKey] = iterValue.decode("utf-8") if iterValue is not None else None
+
+        return resultDict
+
+    def multiGetWithPrefix(self, key, listOfFormatEntries):
+        ''' see ServerDatabase.multiGetWithPrefix()'''
+
+        formattedKeys = [key.format(*iterFormatEntries) for iterFormatEntries in listOfFormatEntries]
+
+        resultDict = self.multiGet(formattedKeys)
+
+        return [resultDict[iterKey] for iterKey in formattedKeys]
+
+    def countRange(self, startKey, endKey=None):
+        ''' see ServerDatabase.countRange()'''
+
+        if not self._readFromMirror():
+            return self._getPrimary().countRange(startKey, endKey)
+
+        return len(self.mirror.rangeItems(startKey.encode("utf-8"), endKey.encode("utf-8") if endKey is not None else None))
+
+    def countWithPrefix(self, key, formatEntries):
+        ''' see ServerDatabase.countWithPrefix()'''
+
+        return self.countRange(key.format(*formatEntries))
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        ''' see ServerDatabase.snapshot(), the mirror doesn't change while we are in the with statement (which
+        also means the ReplicaFollower waits for us, so don't stay in it long)
+
+        @return this MirroredServerDatabase object'''
+
+        if not self._readFromMirror():
+
+            previousReadFromPrimary = self.readFromPrimary
+            self.readFromPrimary = True
+
+            try:
+                with self._getPrimary().snapshot():
+                    yield self
+
+            finally:
+                self.readFromPrimary = previousReadFromPrimary
+
+        else:
+
+            with self.mirror.lock:
+                yield self
@@ -0,0 +1,326 @@
+#
+# counters and histograms that the leveldb_server keeps about itself, so we can see how its doing
+# (with the STATS query or the plaintext metrics listener) without turning on DEBUG logging
+#
+
+import asyncio
+import bisect
+import threading
+import time
+
+
+# upper bounds (in seconds) of the buckets that LatencyHistogram uses by default, anything
+# slower then the last one goes in an extra 'overflow' bucket
+DEFAULT_LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# upper bounds (in number of keys) of the buckets for how many keys a range query went through
+RANGE_SCAN_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class Histogram:
+    ''' counts values in a fixed set of buckets, plus the count, sum and max of everything recorded.
+
+    This doesn't lock anything, so whatever owns it has to (see ServerStats)'''
+
+    def __init__(self, bucketBounds):
+        ''' constructor
+        @param bucketBounds - sorted iterable of the upper bounds (inclusive) of each bucket, a value bigger
+            then the last one goes in an extra overflow bucket'''
+
+        self.bucketBounds = tuple(bucketBounds)
+        self.bucketCounts = [0] * (len(self.bucketBounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        ''' adds a value to the histogram
+        @param value - the value to add (a number)'''
+
+        self.bucketCounts[bisect.bisect_left(self.bucketBounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        ''' estimates a percentile, since we only have buckets this is the upper bound of the bucket
+        that the percentile falls in (or the max, if its in the overflow bucket or the max is smaller)
+
+        @param fraction - which percentile, between 0 and 1, so 0.99 is the 99th percentile
+        @return the estimate, or 0 if nothing has been recorded'''
+
+        if self.count == 0:
+            return 0
+
+        wanted = fraction * self.count
+        seen = 0
+
+        for iterBound, iterCount in zip(self.bucketBounds, self.bucketCounts):
+            seen += iterCount
+            if seen >= wanted:
+                return min(iterBound, self.max)
+
+        return self.max
+
+    def buckets(self):
+        ''' returns the buckets, the overflow bucket has an upper bound of None
+
+        @return a list of two-tuples of (upper bound, count)'''
+
+        return list(zip(self.bucketBounds + (None, ), self.bucketCounts))
+
+
+class LatencyHistogram(Histogram):
+    ''' a Histogram of how long something took, in seconds'''
+
+    def __init__(self, bucketBounds=DEFAULT_LATENCY_BUCKETS):
+        ''' constructor
+        @param bucketBounds - the upper bounds, in seconds, of each bucket'''
+
+        super().__init__(bucketBounds)
+
+
+class ServerStats:
+    ''' everything the leveldb_server keeps track of about itself. The operation and range scan stats get
+    recorded from the StorageScheduler's threads as well as the event loop thread, so those take a lock.
+    The connection and byte counters are only touched from the event loop thread.'''
+
+    def __init__(self):
+        ''' constructor'''
+
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+
+        # operation name (like 'GET') -> LatencyHistogram of how long _runQuery() took for it
+        self.operations = dict()
+
+        # operation name -> how many of them raised an exception
+        self.errors = dict()
+
+        self.rangeScanSizes = Histogram(RANGE_SCAN_BUCKETS)
+
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.activeConnections = 0
+        self.totalConnections = 0
+        self.openSnapshots = 0
+
+    def recordOperation(self, name, seconds, failed=False):
+        ''' records how long an operation took
+
+        @param name - the name of the operation, like 'GET'
+        @param seconds - how long it took
+        @param failed - True if it raised an exception'''
+
+        with self.lock:
+
+            if name not in self.operations:
+                self.operations[name] = LatencyHistogram()
+                self.errors[name] = 0
+
+            self.operations[name].record(seconds)
+
+            if failed:
+                self.errors[name] += 1
+
+    def recordRangeScan(self, numKeys):
+        ''' records how many keys a range query went through
+        @param numKeys - the number of keys'''
+
+        with self.lock:
+            self.rangeScanSizes.record(numKeys)
+
+    def snapshotsOpened(self, count):
+        ''' call when clients open snapshots, this can be called from the StorageScheduler's threads
+        @param count - how many were opened'''
+
+        with self.lock:
+            self.openSnapshots += count
+
+    def snapshotsReleased(self, count):
+        ''' call when clients release snapshots (or disconnect without releasing them)
+        @param count - how many were released'''
+
+        with self.lock:
+            self.openSnapshots -= count
+
+    def connectionMade(self):
+        ''' call when a client connects'''
+
+        self.activeConnections += 1
+        self.totalConnections += 1
+
+    def connectionLost(self):
+        ''' call when a client disconnects'''
+
+        self.activeConnections -= 1
+
+    def fillProto(self, statsProto, leveldbStats=None, valueCache=None, scheduler=None, loopMonitor=None):
+        ''' fills out a LeveldbServerMessages.ServerStats protobuf object
+
+        @param statsProto - the ServerStats protobuf object to fill out
+        @param leveldbStats - the 'leveldb.stats' text from leveldb itself, or None
+        @param valueCache - the leveldb_server's ValueCache, or None if it doesn't have one
+        @param scheduler - the leveldb_server's StorageScheduler, or None if it doesn't have one
+        @param loopMonitor - the leveldb_server's LoopLagMonitor, or None if it doesn't have one'''
+
+        statsProto.uptime_seconds = time.time() - self.startTime
+        statsProto.bytes_in = self.bytesIn
+        statsProto.bytes_out = self.bytesOut
+        statsProto.active_connections = self.activeConnections
+        statsProto.total_connections = self.totalConnections
+        statsProto.open_snapshots = self.openSnapshots
+
+        with self.lock:
+
+            for iterName in sorted(self.operations.keys()):
+
+                iterHistogram = self.operations[iterName]
+
+                tmpOp = statsProto.operations.add()
+                tmpOp.name = iterName
+                tmpOp.count = iterHistogram.count
+                tmpOp.errors = self.errors[iterName]
+                tmpOp.total_seconds = iterHistogram.total
+                tmpOp.max_seconds = iterHistogram.max
+                self._fillBuckets(tmpOp.latency_buckets, iterHistogram)
+
+            self._fillBuckets(statsProto.range_scan_sizes, self.rangeScanSizes)
+
+        if leveldbStats is not None:
+            statsProto.leveldb_stats = leveldbStats
+
+        if valueCache is not None:
+            statsProto.value_cache_hits = valueCache.hits
+            statsProto.value_cache_misses = valueCache.misses
+            statsProto.value_cache_entries = len(valueCache)
+
+        if scheduler is not None:
+            statsProto.scheduler_queue_depth = scheduler.queueDepth
+            statsProto.scheduler_max_queue_depth = scheduler.maxQueueDepth
+            statsProto.scheduler_total_scheduled = scheduler.totalScheduled
+
+        if loopMonitor is not None:
+            statsProto.loop_lag_seconds = loopMonitor.lastLag
+            statsProto.loop_max_lag_seconds = loopMonitor.maxLagEver
+            statsProto.loop_lag_checks = loopMonitor.totalChecks
+
+    def _fillBuckets(self, repeatedField, histogram):
+        ''' adds a HistogramBucket to a repeated protobuf field for each bucket in a histogram
+
+        @param repeatedField - the repeated HistogramBucket field
+        @param histogram - the Histogram'''
+
+        for iterBound, iterCount in histogram.buckets():
+
+            tmpBucket = repeatedField.add()
+            tmpBucket.count = iterCount
+
+            # the overflow bucket doesn't have an upper bound
+            if iterBound is not None:
+                tmpBucket.upper_bound = iterBound
+
+    def toText(self, leveldbStats=None, valueCache=None, scheduler=None, loopMonitor=None):
+        ''' renders the stats as plaintext, one 'name{labels} value' per line like prometheus expects,
+        the buckets are cumulative and the leveldb stats are at the end as comments
+
+        @param leveldbStats - the 'leveldb.stats' text from leveldb itself, or None
+        @param valueCache - the leveldb_server's ValueCache, or None if it doesn't have one
+        @param scheduler - the leveldb_server's StorageScheduler, or None if it doesn't have one
+        @param loopMonitor - the leveldb_server's LoopLagMonitor, or None if it doesn't have one
+        @return a string'''
+
+        lines = [
+            "leveldb_server_uptime_seconds {:.3f}".format(time.time() - self.startTime),
+            "leveldb_server_bytes_in {}".format(self.bytesIn),
+            "leveldb_server_bytes_out {}".format(self.bytesOut),
+            "leveldb_server_active_connections {}".format(self.activeConnections),
+            "leveldb_server_total_connections {}".format(self.totalConnections),
+            "leveldb_server_open_snapshots {}".format(self.openSnapshots)]
+
+        with self.lock:
+
+            for iterName in sorted(self.operations.keys()):
+
+                iterHistogram = self.operations[iterName]
+                label = 'op="{}"'.format(iterName)
+
+                lines.append("leveldb_server_op_count{{{}}} {}".format(label, iterHistogram.count))
+                lines.append("leveldb_server_op_errors{{{}}} {}".format(label, self.errors[iterName]))
+                lines.extend(self._bucketLines("leveldb_server_op_seconds", label, iterHistogram))
+                lines.append("leveldb_server_op_seconds_sum{{{}}} {:.6f}".format(label, iterHistogram.total))
+                lines.append("leveldb_server_op_seconds_max{{{}}} {:.6f}".format(label, iterHistogram.max))
+                lines.append("leveldb_server_op_seconds_p99{{{}}} {:.6f}".format(label, iterHistogram.percentile(0.99)))
+
+            lines.extend(self._bucketLines("leveldb_server_range_scan_keys", None, self.rangeScanSizes))
+            lines.append("leveldb_server_range_scan_keys_sum {}".format(self.rangeScanSizes.total))
+            lines.append("leveldb_server_range_scan_keys_count {}".format(self.rangeScanSizes.count))
+
+        if valueCache is not None:
+            lines.append("leveldb_server_value_cache_hits {}".format(valueCache.hits))
+            lines.append("leveldb_server_value_cache_misses {}".format(valueCache.misses))
+            lines.append("leveldb_server_value_cache_entries {}".format(len(valueCache)))
+
+        if scheduler is not None:
+            lines.append("leveldb_server_scheduler_queue_depth {}".format(scheduler.queueDepth))
+            lines.append("leveldb_server_scheduler_max_queue_depth {}".format(scheduler.maxQueueDepth))
+            lines.append("leveldb_server_scheduler_total_scheduled {}".format(scheduler.totalScheduled))
+
+        if loopMonitor is not None:
+            lines.append("leveldb_server_loop_lag_seconds {:.6f}".format(loopMonitor.lastLag))
+            lines.append("leveldb_server_loop_max_lag_seconds {:.6f}".format(loopMonitor.maxLagEver))
+            lines.append("leveldb_server_loop_lag_checks {}".format(loopMonitor.totalChecks))
+
+        if leveldbStats is not None:
+            lines.append("# leveldb.stats")
+            lines.extend("# " + iterLine for iterLine in leveldbStats.splitlines())
+
+        return "\n".join(lines) + "\n"
+
+    def _bucketLines(self, metricName, label, histogram):
+        ''' creates the cumulative '_bucket' lines for a histogram
+
+        @param metricName - the name of the metric, '_bucket' gets added to it
+        @param label - the labels that go before 'le', like 'op="GET"', or None
+        @param histogram - the Histogram
+        @return a list of strings'''
+
+        result = list()
+        cumulative = 0
+
+        for iterBound, iterCount in histogram.buckets():
+
+            cumulative += iterCount
+            le = 'le="{}"'.format("+Inf" if iterBound is None else iterBound)
+            labels = le if label is None else label + "," + le
+
+            result.append("{}_bucket{{{}}} {}".format(metricName, labels, cumulative))
+
+        return result
+
+
+class StatsTextProtocol(asyncio.Protocol):
+    ''' the plaintext metrics listener, whatever connects to it gets the stats written to it and then
+    we close the connection. Its written as a HTTP/1.0 response so it works with curl or a browser, and
+    with netcat as long as you send it something (like a newline) first'''
+
+    def __init__(self, textFunc):
+        ''' constructor
+        @param textFunc - a function that takes no arguments and returns the stats as a string'''
+
+        self.textFunc = textFunc
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+
+        # we don't care what they asked for, everyone gets the stats
+        body = self.textFunc().encode("utf-8")
+
+        self.transport.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n" +
+            "Content-Length: {}\r\n\r\n".format(len(body)).encode("utf-8") + body)
+        self.transport.close()
@@ -76,6 +76,33 @@ class TestSunspotServer(unittest.TestCase):
         print("version of db: {}".format(serverResponse.version_of_db))
         print("compression type: {}".format(serverResponse.compression_type))
 
+    def testServerTiming(self):
+        ''' tests that the server tells us how long each part of the request took, and that it shows up in /stats'''
+
+        protoObj = SunspotMessages.ActualSunspotMessage()
+        protoObj.timestamp = str(arrow.utcnow().timestamp)
+        protoObj.message_type = SunspotMessages.ActualSunspotMessage.SERVER_QUERY
+        protoObj.server_query_message.asking_for = SunspotMessages.ServerQuery.NEED_FULL_DB
+        protoObj.server_query_message.requested_compression.append(SunspotMessages.COMPRESSION_NONE)
+
+        r = requests.post(self.constants.REMOTE_ENDPOINT, data=protoObj.SerializeToString(), 
+            headers={'Content-Type': 'application/octet-stream'})
+
+        self.assertEqual(r.status_code, 200)
+
+        # like 'connect;dur=0.051, parse;dur=0.012, db;dur=1.203, ..., total;dur=3.500'
+        spans = dict(iterSpan.strip().split(";dur=") for iterSpan in r.headers["Server-Timing"].split(","))
+        for iterName in ("parse", "db", "file", "compress", "serialize", "total"):
+            self.assertIn(iterName, spans)
+            self.assertGreaterEqual(float(spans[iterName]), 0)
+
+        self.assertGreaterEqual(float(spans["total"]), float(spans["db"]))
+
+        stats = requests.get(self.constants.REMOTE_ENDPOINT + "/stats").json()
+        self.assertGreater(stats["requests"], 0)
+        self.assertGreater(stats["spans"]["total"]["count"], 0)
+        self.assertIn("p99_ms", stats["spans"]["db"])
+
             
 
 
@@ -0,0 +1,157 @@
+#
+# which service_ids run on which days. parse_gtfs_data.py reads calendar.txt (the days of the week each service
+# runs between two dates) and calendar_dates.txt (the days that are different, like holidays) into the calendar and
+# calendar_dates tables, and createServiceDates() works them out into the service_dates table, one row for every day
+# that each service runs. "Which trips run today" is then
+# 'SELECT trips.* FROM trips JOIN service_dates ON trips.service_id = service_dates.service_id WHERE service_dates.date = ?'
+# instead of every client working out the calendar for every trip
+#
+
+import collections
+import datetime
+
+
+# calendar_dates.txt's exception_type
+EXCEPTION_ADDED = 1
+EXCEPTION_REMOVED = 2
+
+
+def parseGtfsDate(text):
+    ''' parses a GTFS date
+
+    @param text - a date like 20140822
+    @return a datetime.date'''
+
+    return datetime.datetime.strptime(text, "%Y%m%d").date()
+
+
+def formatGtfsDate(date):
+    ''' formats a date like GTFS does
+
+    @param date - a datetime.date
+    @return a string like 20140822'''
+
+    return date.strftime("%Y%m%d")
+
+
+def activeServiceDates(calendarRows, calendarDateRows):
+    ''' works out which services run on which days
+
+    @param calendarRows - an iterable of (service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday,
+        start_date, end_date) rows from calendar.txt, the days are 1 if it runs on that day of the week
+    @param calendarDateRows - an iterable of (service_id, date, exception_type) rows from calendar_dates.txt
+    @return a dictionary of datetime.date -> set of the service_ids that run that day'''
+
+    servicesByDate = collections.defaultdict(set)
+
+    for iterRow in calendarRows:
+
+        serviceId = iterRow[0]
+        weekdays = [int(iterDay) == 1 for iterDay in iterRow[1:8]]
+
+        date = parseGtfsDate(str(iterRow[8]))
+        endDate = parseGtfsDate(str(iterRow[9]))
+
+        while date <= endDate:
+
+            # date.weekday() is 0 for monday, like the order of the columns
+            if weekdays[date.weekday()]:
+                servicesByDate[date].add(serviceId)
+
+            date += datetime.timedelta(days=1)
+
+    for iterServiceId, iterDate, iterExceptionType in calendarDateRows:
+
+        date = parseGtfsDate(str(iterDate))
+
+        if int(iterExceptionType) == EXCEPTION_ADDED:
+            servicesByDate[date].add(iterServiceId)
+        elif int(iterExceptionType) == EXCEPTION_REMOVED:
+            servicesByDate[date].discard(iterServiceId)
+
+    return servicesByDate
+
+
+def createServiceDates(cursor):
+    ''' creates the service_dates table (date, service_id) from the calendar and calendar_dates tables, a row for
+    every day that each service runs, with the dates like GTFS has them (20140822)
+
+    @param cursor - a cursor for the database, that already has the calendar and calendar_dates tables
+    @return how many rows went into the table'''
+
+    cursor.execute('''SELECT service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday,
+        start_date, end_date FROM calendar''')
+    calendarRows = cursor.fetchall()
+
+    cursor.execute('''SELECT service_id, date, exception_type FROM calendar_dates''')
+    calendarDateRows = cursor.fetchall()
+
+    cursor.execute('''CREATE TABLE service_dates (date TEXT, service_id TEXT)''')
+    cursor.execute('''CREATE INDEX service_dates_date_index ON service_dates (date)''')
+
+    rows = list()
+    for iterDate, iterServices in sorted(activeServiceDates(calendarRows, calendarDateRows).items()):
+        rows.extend((formatGtfsDate(iterDate), iterServiceId) for iterServiceId in sorted(iterServices))
+
+    cursor.executemany('''INSERT INTO service_dates VALUES (?, ?)''', rows)
+
+    return len(rows)
+
+
+class ServiceCalendar:
+    ''' the service_dates table in memory, as a bitset for each service_id of the days it runs, starting at the
+    first day of the feed'''
+
+    def __init__(self, servicesByDate):
+        ''' constructor
+
+        @param servicesByDate - a dictionary of datetime.date -> the service_ids that run that day'''
+
+        self.firstDate = min(servicesByDate.keys()) if servicesByDate else None
+        self.lastDate = max(servicesByDate.keys()) if servicesByDate else None
+
+        # service_id -> int, bit N is set if it runs on self.firstDate + N days
+        serviceBits = collections.defaultdict(int)
+
+        for iterDate, iterServices in servicesByDate.items():
+            dayBit = 1 << (iterDate - self.firstDate).days
+            for iterServiceId in iterServices:
+                serviceBits[iterServiceId] |= dayBit
+
+        self.serviceBits = dict(serviceBits)
+
+    @classmethod
+    def fromCursor(cls, cursor):
+        ''' loads the service_dates table
+
+        @param cursor - a cursor for a database that parse_gtfs_data.py created
+        @return a ServiceCalendar, or raises sqlite3.OperationalError if its a database from before there was a
+            service_dates table'''
+
+        servicesByDate = collections.defaultdict(set)
+
+        cursor.execute('''SELECT date, service_id FROM service_dates''')
+        for iterDate, iterServiceId in cursor.fetchall():
+            servicesByDate[parseGtfsDate(iterDate)].add(iterServiceId)
+
+        return cls(servicesByDate)
+
+    def runsOn(self, serviceId, date):
+        ''' whether a service runs on a day
+
+        @param serviceId - the service_id
+        @param date - a datetime.date
+        @return True or False, False for days before or after the feed'''
+
+        if self.firstDate is None or date < self.firstDate or date > self.lastDate:
+            return False
+
+        return bool(self.serviceBits.get(serviceId, 0) >> (date - self.firstDate).days & 1)
+
+    def activeServices(self, date):
+        ''' the services that run on a day
+
+        @param date - a datetime.date
+        @return a frozenset of service_ids'''
+
+        return frozenset(iterServiceId for iterServiceId in self.serviceBits if self.runsOn(iterServiceId, date))
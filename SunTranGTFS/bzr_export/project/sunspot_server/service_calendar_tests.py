@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+# tests for service_calendar.py, with the calendar from the SunTran feed in 'example files'
+#
+
+import unittest
+import datetime
+import sqlite3
+
+from service_calendar import ServiceCalendar
+from test_fixtures import createCalendarTables
+
+
+# weekdays, saturdays and sundays for a year
+CALENDAR = [
+    ("1", 1, 1, 1, 1, 1, 0, 0, "20140216", "20150215"),
+    ("2", 0, 0, 0, 0, 0, 1, 0, "20140216", "20150215"),
+    ("3", 0, 0, 0, 0, 0, 0, 1, "20140216", "20150215")]
+
+# memorial day and independence day run the sunday service instead of the weekday one
+CALENDAR_DATES = [
+    ("3", "20140526", 1), ("1", "20140526", 2),
+    ("3", "20140704", 1), ("1", "20140704", 2)]
+
+
+class TestServiceCalendar(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        self.db = sqlite3.connect(":memory:")
+        self.cursor = self.db.cursor()
+
+        self.rowCount = createCalendarTables(self.cursor, CALENDAR, CALENDAR_DATES)
+        self.calendar = ServiceCalendar.fromCursor(self.cursor)
+
+    def tearDown(self):
+
+        self.db.close()
+
+    def testServiceDates(self):
+
+        # one service a day, for 365 days
+        self.assertEqual(self.rowCount, 365)
+
+        # 2014-08-22 was a friday
+        self.cursor.execute('''SELECT service_id FROM service_dates WHERE date = ?''', ("20140822",))
+        self.assertEqual(self.cursor.fetchall(), [("1",)])
+
+    def testActiveServices(self):
+
+        self.assertEqual(self.calendar.activeServices(datetime.date(2014, 8, 22)), frozenset(["1"]))
+        self.assertEqual(self.calendar.activeServices(datetime.date(2014, 8, 23)), frozenset(["2"]))
+        self.assertEqual(self.calendar.activeServices(datetime.date(2014, 8, 24)), frozenset(["3"]))
+
+        # a holiday
+        self.assertEqual(self.calendar.activeServices(datetime.date(2014, 7, 4)), frozenset(["3"]))
+
+        # before and after the feed
+        self.assertEqual(self.calendar.activeServices(datetime.date(2014, 2, 15)), frozenset())
+        self.assertTrue(self.calendar.runsOn("1", datetime.date(2015, 2, 13)))
+        self.assertFalse(self.calendar.runsOn("1", datetime.date(2015, 2, 16)))
+
+    def testOnlyCalendarDates(self):
+
+        # a feed can leave out calendar.txt and list every day in calendar_dates.txt instead
+        db = sqlite3.connect(":memory:")
+        cursor = db.cursor()
+
+        createCalendarTables(cursor, [], [("special", "20141225", 1), ("special", "20141231", 1)])
+        calendar = ServiceCalendar.fromCursor(cursor)
+        db.close()
+
+        self.assertTrue(calendar.runsOn("special", datetime.date(2014, 12, 31)))
+        self.assertFalse(calendar.runsOn("special", datetime.date(2014, 12, 26)))
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
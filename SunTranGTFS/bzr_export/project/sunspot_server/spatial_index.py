@@ -0,0 +1,306 @@
+#
+# a grid index over latitude / longitude points, for "stops near me" and "buses near me". The world is cut into
+# cells GRID_CELL_DEGREES on a side and each point goes in the cell it is in, so finding the points near somewhere
+# only looks at the cells around it instead of every point. parse_gtfs_data.py stores the cell of every stop in
+# the stops_grid table when it creates the database, and the realtime VehicleSnapshot builds one for the buses
+#
+
+import collections
+import heapq
+import math
+import sqlite3
+
+
+# about 550 meters north to south, and 470 meters east to west in Tucson
+GRID_CELL_DEGREES = 0.005
+
+EARTH_RADIUS_METERS = 6371000.0
+
+# how many meters one degree of latitude is (everywhere), a degree of longitude is this times cos(latitude)
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * math.pi / 180
+
+# what loadStopsIndex() keeps about each stop
+Stop = collections.namedtuple("Stop", ["stopId", "stopName", "latitude", "longitude"])
+
+
+def distanceMeters(lat1, lon1, lat2, lon2):
+    ''' the great circle (haversine) distance between two points
+
+    @param lat1, lon1 - the first point, in degrees
+    @param lat2, lon2 - the second point, in degrees
+    @return the distance in meters'''
+
+    lat1Rad = math.radians(lat1)
+    lat2Rad = math.radians(lat2)
+
+    a = (math.sin((lat2Rad - lat1Rad) / 2) ** 2
+        + math.cos(lat1Rad) * math.cos(lat2Rad) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def gridCell(lat, lon, cellDegrees=GRID_CELL_DEGREES):
+    ''' the cell of the grid that a point is in
+
+    @param lat, lon - the point, in degrees
+    @param cellDegrees - how big the cells are
+    @return a (row, column) tuple of ints'''
+
+    return (int(math.floor(lat / cellDegrees)), int(math.floor(lon / cellDegrees)))
+
+
+def parseSearchArguments(lat, lon, k=None, radius=None):
+    ''' parses and checks the arguments of a "near me" search, like the ones to /nearby
+
+    @param lat, lon - the point, as strings
+    @param k - how many results, as a string, or None
+    @param radius - the distance in meters, as a string, or None
+    @return a (lat, lon, k, radius) tuple of floats (and an int for k), or raises ValueError if any of them are
+    bad. inf and nan parse as floats, but gridCell() can't do anything with them so they are bad too'''
+
+    try:
+        lat = float(lat)
+        lon = float(lon)
+        k = int(k) if k is not None else None
+        radius = float(radius) if radius is not None else None
+    except ValueError:
+        raise ValueError("lat, lon and radius have to be numbers, and k a whole number")
+
+    if not all(math.isfinite(iterNumber) for iterNumber in (lat, lon, radius if radius is not None else 0.0)):
+        raise ValueError("lat, lon and radius have to be finite numbers")
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or (k is not None and k < 1) or (radius is not None and radius <= 0):
+        raise ValueError("lat / lon out of range, or k or radius isn't positive")
+
+    return (lat, lon, k, radius)
+
+
+class GridIndex:
+    ''' points (each with a key and a value) indexed by grid cell, answers nearest() and withinRadius() by only
+    looking at the cells around the query point. Don't add to it once other threads are using it'''
+
+    def __init__(self, cellDegrees=GRID_CELL_DEGREES):
+        ''' constructor
+        @param cellDegrees - how big the cells are, in degrees'''
+
+        self.cellDegrees = cellDegrees
+
+        # (row, column) -> list of (lat, lon, key, value)
+        self.cells = dict()
+        self.count = 0
+
+        # the smallest and biggest rows and columns that have something in them, so nearest() knows when to stop
+        self.minRow = self.maxRow = self.minCol = self.maxCol = None
+
+    def add(self, key, lat, lon, value=None):
+        ''' adds a point
+
+        @param key - what the point is, like a stop_id
+        @param lat, lon - where it is, in degrees
+        @param value - anything else to keep with it'''
+
+        self.addToCell(gridCell(lat, lon, self.cellDegrees), key, lat, lon, value)
+
+    def addToCell(self, cell, key, lat, lon, value=None):
+        ''' adds a point that we already know the cell of (like from the stops_grid table)
+
+        @param cell - the (row, column) from gridCell()
+        @param key - what the point is, like a stop_id
+        @param lat, lon - where it is, in degrees
+        @param value - anything else to keep with it'''
+
+        row, col = cell
+
+        self.cells.setdefault((row, col), list()).append((lat, lon, key, value))
+        self.count += 1
+
+        if self.minRow is None:
+            self.minRow = self.maxRow = row
+            self.minCol = self.maxCol = col
+        else:
+            self.minRow = min(self.minRow, row)
+            self.maxRow = max(self.maxRow, row)
+            self.minCol = min(self.minCol, col)
+            self.maxCol = max(self.maxCol, col)
+
+    def __len__(self):
+        return self.count
+
+    def _cellsInRing(self, centerRow, centerCol, ring):
+        ''' the cells that are exactly @ring cells away from the center cell (the outside of a square)'''
+
+        if ring == 0:
+            yield (centerRow, centerCol)
+            return
+
+        for iterCol in range(centerCol - ring, centerCol + ring + 1):
+            yield (centerRow - ring, iterCol)
+            yield (centerRow + ring, iterCol)
+
+        for iterRow in range(centerRow - ring + 1, centerRow + ring):
+            yield (iterRow, centerCol - ring)
+            yield (iterRow, centerCol + ring)
+
+    def _ringCoversMeters(self, lat, ring):
+        ''' how far from a point in the center cell we are guaranteed to have looked once we've looked at every
+        cell up to @ring rings out, the point could be at the edge of its cell so its @ring cells, not @ring + 1'''
+
+        # a degree of longitude is shortest at the edge of the rings that is furthest from the equator
+        furthestLat = min(90.0, abs(lat) + (ring + 1) * self.cellDegrees)
+
+        return ring * self.cellDegrees * METERS_PER_DEGREE * math.cos(math.radians(furthestLat))
+
+    def nearest(self, lat, lon, k, maxMeters=None):
+        ''' finds the @k points closest to a point, looking one ring of cells further out at a time until the
+        ones we have are closer then anything in the cells we haven't looked at yet
+
+        @param lat, lon - the point, in degrees
+        @param k - how many points to find
+        @param maxMeters - if not None, don't find anything further away then this
+        @return a list of (distance in meters, key, value) tuples, closest first'''
+
+        if k <= 0 or self.count == 0:
+            return list()
+
+        centerRow, centerCol = gridCell(lat, lon, self.cellDegrees)
+
+        # past this many rings there are no more cells with anything in them
+        lastRing = max(abs(centerRow - self.minRow), abs(centerRow - self.maxRow),
+            abs(centerCol - self.minCol), abs(centerCol - self.maxCol))
+
+        # the k closest so far, as a max heap (negative distances)
+        found = list()
+        ring = 0
+
+        while ring <= lastRing:
+
+            for iterCell in self._cellsInRing(centerRow, centerCol, ring):
+
+                for iterLat, iterLon, iterKey, iterValue in self.cells.get(iterCell, ()):
+
+                    distance = distanceMeters(lat, lon, iterLat, iterLon)
+
+                    if maxMeters is not None and distance > maxMeters:
+                        continue
+
+                    # the key is there so two points at the same distance don't compare their values
+                    if len(found) < k:
+                        heapq.heappush(found, (-distance, iterKey, iterValue))
+                    elif distance < -found[0][0]:
+                        heapq.heapreplace(found, (-distance, iterKey, iterValue))
+
+            coveredMeters = self._ringCoversMeters(lat, ring)
+
+            if len(found) == k and -found[0][0] <= coveredMeters:
+                break
+
+            if maxMeters is not None and coveredMeters >= maxMeters:
+                break
+
+            ring += 1
+
+        return sorted(((-iterDistance, iterKey, iterValue) for iterDistance, iterKey, iterValue in found),
+            key=lambda iterResult: (iterResult[0], iterResult[1]))
+
+    def withinRadius(self, lat, lon, meters):
+        ''' finds every point within a distance of a point
+
+        @param lat, lon - the point, in degrees
+        @param meters - how far away to look
+        @return a list of (distance in meters, key, value) tuples, closest first'''
+
+        latDegrees = meters / METERS_PER_DEGREE
+        lonDegrees = meters / (METERS_PER_DEGREE * max(math.cos(math.radians(min(90.0, abs(lat) + latDegrees))), 1e-9))
+
+        minRow, minCol = gridCell(lat - latDegrees, lon - lonDegrees, self.cellDegrees)
+        maxRow, maxCol = gridCell(lat + latDegrees, lon + lonDegrees, self.cellDegrees)
+
+        # a huge radius would be more cells then we have, so just go through the ones we have
+        if (maxRow - minRow + 1) * (maxCol - minCol + 1) > len(self.cells):
+            cellLists = [iterPoints for (iterRow, iterCol), iterPoints in self.cells.items()
+                if minRow <= iterRow <= maxRow and minCol <= iterCol <= maxCol]
+        else:
+            cellLists = [self.cells.get((iterRow, iterCol), ()) for iterRow in range(minRow, maxRow + 1)
+                for iterCol in range(minCol, maxCol + 1)]
+
+        results = list()
+
+        for iterPoints in cellLists:
+            for iterLat, iterLon, iterKey, iterValue in iterPoints:
+
+                distance = distanceMeters(lat, lon, iterLat, iterLon)
+                if distance <= meters:
+                    results.append((distance, iterKey, iterValue))
+
+        results.sort(key=lambda iterResult: (iterResult[0], iterResult[1]))
+
+        return results
+
+
+def createStopsGrid(cursor, cellDegrees=GRID_CELL_DEGREES):
+    ''' creates the stops_grid table (the grid cell of every stop) from the stops table, and the stops_grid_info
+    table that says how big the cells are. Clients can find the stops near them with
+    'SELECT stop_id FROM stops_grid WHERE cell_row BETWEEN ? AND ? AND cell_col BETWEEN ? AND ?'
+
+    @param cursor - a cursor for the database, that already has the stops table
+    @param cellDegrees - how big the cells are
+    @return how many stops went into the grid'''
+
+    cursor.execute('''CREATE TABLE stops_grid_info (cell_degrees REAL)''')
+    cursor.execute('''INSERT INTO stops_grid_info VALUES (?)''', (cellDegrees,))
+
+    cursor.execute('''CREATE TABLE stops_grid
+        (cell_row INTEGER, cell_col INTEGER, stop_id TEXT)''')
+
+    cursor.execute('''CREATE INDEX stops_grid_cell_index ON stops_grid (cell_row, cell_col)''')
+
+    # stops without a location (if there are any) can't be near anything
+    cursor.execute('''SELECT stop_id, stop_lat, stop_lon FROM stops WHERE stop_lat != ? AND stop_lon != ?''', ("", ""))
+
+    rows = list()
+    for iterStopId, iterLat, iterLon in cursor.fetchall():
+        row, col = gridCell(float(iterLat), float(iterLon), cellDegrees)
+        rows.append((row, col, iterStopId))
+
+    cursor.executemany('''INSERT INTO stops_grid VALUES (?, ?, ?)''', rows)
+
+    return len(rows)
+
+
+def loadStopsIndex(dbPath):
+    ''' loads the stops of a database that parse_gtfs_data.py created into a GridIndex, using the cells in its
+    stops_grid table, or working them out from the stops table if its a database from before there was one
+
+    @param dbPath - the path to the sqlite3 database
+    @return a GridIndex of stop_id -> Stop'''
+
+    db = sqlite3.connect(dbPath)
+
+    try:
+        cursor = db.cursor()
+
+        try:
+            cursor.execute('''SELECT cell_degrees FROM stops_grid_info''')
+            stopsIndex = GridIndex(cursor.fetchone()[0])
+
+            cursor.execute('''SELECT stops_grid.cell_row, stops_grid.cell_col, stops.stop_id, stops.stop_name,
+                stops.stop_lat, stops.stop_lon FROM stops_grid JOIN stops ON stops_grid.stop_id = stops.stop_id''')
+            rows = cursor.fetchall()
+
+        except sqlite3.OperationalError:
+
+            # a database from before there was a stops_grid table, same as createStopsGrid() but in memory
+            stopsIndex = GridIndex()
+
+            cursor.execute('''SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops WHERE stop_lat != ? AND stop_lon != ?''', ("", ""))
+            rows = [gridCell(float(iterLat), float(iterLon), stopsIndex.cellDegrees) + (iterStopId, iterStopName, iterLat, iterLon)
+                for iterStopId, iterStopName, iterLat, iterLon in cursor.fetchall()]
+
+        for iterRow, iterCol, iterStopId, iterStopName, iterLat, iterLon in rows:
+            stop = Stop(iterStopId, iterStopName, float(iterLat), float(iterLon))
+            stopsIndex.addToCell((iterRow, iterCol), iterStopId, stop.latitude, stop.longitude, stop)
+
+    finally:
+        db.close()
+
+    return stopsIndex
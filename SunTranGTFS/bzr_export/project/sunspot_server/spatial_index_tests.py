@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# tests for spatial_index.py, checks the grid's answers against just measuring the distance to every point
+#
+
+import unittest
+import os
+import random
+import sqlite3
+import tempfile
+
+from spatial_index import GridIndex, distanceMeters, createStopsGrid, loadStopsIndex, parseSearchArguments
+
+
+class TestGridIndex(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        # random points around Tucson, and a few exactly on cell edges
+        rand = random.Random(2014)
+        self.points = [("p{}".format(i), rand.uniform(32.0, 32.4), rand.uniform(-111.1, -110.7)) for i in range(2000)]
+        self.points.extend([("edge1", 32.2, -110.9), ("edge2", 32.205, -110.895)])
+
+        self.index = GridIndex()
+        for iterKey, iterLat, iterLon in self.points:
+            self.index.add(iterKey, iterLat, iterLon, (iterLat, iterLon))
+
+        self.queries = [(32.2, -110.9), (32.2213, -110.9688), (32.0, -111.1), (31.5, -110.9), (32.39, -110.71)]
+
+    def _bruteForce(self, lat, lon):
+        ''' the distance to every point, closest first'''
+
+        return sorted((distanceMeters(lat, lon, iterLat, iterLon), iterKey) for iterKey, iterLat, iterLon in self.points)
+
+    def testNearest(self):
+
+        self.assertEqual(len(self.index), len(self.points))
+
+        for iterLat, iterLon in self.queries:
+            for iterK in [1, 5, 25]:
+
+                results = self.index.nearest(iterLat, iterLon, iterK)
+                expected = self._bruteForce(iterLat, iterLon)[:iterK]
+
+                self.assertEqual([iterKey for iterDistance, iterKey, iterValue in results], [iterKey for iterDistance, iterKey in expected])
+
+        # asking for more then there are gets all of them
+        self.assertEqual(len(self.index.nearest(32.2, -110.9, 5000)), len(self.points))
+
+    def testNearestWithinDistance(self):
+
+        results = self.index.nearest(32.2, -110.9, 50, 400)
+        expected = [iterResult for iterResult in self._bruteForce(32.2, -110.9) if iterResult[0] <= 400][:50]
+
+        self.assertEqual([iterKey for iterDistance, iterKey, iterValue in results], [iterKey for iterDistance, iterKey in expected])
+        self.assertEqual(results[0][1], "edge1")
+        self.assertAlmostEqual(results[0][0], 0.0)
+
+        # nothing is that close out in the middle of nowhere
+        self.assertEqual(self.index.nearest(31.5, -110.9, 10, 1000), [])
+
+    def testWithinRadius(self):
+
+        for iterLat, iterLon in self.queries:
+            for iterMeters in [100, 1500, 100000]:
+
+                results = self.index.withinRadius(iterLat, iterLon, iterMeters)
+                expected = [iterResult for iterResult in self._bruteForce(iterLat, iterLon) if iterResult[0] <= iterMeters]
+
+                self.assertEqual([iterKey for iterDistance, iterKey, iterValue in results], [iterKey for iterDistance, iterKey in expected])
+
+    def testEmpty(self):
+
+        index = GridIndex()
+        self.assertEqual(index.nearest(32.2, -110.9, 5), [])
+        self.assertEqual(index.withinRadius(32.2, -110.9, 1000), [])
+
+    def testParseSearchArguments(self):
+
+        self.assertEqual(parseSearchArguments("32.22", "-110.97"), (32.22, -110.97, None, None))
+        self.assertEqual(parseSearchArguments("32.22", "-110.97", "5", "800"), (32.22, -110.97, 5, 800.0))
+
+        # what /nearby answers with a 400, rather then letting gridCell() blow up on an infinite radius
+        for iterArguments in [("x", "-110.97"), ("32.22", "-110.97", "1.5"), ("91", "-110.97"), ("32.22", "-110.97", "0"),
+                ("32.22", "-110.97", None, "-5"), ("inf", "-110.97"), ("32.22", "nan"), ("32.22", "-110.97", None, "inf"),
+                ("32.22", "-110.97", None, "nan"), ("32.22", "-110.97", "5", "-inf")]:
+            with self.assertRaises(ValueError):
+                parseSearchArguments(*iterArguments)
+
+
+class TestStopsGrid(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        tmpFile, self.dbPath = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(tmpFile)
+
+        db = sqlite3.connect(self.dbPath)
+        cursor = db.cursor()
+
+        # the same as parse_gtfs_data.py's stops table, with the values as strings like the csv module gives us
+        cursor.execute('''CREATE TABLE stops
+            (stop_id TEXT, stop_code TEXT, stop_name TEXT, stop_desc TEXT,
+            stop_lat REAL, stop_lon REAL, zone_id TEXT, stop_url TEXT, location_type INTEGER,
+            parent_station TEXT, wheelchair_boarding TEXT)''')
+
+        stops = [("1", "Ronstadt Center", "32.2225", "-110.9697"), ("2", "Speedway & Campbell", "32.2363", "-110.9441"),
+            ("3", "Tucson Mall", "32.2884", "-110.9745"), ("4", "No Location", "", "")]
+
+        for iterStopId, iterName, iterLat, iterLon in stops:
+            cursor.execute('''INSERT INTO stops VALUES (?,?,?,?,?,?,?,?,?,?,?)''',
+                (iterStopId, iterStopId, iterName, "", iterLat, iterLon, "", "", "0", "", ""))
+
+        self.assertEqual(createStopsGrid(cursor), 3)
+
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+
+        os.remove(self.dbPath)
+
+    def testLoadStopsIndex(self):
+
+        stopsIndex = loadStopsIndex(self.dbPath)
+        self.assertEqual(len(stopsIndex), 3)
+
+        results = stopsIndex.nearest(32.2226, -110.9690, 2)
+        self.assertEqual([iterKey for iterDistance, iterKey, iterValue in results], ["1", "2"])
+
+        stop = results[0][2]
+        self.assertEqual(stop.stopName, "Ronstadt Center")
+        self.assertAlmostEqual(stop.latitude, 32.2225)
+
+        self.assertEqual([iterKey for iterDistance, iterKey, iterValue in stopsIndex.withinRadius(32.2884, -110.9745, 500)], ["3"])
+
+    def testOldDatabase(self):
+
+        # a database from before there was a stops_grid table gets the same answers
+        db = sqlite3.connect(self.dbPath)
+        db.execute('''DROP TABLE stops_grid''')
+        db.execute('''DROP TABLE stops_grid_info''')
+        db.commit()
+        db.close()
+
+        stopsIndex = loadStopsIndex(self.dbPath)
+        self.assertEqual(len(stopsIndex), 3)
+
+        results = stopsIndex.nearest(32.2226, -110.9690, 2)
+        self.assertEqual([iterKey for iterDistance, iterKey, iterValue in results], ["1", "2"])
+        self.assertEqual(results[0][2].stopName, "Ronstadt Center")
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
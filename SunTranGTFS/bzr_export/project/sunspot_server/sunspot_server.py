@@ -14,40 +14,34 @@
 import sys
 sys.stdout = sys.stderr
 
-import hashlib
-import atexit
-import threading
 import cherrypy
-from cherrypy.lib.static import serve_file
 
 
 ###################
 # library imports
 ###################
 
-import os.path
+# NOTE: every apache / mod_wsgi worker pays for these before it can answer its first request, so only import 
+# what Root.POST needs up here. Things that only TestZip, the realtime classes or the LZMA compressor use (requests, arrow,
+# lzma...) get imported the first time they are used instead. tools/sunspot_server_startup.py shows how long 
+# each import takes
+import collections
+import itertools
 import os
-import zlib
-import requests
-import zipfile
-import csv
-import io
-import arrow
-from contextlib import closing
-import yaml
-import lzma
 import pathlib
 import json
+import threading
+import time
 
 ###################
 # project imports 
 ###################
 
-# TODO: HACK or else it won't import our classes!
-if "/var/www/sunspot" not in sys.path:
-    sys.path.append("/var/www/sunspot")
-from constants import Constants
+from constants import Constants, ConstantsWatcher
 from server_database import CherrypyServerDatabase, ServerDatabaseEnums
+from server_database_mirror import MirroredServerDatabase
+from request_timing import RequestTimer, RequestTimingStats
+from request_logging import RequestLogger
 
 
 ###################
@@ -55,7 +49,6 @@ from server_database import CherrypyServerDatabase, ServerDatabaseEnums
 ###################
 
 from sunspot_messages_pb2 import SunspotMessages
-from gtfs_realtime_pb2 import FeedMessage
 import google.protobuf.message # for DecodeError exception
 
 
@@ -65,10 +58,11 @@ class Root:
     # let cherrypy know that we are exposing this class to the web to be called
     exposed = True
     
-    def __init__(self):
-        ''' constructor'''
+    def __init__(self, timingStats):
+        ''' constructor
+        @param timingStats - the RequestTimingStats that every request's timings get added to'''
 
-        pass
+        self.timingStats = timingStats
 
     def _setApp(self, app):
         ''' hackish method to make it so this object has a reference to the applications Logger object
@@ -78,12 +72,45 @@ class Root:
         # a recursive dependency here
         self.app = app
         self.logger = self.app.log
-        self.logger.error_log.setLevel("DEBUG")
 
         # self.logger.error(str(app.config))
         # self.logger.error(app.config["/"]["constants_yaml"])
 
-        self.constants = Constants(app.config["/"]["constants_yaml"])
+        self._applyConstants(Constants(app.config["/"]["constants_yaml"]))
+
+        if self.constants.CONSTANTS_RELOAD_INTERVAL > 0:
+            self.constantsWatcher = ConstantsWatcher(self.constants, self.constants.CONSTANTS_RELOAD_INTERVAL,
+                self._applyConstants, self.logger.error_log.getChild("constants"))
+            self.constantsWatcher.start()
+
+
+    def _applyConstants(self, constantsObj):
+        ''' starts using a Constants object, called once at startup and then by the ConstantsWatcher (on its
+        thread) whenever the yaml file changes. Requests that are already running keep using the old one
+
+        @param constantsObj - the Constants object'''
+
+        # DEBUG gets every query that the ServerDatabase sends to the leveldb_server written to the error log
+        self.logger.error_log.setLevel(constantsObj.SUNSPOT_LOGGING_LEVEL)
+
+        # its own logger, so it can have its own level without hiding everything else in the error log
+        self.requestLog = RequestLogger.fromConstants(constantsObj, self.logger.error_log.getChild("requests"))
+
+        self.constants = constantsObj
+
+
+    def getServerDatabase(self, constantsObj):
+        ''' connects to wherever LEVELDB_SERVER_READ_FROM says to read the ServerDatabase from
+
+        @param constantsObj - the Constants object
+        @return a CherrypyServerDatabase (or a MirroredServerDatabase of one)'''
+
+        # we only read, so it doesn't matter that the mirror / replica is a few milliseconds behind the leveldb_server
+        readFrom = constantsObj.LEVELDB_SERVER_READ_FROM
+        if readFrom == "mirror":
+            return MirroredServerDatabase.fromConstants(constantsObj, self.logger, CherrypyServerDatabase)
+
+        return CherrypyServerDatabase.fromConstants(constantsObj, self.logger, replica=(readFrom == "replica"))
 
 
     def _handleError(self, errCode, logMsg, errMsg, httpErrCode=400):
@@ -144,10 +171,10 @@ class Root:
             '''@param bytesToCompress - the bytes to compress, duh
             @return the compressed bytes'''
 
-            self.logger.error("CompressorLzmaXz: beginning compression")
-            zeBytes =  lzma.compress(bytesToCompress, format=lzma.FORMAT_XZ)
-            self.logger.error("CompressorLzmaXz: finished compression")
-            return zeBytes
+            import lzma
+
+            # how long this takes is in the 'compress' part of the Server-Timing header
+            return lzma.compress(bytesToCompress, format=lzma.FORMAT_XZ)
 
 
 
@@ -159,8 +186,6 @@ class Root:
         '''
 
         objToReturn = self.CompressorNone
-        
-        self.logger.error("_getCompressorObj(): The compression list we got: {}".format(str(reqCompressionList)))
 
         for iterCompression in reqCompressionList:
 
@@ -170,7 +195,6 @@ class Root:
                 continue
 
             elif iterCompression == SunspotMessages.COMPRESSION_LZMA_XZ:
-                self.logger.error("_getCompressorObj(): Returning CompressorLzmaXz")
                 objToReturn = self.CompressorLzmaXz
                 break
             else:
@@ -183,7 +207,8 @@ class Root:
     def _getTimestamp(self):
         ''' helper method to get a timestamp'''
 
-        return str(arrow.utcnow().timestamp)
+        # same as arrow.utcnow().timestamp, without importing arrow
+        return str(int(time.time()))
 
 
     def GET(self):
@@ -193,30 +218,56 @@ class Root:
 
     @cherrypy.tools.accept(media='application/octet-stream') # we only accept application/octet-stream content-types
     def POST(self):
-        ''' called when we recieve a POST request'''
+        ''' called when we recieve a POST request, times how long each part of handling it takes (see _handlePost())
+        and sends that back in the Server-Timing header'''
+
+        timer = RequestTimer()
+
+        # _handlePost() puts the request body and the decoded message in here, we log them once we know how long
+        # the request took and whether it worked
+        requestInfo = dict()
+        failed = True
+
+        try:
+            result = self._handlePost(timer, requestInfo)
+            failed = str(cherrypy.response.status or 200)[0] in "45"
+            return result
 
+        finally:
+            timer.finish()
+            cherrypy.response.headers["Server-Timing"] = timer.serverTimingHeader()
+            self.timingStats.record(timer)
 
-        sbObj = CherrypyServerDatabase(self.constants.CONFIG_DB_PATH, self.logger)
+            if "data" in requestInfo:
+                self.requestLog.logRequest(requestInfo["data"], requestInfo.get("clientObj"), timer.totalSeconds, failed)
 
-        self.logger.error("Current dir: {}".format(os.getcwd()))
-        self.logger.error("application config: {}".format(application.config))
-        self.logger.error("process request: {}".format(cherrypy.request.process_request_body))
-        self.logger.error("method: {}".format(cherrypy.request.method))
 
-        data = cherrypy.request.body.read()
-        self.logger.error("The data is: {}".format(data))
+    def _handlePost(self, timer, requestInfo):
+        ''' does the actual work for POST()
 
+        @param timer - the RequestTimer for this request
+        @param requestInfo - a dictionary we put the request body ('data') and the decoded message ('clientObj') in, for logging
+        @return the response body'''
+
+        with timer.span("connect"):
+            constantsObj = self.constants
+            sbObj = self.getServerDatabase(constantsObj)
 
         # read the data that the client sent us
         clientObj = SunspotMessages.ActualSunspotMessage()
         try:
-            clientObj.ParseFromString(data)
+            with timer.span("parse"):
+                data = cherrypy.request.body.read()
+                requestInfo["data"] = data
+                clientObj.ParseFromString(data)
         except google.protobuf.message.DecodeError as e:            
             return self._handleError(SunspotMessages.ServerError.INVALID_PROTOBUF_MSG, 
                 "ERROR: failed to decode SunspotMessages from data: '{}'".format(e),
                 "couldn't decode protobuf, error: {}".format(e))
 
 
+        requestInfo["clientObj"] = clientObj
+
         # ok, what does the client want?
         msgType = clientObj.message_type
 
@@ -249,26 +300,33 @@ class Root:
 
                 compressorObject = self._getCompressorObj(clientObj.server_query_message.requested_compression)
 
-                # need to ask our database what the full path for the latest db is.
+                # need to ask our database what the full path for the latest db is. Read both from a snapshot so 
+                # we can't see a new KEY_LAST_DOWNLOAD_TIME from before the parse_gtfs_data.py publishes everything else
                 latestDbTime = None
                 latestDbPath = None
                 try:
-                    latestDbTime = sbObj[ServerDatabaseEnums.KEY_LAST_DOWNLOAD_TIME]
+                    with timer.span("db"), sbObj.snapshot():
+                        latestDbTime = sbObj[ServerDatabaseEnums.KEY_LAST_DOWNLOAD_TIME]
 
-                    latestDbPath = sbObj.getWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [latestDbTime])
+                        latestDbPath = sbObj.getWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [latestDbTime])
 
                 except Exception as e:
                     return self._handleError(SunspotMessages.ServerError.SERVER_ERROR, "ERROR: got KeyError when reading from "
                         + " ServerDatabase when trying to get the path to the latest database: {}".format(e), 
                         "Server encountered an error", 500)
 
-                with open(latestDbPath, "rb") as f:
-                    respMsg.actual_data = compressorObject.compress(f.read())
+                with timer.span("file"), open(latestDbPath, "rb") as f:
+                    dbBytes = f.read()
+
+                with timer.span("compress"):
+                    respMsg.actual_data = compressorObject.compress(dbBytes)
 
                 respMsg.compression_type = compressorObject.compressionType
 
                 cherrypy.response.headers['Content-Type'] = "application/octet-stream"
-                return fullDbProtoObj.SerializeToString()
+
+                with timer.span("serialize"):
+                    return fullDbProtoObj.SerializeToString()
 
             elif askingFor == SunspotMessages.ServerQuery.NEED_PATCH:
                 pass
@@ -298,8 +356,6 @@ class Root:
 
 
 
-        self.logger.error("the object was: {}".format(str(clientObj)))
-
         return "hello"
 
 
@@ -348,10 +404,36 @@ class TestZip():
         # NOTE: THE ZIP FILES MUST BE OWNED by www-data for this call to work!
         os.utime(str(tmpZipFilePath), times=(modtime, modtime))
 
+        from cherrypy.lib.static import serve_file
+
         self.logger.error("Testzip: num is {}, serving {}".format(num, tmpZipFilePath))
         return serve_file(str(tmpZipFilePath), "application/zip", str(tmpZipFilePath))
 
 
+def getRealtimeSnapshot(constantsObj, logger):
+    ''' gets the newest VehicleSnapshot of the realtime feed, for TmpFindBus and RealtimeVehicles. Every request
+    thread shares one poller that downloads the feed in the background, so this doesn't download anything itself
+
+    @param constantsObj - the Constants object, for the REALTIME_* settings
+    @param logger - the cherrypy application's log
+    @return the VehicleSnapshot, or raises a 503 HTTPError if we don't have a recent one'''
+
+    from realtime_feed import RealtimeFeedPoller
+
+    poller = RealtimeFeedPoller.shared(constantsObj, logger.error_log.getChild("realtime"))
+
+    if not poller.waitUntilReady(constantsObj.REALTIME_REQUEST_TIMEOUT):
+        logger.error("\tdon't have the realtime feed yet")
+        raise cherrypy.HTTPError(503)
+
+    if time.time() - poller.lastCheckedTime > constantsObj.REALTIME_STALE_SECONDS:
+        import arrow
+        logger.error("\tthe realtime feed is stale, last heard from it at {}".format(arrow.get(poller.lastCheckedTime).isoformat()))
+        raise cherrypy.HTTPError(503)
+
+    return poller.snapshot
+
+
 class TmpFindBus():
     ''' simple cherrypy application that just returns json of a bus's coordinates that they specify
     '''
@@ -364,42 +446,666 @@ class TmpFindBus():
         ''' constructor'''
         self.logger = None
 
+        # the Root application, for its Constants
+        self.root = None
+
 
     def GET(self, busNum, milliSinceEpoch):
 
         cherrypy.response.headers['Content-Type'] = "application/json"
 
-        actualDate = arrow.get(int(milliSinceEpoch) / 1000)
+        snapshot = getRealtimeSnapshot(self.root.constants, self.logger)
+
+        # the snapshot already has the json for every bus
+        vehicleJson = snapshot.vehicleJson.get(busNum)
+
+        if vehicleJson is None:
+            self.logger.error("\tcouldn't find bus with number {}".format(busNum))
+            raise cherrypy.HTTPError(401)
+
+        return vehicleJson
+
+        # return "{'hello': 'bob'}".encode("utf-8")
+
+
+class RealtimeVehicles():
+    ''' cherrypy application that returns json of every bus on a route (?route=<route_id>) or a trip
+    (?trip=<trip_id>), so a map can show them all with one request instead of asking TmpFindBus about each one.
+    A route or trip that doesn't have any buses on it right now gets an empty 'vehicles' list'''
+
+    # let cherrypy know that we are exposing this class to the web to be called
+    exposed = True
+
+
+    def __init__(self):
+        ''' constructor'''
+        self.logger = None
+
+        # the Root application, for its Constants
+        self.root = None
+
+
+    def GET(self, route=None, trip=None):
+
+        if (route is None) == (trip is None):
+            raise cherrypy.HTTPError(400, "specify either route or trip")
+
+        cherrypy.response.headers['Content-Type'] = "application/json"
+
+        snapshot = getRealtimeSnapshot(self.root.constants, self.logger)
+
+        if route is not None:
+            return snapshot.routeJson.get(route) or snapshot.vehicleListJson("route_id", route, ())
+
+        return snapshot.tripJson.get(trip) or snapshot.vehicleListJson("trip_id", trip, ())
+
+class RealtimeSubscribe():
+    ''' cherrypy application that tells clients when buses move, instead of them asking TmpFindBus over and over.
+    The client says which vehicles (labels) and / or routes (route_ids) it cares about:
+
+        /subscribe?vehicles=100,200&routes=4&since=<version>
+
+    is a long poll, it answers straight away with anything that changed since that version (or everything, if
+    there is no since), otherwise it waits for one of them to change, or REALTIME_LONG_POLL_TIMEOUT seconds.
+    Either way the client asks again with the 'version' it got back. /subscribe/events is the same thing as a
+    server sent events stream. Nothing here downloads the feed, they all wait on the one shared poller.
+
+    Each one holds on to one of the server's threads while it waits, so only REALTIME_MAX_SUBSCRIBERS can wait at
+    once (in each process), after that they get a 503 with a Retry-After header
+    '''
+
+    # let cherrypy know that we are exposing this class to the web to be called
+    exposed = True
+
+    # the most vehicles + routes one request can ask about
+    MAX_KEYS = 50
+
+
+    def __init__(self):
+        ''' constructor'''
+        self.logger = None
+
+        # the Root application, for its Constants
+        self.root = None
+
+        # the RealtimeBroadcaster for this process's poller, created the first time someone subscribes
+        self.broadcaster = None
+        self.broadcasterLock = threading.Lock()
+
+        # how many long polls and event streams are waiting right now
+        self.subscriberCount = 0
+        self.subscriberLock = threading.Lock()
+
+        self.events = RealtimeSubscribeEvents(self)
+
+
+    def getBroadcaster(self):
+        ''' gets the RealtimeBroadcaster for this process, once we have a recent version of the feed
+
+        @return the RealtimeBroadcaster, or raises a 503 HTTPError like getRealtimeSnapshot()'''
+
+        from realtime_feed import RealtimeFeedPoller
+        from realtime_broadcast import RealtimeBroadcaster
+
+        getRealtimeSnapshot(self.root.constants, self.logger)
+        poller = RealtimeFeedPoller.shared(self.root.constants)
 
-        self.logger.error("[{}]: bus number is {}".format(actualDate.isoformat(), busNum))
+        with self.broadcasterLock:
 
+            # the poller is per process, if we got forked we need a new one
+            if self.broadcaster is None or self.broadcaster.poller is not poller:
+                self.broadcaster = RealtimeBroadcaster(poller)
 
-        resp = requests.get("http://suntran.com/TMGTFSRealTimeWebService/Vehicle/VehiclePositions.pb")
+            return self.broadcaster
 
 
+    def addSubscriber(self):
+        ''' counts a long poll or event stream that is about to wait on the broadcaster, call removeSubscriber() once
+        it is done
+
+        @return True, or False if REALTIME_MAX_SUBSCRIBERS are already waiting'''
+
+        constantsObj = self.root.constants
+
+        with self.subscriberLock:
+
+            if self.subscriberCount >= constantsObj.REALTIME_MAX_SUBSCRIBERS:
+                return False
+
+            self.subscriberCount += 1
+            return True
+
+
+    def removeSubscriber(self):
+        ''' call when a long poll or event stream that addSubscriber() counted is done'''
+
+        with self.subscriberLock:
+            self.subscriberCount -= 1
+
+
+    def tooManySubscribers(self):
+        ''' sets up a 503 response for when addSubscriber() says there are too many. This doesn't raise a HTTPError,
+        cherrypy takes the Retry-After header off of those
+
+        @return the response body'''
+
+        constantsObj = self.root.constants
+
+        self.logger.error("\tturning away a subscriber, {} are already waiting".format(constantsObj.REALTIME_MAX_SUBSCRIBERS))
+
+        # the feed changes about this often, so there is no point coming back sooner
+        cherrypy.response.status = 503
+        cherrypy.response.headers['Retry-After'] = str(max(1, int(constantsObj.REALTIME_POLL_INTERVAL)))
+        cherrypy.response.headers['Content-Type'] = "text/plain"
+
+        return b"too many subscribers, try again later"
+
+
+    def parseKeys(self, vehicles, routes):
+        ''' turns the vehicles and routes parameters into the keys for the RealtimeBroadcaster
+
+        @param vehicles - comma separated vehicle labels, or None
+        @param routes - comma separated route_ids, or None
+        @return a list of keys, or raises a 400 HTTPError'''
+
+        from realtime_broadcast import KEY_VEHICLE, KEY_ROUTE
+
+        keys = list()
+
+        for iterKind, iterParam in [(KEY_VEHICLE, vehicles), (KEY_ROUTE, routes)]:
+            if iterParam:
+                keys.extend((iterKind, iterId.strip()) for iterId in iterParam.split(",") if iterId.strip())
+
+        if not keys or len(keys) > self.MAX_KEYS:
+            raise cherrypy.HTTPError(400, "specify between 1 and {} vehicles and / or routes".format(self.MAX_KEYS))
+
+        return keys
+
+
+    def GET(self, vehicles=None, routes=None, since=None):
+
+        from realtime_broadcast import updateJson
+
+        keys = self.parseKeys(vehicles, routes)
+        broadcaster = self.getBroadcaster()
+
+        if not self.addSubscriber():
+            return self.tooManySubscribers()
+
         try:
-            protoObj = FeedMessage.FromString(resp.content)
-        except google.protobuf.message.DecodeError as e:  
-            raise cherrypy.HTTPError(401)
+            version, snapshot, changedKeys = broadcaster.waitForChange(keys, since, self.root.constants.REALTIME_LONG_POLL_TIMEOUT)
+        finally:
+            self.removeSubscriber()
 
-        for iterEnt in protoObj.entity:
-            if iterEnt.HasField("vehicle"):
-                if iterEnt.vehicle.vehicle.label == busNum:
-                    ts = arrow.now().isoformat()
-                    returnStr = json.dumps({
-                        "vehicle": busNum, 
-                        "lat": iterEnt.vehicle.position.latitude, 
-                        "lon": iterEnt.vehicle.position.longitude,
-                        "timestamp": ts})
-                    self.logger.error("\tFound bus, returning lat: {}, lon: {}, time: {}".format(
-                        iterEnt.vehicle.position.latitude, iterEnt.vehicle.position.longitude, ts ))
-                    return returnStr.encode("utf-8")
-
-        # if we get here we haven't found the bus
-        self.logger.error("\tcouldn't find bus with number {}".format(busNum))
-        raise cherrypy.HTTPError(401)
+        cherrypy.response.headers['Content-Type'] = "application/json"
+        cherrypy.response.headers['Cache-Control'] = "no-cache"
+
+        return updateJson(version, snapshot, changedKeys)
+
+
+class RealtimeSubscribeEvents():
+    ''' cherrypy application for /subscribe/events, the server sent events version of RealtimeSubscribe. Each
+    change is an 'update' event with the version as its id (so a browser that reconnects picks up where it left
+    off) and the same JSON as a long poll as its data. The stream ends after REALTIME_SSE_MAX_SECONDS'''
+
+    # let cherrypy know that we are exposing this class to the web to be called
+    exposed = True
+
+
+    def __init__(self, subscribe):
+        ''' constructor
+        @param subscribe - the RealtimeSubscribe this is a part of'''
+
+        self.subscribe = subscribe
+
+
+    def GET(self, vehicles=None, routes=None, since=None):
+
+        from realtime_broadcast import updateJson
+
+        keys = self.subscribe.parseKeys(vehicles, routes)
+        broadcaster = self.subscribe.getBroadcaster()
+        constantsObj = self.subscribe.root.constants
+
+        # what EventSource sends when it reconnects
+        since = cherrypy.request.headers.get("Last-Event-ID", since)
+
+        if not self.subscribe.addSubscriber():
+            return self.subscribe.tooManySubscribers()
+
+        cherrypy.response.headers['Content-Type'] = "text/event-stream"
+        cherrypy.response.headers['Cache-Control'] = "no-cache"
+
+        def eventStream(since):
+
+            try:
+                yield b": connected\n\n"
+
+                endTime = time.time() + constantsObj.REALTIME_SSE_MAX_SECONDS
+
+                while True:
+
+                    timeLeft = endTime - time.time()
+                    if timeLeft <= 0:
+                        break
+
+                    version, snapshot, changedKeys = broadcaster.waitForChange(keys, since,
+                        min(constantsObj.REALTIME_LONG_POLL_TIMEOUT, timeLeft))
+
+                    if changedKeys:
+                        yield b"".join([b"id: ", version.encode("utf-8"), b"\nevent: update\ndata: ",
+                            updateJson(version, snapshot, changedKeys), b"\n\n"])
+                    else:
+                        # a comment, so proxies don't think the connection is dead
+                        yield b": nothing new\n\n"
+
+                    since = version
+
+            finally:
+                # the client went away (cherrypy closes the generator) or we are done
+                self.subscribe.removeSubscriber()
+
+        # start it here, a generator that never started doesn't run its finally when it gets closed, so if cherrypy
+        # never got to it we would never stop counting it
+        stream = eventStream(since)
+        return itertools.chain([next(stream)], stream)
+
+
+class RealtimeDeltas():
+    ''' cherrypy application that keeps a phone's buses and trip delays up to date with as few bytes as we can,
+    /delta?stream=<stream_id>&since=<sequence> returns a RealtimeDelta protobuf (see realtime_delta.py) of what
+    changed in the realtime feeds since that sequence number. Without them (or if the phone is too far behind) it
+    is a full snapshot, either way the phone asks with the stream_id and to_sequence it got back next time
+    '''
+
+    # let cherrypy know that we are exposing this class to the web to be called
+    exposed = True
+
+
+    def __init__(self):
+        ''' constructor'''
+        self.logger = None
+
+        # the Root application, for its Constants
+        self.root = None
+
+        # the RealtimeDeltaHistory for this process's pollers, created the first time someone asks
+        self.history = None
+        self.historyLock = threading.Lock()
+
+
+    def getHistory(self):
+        ''' gets the RealtimeDeltaHistory for this process, once we have a recent version of the VehiclePositions feed
+
+        @return the RealtimeDeltaHistory, or raises a 503 HTTPError like getRealtimeSnapshot()'''
+
+        from realtime_feed import RealtimeFeedPoller
+        from realtime_delta import RealtimeDeltaHistory
+        from trip_predictions import TripUpdatesSnapshot
+
+        constantsObj = self.root.constants
+
+        getRealtimeSnapshot(constantsObj, self.logger)
+        vehiclePoller = RealtimeFeedPoller.shared(constantsObj)
+
+        # the trip delays show up once the TripUpdates feed has been downloaded, until then its just vehicles
+        tripUpdatesPoller = RealtimeFeedPoller.shared(constantsObj, self.logger.error_log.getChild("tripupdates"),
+            constantsObj.REALTIME_TRIP_UPDATES_URL, TripUpdatesSnapshot.fromFeedBytes)
+
+        with self.historyLock:
+
+            # the pollers are per process, if we got forked we need a new one
+            if self.history is None or self.history.vehiclePoller is not vehiclePoller:
+                self.history = RealtimeDeltaHistory(vehiclePoller, tripUpdatesPoller, constantsObj.REALTIME_DELTA_HISTORY)
+
+            return self.history
+
+
+    def GET(self, stream=None, since=None):
+
+        from realtime_delta import parseSequence
+
+        try:
+            since = parseSequence(since) if since is not None else None
+        except ValueError:
+            raise cherrypy.HTTPError(400, "since has to be a whole number from 0 to 2^64 - 1")
+
+        history = self.getHistory()
+
+        cherrypy.response.headers['Content-Type'] = "application/octet-stream"
+        cherrypy.response.headers['Cache-Control'] = "no-cache"
+
+        return history.deltaBytes(stream, since)
+
+
+class LatestDatabaseCache():
+    ''' something made from the newest database that parse_gtfs_data.py published (like the GridIndex of its stops),
+    that we only make once per database and then share between the request threads. Which database is the newest
+    is only looked up in the ServerDatabase every LATEST_DATABASE_CHECK_SECONDS, not on every request'''
+
+    # (time.time() of when we last looked, the path of the newest database), shared by every LatestDatabaseCache in
+    # the process since they all want the same path
+    latestPath = (None, None)
+
+    def __init__(self, loadFunc, description):
+        ''' constructor
+        @param loadFunc - function that takes the path to the database and returns the thing made from it
+        @param description - what it is, for the log'''
+
+        self.loadFunc = loadFunc
+        self.description = description
+
+        # (path of the database, what loadFunc made from it), replaced once parse_gtfs_data.py publishes a new database
+        self.loaded = (None, None)
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def latestDatabasePath(cls, root, logger):
+        ''' the path to the newest database that parse_gtfs_data.py published, from the ServerDatabase if we haven't
+        looked in the last LATEST_DATABASE_CHECK_SECONDS
+
+        @param root - the Root application, for its Constants and ServerDatabase
+        @param logger - the cherrypy application's log
+        @return the path, or raises a 500 HTTPError if we can't find it'''
+
+        checkedTime, latestDbPath = cls.latestPath
+
+        if checkedTime is not None and time.time() - checkedTime < root.constants.LATEST_DATABASE_CHECK_SECONDS:
+            return latestDbPath
+
+        sbObj = root.getServerDatabase(root.constants)
+
+        try:
+            with sbObj.snapshot():
+                latestDbTime = sbObj[ServerDatabaseEnums.KEY_LAST_DOWNLOAD_TIME]
+                latestDbPath = sbObj.getWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [latestDbTime])
+
+        except Exception as e:
+            logger.error("\tcouldn't get the path to the latest database from the ServerDatabase: {}".format(e))
+            raise cherrypy.HTTPError(500)
+
+        cls.latestPath = (time.time(), latestDbPath)
+
+        return latestDbPath
+
+
+    def get(self, root, logger):
+        ''' gets the thing made from the newest database, only making it the first time we see that database
+
+        @param root - the Root application, for its Constants and ServerDatabase
+        @param logger - the cherrypy application's log
+        @return whatever loadFunc returned, or raises a 500 HTTPError if we can't find the newest database'''
+
+        latestDbPath = self.latestDatabasePath(root, logger)
+
+        dbPath, value = self.loaded
+
+        if dbPath != latestDbPath:
+
+            with self.lock:
+
+                # another thread might have loaded it while we waited for the lock
+                dbPath, value = self.loaded
+
+                if dbPath != latestDbPath:
+
+                    startTime = time.time()
+                    value = self.loadFunc(latestDbPath)
+                    self.loaded = (latestDbPath, value)
+
+                    logger.error("\tloaded the {} from {} in {:.3f} seconds".format(self.description, latestDbPath, time.time() - startTime))
+
+        return value
+
+
+class Nearby():
+    ''' cherrypy application that returns json of the stops (?what=stops, the default) or buses (?what=vehicles)
+    closest to a point. /nearby?lat=32.22&lon=-110.97 gets the 10 closest, add k=<how many> for a different
+    number and / or radius=<meters> to only get the ones within that distance. Both use a grid index, the
+    stops one comes from the stops_grid table in the newest database and the buses one from the realtime feed
+    '''
+
+    # let cherrypy know that we are exposing this class to the web to be called
+    exposed = True
+
+    DEFAULT_RESULTS = 10
+    MAX_RESULTS = 100
+
+
+    def __init__(self):
+        ''' constructor'''
+        self.logger = None
+
+        # the Root application, for its Constants and ServerDatabase
+        self.root = None
+
+        # the GridIndex of stop_id -> spatial_index.Stop
+        self.stopsIndex = LatestDatabaseCache(self._loadStopsIndex, "stops index")
+
+
+    def _loadStopsIndex(self, dbPath):
+
+        # only imported once someone asks for it, see the note at the top
+        from spatial_index import loadStopsIndex
+
+        return loadStopsIndex(dbPath)
+
+
+    def GET(self, lat, lon, k=None, radius=None, what="stops"):
+
+        from spatial_index import parseSearchArguments
+
+        try:
+            lat, lon, k, radius = parseSearchArguments(lat, lon, k, radius)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+
+        if what == "stops":
+            index = self.stopsIndex.get(self.root, self.logger)
+        elif what == "vehicles":
+            snapshot = getRealtimeSnapshot(self.root.constants, self.logger)
+            index = snapshot.vehicleGrid
+        else:
+            raise cherrypy.HTTPError(400, "what has to be 'stops' or 'vehicles'")
+
+        # just a radius means everything in it, but never more then MAX_RESULTS of them
+        if k is None and radius is not None:
+            results = index.withinRadius(lat, lon, radius)[:self.MAX_RESULTS]
+        else:
+            results = index.nearest(lat, lon, min(k or self.DEFAULT_RESULTS, self.MAX_RESULTS), radius)
+
+        resultList = list()
+
+        for iterDistance, iterKey, iterValue in results:
+
+            if what == "stops":
+                resultDict = collections.OrderedDict([("stop_id", iterValue.stopId), ("stop_name", iterValue.stopName),
+                    ("lat", iterValue.latitude), ("lon", iterValue.longitude)])
+            else:
+                resultDict = snapshot.vehicleDict(iterValue)
+
+            resultDict["distance_meters"] = round(iterDistance, 1)
+            resultList.append(resultDict)
+
+        cherrypy.response.headers['Content-Type'] = "application/json"
+
+        return json.dumps(collections.OrderedDict([("lat", lat), ("lon", lon), (what, resultList)])).encode("utf-8")
+
+
+class Departures():
+    ''' cherrypy application that returns json of the next buses to leave a stop, /departures?stop=<stop_id>
+    (and limit=<how many>, 10 by default). Each one has its scheduled time and, if the TripUpdates feed has one,
+    its predicted time (both seconds since the epoch), and they are sorted by when we think they will leave
+    '''
+
+    # let cherrypy know that we are exposing this class to the web to be called
+    exposed = True
+
+    DEFAULT_RESULTS = 10
+    MAX_RESULTS = 50
+
+
+    def __init__(self):
+        ''' constructor'''
+        self.logger = None
+
+        # the Root application, for its Constants and ServerDatabase
+        self.root = None
+
+        # the trip_predictions.StaticSchedule
+        self.schedule = LatestDatabaseCache(self._loadSchedule, "schedule")
+
+
+    def _loadSchedule(self, dbPath):
+
+        # only imported once someone asks for it, see the note at the top
+        from trip_predictions import StaticSchedule
+
+        return StaticSchedule.fromDatabase(dbPath)
+
+
+    def GET(self, stop, limit=None):
+
+        from trip_predictions import TripPredictions, nextDepartures, serviceDayStart, serviceDayDate
+
+        try:
+            limit = min(int(limit), self.MAX_RESULTS) if limit is not None else self.DEFAULT_RESULTS
+        except ValueError:
+            raise cherrypy.HTTPError(400, "limit has to be a whole number")
+
+        if limit < 1:
+            raise cherrypy.HTTPError(400, "limit has to be positive")
+
+        constantsObj = self.root.constants
+        schedule = self.schedule.get(self.root, self.logger)
+
+        # starts downloading the TripUpdates feed the first time, until then (or if the feed goes stale) its
+        # just the schedule
+        tripPredictions = TripPredictions.shared(constantsObj, self.logger.error_log.getChild("tripupdates"))
+        tripPredictions.setSchedule(schedule)
+        predictionTable = tripPredictions.currentTable(constantsObj.REALTIME_STALE_SECONDS)
+
+        now = int(time.time())
+        departures = nextDepartures(schedule, predictionTable, stop, now, serviceDayStart(now, constantsObj.GTFS_TIMEZONE), limit,
+            todayDate=serviceDayDate(now, constantsObj.GTFS_TIMEZONE))
+
+        cherrypy.response.headers['Content-Type'] = "application/json"
+
+        return json.dumps(collections.OrderedDict([
+            ("stop_id", stop),
+            ("now", now),
+            ("realtime", predictionTable is not None),
+            ("departures", [collections.OrderedDict([
+                ("trip_id", iterDeparture.tripId),
+                ("route_id", iterDeparture.routeId),
+                ("headsign", iterDeparture.headsign),
+                ("stop_sequence", iterDeparture.stopSequence),
+                ("scheduled", iterDeparture.scheduled),
+                ("predicted", iterDeparture.predicted),
+                ("delay_seconds", iterDeparture.predicted - iterDeparture.scheduled if iterDeparture.predicted is not None else None)])
+                for iterDeparture in departures])])).encode("utf-8")
+
+
+class Plan():
+    ''' cherrypy application that returns json of the journey that gets from one stop to another the soonest,
+    /plan?from_stop=<stop_id>&to_stop=<stop_id> (and depart=<seconds since the epoch> to leave later then now). The
+    journey is a list of legs, each one a bus or a walk between two stops, with the times as seconds since the
+    epoch, or null if we can't get there today. It only uses the schedule, see journey_planner.py
+    '''
+
+    # let cherrypy know that we are exposing this class to the web to be called
+    exposed = True
+
+
+    def __init__(self):
+        ''' constructor'''
+        self.logger = None
+
+        # the Root application, for its Constants and ServerDatabase
+        self.root = None
+
+        # the journey_planner.JourneyPlanner
+        self.planner = LatestDatabaseCache(self._loadPlanner, "journey planner")
+
+
+    def _loadPlanner(self, dbPath):
+
+        # only imported once someone asks for it, see the note at the top
+        from journey_planner import JourneyPlanner
+
+        return JourneyPlanner.fromDatabase(dbPath)
+
+
+    def GET(self, from_stop, to_stop, depart=None):
+
+        from trip_predictions import serviceDayStart, serviceDayDate
+
+        try:
+            departure = int(depart) if depart is not None else int(time.time())
+        except ValueError:
+            raise cherrypy.HTTPError(400, "depart has to be a whole number")
+
+        constantsObj = self.root.constants
+        planner = self.planner.get(self.root, self.logger)
+
+        for iterStopId in (from_stop, to_stop):
+            if iterStopId not in planner.stopIndexes:
+                raise cherrypy.HTTPError(404, "unknown stop_id: {}".format(iterStopId))
+
+        journey = planner.plan(from_stop, to_stop, departure, serviceDayStart(departure, constantsObj.GTFS_TIMEZONE),
+            serviceDayDate(departure, constantsObj.GTFS_TIMEZONE))
+
+        journeyDict = None
+
+        if journey is not None:
+            journeyDict = collections.OrderedDict([
+                ("departure", journey.departure),
+                ("arrival", journey.arrival),
+                ("legs", [collections.OrderedDict([
+                    ("kind", iterLeg.kind),
+                    ("from_stop_id", iterLeg.fromStopId),
+                    ("from_stop_name", planner.stopNames.get(iterLeg.fromStopId)),
+                    ("to_stop_id", iterLeg.toStopId),
+                    ("to_stop_name", planner.stopNames.get(iterLeg.toStopId)),
+                    ("departure", iterLeg.departure),
+                    ("arrival", iterLeg.arrival),
+                    ("trip_id", iterLeg.tripId),
+                    ("route_id", iterLeg.routeId),
+                    ("headsign", iterLeg.headsign),
+                    ("stop_count", iterLeg.stopCount)])
+                    for iterLeg in journey.legs])])
+
+        cherrypy.response.headers['Content-Type'] = "application/json"
+
+        return json.dumps(collections.OrderedDict([
+            ("from_stop_id", from_stop),
+            ("to_stop_id", to_stop),
+            ("depart", departure),
+            ("journey", journeyDict)])).encode("utf-8")
+
+
+class RequestStats():
+    ''' cherrypy application that returns the RequestTimingStats (how long each part of handling the requests
+    to Root.POST took) as json. Each process has its own, so the 'pid' says which one answered'''
+
+    # let cherrypy know that we are exposing this class to the web to be called
+    exposed = True
+
+
+    def __init__(self, timingStats):
+        ''' constructor
+        @param timingStats - the RequestTimingStats to show'''
+
+        self.timingStats = timingStats
+
+
+    def GET(self):
+
+        cherrypy.response.headers['Content-Type'] = "application/json"
+
+        return json.dumps(self.timingStats.toDict()).encode("utf-8")
 
-        # return "{'hello': 'bob'}".encode("utf-8")
 
 # config object we pass to cherrypy.Application()
 config = {
@@ -420,15 +1126,78 @@ config = {
         'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
         "log.error_file": "/var/www/tmpfindbus_error.log",
 
+    },
+    "/vehicles":
+    {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        "log.error_file": "/var/www/tmpfindbus_error.log",
+    },
+    "/nearby":
+    {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        "log.error_file": "/var/www/sunspot_error.log",
+    },
+    "/subscribe":
+    {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        "log.error_file": "/var/www/tmpfindbus_error.log",
+    },
+    "/subscribe/events":
+    {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        "log.error_file": "/var/www/tmpfindbus_error.log",
+        # send each event as soon as we yield it, instead of cherrypy collecting the whole response first
+        "response.stream": True,
+    },
+    "/delta":
+    {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        "log.error_file": "/var/www/tmpfindbus_error.log",
+    },
+    "/departures":
+    {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        "log.error_file": "/var/www/sunspot_error.log",
+    },
+    "/plan":
+    {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        "log.error_file": "/var/www/sunspot_error.log",
+    },
+    "/stats":
+    {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        "log.error_file": "/var/www/sunspot_error.log",
     }
 }
 
 
 # server setup
-root = Root()
+timingStats = RequestTimingStats()
+root = Root(timingStats)
 root.testzip = TestZip()
 root.tmpFindBus = TmpFindBus()
+root.vehicles = RealtimeVehicles()
+root.nearby = Nearby()
+root.subscribe = RealtimeSubscribe()
+root.delta = RealtimeDeltas()
+root.departures = Departures()
+root.plan = Plan()
+root.stats = RequestStats(timingStats)
 application = cherrypy.Application(root, script_name="/sunspot", config=config)
 root.testzip.logger = application.log
 root.tmpFindBus.logger = application.log
+root.tmpFindBus.root = root
+root.vehicles.logger = application.log
+root.vehicles.root = root
+root.nearby.logger = application.log
+root.nearby.root = root
+root.subscribe.logger = application.log
+root.subscribe.root = root
+root.delta.logger = application.log
+root.delta.root = root
+root.departures.logger = application.log
+root.departures.root = root
+root.plan.logger = application.log
+root.plan.root = root
 root._setApp(application)
@@ -0,0 +1,156 @@
+#
+# made up feeds, databases and stand ins that more than one of the *_tests.py modules use
+#
+
+import sqlite3
+
+from gtfs_realtime_pb2 import FeedMessage, TripUpdate, TripDescriptor
+from service_calendar import createServiceDates
+from trip_predictions import createStopDepartures
+
+
+TIMEZONE = "America/Phoenix"
+
+# 2014-08-22 08:00:00 in Tucson, a friday
+NOW = 1408719600
+
+
+def createFeedBytes(vehicles, feedTimestamp=1000, routeIds=None, tripIds=None):
+    ''' creates a VehiclePositions FeedMessage
+
+    @param vehicles - a list of (label, latitude, longitude) three-tuples
+    @param feedTimestamp - the timestamp in the feed's header
+    @param routeIds - the route_id of each vehicle, or None for 'route0', 'route1'...
+    @param tripIds - the trip_id of each vehicle, or None to leave them out
+    @return the serialized FeedMessage'''
+
+    feed = FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = feedTimestamp
+
+    for iterNumber, (iterLabel, iterLat, iterLon) in enumerate(vehicles):
+
+        tmpEntity = feed.entity.add()
+        tmpEntity.id = str(iterNumber)
+        tmpEntity.vehicle.vehicle.id = "id" + iterLabel
+        tmpEntity.vehicle.vehicle.label = iterLabel
+        tmpEntity.vehicle.position.latitude = iterLat
+        tmpEntity.vehicle.position.longitude = iterLon
+        tmpEntity.vehicle.timestamp = feedTimestamp
+        tmpEntity.vehicle.trip.route_id = routeIds[iterNumber] if routeIds is not None else "route{}".format(iterNumber)
+
+        if tripIds is not None:
+            tmpEntity.vehicle.trip.trip_id = tripIds[iterNumber]
+
+    return feed.SerializeToString()
+
+
+def createTripUpdatesBytes(tripUpdates, feedTimestamp=NOW, startDates=None):
+    ''' creates a TripUpdates FeedMessage
+
+    @param tripUpdates - a list of (trip_id, canceled, [(stop_sequence, departure delay or None, skipped), ...])
+    @param feedTimestamp - the timestamp in the feed's header
+    @param startDates - a dictionary of trip_id -> start_date, trips that aren't in it don't have one
+    @return the serialized FeedMessage'''
+
+    feed = FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = feedTimestamp
+
+    for iterNumber, (iterTripId, iterCanceled, iterUpdates) in enumerate(tripUpdates):
+
+        tmpEntity = feed.entity.add()
+        tmpEntity.id = str(iterNumber)
+        tmpEntity.trip_update.trip.trip_id = iterTripId
+
+        if startDates is not None and iterTripId in startDates:
+            tmpEntity.trip_update.trip.start_date = startDates[iterTripId]
+
+        if iterCanceled:
+            tmpEntity.trip_update.trip.schedule_relationship = TripDescriptor.CANCELED
+
+        for iterSequence, iterDelay, iterSkipped in iterUpdates:
+
+            tmpUpdate = tmpEntity.trip_update.stop_time_update.add()
+            tmpUpdate.stop_sequence = iterSequence
+
+            if iterDelay is not None:
+                tmpUpdate.departure.delay = iterDelay
+            if iterSkipped:
+                tmpUpdate.schedule_relationship = TripUpdate.StopTimeUpdate.SKIPPED
+
+    return feed.SerializeToString()
+
+
+def createScheduleDatabase(dbPath, stopTimes, stopDepartures=True):
+    ''' creates the trips and stop_times tables like parse_gtfs_data.py does
+
+    @param dbPath - where to create the database
+    @param stopTimes - a list of (trip_id, stop_sequence, stop_id, time) four-tuples, the arrival and departure
+        are both the time
+    @param stopDepartures - whether to create the stop_departures table too, like parse_gtfs_data.py has since
+        it had one'''
+
+    db = sqlite3.connect(dbPath)
+    cursor = db.cursor()
+
+    cursor.execute('''CREATE TABLE trips
+        (route_id TEXT, service_id TEXT, trip_id TEXT, trip_headsign TEXT,
+        trip_short_name TEXT, direction_id INTEGER, block_id TEXT, shape_id TEXT)''')
+    cursor.execute('''CREATE TABLE stop_times
+        (trip_id TEXT, arrival_time TEXT, departure_time TEXT, stop_id TEXT, stop_sequence INTEGER,
+        stop_headsign TEXT, pickup_type INTEGER, drop_off_type INTEGER, shape_dist_traveled REAL)''')
+
+    for iterTripId in sorted(set(iterStopTime[0] for iterStopTime in stopTimes)):
+        cursor.execute('''INSERT INTO trips VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            ("route" + iterTripId[0], "weekday", iterTripId, "to " + iterTripId, "", "0", "", ""))
+
+    for iterTripId, iterSequence, iterStopId, iterTime in stopTimes:
+        cursor.execute('''INSERT INTO stop_times VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (iterTripId, iterTime, iterTime, iterStopId, str(iterSequence), "", "0", "0", ""))
+
+    if stopDepartures:
+        createStopDepartures(cursor)
+
+    db.commit()
+    db.close()
+
+
+def createCalendarTables(cursor, calendarRows, calendarDateRows):
+    ''' creates the calendar, calendar_dates and service_dates tables like parse_gtfs_data.py does
+
+    @param cursor - a cursor for the database
+    @param calendarRows - the rows of calendar.txt
+    @param calendarDateRows - the rows of calendar_dates.txt'''
+
+    cursor.execute('''CREATE TABLE calendar
+        (service_id TEXT, monday INTEGER, tuesday INTEGER, wednesday INTEGER, thursday INTEGER,
+        friday INTEGER, saturday INTEGER, sunday INTEGER, start_date TEXT, end_date TEXT)''')
+    cursor.execute('''CREATE TABLE calendar_dates
+        (service_id TEXT, date TEXT, exception_type INTEGER)''')
+
+    cursor.executemany('''INSERT INTO calendar VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', calendarRows)
+    cursor.executemany('''INSERT INTO calendar_dates VALUES (?, ?, ?)''', calendarDateRows)
+
+    return createServiceDates(cursor)
+
+
+class StandInPoller:
+    ''' just enough of a RealtimeFeedPoller for the things that listen to one, setSnapshot() does what a new
+    version of the feed does'''
+
+    def __init__(self, url="http://example.com/feed"):
+        self.url = url
+        self.snapshot = None
+        self.listeners = list()
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def setSnapshot(self, snapshot):
+
+        oldSnapshot = self.snapshot
+        self.snapshot = snapshot
+
+        for iterListener in self.listeners:
+            iterListener(oldSnapshot, self.snapshot)
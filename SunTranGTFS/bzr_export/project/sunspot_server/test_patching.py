@@ -12,6 +12,7 @@ import bsdiff4
 import arrow
 
 from server_database import ServerDatabase, ServerDatabaseEnums
+from constants import Constants
 
 def testPatching(args):
     '''tests the db patches generating the expected databases by using the information in the provided ServerDatabase leveldb database
@@ -24,8 +25,8 @@ def testPatching(args):
         lg.setLevel("DEBUG")
 
 
-    # open the ServerDatabase
-    sbObj = ServerDatabase(args.serverDatabasePath, lg)
+    # connect to the leveldb_server that holds the ServerDatabase
+    sbObj = ServerDatabase.fromConstants(Constants(args.constantsYamlPath), lg)
 
     latestDbHasher = hashlib.sha256()
 
@@ -47,12 +48,18 @@ def testPatching(args):
     # equals the latest database's hash
 
     errorList = list()
+
+    # get every database version first, so we can look up all of the patch entries in one round trip
+    dbVersionList = list()
     for iterDbKey, iterDbValue in sbObj.getGeneratorWithPrefix(ServerDatabaseEnums.PREFIX_DATABASE_TIME_TO_LOCATION, [""]):
 
+        # getGeneratorWithPrefix already decodes the keys and values for us
+        dbVersionList.append((iterDbKey[iterDbKey.find(":")+1:], iterDbValue))
+
+    patchResultList = sbObj.multiGetWithPrefix(ServerDatabaseEnums.PREFIX_DB_PATCH, 
+        [(iterDbTime, latestDbTime) for iterDbTime, iterDbPath in dbVersionList])
 
-        iterDbTime = iterDbKey.decode("utf-8")
-        iterDbTime = iterDbTime[iterDbTime.find(":")+1:]
-        iterDbPath = iterDbValue.decode("utf-8")
+    for (iterDbTime, iterDbPath), iterPatchResult in zip(dbVersionList, patchResultList):
 
         lg.info("on database version: {} ({})".format(iterDbTime, arrow.get(iterDbTime).isoformat()))
 
@@ -62,9 +69,7 @@ def testPatching(args):
             continue
 
         # get the patch between this database and the latest database
-        try:
-            iterPatchResult = sbObj.getWithPrefix(ServerDatabaseEnums.PREFIX_DB_PATCH, [iterDbTime, latestDbTime])
-        except KeyError:
+        if iterPatchResult is None:
             lg.error("\tPatch entry from {} to {} doesn't exist in the ServerDatabase!".format(iterDbTime, latestDbTime))
             errorList.append(iterDbTime)
             continue
@@ -125,7 +130,8 @@ if __name__ == "__main__":
     epilog="Copyright Aug 22, 2014 Mark Grandi")
 
 
-    parser.add_argument('serverDatabasePath', help="the path to the leveldb database used by the ServerDatabase in parse_gtfs_data.py and all other scripts")
+    parser.add_argument('constantsYamlPath', help="the path to the yaml that holds the constants, used to find the leveldb_server that " 
+        + "holds the ServerDatabase used by parse_gtfs_data.py and all other scripts")
     parser.add_argument("--verbose", "-v", action="store_true", help="increase verbosity")
 
     logging.basicConfig(level="INFO", format='%(asctime)s %(name)-12s %(levelname)-8s: %(message)s')
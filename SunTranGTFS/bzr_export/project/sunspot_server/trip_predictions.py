@@ -0,0 +1,637 @@
+#
+# realtime predictions of when buses will get to each stop. SunTran's GTFS realtime TripUpdates feed is downloaded
+# by a RealtimeFeedPoller (like the VehiclePositions one), and each version of it is joined with the static
+# schedule from the newest database (by trip_id and stop_sequence) into a PredictionTable of
+# (trip_id, stop_sequence, service day) -> predicted arrival / departure. nextDepartures() merges that with the
+# scheduled departures at a stop, for sunspot_server.py's /departures
+#
+
+import array
+import bisect
+import collections
+import datetime
+import sqlite3
+import threading
+import time
+import types
+
+import google.protobuf.message # for DecodeError
+
+from gtfs_realtime_pb2 import FeedMessage, TripUpdate, TripDescriptor
+from realtime_feed import RealtimeFeedPoller
+from service_calendar import ServiceCalendar
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# a stop on a trip in the static schedule, the times are seconds after the start of the service day (GTFS times
+# can go past 24:00:00 for trips that run after midnight)
+ScheduledStop = collections.namedtuple("ScheduledStop", ["stopSequence", "stopId", "arrival", "departure"])
+
+# a trip in the static schedule, stops is a tuple of ScheduledStops in stop_sequence order
+ScheduledTrip = collections.namedtuple("ScheduledTrip", ["tripId", "routeId", "serviceId", "headsign", "stops"])
+
+# a row of the stop_departures table, see createStopDepartures()
+StopDepartureRow = collections.namedtuple("StopDepartureRow",
+    ["stopId", "departure", "arrival", "serviceId", "tripId", "stopSequence"])
+
+# one stop_time_update from the TripUpdates feed, the delays are seconds and the times seconds since the epoch,
+# any of them can be None if the feed didn't say
+StopTimeUpdate = collections.namedtuple("StopTimeUpdate",
+    ["stopSequence", "stopId", "arrivalDelay", "arrivalTime", "departureDelay", "departureTime", "skipped", "noData"])
+
+# one trip_update from the TripUpdates feed, stopTimeUpdates is a tuple of StopTimeUpdates
+TripUpdateInfo = collections.namedtuple("TripUpdateInfo", ["tripId", "routeId", "startDate", "canceled", "stopTimeUpdates"])
+
+# what we predict for a stop on a trip, the times are seconds since the epoch
+Prediction = collections.namedtuple("Prediction", ["arrival", "departure", "skipped"])
+
+# one of the results of nextDepartures(), the times are seconds since the epoch, predicted is None if there is no
+# prediction for it
+Departure = collections.namedtuple("Departure",
+    ["tripId", "routeId", "headsign", "stopSequence", "scheduled", "predicted"])
+
+
+def parseGtfsTime(text):
+    ''' turns a GTFS time like '25:10:00' into seconds after the start of the service day
+
+    @param text - the time, as a string
+    @return the number of seconds, or None if @text is empty'''
+
+    if not text:
+        return None
+
+    hours, minutes, seconds = text.strip().split(":")
+
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def serviceDayStart(timestamp, timezone):
+    ''' when the service day that @timestamp is in started, midnight in the agency's timezone (GTFS says noon
+    minus 12 hours, which is only different on days the clocks change, and Tucson doesn't change its clocks)
+
+    @param timestamp - seconds since the epoch
+    @param timezone - the timezone name, like 'America/Phoenix'
+    @return seconds since the epoch'''
+
+    import arrow
+
+    return arrow.get(timestamp).to(timezone).floor("day").timestamp
+
+
+def serviceDayDate(timestamp, timezone):
+    ''' the date of the service day that @timestamp is in, see serviceDayStart()
+
+    @param timestamp - seconds since the epoch
+    @param timezone - the timezone name, like 'America/Phoenix'
+    @return a datetime.date'''
+
+    import arrow
+
+    return arrow.get(timestamp).to(timezone).date()
+
+
+def startDateDayStart(startDate, timezone):
+    ''' when the service day of a trip's start_date (from the TripUpdates feed) started, see serviceDayStart()
+
+    @param startDate - the date, as a 'YYYYMMDD' string
+    @param timezone - the timezone name, like 'America/Phoenix'
+    @return seconds since the epoch, or None if @startDate isn't a date'''
+
+    import arrow
+
+    try:
+        return arrow.get(startDate, "YYYYMMDD").replace(tzinfo=timezone).timestamp
+    except (arrow.parser.ParserError, ValueError):
+        return None
+
+
+def stopDepartureRows(cursor):
+    ''' works out every departure from every stop from the stop_times and trips tables, with the times as seconds
+    after the start of the service day instead of text. Stops between timepoints can leave the times out, we don't
+    guess at them, and a stop with only one of the times uses it for both
+
+    @param cursor - a cursor for the database, that already has the trips and stop_times tables
+    @return a list of StopDepartureRows, sorted by stop_id, departure, service_id, trip_id and stop_sequence'''
+
+    cursor.execute('''SELECT trip_id, service_id FROM trips''')
+    tripServices = dict(cursor.fetchall())
+
+    rows = list()
+
+    cursor.execute('''SELECT stop_id, arrival_time, departure_time, trip_id, stop_sequence FROM stop_times''')
+    for iterStopId, iterArrival, iterDeparture, iterTripId, iterSequence in cursor.fetchall():
+
+        arrival = parseGtfsTime(iterArrival)
+        departure = parseGtfsTime(iterDeparture)
+
+        if arrival is None and departure is None:
+            continue
+
+        rows.append(StopDepartureRow(iterStopId, departure if departure is not None else arrival,
+            arrival if arrival is not None else departure, tripServices.get(iterTripId), iterTripId, int(iterSequence)))
+
+    rows.sort(key=lambda row: (row.stopId, row.departure, row.serviceId or "", row.tripId, row.stopSequence))
+
+    return rows
+
+
+def createStopDepartures(cursor):
+    ''' creates the stop_departures table, every stop's timetable: the departures from it sorted by time (and
+    service_id), with the times as whole seconds after the start of the service day. The next departures from a
+    stop are
+    'SELECT * FROM stop_departures WHERE stop_id = ? AND departure_seconds >= ? ORDER BY departure_seconds LIMIT ?',
+    which only needs the index, and the rows are inserted in that order so the StaticSchedule can read them
+    straight into its binary search arrays without sorting anything
+
+    @param cursor - a cursor for the database, that already has the trips and stop_times tables
+    @return how many rows went into the table'''
+
+    cursor.execute('''CREATE TABLE stop_departures
+        (stop_id TEXT, departure_seconds INTEGER, arrival_seconds INTEGER, service_id TEXT, trip_id TEXT,
+        stop_sequence INTEGER)''')
+
+    cursor.execute('''CREATE INDEX stop_departures_stop_index ON stop_departures
+        (stop_id, departure_seconds, service_id)''')
+
+    rows = stopDepartureRows(cursor)
+
+    cursor.executemany('''INSERT INTO stop_departures VALUES (?, ?, ?, ?, ?, ?)''', rows)
+
+    return len(rows)
+
+
+class StaticSchedule:
+    ''' the parts of the static schedule in a database that predictions need: every trip's stops and times, every
+    stop's departures sorted by time, so the next ones after a time are a binary search away, and which days each
+    trip's service runs'''
+
+    def __init__(self, trips, stopDepartures, serviceCalendar=None):
+        ''' constructor
+
+        @param trips - dictionary of trip_id -> ScheduledTrip
+        @param stopDepartures - dictionary of stop_id -> list of (departure, trip_id, stop_sequence), sorted
+        @param serviceCalendar - the service_calendar.ServiceCalendar, or None if we don't know (every trip runs
+            every day)'''
+
+        self.trips = types.MappingProxyType(trips)
+        self.serviceCalendar = serviceCalendar
+
+        # stop_id -> (array of the departure times, list of (trip_id, stop_sequence) in the same order), separate
+        # so bisect can search the times without building a tuple to compare with
+        self.stopDepartures = types.MappingProxyType({iterStopId: (array.array("l", [iterEntry[0] for iterEntry in iterEntries]),
+            [(iterEntry[1], iterEntry[2]) for iterEntry in iterEntries]) for iterStopId, iterEntries in stopDepartures.items()})
+
+    @classmethod
+    def fromDatabase(cls, dbPath):
+        ''' loads the schedule from a database that parse_gtfs_data.py created, from its stop_departures table, or
+        from stop_times if its a database from before there was one
+
+        @param dbPath - the path to the sqlite3 database
+        @return a StaticSchedule'''
+
+        db = sqlite3.connect(dbPath)
+
+        try:
+            cursor = db.cursor()
+
+            try:
+                serviceCalendar = ServiceCalendar.fromCursor(cursor)
+            except sqlite3.OperationalError:
+                # a database from before there was a service_dates table
+                serviceCalendar = None
+
+            tripInfo = dict()
+            cursor.execute('''SELECT trip_id, route_id, service_id, trip_headsign FROM trips''')
+            for iterTripId, iterRouteId, iterServiceId, iterHeadsign in cursor.fetchall():
+                tripInfo[iterTripId] = (iterRouteId, iterServiceId, iterHeadsign)
+
+            try:
+                # the cursor goes through the rows as we ask for them, instead of making a list of all of them first
+                cursor.execute('''SELECT stop_id, departure_seconds, arrival_seconds, service_id, trip_id, stop_sequence
+                    FROM stop_departures ORDER BY stop_id, departure_seconds, service_id''')
+                rows = cursor
+
+            except sqlite3.OperationalError:
+                rows = stopDepartureRows(cursor)
+
+            tripStops = collections.defaultdict(list)
+            stopDepartures = collections.defaultdict(list)
+
+            # the rows are already in the order the stops need them
+            for iterStopId, iterDeparture, iterArrival, iterServiceId, iterTripId, iterSequence in rows:
+                tripStops[iterTripId].append(ScheduledStop(iterSequence, iterStopId, iterArrival, iterDeparture))
+                stopDepartures[iterStopId].append((iterDeparture, iterTripId, iterSequence))
+
+        finally:
+            db.close()
+
+        trips = dict()
+        for iterTripId, iterStops in tripStops.items():
+            routeId, serviceId, headsign = tripInfo.get(iterTripId, (None, None, None))
+            trips[iterTripId] = ScheduledTrip(iterTripId, routeId, serviceId, headsign, tuple(sorted(iterStops)))
+
+        return cls(trips, stopDepartures, serviceCalendar)
+
+    def departuresAt(self, stopId, fromSeconds, toSeconds=None):
+        ''' the scheduled departures from a stop in a time range
+
+        @param stopId - the stop_id
+        @param fromSeconds - the start of the range, in seconds after the start of a service day
+        @param toSeconds - the end of the range (inclusive), or None for the end of the day
+        @return a generator of (departure, trip_id, stop_sequence), in departure order'''
+
+        times, entries = self.stopDepartures.get(stopId, ((), ()))
+
+        index = bisect.bisect_left(times, fromSeconds)
+
+        while index < len(times) and (toSeconds is None or times[index] <= toSeconds):
+            yield (times[index], entries[index][0], entries[index][1])
+            index += 1
+
+
+class TripUpdatesSnapshot:
+    ''' the trips from one version of the TripUpdates feed, this never changes once its created'''
+
+    def __init__(self, tripUpdates, feedTimestamp, fetchedTime):
+        ''' constructor
+
+        @param tripUpdates - a dictionary of trip_id -> TripUpdateInfo
+        @param feedTimestamp - the timestamp in the feed's header (seconds since the epoch), or None
+        @param fetchedTime - time.time() of when we downloaded this version of the feed'''
+
+        self.tripUpdates = types.MappingProxyType(tripUpdates)
+        self.feedTimestamp = feedTimestamp
+        self.fetchedTime = fetchedTime
+
+    def __len__(self):
+        return len(self.tripUpdates)
+
+    @classmethod
+    def fromFeedBytes(cls, feedBytes, fetchedTime):
+        ''' parses the TripUpdates feed, this is the RealtimeFeedPoller's parseFunc
+
+        @param feedBytes - the serialized FeedMessage
+        @param fetchedTime - time.time() of when we downloaded it
+        @return a TripUpdatesSnapshot, or raises google.protobuf.message.DecodeError'''
+
+        feed = FeedMessage.FromString(feedBytes)
+
+        # see VehicleSnapshot.fromFeedBytes()
+        if not feed.IsInitialized():
+            raise google.protobuf.message.DecodeError("the feed is missing required fields, its probably not a FeedMessage")
+
+        def eventValues(update, fieldName):
+            ''' the (delay, time) of the arrival or departure of a StopTimeUpdate, either can be None'''
+
+            if not update.HasField(fieldName):
+                return (None, None)
+
+            event = getattr(update, fieldName)
+
+            return (event.delay if event.HasField("delay") else None, event.time if event.HasField("time") else None)
+
+        tripUpdates = dict()
+
+        for iterEntity in feed.entity:
+
+            if not iterEntity.HasField("trip_update"):
+                continue
+
+            tmpTripUpdate = iterEntity.trip_update
+            tripId = tmpTripUpdate.trip.trip_id
+
+            if not tripId:
+                continue # we can only join trips we can find in the schedule
+
+            stopTimeUpdates = list()
+
+            for iterUpdate in tmpTripUpdate.stop_time_update:
+
+                arrivalDelay, arrivalTime = eventValues(iterUpdate, "arrival")
+                departureDelay, departureTime = eventValues(iterUpdate, "departure")
+
+                stopTimeUpdates.append(StopTimeUpdate(
+                    iterUpdate.stop_sequence if iterUpdate.HasField("stop_sequence") else None,
+                    iterUpdate.stop_id or None, arrivalDelay, arrivalTime, departureDelay, departureTime,
+                    iterUpdate.schedule_relationship == TripUpdate.StopTimeUpdate.SKIPPED,
+                    iterUpdate.schedule_relationship == TripUpdate.StopTimeUpdate.NO_DATA))
+
+            tripUpdates[tripId] = TripUpdateInfo(tripId, tmpTripUpdate.trip.route_id or None,
+                tmpTripUpdate.trip.start_date or None,
+                tmpTripUpdate.trip.schedule_relationship == TripDescriptor.CANCELED, tuple(stopTimeUpdates))
+
+        return cls(tripUpdates, feed.header.timestamp if feed.header.HasField("timestamp") else None, fetchedTime)
+
+
+class PredictionTable:
+    ''' a version of the TripUpdates feed joined with the static schedule, this never changes once its created.
+    The same trip_id runs every day its service does, so everything is keyed by the start of the service day
+    (seconds since the epoch, see serviceDayStart()) too, so a prediction for tonight's run of a trip that goes past
+    midnight isn't used for last night's (or the other way around)
+
+        predictions - (trip_id, stop_sequence, service day start) -> Prediction, for the stops the feed tells us
+            about and the ones after them on the same trip (which get the last delay we know of)
+        canceledTrips - a frozenset of the (trip_id, service day start) of the trips that aren't running'''
+
+    def __init__(self, tripUpdatesSnapshot, schedule, timezone):
+        ''' constructor, does the join
+
+        @param tripUpdatesSnapshot - the TripUpdatesSnapshot
+        @param schedule - the StaticSchedule
+        @param timezone - the agency's timezone name, for which service day a trip is on'''
+
+        self.tripUpdatesSnapshot = tripUpdatesSnapshot
+        self.schedule = schedule
+        self.fetchedTime = tripUpdatesSnapshot.fetchedTime
+
+        # trips in the feed that aren't in the schedule, so probably the feed and our database don't match
+        self.unmatchedTrips = 0
+
+        # trips whose start_date isn't a date, or isn't yesterday, today or tomorrow
+        self.outOfRangeTrips = 0
+
+        predictions = dict()
+        canceledTrips = set()
+
+        feedTime = tripUpdatesSnapshot.feedTimestamp or tripUpdatesSnapshot.fetchedTime
+        todayStart = serviceDayStart(feedTime, timezone)
+        dayStartByDate = dict()
+
+        for iterTripUpdate in tripUpdatesSnapshot.tripUpdates.values():
+
+            trip = schedule.trips.get(iterTripUpdate.tripId)
+
+            if trip is None:
+                self.unmatchedTrips += 1
+                continue
+
+            if iterTripUpdate.startDate is not None:
+
+                if iterTripUpdate.startDate not in dayStartByDate:
+                    dayStartByDate[iterTripUpdate.startDate] = startDateDayStart(iterTripUpdate.startDate, timezone)
+
+                dayStart = dayStartByDate[iterTripUpdate.startDate]
+
+            else:
+                # no start_date, so its today's trip, unless today's would start more then 12 hours from now, then its
+                # yesterday's (that goes past midnight)
+                dayStart = todayStart
+                if trip.stops[0].departure + dayStart > feedTime + SECONDS_PER_DAY // 2:
+                    dayStart -= SECONDS_PER_DAY
+
+            # nobody asks about any other days, and a trip that far away is the feed's mistake, not a trip we
+            # should be putting predictions on
+            if dayStart is None or not todayStart - SECONDS_PER_DAY <= dayStart <= todayStart + SECONDS_PER_DAY:
+                self.outOfRangeTrips += 1
+                continue
+
+            if iterTripUpdate.canceled:
+                canceledTrips.add((iterTripUpdate.tripId, dayStart))
+                continue
+
+            self._predictTrip(trip, iterTripUpdate, dayStart, predictions)
+
+        self.predictions = types.MappingProxyType(predictions)
+        self.canceledTrips = frozenset(canceledTrips)
+
+    def _predictTrip(self, trip, tripUpdate, dayStart, predictions):
+        ''' works out the Predictions for the stops on one trip, starting at the first stop the feed says anything
+        about. A stop without an update gets the delay of the last one before it that had one (the bus doesn't
+        catch up unless the feed says so)
+
+        @param trip - the ScheduledTrip
+        @param tripUpdate - the TripUpdateInfo
+        @param dayStart - the start of the trip's service day, seconds since the epoch
+        @param predictions - the dictionary to add the Predictions to'''
+
+        updatesBySequence = dict()
+        sequenceByStopId = {iterStop.stopId: iterStop.stopSequence for iterStop in trip.stops}
+
+        for iterUpdate in tripUpdate.stopTimeUpdates:
+
+            sequence = iterUpdate.stopSequence
+            if sequence is None:
+                sequence = sequenceByStopId.get(iterUpdate.stopId)
+
+            if sequence is not None:
+                updatesBySequence[sequence] = iterUpdate
+
+        if not updatesBySequence:
+            return
+
+        firstSequence = min(updatesBySequence.keys())
+        delay = None
+
+        for iterStop in trip.stops:
+
+            if iterStop.stopSequence < firstSequence:
+                continue
+
+            scheduledArrival = dayStart + iterStop.arrival
+            scheduledDeparture = dayStart + iterStop.departure
+
+            update = updatesBySequence.get(iterStop.stopSequence)
+
+            if update is not None:
+
+                if update.noData:
+                    delay = None
+                    continue
+
+                if update.skipped:
+                    predictions[(trip.tripId, iterStop.stopSequence, dayStart)] = Prediction(None, None, True)
+                    continue
+
+                # a time beats a delay, and an arrival with nothing about the departure leaves when it arrives
+                # (plus however long the schedule says it waits there)
+                if update.arrivalTime is not None:
+                    delay = update.arrivalTime - scheduledArrival
+                elif update.arrivalDelay is not None:
+                    delay = update.arrivalDelay
+
+                arrival = scheduledArrival + delay if delay is not None else None
+
+                if update.departureTime is not None:
+                    delay = update.departureTime - scheduledDeparture
+                elif update.departureDelay is not None:
+                    delay = update.departureDelay
+
+                if arrival is None and delay is not None:
+                    arrival = scheduledArrival + delay
+
+            elif delay is not None:
+                arrival = scheduledArrival + delay
+
+            else:
+                continue
+
+            if delay is None:
+                continue
+
+            predictions[(trip.tripId, iterStop.stopSequence, dayStart)] = Prediction(arrival, max(arrival, scheduledDeparture + delay), False)
+
+
+class TripPredictions:
+    ''' keeps the newest PredictionTable for this process, remaking it (on the poller's thread) every time the
+    TripUpdates feed changes, and (on whatever thread calls setSchedule()) every time the database does'''
+
+    _shared = dict()
+    _sharedLock = threading.Lock()
+
+    def __init__(self, poller, timezone):
+        ''' constructor, starts listening to @poller
+
+        @param poller - the RealtimeFeedPoller of the TripUpdates feed
+        @param timezone - the agency's timezone name'''
+
+        self.poller = poller
+        self.timezone = timezone
+        self.lock = threading.Lock()
+
+        self.schedule = None
+
+        # None until we have both a schedule and a version of the feed
+        self.table = None
+
+        poller.addListener(self._onSnapshot)
+
+    @classmethod
+    def shared(cls, constantsObj, logger=None):
+        ''' gets the TripPredictions for this process, and starts downloading the TripUpdates feed the first time
+
+        @param constantsObj - the Constants object, for the REALTIME_* settings and GTFS_TIMEZONE
+        @param logger - a logging.Logger
+        @return the TripPredictions'''
+
+        poller = RealtimeFeedPoller.shared(constantsObj, logger, constantsObj.REALTIME_TRIP_UPDATES_URL,
+            TripUpdatesSnapshot.fromFeedBytes)
+
+        with cls._sharedLock:
+
+            tripPredictions = cls._shared.get(poller)
+
+            if tripPredictions is None:
+                tripPredictions = cls(poller, constantsObj.GTFS_TIMEZONE)
+
+                # a new poller (we got forked) means the old ones are gone
+                cls._shared = {poller: tripPredictions}
+
+            return tripPredictions
+
+    def setSchedule(self, schedule):
+        ''' starts using a StaticSchedule, redoing the join if its not the one we have already
+
+        @param schedule - the StaticSchedule'''
+
+        if schedule is self.schedule:
+            return
+
+        with self.lock:
+
+            if schedule is self.schedule:
+                return
+
+            self.schedule = schedule
+            self._rebuild(self.poller.snapshot)
+
+    def _onSnapshot(self, oldSnapshot, newSnapshot):
+        ''' called by the poller when the TripUpdates feed changes'''
+
+        with self.lock:
+            self._rebuild(newSnapshot)
+
+    def _rebuild(self, tripUpdatesSnapshot):
+        ''' makes a new PredictionTable, call this with self.lock held'''
+
+        if self.schedule is None or tripUpdatesSnapshot is None:
+            return
+
+        self.table = PredictionTable(tripUpdatesSnapshot, self.schedule, self.timezone)
+
+    def currentTable(self, staleSeconds):
+        ''' the newest PredictionTable, if its for the schedule we have and we heard from the feed recently
+
+        @param staleSeconds - how old the feed can be
+        @return the PredictionTable, or None'''
+
+        table = self.table
+        lastCheckedTime = self.poller.lastCheckedTime
+
+        if table is None or table.schedule is not self.schedule or lastCheckedTime is None:
+            return None
+
+        if time.time() - lastCheckedTime > staleSeconds:
+            return None
+
+        return table
+
+
+def nextDepartures(schedule, predictionTable, stopId, now, todayStart, limit, lateSeconds=1800, todayDate=None):
+    ''' the next buses to leave a stop, with their predicted times if we have them. A bus that was scheduled to
+    leave up to @lateSeconds ago is still coming if its prediction says so, and buses are sorted by when we
+    think they will leave (the prediction, or the schedule if there isn't one). Trips whose service doesn't run
+    on their service day are left out, if we know the date and the schedule has a calendar
+
+    @param schedule - the StaticSchedule
+    @param predictionTable - the PredictionTable, or None for just the schedule
+    @param stopId - the stop_id
+    @param now - seconds since the epoch
+    @param todayStart - the start of today's service day, from serviceDayStart()
+    @param limit - how many Departures to find
+    @param lateSeconds - how late a bus can be and still show up
+    @param todayDate - the datetime.date of today's service day, from serviceDayDate(), or None to not look at
+        the calendar
+    @return a list of Departures'''
+
+    results = list()
+
+    predictions = predictionTable.predictions if predictionTable is not None else dict()
+    canceledTrips = predictionTable.canceledTrips if predictionTable is not None else frozenset()
+
+    serviceCalendar = schedule.serviceCalendar if todayDate is not None else None
+
+    # yesterday's service day still has trips after midnight (times past 24:00:00)
+    for iterDayStart, iterDaysAgo in ((todayStart - SECONDS_PER_DAY, 1), (todayStart, 0)):
+
+        found = list()
+
+        activeServices = None
+        if serviceCalendar is not None:
+            activeServices = serviceCalendar.activeServices(todayDate - datetime.timedelta(days=iterDaysAgo))
+
+        for iterDeparture, iterTripId, iterSequence in schedule.departuresAt(stopId, now - lateSeconds - iterDayStart):
+
+            scheduled = iterDayStart + iterDeparture
+
+            # the rest of them are too far in the future to matter, if we already have enough that will leave
+            # before them (even if they are early)
+            if len(found) >= limit and scheduled - lateSeconds > found[limit - 1][0]:
+                break
+
+            if (iterTripId, iterDayStart) in canceledTrips:
+                continue
+
+            trip = schedule.trips[iterTripId]
+
+            if activeServices is not None and trip.serviceId not in activeServices:
+                continue
+
+            prediction = predictions.get((iterTripId, iterSequence, iterDayStart))
+
+            if prediction is not None and prediction.skipped:
+                continue
+
+            predicted = prediction.departure if prediction is not None else None
+            expected = predicted if predicted is not None else scheduled
+
+            if expected < now:
+                continue
+
+            bisect.insort(found, (expected, iterTripId, iterSequence, Departure(iterTripId, trip.routeId, trip.headsign, iterSequence, scheduled, predicted)))
+
+        results.extend(found[:limit])
+
+    results.sort()
+
+    return [iterResult[3] for iterResult in results[:limit]]
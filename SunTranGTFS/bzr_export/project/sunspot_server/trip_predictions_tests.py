@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+# tests for trip_predictions.py, against a small made up schedule and TripUpdates feed
+#
+
+import unittest
+import os
+import sqlite3
+import tempfile
+
+from trip_predictions import (StaticSchedule, TripUpdatesSnapshot, PredictionTable, nextDepartures, parseGtfsTime,
+    serviceDayStart, serviceDayDate)
+from test_fixtures import TIMEZONE, NOW, createScheduleDatabase, createTripUpdatesBytes, createCalendarTables
+
+
+class TestTripPredictions(unittest.TestCase):
+    ''' note that test methods must start with the word 'test' '''
+
+    def setUp(self):
+
+        tmpFile, self.dbPath = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(tmpFile)
+
+        # three trips through stops A, B, C and one that leaves A after midnight
+        self.stopTimes = [
+            ("1a", 1, "A", "07:50:00"), ("1a", 2, "B", "08:00:00"), ("1a", 3, "C", "08:10:00"),
+            ("1b", 1, "A", "08:05:00"), ("1b", 2, "B", "08:15:00"), ("1b", 3, "C", "08:25:00"),
+            ("2a", 1, "A", "08:20:00"), ("2a", 2, "B", "08:30:00"), ("2a", 3, "C", "08:40:00"),
+            ("3a", 1, "A", "24:30:00"), ("3a", 2, "B", "24:40:00")]
+        createScheduleDatabase(self.dbPath, self.stopTimes)
+
+        self.schedule = StaticSchedule.fromDatabase(self.dbPath)
+        self.todayStart = serviceDayStart(NOW, TIMEZONE)
+
+    def tearDown(self):
+
+        os.remove(self.dbPath)
+
+    def _table(self, tripUpdates, startDates=None):
+        return PredictionTable(TripUpdatesSnapshot.fromFeedBytes(createTripUpdatesBytes(tripUpdates, NOW, startDates), NOW),
+            self.schedule, TIMEZONE)
+
+    def testSchedule(self):
+
+        self.assertEqual(parseGtfsTime("25:10:00"), 90600)
+        self.assertIsNone(parseGtfsTime(""))
+        self.assertEqual(NOW - self.todayStart, 8 * 3600)
+
+        self.assertEqual([iterStop.stopId for iterStop in self.schedule.trips["1b"].stops], ["A", "B", "C"])
+        self.assertEqual([iterEntry[1] for iterEntry in self.schedule.departuresAt("A", parseGtfsTime("08:00:00"))], ["1b", "2a", "3a"])
+
+    def testStopDepartures(self):
+
+        db = sqlite3.connect(self.dbPath)
+        rows = db.execute('''SELECT stop_id, departure_seconds, service_id, trip_id FROM stop_departures
+            WHERE stop_id = ? AND departure_seconds >= ? ORDER BY departure_seconds LIMIT 2''', ("A", parseGtfsTime("08:00:00"))).fetchall()
+        db.close()
+
+        self.assertEqual(rows, [("A", parseGtfsTime("08:05:00"), "weekday", "1b"), ("A", parseGtfsTime("08:20:00"), "weekday", "2a")])
+
+        # a database from before there was a stop_departures table gets the same schedule out of stop_times
+        tmpFile, oldDbPath = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(tmpFile)
+
+        try:
+            createScheduleDatabase(oldDbPath, self.stopTimes, False)
+            oldSchedule = StaticSchedule.fromDatabase(oldDbPath)
+        finally:
+            os.remove(oldDbPath)
+
+        self.assertEqual(dict(oldSchedule.trips), dict(self.schedule.trips))
+        self.assertEqual(dict(oldSchedule.stopDepartures), dict(self.schedule.stopDepartures))
+        self.assertEqual(self.schedule.trips["2a"].serviceId, "weekday")
+
+    def testDelayCarriesForward(self):
+
+        # 1a is 3 minutes late leaving B, nothing about C, so its 3 minutes late there too
+        table = self._table([("1a", False, [(2, 180, False)])])
+
+        self.assertNotIn(("1a", 1, self.todayStart), table.predictions)
+        self.assertEqual(table.predictions[("1a", 2, self.todayStart)].departure, self.todayStart + parseGtfsTime("08:03:00"))
+        self.assertEqual(table.predictions[("1a", 3, self.todayStart)].departure, self.todayStart + parseGtfsTime("08:13:00"))
+
+    def testUnknownTrip(self):
+
+        table = self._table([("nope", False, [(1, 60, False)])])
+
+        self.assertEqual(table.unmatchedTrips, 1)
+        self.assertEqual(len(table.predictions), 0)
+
+    def testNextDepartures(self):
+
+        # 1a is scheduled to leave B at 8:00 (now) but is 5 minutes late, 1b leaves at 8:15 but skips B,
+        # and 2a is canceled
+        table = self._table([("1a", False, [(2, 300, False)]), ("1b", False, [(2, None, True)]), ("2a", True, [])])
+
+        departures = nextDepartures(self.schedule, table, "B", NOW + 60, self.todayStart, 5)
+
+        self.assertEqual([iterDeparture.tripId for iterDeparture in departures], ["1a", "3a"])
+        self.assertEqual(departures[0].scheduled, self.todayStart + parseGtfsTime("08:00:00"))
+        self.assertEqual(departures[0].predicted, self.todayStart + parseGtfsTime("08:05:00"))
+        self.assertIsNone(departures[1].predicted)
+
+        # without predictions, 1a already left
+        departures = nextDepartures(self.schedule, None, "B", NOW + 60, self.todayStart, 2)
+        self.assertEqual([iterDeparture.tripId for iterDeparture in departures], ["1b", "2a"])
+
+    def testServiceDay(self):
+
+        # tonight's 3a (which leaves B at 24:40:00) will be 5 minutes late, and 1a is on yesterday's service day
+        table = self._table([("3a", False, [(2, 300, False)]), ("1a", False, [(2, 60, False)])], {"3a": "20140822", "1a": "20140821"})
+
+        self.assertEqual(set(table.predictions.keys()), {("3a", 2, self.todayStart), ("1a", 2, self.todayStart - 24 * 3600),
+            ("1a", 3, self.todayStart - 24 * 3600)})
+
+        # at 12:35 this morning last night's 3a hasn't left yet, but that prediction isn't for it, and today's 1a
+        # has no prediction at all
+        departures = nextDepartures(self.schedule, table, "B", self.todayStart + 35 * 60, self.todayStart, 5)
+
+        self.assertEqual([(iterDeparture.tripId, iterDeparture.predicted) for iterDeparture in departures],
+            [("3a", None), ("1a", None), ("1b", None), ("2a", None),
+            ("3a", self.todayStart + parseGtfsTime("24:45:00"))])
+
+        # canceling yesterday's run doesn't cancel today's
+        table = self._table([("3a", True, [])], {"3a": "20140821"})
+
+        departures = nextDepartures(self.schedule, table, "B", self.todayStart + 35 * 60, self.todayStart, 5)
+        self.assertEqual([iterDeparture.tripId for iterDeparture in departures], ["1a", "1b", "2a", "3a"])
+
+    def testStartDateOutOfRange(self):
+
+        # weeks ago, and not a date at all
+        table = self._table([("1a", False, [(2, 60, False)]), ("1b", False, [(2, 60, False)]), ("2a", True, [])],
+            {"1a": "20140801", "1b": "someday", "2a": "20140901"})
+
+        self.assertEqual(table.outOfRangeTrips, 3)
+        self.assertEqual((len(table.predictions), len(table.canceledTrips)), (0, 0))
+
+    def testAfterMidnight(self):
+
+        # 12:35 in the morning is still yesterday's service day for 3a, which leaves B at 24:40:00
+        tomorrowMorning = self.todayStart + 24 * 3600 + 35 * 60
+
+        departures = nextDepartures(self.schedule, None, "B", tomorrowMorning, serviceDayStart(tomorrowMorning, TIMEZONE), 1)
+
+        self.assertEqual(departures[0].tripId, "3a")
+        self.assertEqual(departures[0].scheduled, self.todayStart + parseGtfsTime("24:40:00"))
+
+    def testServiceCalendar(self):
+
+        # without a calendar every trip runs every day
+        self.assertIsNone(self.schedule.serviceCalendar)
+
+        db = sqlite3.connect(self.dbPath)
+        createCalendarTables(db.cursor(), [("weekday", 1, 1, 1, 1, 1, 0, 0, "20140801", "20140831")], [])
+        db.commit()
+        db.close()
+
+        schedule = StaticSchedule.fromDatabase(self.dbPath)
+
+        # on saturday morning friday night's 3a still leaves B at 24:40:00, but none of the weekday trips run today
+        tomorrowMorning = self.todayStart + 24 * 3600 + 35 * 60
+        tomorrowStart = serviceDayStart(tomorrowMorning, TIMEZONE)
+
+        departures = nextDepartures(schedule, None, "B", tomorrowMorning, tomorrowStart, 5,
+            todayDate=serviceDayDate(tomorrowMorning, TIMEZONE))
+        self.assertEqual([iterDeparture.tripId for iterDeparture in departures], ["3a"])
+
+        # and without the date it doesn't look at the calendar
+        departures = nextDepartures(schedule, None, "B", tomorrowMorning, tomorrowStart, 5)
+        self.assertEqual([iterDeparture.tripId for iterDeparture in departures], ["3a", "1a", "1b", "2a", "3a"])
+
+        # on friday they all run
+        departures = nextDepartures(schedule, None, "B", NOW - 60, self.todayStart, 5, todayDate=serviceDayDate(NOW, TIMEZONE))
+        self.assertEqual([iterDeparture.tripId for iterDeparture in departures], ["1a", "1b", "2a", "3a"])
+
+
+
+# run the unit tests
+if __name__ == '__main__':
+    unittest.main()
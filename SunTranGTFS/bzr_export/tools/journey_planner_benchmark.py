@@ -0,0 +1,119 @@
+#
+# benchmark for the journey planner, loads a JourneyPlanner from a database that parse_gtfs_data.py created and
+# plans journeys between random pairs of stops (the ones that have buses that day) leaving at random times, and
+# prints how long loading took and how long the plans took (the median, 95th percentile and slowest), like
+# sunspot_server.py's /plan would see once it has the planner loaded
+#
+# a database from before there was a stop_transfers table works too, the planner works out the transfers when it
+# loads it (so loading takes longer)
+#
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+import arrow
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project", "sunspot_server"))
+
+from journey_planner import JourneyPlanner
+from service_calendar import parseGtfsDate
+from trip_predictions import serviceDayStart
+
+
+def pickDate(args, planner):
+    ''' the day to plan journeys on, --date or the first weekday the feed has service on
+
+    @param args - the namespace object we get from argparse.parse_args()
+    @param planner - the JourneyPlanner
+    @return a datetime.date, or None if the database doesn't have a calendar'''
+
+    if args.date:
+        return parseGtfsDate(args.date)
+
+    if planner.serviceCalendar is None or planner.serviceCalendar.firstDate is None:
+        return None
+
+    date = planner.serviceCalendar.firstDate
+    while date.weekday() >= 5:
+        date += datetime.timedelta(days=1)
+
+    return date
+
+
+def percentile(sortedValues, percent):
+    ''' the value that @percent percent of @sortedValues are smaller then'''
+
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * percent / 100))]
+
+
+def main(args):
+    ''' runs the benchmark
+    @param args - the namespace object we get from argparse.parse_args()'''
+
+    startTime = time.time()
+    planner = JourneyPlanner.fromDatabase(args.database)
+    loadSeconds = time.time() - startTime
+
+    date = pickDate(args, planner)
+
+    # noon that day in the agency's timezone is always in that service day
+    noon = arrow.get(datetime.datetime.combine(date or datetime.date.today(), datetime.time(12))).replace(tzinfo=args.timezone)
+    todayStart = serviceDayStart(noon.timestamp, args.timezone)
+
+    startTime = time.time()
+    dayConnections = planner.connectionsFor(date)
+    daySeconds = time.time() - startTime
+
+    print("loaded {} stops, {} trips and {} connections from {} in {:.3f} seconds".format(
+        len(planner.stopIds), len(planner.tripInfo), len(planner.connections), args.database, loadSeconds))
+    print("{} connections run on {}, sorted out in {:.3f} seconds".format(len(dayConnections), date, daySeconds))
+
+    rand = random.Random(args.seed)
+    stopIds = sorted(set(planner.stopIds[iterStop] for iterStop in dayConnections.fromStops))
+
+    if len(stopIds) < 2:
+        print("no buses run that day, nothing to plan")
+        return
+
+    queries = [(rand.choice(stopIds), rand.choice(stopIds), todayStart + rand.randint(args.earliest * 3600, args.latest * 3600))
+        for i in range(args.queries)]
+
+    times = list()
+    found = 0
+    legCount = 0
+
+    for iterFromStopId, iterToStopId, iterDeparture in queries:
+
+        startTime = time.time()
+        journey = planner.plan(iterFromStopId, iterToStopId, iterDeparture, todayStart, date)
+        times.append(time.time() - startTime)
+
+        if journey is not None:
+            found += 1
+            legCount += len(journey.legs)
+
+    times.sort()
+
+    print("{} journeys between random stops leaving between {}:00 and {}:00, found {} ({:.1%}), {:.1f} legs on average".format(
+        args.queries, args.earliest, args.latest, found, found / args.queries, legCount / max(found, 1)))
+    print("median {:.1f} ms, 95th percentile {:.1f} ms, slowest {:.1f} ms, {:.0f} plans/sec".format(
+        percentile(times, 50) * 1000, percentile(times, 95) * 1000, times[-1] * 1000, len(times) / sum(times)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmarks the journey planner over random pairs of stops")
+
+    parser.add_argument("database", help="a sqlite3 database that parse_gtfs_data.py created")
+    parser.add_argument("--queries", type=int, default=1000, help="how many journeys to plan")
+    parser.add_argument("--date", help="the day to plan journeys on, like 20140822, the first weekday the feed has service on by default")
+    parser.add_argument("--earliest", type=int, default=6, help="the earliest hour of the day to leave at")
+    parser.add_argument("--latest", type=int, default=20, help="the latest hour of the day to leave at")
+    parser.add_argument("--timezone", default="America/Phoenix", help="the agency's timezone, like GTFS_TIMEZONE")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random number generator")
+
+    main(parser.parse_args())
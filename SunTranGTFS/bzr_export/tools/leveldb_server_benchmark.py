@@ -0,0 +1,310 @@
+#
+# benchmark for the leveldb_server, runs a bunch of queries through a LeveldbServer (in this process,
+# against a temporary leveldb database) with the logging level set to INFO and then DEBUG, and prints
+# how many operations per second we get with each, so we can see how much the logging costs us.
+#
+# with --constants it also runs the queries through a ServerDatabase connected to a real leveldb_server,
+# to see what the logging costs on the client side as well
+#
+# it also runs just GETs, for keys that exist, with and without the leveldb_server's value cache
+# (LEVELDB_SERVER_VALUE_CACHE_ENTRIES), by default the keys follow a zipf distribution since a few
+# keys (like KEY_LAST_DOWNLOAD_TIME) get read by almost every request
+#
+# and it runs the same GETs as protobuf messages (with and without the query echoed back in the response) and as
+# compact frames (see leveldb_server_frames.py), both in process and (with --constants) through a ServerDatabase
+#
+
+import argparse
+import bisect
+import itertools
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project", "sunspot_server"))
+
+import leveldb
+
+from constants import Constants
+from leveldb_server import LeveldbServer
+from leveldb_server_cache import ValueCache
+import leveldb_server_frames
+from leveldb_server_messages_pb2 import LeveldbServerMessages
+from logging_helpers import RequestLogSampler
+from server_database import ServerDatabase
+
+
+class FakeTransport:
+    ''' stands in for the asyncio transport, so we can call LeveldbServer.data_received() directly and only
+    measure the server itself and not the network'''
+
+    def __init__(self):
+        self.bytesWritten = 0
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 12345) if name == "peername" else default
+
+    def write(self, data):
+        self.bytesWritten += len(data)
+
+    def close(self):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+def createQueryBytes(queryType, key, value=None, compactFrames=False):
+    ''' creates the size prefixed bytes of a query, like ServerDatabase would send
+
+    @param queryType - the ServerQuery type
+    @param key - the key as bytes
+    @param value - the value as bytes, or None
+    @param compactFrames - if True, create a compact frame instead of a protobuf message
+    @return bytes'''
+
+    if compactFrames:
+        msg = leveldb_server_frames.packQuery(queryType, key, value or b"")
+        return len(msg).to_bytes(2, "big") + msg
+
+    protoObj = LeveldbServerMessages.ActualData()
+    protoObj.timestamp = int(time.time())
+    protoObj.type = LeveldbServerMessages.ActualData.QUERY
+    protoObj.query.type = queryType
+    protoObj.query.key = key
+
+    if value is not None:
+        protoObj.query.value = value
+
+    msg = protoObj.SerializeToString()
+    return len(msg).to_bytes(2, "big") + msg
+
+
+def createKeyChooser(args, rand):
+    ''' creates a function that picks which key (by number) the next query uses
+
+    @param args - the namespace object we get from argparse.parse_args()
+    @param rand - the random.Random object to use
+    @return a function that takes no arguments and returns an int between 0 and args.keys - 1'''
+
+    if args.distribution == "uniform":
+        return lambda: rand.randrange(args.keys)
+
+    # zipf, key number N gets picked in proportion to 1 / (N + 1) ^ exponent, so key 0 is the most popular
+    cumulativeWeights = list(itertools.accumulate(1.0 / (i + 1) ** args.zipf_exponent for i in range(args.keys)))
+    totalWeight = cumulativeWeights[-1]
+
+    return lambda: min(bisect.bisect_left(cumulativeWeights, rand.random() * totalWeight), args.keys - 1)
+
+
+def createWorkload(args, reads, compactFrames=False):
+    ''' creates the list of queries to run, @reads percent of them are GETs and the rest are SETs
+
+    @param args - the namespace object we get from argparse.parse_args()
+    @param reads - what percent of the queries are GETs
+    @param compactFrames - if True, the queries are compact frames instead of protobuf messages
+    @return a list of size prefixed query bytes'''
+
+    rand = random.Random(args.seed)
+    chooseKey = createKeyChooser(args, rand)
+    value = b"x" * args.value_size
+
+    queries = list()
+    for i in range(args.operations):
+
+        key = "benchmark:{}".format(chooseKey()).encode("utf-8")
+
+        if rand.randrange(100) < reads:
+            queries.append(createQueryBytes(LeveldbServerMessages.ServerQuery.GET, key, compactFrames=compactFrames))
+        else:
+            queries.append(createQueryBytes(LeveldbServerMessages.ServerQuery.SET, key, value, compactFrames))
+
+    return queries
+
+
+def populate(args):
+    ''' SETs every key the workload can use, so the GETs find something
+
+    @param args - the namespace object we get from argparse.parse_args()'''
+
+    value = b"x" * args.value_size
+
+    for i in range(args.keys):
+        LeveldbServer.db.Put("benchmark:{}".format(i).encode("utf-8"), value)
+
+
+def runInProcess(queries, level, valueCache=None, compactFrames=False, echoQuery=True):
+    ''' runs every query through a LeveldbServer with the logging level set to @level
+
+    @param queries - a list of size prefixed query bytes
+    @param level - the logging level to use
+    @param valueCache - the ValueCache the LeveldbServer should use, or None to not use one
+    @param compactFrames - the connection's compact_frames option, needs to be True if @queries are compact frames
+    @param echoQuery - the connection's echo_query option
+    @return a two-tuple of (operations per second, average bytes per response)'''
+
+    logging.getLogger("LeveldbServer").setLevel(level)
+    LeveldbServer.valueCache = valueCache
+
+    transport = FakeTransport()
+    server = LeveldbServer()
+    server.connection_made(transport)
+
+    # same thing SET_CONNECTION_OPTIONS does
+    server.compactFrames = compactFrames
+    server.echoQuery = echoQuery
+
+    startTime = time.perf_counter()
+    for iterQuery in queries:
+        server.data_received(iterQuery)
+    elapsed = time.perf_counter() - startTime
+
+    return len(queries) / elapsed, transport.bytesWritten / len(queries)
+
+
+def runClient(args, level, reads, compactFrames=False, echoQuery=True):
+    ''' runs the same kind of workload through a ServerDatabase connected to a real leveldb_server, with the
+    client's logger set to @level
+
+    @param args - the namespace object we get from argparse.parse_args()
+    @param level - the logging level to use
+    @param reads - what percent of the queries are GETs
+    @param compactFrames - passed to the ServerDatabase
+    @param echoQuery - passed to the ServerDatabase
+    @return operations per second'''
+
+    clientLogger = logging.getLogger("ServerDatabase")
+    clientLogger.setLevel(level)
+
+    constantsObj = Constants(args.constants)
+    serverDb = ServerDatabase(constantsObj.LEVELDB_SERVER_HOST, constantsObj.LEVELDB_SERVER_PORT, clientLogger, 
+        constantsObj.LEVELDB_SERVER_UNIX_SOCKET_PATH or None, compactFrames, echoQuery)
+
+    rand = random.Random(args.seed)
+    chooseKey = createKeyChooser(args, rand)
+    value = "x" * args.value_size
+
+    startTime = time.perf_counter()
+    for i in range(args.operations):
+
+        key = "benchmark:{}".format(chooseKey())
+
+        if rand.randrange(100) < reads:
+            try:
+                serverDb[key]
+            except KeyError:
+                pass
+        else:
+            serverDb[key] = value
+
+    elapsed = time.perf_counter() - startTime
+
+    serverDb.deleteAllInRange("benchmark:", [])
+
+    return args.operations / elapsed
+
+
+def main(args):
+    ''' runs the benchmark
+    @param args - the namespace object we get from argparse.parse_args()'''
+
+    # the messages have to actually go somewhere for DEBUG to cost what it does in production,
+    # but we don't want them on the screen
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)-35s %(levelname)-8s: %(message)s"))
+        logging.getLogger().addHandler(handler)
+
+        tmpDir = tempfile.mkdtemp(prefix="leveldb_server_benchmark")
+
+        try:
+            LeveldbServer.dbPath = tmpDir
+            LeveldbServer.db = leveldb.LevelDB(tmpDir)
+            LeveldbServer.requestLogSampler = RequestLogSampler(args.sample_rate)
+
+            queries = createWorkload(args, args.reads)
+
+            print("{} operations, {}% GETs, {} keys ({}), {} byte values, logging 1 in every {} queries at INFO".format(
+                args.operations, args.reads, args.keys, args.distribution, args.value_size, args.sample_rate))
+
+            for iterLevel in ("INFO", "DEBUG"):
+                print("in process LeveldbServer, logging at {:5s}: {:10.0f} ops/sec".format(
+                    iterLevel, runInProcess(queries, iterLevel)[0]))
+
+            if args.constants:
+                for iterLevel in ("INFO", "DEBUG"):
+                    print("ServerDatabase -> leveldb_server, logging at {:5s}: {:10.0f} ops/sec".format(
+                        iterLevel, runClient(args, iterLevel, args.reads)))
+
+            # GETs only, for keys that all exist
+            populate(args)
+            getQueries = createWorkload(args, 100)
+
+            print("{} GETs, {} keys ({}), logging at INFO".format(args.operations, args.keys, args.distribution))
+
+            # the difference is small next to the rest of what the server does per query, so take the best of
+            # a few runs of each, alternating between them, so the noise doesn't decide which one wins
+            noCacheResults = list()
+            cacheResults = list()
+            for i in range(args.repeat):
+                noCacheResults.append(runInProcess(getQueries, "INFO")[0])
+                valueCache = ValueCache(args.value_cache)
+                cacheResults.append(runInProcess(getQueries, "INFO", valueCache)[0])
+
+            print("in process LeveldbServer, no value cache          : {:10.0f} GETs/sec (best of {})".format(max(noCacheResults), args.repeat))
+            print("in process LeveldbServer, {:6d} entry value cache: {:10.0f} GETs/sec (best of {}, {:.1%} hit rate)".format(
+                args.value_cache, max(cacheResults), args.repeat, valueCache.hits / (valueCache.hits + valueCache.misses)))
+
+            # the same GETs as protobuf messages and as compact frames
+            compactGetQueries = createWorkload(args, 100, compactFrames=True)
+            frameFormats = [
+                ("protobuf, query echoed", getQueries, False, True),
+                ("protobuf, no echo", getQueries, False, False),
+                ("compact frames", compactGetQueries, True, False)]
+
+            for iterName, iterQueries, iterCompactFrames, iterEchoQuery in frameFormats:
+
+                results = [runInProcess(iterQueries, "INFO", None, iterCompactFrames, iterEchoQuery) for i in range(args.repeat)]
+                print("in process LeveldbServer, {:22s}: {:10.0f} GETs/sec (best of {}), {:5.1f} bytes per query, {:5.1f} bytes per response".format(
+                    iterName, max(iterResult[0] for iterResult in results), args.repeat, 
+                    sum(len(iterQuery) for iterQuery in iterQueries) / len(iterQueries), results[0][1]))
+
+            if args.constants:
+                for iterName, iterQueries, iterCompactFrames, iterEchoQuery in frameFormats:
+                    print("ServerDatabase -> leveldb_server, {:22s}: {:10.0f} GETs/sec".format(
+                        iterName, runClient(args, "INFO", 100, iterCompactFrames, iterEchoQuery)))
+
+        finally:
+            LeveldbServer.db = None
+            LeveldbServer.valueCache = None
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmarks the leveldb_server with logging at INFO and DEBUG")
+
+    parser.add_argument("--operations", type=int, default=50000, help="how many queries to run at each logging level")
+    parser.add_argument("--keys", type=int, default=1000, help="how many different keys to use")
+    parser.add_argument("--reads", type=int, default=90, help="what percent of the queries are GETs, the rest are SETs")
+    parser.add_argument("--value-size", type=int, default=100, help="how big the values we SET are, in bytes")
+    parser.add_argument("--sample-rate", type=int, default=100, 
+        help="log 1 in every this many queries at INFO, like SERVERDATABASE_LOGGING_REQUEST_SAMPLE_RATE")
+    parser.add_argument("--distribution", choices=["zipf", "uniform"], default="zipf", help="how the keys the queries use are picked")
+    parser.add_argument("--zipf-exponent", type=float, default=1.0, help="bigger means the most popular keys get more of the queries")
+    parser.add_argument("--value-cache", type=int, default=100, help="how many entries the value cache has for the GET benchmark, "
+        "like LEVELDB_SERVER_VALUE_CACHE_ENTRIES")
+    parser.add_argument("--repeat", type=int, default=5, help="how many times to run the GET benchmark with and without the value cache")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random number generator")
+    parser.add_argument("--constants", help="a constants yaml file, if given we also benchmark a ServerDatabase "
+        "connected to the leveldb_server that it points to")
+
+    main(parser.parse_args())
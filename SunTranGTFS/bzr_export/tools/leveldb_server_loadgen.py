@@ -0,0 +1,426 @@
+#
+# load generator for a running leveldb_server: a bunch of AsyncServerDatabase clients, each on its own connection,
+# sending a mix of GETs, SETs, DELETEs and range reads as fast as the server answers them (one at a time, or
+# with --pipeline, several at once per connection), for a fixed amount of time.
+#
+# the results (throughput, and p50/p95/p99/max latency for each kind of query) are written as JSON, and a run can
+# be compared against the JSON from an earlier one with --baseline, which exits with 1 if it got slower. So:
+#
+#   python3 leveldb_server_loadgen.py constants_config.yaml --output before.json
+#   (change the leveldb_server, restart it)
+#   python3 leveldb_server_loadgen.py constants_config.yaml --baseline before.json
+#
+# every key it uses starts with 'loadgen:', and they are deleted at the end unless you pass --keep-keys
+#
+
+import argparse
+import asyncio
+import bisect
+import collections
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project", "sunspot_server"))
+
+from constants import Constants
+from leveldb_server_benchmark import createKeyChooser
+from server_database import AsyncServerDatabase, ServerDatabaseWriteBatch
+
+
+KEY_FORMAT = "loadgen:{:08d}" # zero padded, so the keys sort in the same order as their numbers for the range reads
+
+OPERATION_NAMES = ("get", "set", "delete", "range")
+
+
+def isMixType(stringArg):
+    ''' helper method for argparse that parses the operation mix, like 'get=80,set=10,delete=5,range=5'
+
+    @param stringArg - the argument we get from argparse
+    @return a dictionary of operation name -> weight, or raises ArgumentTypeError'''
+
+    mix = dict()
+
+    try:
+        for iterPart in stringArg.split(","):
+            name, weight = iterPart.split("=")
+            mix[name.strip()] = int(weight)
+    except ValueError:
+        raise argparse.ArgumentTypeError("the mix should look like 'get=80,set=10,delete=5,range=5', not '{}'".format(stringArg))
+
+    unknownNames = set(mix) - set(OPERATION_NAMES)
+    if unknownNames:
+        raise argparse.ArgumentTypeError("unknown operations in the mix: {}, we know {}".format(
+            ", ".join(sorted(unknownNames)), ", ".join(OPERATION_NAMES)))
+
+    if sum(mix.values()) <= 0 or min(mix.values()) < 0:
+        raise argparse.ArgumentTypeError("the weights in the mix have to be positive")
+
+    return mix
+
+
+def percentile(sortedValues, percent):
+    ''' the nearest rank percentile of a sorted list
+
+    @param sortedValues - a sorted, non empty list
+    @param percent - the percentile, like 99
+    @return the value'''
+
+    return sortedValues[max(0, math.ceil(percent / 100 * len(sortedValues)) - 1)]
+
+
+class LatencyRecorder:
+    ''' keeps the latency of every operation (in seconds) by operation name, once recording is turned on'''
+
+    def __init__(self):
+
+        self.recording = False
+        self.startTime = None
+        self.stopTime = None
+
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def start(self):
+        ''' starts recording, called once the warmup is over'''
+
+        self.recording = True
+        self.startTime = time.perf_counter()
+
+    def stop(self):
+        ''' stops recording, called when time is up'''
+
+        self.recording = False
+        self.stopTime = time.perf_counter()
+
+    def record(self, operationName, seconds):
+        if self.recording:
+            self.latencies[operationName].append(seconds)
+
+    def recordError(self, operationName):
+        if self.recording:
+            self.errors[operationName] += 1
+
+    @staticmethod
+    def _summarize(latencies):
+        ''' summarizes a list of latencies in seconds
+
+        @param latencies - a non empty list of seconds
+        @return a dictionary of the count, and the mean, p50, p95, p99 and max in milliseconds'''
+
+        sortedLatencies = sorted(latencies)
+
+        return collections.OrderedDict([
+            ("count", len(sortedLatencies)),
+            ("mean_ms", sum(sortedLatencies) / len(sortedLatencies) * 1000),
+            ("p50_ms", percentile(sortedLatencies, 50) * 1000),
+            ("p95_ms", percentile(sortedLatencies, 95) * 1000),
+            ("p99_ms", percentile(sortedLatencies, 99) * 1000),
+            ("max_ms", sortedLatencies[-1] * 1000)])
+
+    def results(self):
+        ''' the throughput and latency percentiles of everything we recorded
+
+        @return a dictionary that can be turned into JSON'''
+
+        allLatencies = [iterLatency for iterList in self.latencies.values() for iterLatency in iterList]
+        elapsed = self.stopTime - self.startTime
+
+        latencies = collections.OrderedDict()
+        if allLatencies:
+            latencies["all"] = self._summarize(allLatencies)
+        for iterName in OPERATION_NAMES:
+            if self.latencies[iterName]:
+                latencies[iterName] = self._summarize(self.latencies[iterName])
+
+        return collections.OrderedDict([
+            ("duration_seconds", elapsed),
+            ("operations", len(allLatencies)),
+            ("ops_per_second", len(allLatencies) / elapsed),
+            ("errors", dict(self.errors)),
+            ("latency", latencies)])
+
+
+@asyncio.coroutine
+def runOperation(serverDb, operationName, keyNumber, args, value, recorder):
+    ''' coroutine that runs one operation and records how long it took
+
+    @param serverDb - the AsyncServerDatabase
+    @param operationName - one of OPERATION_NAMES
+    @param keyNumber - which key to use
+    @param args - the namespace object we get from argparse.parse_args()
+    @param value - the value to SET
+    @param recorder - the LatencyRecorder'''
+
+    key = KEY_FORMAT.format(keyNumber)
+    startTime = time.perf_counter()
+
+    try:
+        if operationName == "get":
+            try:
+                yield from serverDb.get(key)
+            except KeyError:
+                pass # DELETEs mean not every key exists
+
+        elif operationName == "set":
+            yield from serverDb.set(key, value)
+
+        elif operationName == "delete":
+            yield from serverDb.delete(key)
+
+        else:
+            yield from serverDb.range(key, KEY_FORMAT.format(keyNumber + args.range_size - 1))
+
+    except (ConnectionError, asyncio.IncompleteReadError):
+        raise
+
+    except Exception as e:
+        logging.getLogger("loadgen").debug("%s of %s failed: %s", operationName, key, e)
+        recorder.recordError(operationName)
+        return
+
+    recorder.record(operationName, time.perf_counter() - startTime)
+
+
+@asyncio.coroutine
+def runClient(serverDb, clientNumber, args, recorder, stopTime):
+    ''' coroutine for one client, keeps sending operations until @stopTime, with up to args.pipeline of them
+    waiting on the leveldb_server at once
+
+    @param serverDb - the AsyncServerDatabase for this client
+    @param clientNumber - which client this is, so each one gets its own random numbers
+    @param args - the namespace object we get from argparse.parse_args()
+    @param recorder - the LatencyRecorder
+    @param stopTime - the time.perf_counter() to stop at'''
+
+    loop = asyncio.get_event_loop()
+    rand = random.Random(args.seed * 1000 + clientNumber)
+    chooseKey = createKeyChooser(args, rand)
+    value = "x" * args.value_size
+
+    operationNames = sorted(args.mix)
+    cumulativeWeights = list(itertools.accumulate(args.mix[iterName] for iterName in operationNames))
+
+    inFlight = set()
+
+    while time.perf_counter() < stopTime:
+
+        operationName = operationNames[bisect.bisect_right(cumulativeWeights, rand.random() * cumulativeWeights[-1])]
+        coro = runOperation(serverDb, operationName, chooseKey(), args, value, recorder)
+
+        if args.pipeline <= 1:
+            yield from coro
+            continue
+
+        tmpTask = loop.create_task(coro)
+        inFlight.add(tmpTask)
+        tmpTask.add_done_callback(inFlight.discard)
+
+        if len(inFlight) >= args.pipeline:
+            done, pending = yield from asyncio.wait(inFlight, return_when=asyncio.FIRST_COMPLETED)
+
+            # a lost connection, everything else on it is going to fail too
+            for iterTask in done:
+                iterTask.result()
+
+    if inFlight:
+        yield from asyncio.wait(inFlight)
+
+
+@asyncio.coroutine
+def connect(constantsObj, args):
+    ''' coroutine that connects one client to the leveldb_server, with the connection options from the
+    Constants unless args say otherwise
+
+    @param constantsObj - a Constants object
+    @param args - the namespace object we get from argparse.parse_args()
+    @return a AsyncServerDatabase'''
+
+    compactFrames = constantsObj.LEVELDB_SERVER_COMPACT_FRAMES if args.frames == "constants" else args.frames == "compact"
+    echoQuery = constantsObj.LEVELDB_SERVER_ECHO_QUERY if args.echo_query == "constants" else args.echo_query == "yes"
+
+    return (yield from AsyncServerDatabase.connect(constantsObj.LEVELDB_SERVER_HOST, constantsObj.LEVELDB_SERVER_PORT,
+        None, constantsObj.LEVELDB_SERVER_UNIX_SOCKET_PATH or None, compactFrames, echoQuery))
+
+
+@asyncio.coroutine
+def populate(serverDb, args):
+    ''' coroutine that SETs every key the workload can use, in write batches that fit in one message
+
+    @param serverDb - a AsyncServerDatabase
+    @param args - the namespace object we get from argparse.parse_args()'''
+
+    value = "x" * args.value_size
+    keysPerBatch = max(1, 40000 // (args.value_size + 30))
+
+    for iterStart in range(0, args.keys, keysPerBatch):
+
+        batch = ServerDatabaseWriteBatch()
+        for iterKeyNumber in range(iterStart, min(iterStart + keysPerBatch, args.keys)):
+            batch[KEY_FORMAT.format(iterKeyNumber)] = value
+
+        yield from serverDb.commitBatch(batch)
+
+
+@asyncio.coroutine
+def runLoad(args):
+    ''' coroutine that runs the whole thing
+
+    @param args - the namespace object we get from argparse.parse_args()
+    @return the results dictionary'''
+
+    constantsObj = Constants(args.constants)
+    loop = asyncio.get_event_loop()
+
+    clients = list()
+    for i in range(args.clients):
+        clients.append((yield from connect(constantsObj, args)))
+
+    try:
+        if not args.no_populate:
+            yield from populate(clients[0], args)
+
+        recorder = LatencyRecorder()
+        startTime = time.perf_counter()
+        stopTime = startTime + args.warmup + args.duration
+
+        loop.call_later(args.warmup, recorder.start)
+
+        yield from asyncio.gather(*[runClient(iterDb, iterNumber, args, recorder, stopTime)
+            for iterNumber, iterDb in enumerate(clients)])
+
+        recorder.stop()
+
+        if not args.keep_keys:
+            yield from clients[0].deleteAllInRange("loadgen:")
+
+    finally:
+        for iterDb in clients:
+            yield from iterDb.close()
+
+    results = recorder.results()
+    results["config"] = collections.OrderedDict([
+        ("clients", args.clients),
+        ("pipeline", args.pipeline),
+        ("mix", args.mix),
+        ("keys", args.keys),
+        ("distribution", args.distribution),
+        ("zipf_exponent", args.zipf_exponent),
+        ("value_size", args.value_size),
+        ("range_size", args.range_size),
+        ("frames", args.frames),
+        ("echo_query", args.echo_query),
+        ("warmup", args.warmup),
+        ("duration", args.duration)])
+
+    return results
+
+
+def compareToBaseline(results, baseline, tolerance):
+    ''' sees if @results are worse then @baseline, by more then @tolerance
+
+    @param results - the results dictionary from this run
+    @param baseline - the results dictionary from an earlier run
+    @param tolerance - how much worse is still ok, 0.1 means 10%
+    @return a list of strings, one for each thing that got worse'''
+
+    regressions = list()
+
+    if results["ops_per_second"] < baseline["ops_per_second"] * (1 - tolerance):
+        regressions.append("throughput went from {:.0f} to {:.0f} ops/sec".format(baseline["ops_per_second"], results["ops_per_second"]))
+
+    for iterName, iterLatency in results["latency"].items():
+
+        baselineLatency = baseline["latency"].get(iterName)
+        if baselineLatency is None:
+            continue
+
+        for iterPercentile in ("p50_ms", "p99_ms"):
+            if iterLatency[iterPercentile] > baselineLatency[iterPercentile] * (1 + tolerance):
+                regressions.append("{} {} went from {:.3f}ms to {:.3f}ms".format(iterName, iterPercentile,
+                    baselineLatency[iterPercentile], iterLatency[iterPercentile]))
+
+    return regressions
+
+
+def main(args):
+    ''' runs the load generator
+    @param args - the namespace object we get from argparse.parse_args()
+    @return the exit code'''
+
+    logging.basicConfig(level="WARNING", format="%(asctime)s %(name)-15s %(levelname)-8s: %(message)s")
+
+    results = asyncio.get_event_loop().run_until_complete(runLoad(args))
+
+    resultsJson = json.dumps(results, indent=4)
+    if args.output == "-":
+        print(resultsJson)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(resultsJson + "\n")
+
+    # the human readable version goes to stderr, so stdout is just the JSON
+    print("{} clients, pipeline {}: {:.0f} ops/sec over {:.1f} seconds, errors: {}".format(args.clients, args.pipeline,
+        results["ops_per_second"], results["duration_seconds"], results["errors"] or "none"), file=sys.stderr)
+
+    for iterName, iterLatency in results["latency"].items():
+        print("\t{:6s} {:8d} ops, p50 {:7.3f}ms, p95 {:7.3f}ms, p99 {:7.3f}ms, max {:7.3f}ms".format(iterName, iterLatency["count"],
+            iterLatency["p50_ms"], iterLatency["p95_ms"], iterLatency["p99_ms"], iterLatency["max_ms"]), file=sys.stderr)
+
+    if args.baseline:
+
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+        if baseline.get("config") != json.loads(json.dumps(results["config"])):
+            print("WARNING: {} was run with different options, so the numbers might not be comparable".format(args.baseline),
+                file=sys.stderr)
+
+        regressions = compareToBaseline(results, baseline, args.tolerance)
+
+        for iterRegression in regressions:
+            print("REGRESSION: " + iterRegression, file=sys.stderr)
+
+        if regressions:
+            return 1
+
+        print("no regressions compared to {} (tolerance {:.0%})".format(args.baseline, args.tolerance), file=sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="generates load against a running leveldb_server and reports throughput "
+        "and latency percentiles as JSON")
+
+    parser.add_argument("constants", help="a constants yaml file, we connect to the leveldb_server that it points to")
+    parser.add_argument("--clients", type=int, default=8, help="how many connections to the leveldb_server")
+    parser.add_argument("--pipeline", type=int, default=1, help="how many queries each client has waiting on the "
+        "leveldb_server at once, 1 waits for each response before sending the next query")
+    parser.add_argument("--mix", type=isMixType, default="get=80,set=10,delete=5,range=5",
+        help="the relative weights of each kind of query, out of " + ", ".join(OPERATION_NAMES))
+    parser.add_argument("--duration", type=float, default=10, help="how many seconds to record for")
+    parser.add_argument("--warmup", type=float, default=1, help="how many seconds to run before we start recording")
+    parser.add_argument("--keys", type=int, default=10000, help="how many different keys to use")
+    parser.add_argument("--distribution", choices=["zipf", "uniform"], default="zipf", help="how the keys the queries use are picked")
+    parser.add_argument("--zipf-exponent", type=float, default=1.0, help="bigger means the most popular keys get more of the queries")
+    parser.add_argument("--value-size", type=int, default=100, help="how big the values we SET are, in bytes")
+    parser.add_argument("--range-size", type=int, default=20, help="how many keys each range read covers")
+    parser.add_argument("--frames", choices=["constants", "protobuf", "compact"], default="constants",
+        help="send GET/SET/DELETE as protobuf messages or compact frames, by default LEVELDB_SERVER_COMPACT_FRAMES decides")
+    parser.add_argument("--echo-query", choices=["constants", "yes", "no"], default="constants",
+        help="if the leveldb_server sends our queries back to us, by default LEVELDB_SERVER_ECHO_QUERY decides")
+    parser.add_argument("--no-populate", action="store_true", help="don't SET every key before we start")
+    parser.add_argument("--keep-keys", action="store_true", help="don't delete the keys we used at the end")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random number generator")
+    parser.add_argument("--output", default="-", help="where to write the JSON results, - for stdout")
+    parser.add_argument("--baseline", help="the JSON results of an earlier run, exit with 1 if this run is worse")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="how much worse then --baseline is still ok, 0.1 means 10%%")
+
+    sys.exit(main(parser.parse_args()))
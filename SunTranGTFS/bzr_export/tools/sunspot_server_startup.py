@@ -0,0 +1,170 @@
+#
+# measures how long a fresh sunspot_server.py process takes to get going, like an apache / mod_wsgi worker does
+# after a restart: starting python, importing sunspot_server (which creates the cherrypy application), and
+# answering its first request (a GET of /, straight through the WSGI application, no network involved).
+#
+# each run is a new python process so nothing is already imported. It prints the median of each part, and
+# the slowest imports (including whatever they import) from the first run:
+#
+#   python3 sunspot_server_startup.py --runs 10 --output startup.json
+#
+# run it where sunspot_server.py is deployed, it reads the constants yaml from the same place it does
+#
+
+import argparse
+import builtins
+import collections
+import importlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import wsgiref.util
+
+
+class ImportTimer:
+    ''' replaces builtins.__import__ to time the first import of each module, including everything that it
+    imports itself'''
+
+    def __init__(self):
+
+        # (depth, module name, seconds), in the order the imports started
+        self.imports = list()
+        self.depth = 0
+        self.realImport = builtins.__import__
+
+    def install(self):
+        builtins.__import__ = self._timedImport
+
+    def uninstall(self):
+        builtins.__import__ = self.realImport
+
+    def _timedImport(self, name, globals=None, locals=None, fromlist=(), level=0):
+        ''' wrapper around the real __import__ that times it if the module hasn't been imported yet'''
+
+        if level != 0 or name in sys.modules:
+            return self.realImport(name, globals, locals, fromlist, level)
+
+        index = len(self.imports)
+        self.imports.append(None)
+        self.depth += 1
+        startTime = time.perf_counter()
+
+        try:
+            return self.realImport(name, globals, locals, fromlist, level)
+        finally:
+            self.depth -= 1
+            self.imports[index] = (self.depth, name, time.perf_counter() - startTime)
+
+
+def runChild(args):
+    ''' what each of the fresh python processes runs, imports sunspot_server, gets the first response from it,
+    and prints how long that took as JSON
+
+    @param args - the namespace object we get from argparse.parse_args()'''
+
+    sys.path.insert(0, args.sunspot_dir)
+
+    timer = ImportTimer()
+    startTime = time.perf_counter()
+
+    timer.install()
+    try:
+        sunspotServer = importlib.import_module("sunspot_server")
+    finally:
+        timer.uninstall()
+
+    importSeconds = time.perf_counter() - startTime
+
+    # cherrypy gets the path from SCRIPT_NAME + PATH_INFO, the same as under mod_wsgi
+    environ = dict()
+    wsgiref.util.setup_testing_defaults(environ)
+    environ["SCRIPT_NAME"] = "/sunspot"
+    environ["PATH_INFO"] = "/"
+    environ["wsgi.errors"] = io.StringIO()
+
+    statuses = list()
+    responseStartTime = time.perf_counter()
+    body = b"".join(sunspotServer.application(environ, lambda status, headers, excInfo=None: statuses.append(status)))
+    firstResponseSeconds = time.perf_counter() - responseStartTime
+
+    # sunspot_server.py points sys.stdout at sys.stderr, so write to the real stdout
+    sys.__stdout__.write(json.dumps({
+        "import_seconds": importSeconds,
+        "first_response_seconds": firstResponseSeconds,
+        "status": statuses[0] if statuses else None,
+        "body_bytes": len(body),
+        "imports": timer.imports}))
+    sys.__stdout__.flush()
+
+
+def runOnce(args):
+    ''' starts a fresh python process that runs runChild()
+
+    @param args - the namespace object we get from argparse.parse_args()
+    @return the dictionary that the process printed, plus how long the whole process took'''
+
+    startTime = time.perf_counter()
+
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", "--sunspot-dir", args.sunspot_dir],
+        stderr=subprocess.DEVNULL)
+
+    result = json.loads(output.decode("utf-8"))
+    result["process_seconds"] = time.perf_counter() - startTime
+
+    return result
+
+
+def main(args):
+    ''' runs sunspot_server.py's startup args.runs times and reports how long it took
+
+    @param args - the namespace object we get from argparse.parse_args()'''
+
+    if args.child:
+        runChild(args)
+        return
+
+    runs = [runOnce(args) for i in range(args.runs)]
+
+    if runs[0]["status"] is None or not runs[0]["status"].startswith("200"):
+        print("WARNING: the first response was {}, not 200 OK".format(runs[0]["status"]), file=sys.stderr)
+
+    # a module imported at more then one depth only counts the first time, so the total is just the top level ones
+    slowestImports = sorted(runs[0]["imports"], key=lambda iterImport: iterImport[2], reverse=True)[:args.top]
+
+    results = collections.OrderedDict([
+        ("runs", args.runs),
+        ("median_process_seconds", statistics.median(iterRun["process_seconds"] for iterRun in runs)),
+        ("median_import_seconds", statistics.median(iterRun["import_seconds"] for iterRun in runs)),
+        ("median_first_response_seconds", statistics.median(iterRun["first_response_seconds"] for iterRun in runs)),
+        ("slowest_imports", [collections.OrderedDict([("module", iterName), ("depth", iterDepth), ("seconds", iterSeconds)])
+            for iterDepth, iterName, iterSeconds in slowestImports])])
+
+    print("{} runs, medians: process start to exit {:.1f}ms, importing sunspot_server {:.1f}ms, first response {:.1f}ms".format(
+        args.runs, results["median_process_seconds"] * 1000, results["median_import_seconds"] * 1000,
+        results["median_first_response_seconds"] * 1000), file=sys.stderr)
+
+    print("slowest imports in the first run (including what they import):", file=sys.stderr)
+    for iterImport in results["slowest_imports"]:
+        print("\t{:8.1f}ms  {}{}".format(iterImport["seconds"] * 1000, "  " * iterImport["depth"], iterImport["module"]), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(json.dumps(results, indent=4) + "\n")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="measures how long sunspot_server.py takes to import and answer its first request")
+
+    parser.add_argument("--sunspot-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project", "sunspot_server"),
+        help="the folder that sunspot_server.py is in")
+    parser.add_argument("--runs", type=int, default=5, help="how many fresh processes to time")
+    parser.add_argument("--top", type=int, default=20, help="how many of the slowest imports to show")
+    parser.add_argument("--output", help="write the results as JSON to this file too")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+
+    main(parser.parse_args())